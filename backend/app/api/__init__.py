@@ -4,6 +4,7 @@ from app.api.routers.script import router as script_router
 from app.api.routers.shotlist import router as shotlist_router
 from app.api.routers.tts import router as tts_router
 from app.api.routers.video import router as video_router
+from app.api.routers.jobs import router as jobs_router
 
 
 router = APIRouter()
@@ -11,4 +12,5 @@ router.include_router(analysis_router, tags=["api"])
 router.include_router(script_router, tags=["api"])
 router.include_router(shotlist_router, tags=["api"])
 router.include_router(tts_router, tags=["api"])
-router.include_router(video_router, tags=["api"])
\ No newline at end of file
+router.include_router(video_router, tags=["api"])
+router.include_router(jobs_router, tags=["jobs"])
\ No newline at end of file
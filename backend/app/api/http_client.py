@@ -1,12 +1,42 @@
 # app/api/http_client.py
 from __future__ import annotations
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Optional, Tuple, Union
 from pydantic import AnyHttpUrl
 from fastapi import HTTPException
 from starlette import status
 import httpx
 import json as _json
 
+from app.core.retry import RetryPolicy, default_policy, raise_for_retryable_status, retry_async
+
+# Client dùng chung (connection pool + keep-alive) cho các call outbound lặp lại
+# (fetch landing page, TTS batch, ...). Đóng khi app shutdown.
+_shared_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        _shared_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+            follow_redirects=True,
+            headers={"user-agent": "CaseSurf2/1.0 (+landing-fetch)"},
+        )
+    return _shared_client
+
+async def close_http_client() -> None:
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
+
+def _post_policy(idempotency_key: Optional[str]) -> Tuple[Dict[str, str], RetryPolicy]:
+    """POST sang n8n có thể tạo side effect: chỉ retry mọi lỗi tạm thời khi có Idempotency-Key,
+    không thì chỉ retry lỗi connect / 429 (request chắc chắn chưa được xử lý)."""
+    if idempotency_key:
+        return {"Idempotency-Key": idempotency_key}, default_policy()
+    return {}, default_policy(idempotent=False)
+
 def _try_parse_json(text: str) -> Optional[Dict[str, Any]]:
     try:
         return _json.loads(text)
@@ -17,27 +47,35 @@ async def post_json(
     url: Union[str, AnyHttpUrl],
     payload: Dict[str, Any],
     timeout_s: float = 60.0,
+    idempotency_key: Optional[str] = None,
 ) -> Dict[str, Any]:
     url = str(url)
-    try:
+    headers, policy = _post_policy(idempotency_key)
+
+    async def _post() -> httpx.Response:
         async with httpx.AsyncClient(timeout=timeout_s) as client:
-            r = await client.post(url, json=payload)
-            # Nếu lỗi HTTP thì ném ngay (để thấy thân lỗi)
-            if r.status_code >= 400:
-                body = r.text.strip()
-                raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
-                                    detail=f"n8n upstream error: {r.status_code}. body={body[:800]}")
-
-            # Luôn cố parse JSON, bất kể content-type ghi gì
-            text = r.text
-            data = _try_parse_json(text)
-            if data is not None:
-                # giữ raw để debug/fallback
-                data.setdefault("_raw_text", text)
-                return data
-
-            # Không phải JSON → trả về dạng text
-            return {"_text": text}
+            r = await client.post(url, json=payload, headers=headers)
+        raise_for_retryable_status(r)
+        return r
+
+    try:
+        r = await retry_async(_post, name="n8n", policy=policy)
+        # Nếu lỗi HTTP thì ném ngay (để thấy thân lỗi)
+        if r.status_code >= 400:
+            body = r.text.strip()
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
+                                detail=f"n8n upstream error: {r.status_code}. body={body[:800]}")
+
+        # Luôn cố parse JSON, bất kể content-type ghi gì
+        text = r.text
+        data = _try_parse_json(text)
+        if data is not None:
+            # giữ raw để debug/fallback
+            data.setdefault("_raw_text", text)
+            return data
+
+        # Không phải JSON → trả về dạng text
+        return {"_text": text}
     except HTTPException:
         raise
     except Exception as e:
@@ -50,8 +88,10 @@ async def post_multipart_file(
     data: Optional[Dict[str, Any]] = None,
     files: Optional[Dict[str, Any]] = None,
     timeout_s: float = 120.0,
+    idempotency_key: Optional[str] = None,
 ) -> Dict[str, Any]:
     url = str(url)
+    headers, policy = _post_policy(idempotency_key)
 
     # Đảm bảo form-data chỉ có primitive
     form_data: Dict[str, str] = {}
@@ -63,21 +103,31 @@ async def post_multipart_file(
         else:
             form_data[k] = str(v)
 
-    try:
+    async def _post() -> httpx.Response:
+        # file object đã bị đọc ở lần thử trước -> tua lại đầu
+        for f in (files or {}).values():
+            fobj = f[1] if isinstance(f, tuple) and len(f) > 1 else f
+            if hasattr(fobj, "seek"):
+                fobj.seek(0)
         async with httpx.AsyncClient(timeout=timeout_s) as client:
-            r = await client.post(url, data=form_data, files=files)
-            if r.status_code >= 400:
-                body = r.text.strip()
-                raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
-                                    detail=f"n8n upstream error: {r.status_code}. body={body[:800]}")
-
-            text = r.text
-            data = _try_parse_json(text)
-            if data is not None:
-                data.setdefault("_raw_text", text)
-                return data
-
-            return {"_text": text}
+            r = await client.post(url, data=form_data, files=files, headers=headers)
+        raise_for_retryable_status(r)
+        return r
+
+    try:
+        r = await retry_async(_post, name="n8n", policy=policy)
+        if r.status_code >= 400:
+            body = r.text.strip()
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
+                                detail=f"n8n upstream error: {r.status_code}. body={body[:800]}")
+
+        text = r.text
+        data = _try_parse_json(text)
+        if data is not None:
+            data.setdefault("_raw_text", text)
+            return data
+
+        return {"_text": text}
     except HTTPException:
         raise
     except Exception as e:
@@ -1,21 +1,46 @@
 from typing import Any, Dict, List, Optional, Tuple
 from pathlib import Path
-import os, re, mimetypes
+import os, re, json, mimetypes, hashlib, time, unicodedata, asyncio, shutil, subprocess
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, Request
+from fastapi.responses import StreamingResponse
 from starlette import status
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 from app.core.config import get_settings
 from app.core.logger import setup_app_logger  # ⬅️ dùng logger xoay file theo ngày
+from app.core import metrics
+from app.core.store import content_key, store_get, store_put
+from app.core.netguard import UnsafeURLError
+from app.services.jobs import register_job_cleanup, register_job_handler, submit_job, public_job, validate_webhook_url
+from app.services.keyframes import analyze_scenes, extract_audio, probe_duration
+from app.services.video_segments import split_media
+from app.services.dedupe import dedupe_feedback_text
+from app.services.script_infer import angle_context_text, precompute_required_inputs
+from app.services.landing_fetch import LandingFetchError, fetch_landing_page, landing_page_text, looks_like_url
 from app.services.gemini import (
     gemini_upload_file,
     gemini_generate_video_report,
-    gemini_generate_landing_analysis,
+    gemini_analyze_transcript,
+    gemini_generate_keyframe_report,
+    gemini_transcribe_segments,
+    gemini_report_from_transcript,
+    keyframe_visual_parts,
+    assemble_video_report,
+    gemini_landing_phase1,
+    gemini_landing_angles,
+    gemini_landing_angles_stream,
+    gemini_landing_angles_structured,
+    IncrementalAngleParser,
+    ensure_report_digest,
+    get_report_digest,
+    report_for_prompt,
     split_angles_output,
     extract_angles_from_block,
     DEFAULT_TEXT_MODEL,
     DEFAULT_VISION_MODEL,
+    VIDEO_REPORT_PROMPT_VERSION,
+    LANDING_PHASE1_PROMPT_VERSION,
 )
 
 router = APIRouter()
@@ -43,7 +68,8 @@ def _ensure_dir(path: Path) -> Path:
     path.mkdir(parents=True, exist_ok=True)
     return path
 
-def _save_upload(f: UploadFile, dest_dir: Path, max_mb: int) -> Tuple[Path, int, str]:
+def _save_upload(f: UploadFile, dest_dir: Path, max_mb: int) -> Tuple[Path, int, str, str]:
+    """Lưu upload theo chunk, trả (path, size, mime, sha256 nội dung)."""
     name = f.filename or "upload.bin"
     ext = "".join(Path(name).suffixes) or ".bin"
     safe_base = re.sub(r"[^a-zA-Z0-9_-]+", "-", Path(name).stem) or "file"
@@ -51,12 +77,14 @@ def _save_upload(f: UploadFile, dest_dir: Path, max_mb: int) -> Tuple[Path, int,
     _ensure_dir(dest_dir)
 
     size = 0
+    digest = hashlib.sha256()
     with open(stored, "wb") as out:
         while True:
             chunk = f.file.read(1024 * 1024)
             if not chunk:
                 break
             size += len(chunk)
+            digest.update(chunk)
             if size > max_mb * 1024 * 1024:
                 out.close()
                 try:
@@ -67,7 +95,77 @@ def _save_upload(f: UploadFile, dest_dir: Path, max_mb: int) -> Tuple[Path, int,
             out.write(chunk)
 
     mime = f.content_type or mimetypes.guess_type(str(stored))[0] or "application/octet-stream"
-    return stored, size, mime
+    return stored, size, mime, digest.hexdigest()
+
+def _normalize_prompt(s: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", s or "").split())
+
+def _unlink_quiet(ip: str, path: Path) -> None:
+    try:
+        path.unlink()
+        _log(ip, f"TEMP_CLEANED path={path.name}")
+    except Exception as _e:
+        _log(ip, f"TEMP_CLEAN_FAIL path={path} err={_e}")
+
+# ---- Report cache -------------------------------------------------------------
+# Key = (sha256 video, prompt đã chuẩn hoá, model, version prompt template).
+# Đổi template trong gemini.py -> VIDEO_REPORT_PROMPT_VERSION đổi -> cache cũ tự miss.
+_REPORT_CACHE_NS = "report_cache"
+
+def _report_cache_key(video_sha: str, message: str, model_name: str, mode: str = "full") -> str:
+    parts = [video_sha, _normalize_prompt(message), model_name, VIDEO_REPORT_PROMPT_VERSION]
+    if mode != "full":
+        parts.append(mode)
+    return content_key(*parts)
+
+def _report_cache_mode(mode: str, settings) -> str:
+    """Mode keyframes kèm tham số cắt cảnh: đổi fps / số keyframe / width -> cache cũ tự miss."""
+    if mode != REPORT_MODE_KEYFRAMES:
+        return mode
+    return "{}:fps={}:max={}:w={}".format(
+        mode, settings.KEYFRAME_SAMPLE_FPS, settings.KEYFRAME_MAX, settings.KEYFRAME_WIDTH
+    )
+
+# ---- Transcript artifacts ------------------------------------------------------
+# Transcript (Step 1) được lưu riêng với id để /reanalyze-report chạy lại Step 2
+# với prompt mới mà không cần upload/transcribe lại video.
+_TRANSCRIPT_NS = "transcripts"
+_TRANSCRIPT_ID_RE = re.compile(r"^[a-f0-9]{16,64}$")
+
+def _save_transcript(transcript: str, *, model_name: str, video_sha: str, message: str) -> str:
+    transcript_id = os.urandom(8).hex()
+    store_put(_TRANSCRIPT_NS, transcript_id, {
+        "transcript_id": transcript_id,
+        "transcript": transcript,
+        "model": model_name,
+        "video_sha256": video_sha,
+        "user_prompt": message or "",
+        "created_at": int(time.time()),
+    })
+    return transcript_id
+
+def _load_transcript(transcript_id: str) -> Optional[Dict[str, Any]]:
+    tid = (transcript_id or "").strip().lower()
+    if not _TRANSCRIPT_ID_RE.match(tid):
+        return None
+    art = store_get(_TRANSCRIPT_NS, tid)
+    return art if art and (art.get("transcript") or "").strip() else None
+
+# ---- Landing phase-1 cache -----------------------------------------------------
+# Output PROMPT1 lưu theo hash(page_text, user_prompt, model, template version);
+# regenerateAngles=true dùng lại bản này và chỉ chạy PROMPT2.
+_LANDING_PHASE1_NS = "landing_phase1"
+_LANDING_ID_RE = re.compile(r"^[a-f0-9]{64}$")
+
+def _landing_phase1_key(page_text: str, user_prompt: str, model_name: str) -> str:
+    return content_key(page_text, _normalize_prompt(user_prompt), model_name, LANDING_PHASE1_PROMPT_VERSION)
+
+def _load_landing_phase1(landing_id: str, max_age_s: int) -> Optional[Dict[str, Any]]:
+    lid = (landing_id or "").strip().lower()
+    if not _LANDING_ID_RE.match(lid):
+        return None
+    art = store_get(_LANDING_PHASE1_NS, lid, max_age_s=max_age_s)
+    return art if art and (art.get("analysis") or "").strip() else None
 
 # ---- Local schemas (để file tự chạy độc lập) --------------------------------
 class AngleFull(BaseModel):
@@ -82,6 +180,9 @@ class LandingAnalysisResponse(BaseModel):
     angles: List[str]
     angles_full: Optional[List[AngleFull]] = None
     angles_store: Optional[Dict[str, Any]] = None
+    landing_id: Optional[str] = None
+    phase1_cached: bool = False
+    script_inputs_job_id: Optional[str] = None
 
 # ---- Constants ---------------------------------------------------------------
 ALLOWED_VIDEO = {
@@ -93,6 +194,235 @@ ALLOWED_VIDEO = {
 }
 MAX_MB = 300
 
+REPORT_MODE_FULL = "full"            # upload cả video (mặc định)
+REPORT_MODE_KEYFRAMES = "keyframes"  # audio + keyframes + cut list (nhẹ hơn nhiều cho video dài)
+REPORT_MODES = {REPORT_MODE_FULL, REPORT_MODE_KEYFRAMES}
+
+# ---- Core flow (dùng chung cho route đồng bộ và job nền) ---------------------
+async def _long_media_duration(media_path: Path, settings) -> Optional[float]:
+    """Trả duration nếu media đủ dài để cắt cửa sổ (map-reduce transcript), ngược lại None."""
+    duration = await asyncio.to_thread(probe_duration, media_path)
+    if duration and duration > settings.REPORT_SEGMENT_THRESHOLD_SEC:
+        return duration
+    return None
+
+async def _generate_report_segmented(
+    ip: str,
+    media_path: Path,
+    message: str,
+    model_name: str,
+    settings,
+    visual_parts: Optional[List[Any]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Media dài: cắt cửa sổ REPORT_SEGMENT_WINDOW_SEC, transcribe song song,
+    ghép timestamp theo thứ tự rồi chạy Step 2 trên transcript đã ghép (không cắt giữa).
+    """
+    seg_dir = media_path.parent / "{}-segments".format(media_path.stem)
+    segments = await asyncio.to_thread(split_media, media_path, settings.REPORT_SEGMENT_WINDOW_SEC, seg_dir)
+    _log(ip, f"SEGMENTS ok count={len(segments)} window_s={settings.REPORT_SEGMENT_WINDOW_SEC}")
+    try:
+        transcript_text, t_meta = await gemini_transcribe_segments(
+            api_key=settings.GEMINI_API_KEY,
+            segments=segments,
+            user_prompt=message or "",
+            model_name=model_name,
+            concurrency=settings.REPORT_SEGMENT_CONCURRENCY,
+        )
+    finally:
+        shutil.rmtree(seg_dir, ignore_errors=True)
+
+    report_text, report_meta = await gemini_report_from_transcript(
+        api_key=settings.GEMINI_API_KEY,
+        transcript_text=transcript_text,
+        user_prompt=message or "",
+        model_name=model_name,
+        visual_parts=visual_parts,
+        max_transcript_chars=settings.REPORT_TRANSCRIPT_MAX_CHARS,
+        t_transcript_ms=t_meta["t_transcript_ms"],
+    )
+    report_meta["segments"] = len(segments)
+    return report_text, report_meta
+
+async def _generate_report_full(
+    ip: str, stored_path: Path, message: str, model_name: str, settings
+) -> Tuple[str, Dict[str, Any]]:
+    duration = await _long_media_duration(stored_path, settings)
+    if duration:
+        _log(ip, f"GEMINI_VIDEO_REPORT start segmented duration={duration:.1f}")
+        report_text, report_meta = await _generate_report_segmented(ip, stored_path, message, model_name, settings)
+        _log(ip, "GEMINI_VIDEO_REPORT ok")
+        return report_text, report_meta
+
+    _log(ip, "GEMINI_UPLOAD start")
+    uploaded_file = await gemini_upload_file(
+        api_key=settings.GEMINI_API_KEY,
+        file_path=str(stored_path),
+    )
+    _log(ip, "GEMINI_UPLOAD ok")
+
+    _log(ip, "GEMINI_VIDEO_REPORT start")
+    report_text, report_meta = await gemini_generate_video_report(
+        api_key=settings.GEMINI_API_KEY,
+        uploaded_file=uploaded_file,
+        user_prompt=message or "",
+        model_name=model_name,
+    )
+    _log(ip, "GEMINI_VIDEO_REPORT ok")
+    return report_text, report_meta
+
+async def _generate_report_keyframes(
+    ip: str, stored_path: Path, message: str, model_name: str, settings
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Mode keyframes: cắt cảnh + keyframe local, chỉ upload audio track cho transcript.
+    Không tách được audio -> upload video gốc cho Step 1 (Step 2 vẫn dùng keyframes).
+    ffmpeg không decode được frame (thiếu ffmpeg, codec lạ) -> chạy mode full.
+    """
+    t0 = time.perf_counter()
+    try:
+        scene_info = await asyncio.to_thread(
+            analyze_scenes,
+            stored_path,
+            sample_fps=settings.KEYFRAME_SAMPLE_FPS,
+            max_keyframes=settings.KEYFRAME_MAX,
+            keyframe_width=settings.KEYFRAME_WIDTH,
+        )
+    except (subprocess.CalledProcessError, OSError) as e:
+        stderr = getattr(e, "stderr", None) or b""
+        _log(ip, f"SCENES_FAIL fallback=full err={e} stderr={stderr[-300:]!r}")
+        metrics.incr("report.keyframes_fallback")
+        report_text, report_meta = await _generate_report_full(ip, stored_path, message, model_name, settings)
+        report_meta["mode_fallback"] = REPORT_MODE_FULL
+        return report_text, report_meta
+    kf_bytes = sum(len(k["jpeg"]) for k in scene_info["keyframes"])
+    _log(ip, f"SCENES ok cuts={len(scene_info['cuts'])} keyframes={len(scene_info['keyframes'])} "
+             f"kf_bytes={kf_bytes} dt_ms={int((time.perf_counter() - t0) * 1000)}")
+
+    audio_path = await asyncio.to_thread(extract_audio, stored_path, stored_path.with_suffix(".audio.mp3"))
+    media_path = audio_path or stored_path
+    try:
+        duration = await _long_media_duration(media_path, settings)
+        if duration:
+            _log(ip, f"GEMINI_VIDEO_REPORT start mode=keyframes segmented duration={duration:.1f}")
+            report_text, report_meta = await _generate_report_segmented(
+                ip, media_path, message, model_name, settings,
+                visual_parts=keyframe_visual_parts(scene_info),
+            )
+        else:
+            _log(ip, f"GEMINI_UPLOAD start media={'audio' if audio_path else 'video'} bytes={media_path.stat().st_size}")
+            uploaded_media = await gemini_upload_file(
+                api_key=settings.GEMINI_API_KEY,
+                file_path=str(media_path),
+            )
+            _log(ip, "GEMINI_UPLOAD ok")
+
+            _log(ip, "GEMINI_VIDEO_REPORT start mode=keyframes")
+            report_text, report_meta = await gemini_generate_keyframe_report(
+                api_key=settings.GEMINI_API_KEY,
+                uploaded_media=uploaded_media,
+                scene_info=scene_info,
+                user_prompt=message or "",
+                model_name=model_name,
+            )
+    finally:
+        if audio_path:
+            _unlink_quiet(ip, audio_path)
+    _log(ip, "GEMINI_VIDEO_REPORT ok")
+    report_meta["scenes"] = {
+        "duration": scene_info["duration"],
+        "cuts": scene_info["cuts"],
+        "pacing": scene_info["pacing"],
+        "keyframe_times": [k["t"] for k in scene_info["keyframes"]],
+    }
+    return report_text, report_meta
+
+async def _run_analysis_report(
+    ip: str,
+    stored_path: Path,
+    video_sha: str,
+    message: str,
+    settings,
+    label: str = "/analysis-report",
+    mode: str = REPORT_MODE_FULL,
+) -> Dict[str, Any]:
+    """
+    Cache lookup -> upload Gemini -> report -> lưu transcript + cache.
+    Luôn xoá file local khi xong.
+    """
+    model_name = getattr(settings, "GEMINI_MODEL_VISION", DEFAULT_VISION_MODEL)
+    cache_key = _report_cache_key(video_sha, message, model_name, _report_cache_mode(mode, settings))
+    if settings.REPORT_CACHE_ENABLED:
+        t_lookup = time.perf_counter()
+        cached = store_get(_REPORT_CACHE_NS, cache_key, max_age_s=settings.REPORT_CACHE_TTL_SEC)
+        if cached and (cached.get("report") or "").strip():
+            saved_ms = int((cached.get("meta") or {}).get("t_total_ms") or 0)
+            metrics.incr("report_cache.hit")
+            metrics.incr("report_cache.saved_ms", saved_ms)
+            metrics.observe_ms("report_cache.lookup", (time.perf_counter() - t_lookup) * 1000)
+            _log(ip, f"REPORT_CACHE hit key={cache_key[:12]} saved_ms={saved_ms}")
+            _unlink_quiet(ip, stored_path)
+            transcript_id = cached.get("transcript_id")
+            if transcript_id and not _load_transcript(transcript_id):
+                transcript_id = None
+            _log(ip, f"END {label} success (cached)")
+            return {
+                "step": "report_done",
+                "report": cached["report"],
+                "transcript_id": transcript_id,
+                "scenes": (cached.get("meta") or {}).get("scenes"),
+                "options": {"create_script": True, "analyze_landing_page": True},
+                "cached": True,
+            }
+        metrics.incr("report_cache.miss")
+        _log(ip, f"REPORT_CACHE miss key={cache_key[:12]}")
+
+    try:
+        if mode == REPORT_MODE_KEYFRAMES:
+            report_text, report_meta = await _generate_report_keyframes(ip, stored_path, message, model_name, settings)
+        else:
+            report_text, report_meta = await _generate_report_full(ip, stored_path, message, model_name, settings)
+    except Exception as e:
+        _log(ip, f"ERROR {label}: {e}")
+        raise HTTPException(status.HTTP_502_BAD_GATEWAY, "Lỗi xử lý video từ Gemini: {}".format(e))
+    finally:
+        _unlink_quiet(ip, stored_path)
+
+    transcript_id = None
+    transcript_text = (report_meta.pop("transcript", "") or "").strip()
+    if transcript_text:
+        try:
+            transcript_id = _save_transcript(transcript_text, model_name=model_name, video_sha=video_sha, message=message)
+            _log(ip, f"TRANSCRIPT_SAVED id={transcript_id} chars={len(transcript_text)}")
+        except Exception as e:
+            _log(ip, f"TRANSCRIPT_SAVE_FAIL err={e}")
+
+    # report fallback (keyframes -> full) không cache dưới key keyframes: lần sau có ffmpeg thì chạy lại đúng mode
+    if settings.REPORT_CACHE_ENABLED and (report_text or "").strip() and not report_meta.get("mode_fallback"):
+        try:
+            store_put(_REPORT_CACHE_NS, cache_key, {
+                "report": report_text,
+                "transcript_id": transcript_id,
+                "meta": report_meta,
+                "video_sha256": video_sha,
+                "model": model_name,
+                "prompt_version": VIDEO_REPORT_PROMPT_VERSION,
+                "created_at": int(time.time()),
+            })
+        except Exception as e:
+            _log(ip, f"REPORT_CACHE store_fail err={e}")
+
+    await _submit_report_digest(ip, settings, report_text)
+    _log(ip, f"END {label} success")
+    return {
+        "step": "report_done",
+        "report": report_text,  # RAW markdown
+        "transcript_id": transcript_id,
+        "scenes": report_meta.get("scenes"),  # chỉ có ở mode keyframes (cut list + pacing đo local)
+        "options": {"create_script": True, "analyze_landing_page": True},
+        "cached": False,
+    }
+
 # ---- Routes -----------------------------------------------------------------
 @router.post("/analysis-report")
 async def analysis_report(
@@ -101,13 +431,16 @@ async def analysis_report(
     message: str = Form(""),
     userId: str = Form("anon"),
     projectId: str = Form("default"),
+    mode: str = Form(REPORT_MODE_FULL),
     settings=Depends(get_settings),
 ):
     ip = _client_ip(request)
     _log(ip, f"START /analysis-report userId={userId} projectId={projectId} file={getattr(video,'filename',None)}")
+    if mode not in REPORT_MODES:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "mode không hợp lệ: {} (hỗ trợ: {})".format(mode, ", ".join(sorted(REPORT_MODES))))
 
-    stored_path, size_bytes, mime = _save_upload(video, settings.UPLOAD_DIR, MAX_MB)
-    _log(ip, f"UPLOAD_SAVED path={stored_path.name} size={size_bytes} mime={mime}")
+    stored_path, size_bytes, mime, video_sha = _save_upload(video, settings.UPLOAD_DIR, MAX_MB)
+    _log(ip, f"UPLOAD_SAVED path={stored_path.name} size={size_bytes} mime={mime} sha={video_sha[:12]}")
 
     if mime not in ALLOWED_VIDEO:
         try:
@@ -117,51 +450,229 @@ async def analysis_report(
         _log(ip, f"UNSUPPORTED_MEDIA mime={mime}")
         raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Định dạng video không hỗ trợ: {}".format(mime))
 
+    return await _run_analysis_report(ip, stored_path, video_sha, message, settings, mode=mode)
+
+@router.post("/jobs/analysis-report", status_code=status.HTTP_202_ACCEPTED)
+async def analysis_report_job(
+    request: Request,
+    video: UploadFile = File(...),
+    message: str = Form(""),
+    userId: str = Form("anon"),
+    projectId: str = Form("default"),
+    mode: str = Form(REPORT_MODE_FULL),
+    webhookUrl: str = Form(""),
+    settings=Depends(get_settings),
+):
+    """
+    Bản async của /analysis-report: lưu video, tạo job và trả job_id ngay.
+    Theo dõi qua GET /jobs/{job_id}; kết quả (cùng shape với /analysis-report) ở /jobs/{job_id}/result.
+    """
+    ip = _client_ip(request)
+    _log(ip, f"START /jobs/analysis-report userId={userId} projectId={projectId} file={getattr(video,'filename',None)}")
+    if mode not in REPORT_MODES:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "mode không hợp lệ: {} (hỗ trợ: {})".format(mode, ", ".join(sorted(REPORT_MODES))))
     try:
-        _log(ip, "GEMINI_UPLOAD start")
-        uploaded_file = await gemini_upload_file(
-            api_key=settings.GEMINI_API_KEY,
-            file_path=str(stored_path),
-        )
-        _log(ip, "GEMINI_UPLOAD ok")
+        webhook_url = await validate_webhook_url(webhookUrl)
+    except UnsafeURLError as e:
+        _log(ip, f"BAD_WEBHOOK err={e}")
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "webhookUrl không hợp lệ: {}".format(e))
 
-        _log(ip, "GEMINI_VIDEO_REPORT start")
-        report_text, _ = await gemini_generate_video_report(
+    stored_path, size_bytes, mime, video_sha = _save_upload(video, settings.UPLOAD_DIR / "jobs", MAX_MB)
+    if mime not in ALLOWED_VIDEO:
+        _unlink_quiet(ip, stored_path)
+        _log(ip, f"UNSUPPORTED_MEDIA mime={mime}")
+        raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Định dạng video không hỗ trợ: {}".format(mime))
+
+    # Giữ JOB_MAX_ATTEMPTS mặc định: job chỉ chạy lại khi worker chết (hết lease) mà video tạm còn đó.
+    # Chạy lại chỉ upload + đọc report lần nữa (không side effect ngoài), report đã xong thì trúng cache.
+    job = await asyncio.to_thread(
+        submit_job,
+        "analysis_report",
+        {
+            "path": str(stored_path),
+            "video_sha256": video_sha,
+            "message": message or "",
+            "mode": mode,
+            "userId": userId,
+            "projectId": projectId,
+        },
+        webhook_url=webhook_url,
+    )
+    _log(ip, f"END /jobs/analysis-report job_id={job['id']} size={size_bytes}")
+    return public_job(job)
+
+@register_job_handler("analysis_report")
+async def _analysis_report_job_handler(payload: Dict[str, Any]) -> Dict[str, Any]:
+    stored_path = Path(payload["path"])
+    if not stored_path.is_file():
+        raise RuntimeError("Video tạm của job không còn tồn tại: {}".format(stored_path.name))
+    return await _run_analysis_report(
+        "job",
+        stored_path,
+        payload.get("video_sha256") or "",
+        payload.get("message") or "",
+        get_settings(),
+        label="job:analysis_report",
+        mode=payload.get("mode") or REPORT_MODE_FULL,
+    )
+
+@register_job_cleanup("analysis_report")
+def _analysis_report_job_cleanup(payload: Dict[str, Any]) -> None:
+    """Job failed (kể cả worker chết, hết lease) -> xoá video tạm trong uploads/jobs."""
+    path = Path(payload.get("path") or "")
+    if payload.get("path") and path.is_file():
+        _unlink_quiet("job", path)
+
+@router.post("/reanalyze-report")
+async def reanalyze_report(
+    request: Request,
+    transcriptId: str = Form(...),
+    message: str = Form(""),
+    userId: str = Form("anon"),
+    projectId: str = Form("default"),
+    settings=Depends(get_settings),
+):
+    """
+    Chỉ chạy lại Step 2 (analyses) trên transcript đã lưu, với USER_NOTE mới.
+    """
+    ip = _client_ip(request)
+    _log(ip, f"START /reanalyze-report userId={userId} projectId={projectId} transcriptId={transcriptId}")
+
+    art = _load_transcript(transcriptId)
+    if not art:
+        _log(ip, f"NOT_FOUND transcriptId={transcriptId}")
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Không tìm thấy transcript: {}".format(transcriptId))
+
+    transcript_text = art["transcript"]
+    model_name = art.get("model") or getattr(settings, "GEMINI_MODEL_VISION", DEFAULT_VISION_MODEL)
+    try:
+        _log(ip, "GEMINI_REANALYZE start")
+        analyses_text, meta = await gemini_analyze_transcript(
             api_key=settings.GEMINI_API_KEY,
-            uploaded_file=uploaded_file,
+            transcript_text=transcript_text,
             user_prompt=message or "",
-            model_name=getattr(settings, "GEMINI_MODEL_VISION", DEFAULT_VISION_MODEL),
+            model_name=model_name,
+            max_transcript_chars=settings.REPORT_TRANSCRIPT_MAX_CHARS,
         )
-        _log(ip, "GEMINI_VIDEO_REPORT ok")
+        _log(ip, f"GEMINI_REANALYZE ok dt_ms={meta.get('t_analyses_ms')}")
     except Exception as e:
-        _log(ip, f"ERROR /analysis-report: {e}")
-        raise HTTPException(status.HTTP_502_BAD_GATEWAY, "Lỗi xử lý video từ Gemini: {}".format(e))
-    finally:
-        try:
-            stored_path.unlink()
-            _log(ip, f"TEMP_CLEANED path={stored_path.name}")
-        except Exception as _e:
-            _log(ip, f"TEMP_CLEAN_FAIL path={stored_path} err={_e}")
+        _log(ip, f"ERROR /reanalyze-report: {e}")
+        raise HTTPException(status.HTTP_502_BAD_GATEWAY, "Lỗi phân tích lại transcript từ Gemini: {}".format(e))
 
-    _log(ip, "END /analysis-report success")
+    report_text = assemble_video_report(transcript_text, analyses_text)
+    await _submit_report_digest(ip, settings, report_text)
+    _log(ip, "END /reanalyze-report success")
     return {
         "step": "report_done",
-        "report": report_text,  # RAW markdown
+        "report": report_text,
+        "transcript_id": art["transcript_id"],
         "options": {"create_script": True, "analyze_landing_page": True},
+        "cached": False,
     }
 
-@router.post("/analysis-landing-page", response_model=LandingAnalysisResponse)
-async def analysis_landing_page(
-    request: Request,
-    landingUrl: str = Form(...),
-    userId: str = Form("unknown"),
-    projectId: str = Form("default"),
-    settings=Depends(get_settings),
-):
-    ip = _client_ip(request)
-    page_text = (landingUrl or "").strip()
+# ---- Report digest: sinh 1 lần / report, ngay sau khi report xong -------------------
+async def _submit_report_digest(ip: str, settings, report_text: str) -> Optional[str]:
+    """Chạy nền ensure_report_digest; script/infer đọc lại digest từ store thay vì report đầy đủ."""
+    if not settings.REPORT_DIGEST_ENABLED or len((report_text or "").strip()) < settings.REPORT_DIGEST_MIN_CHARS:
+        return None
+    if get_report_digest(report_text):
+        return None  # đã có digest -> khỏi tạo job
+    try:
+        job = await asyncio.to_thread(submit_job, "report_digest", {"report": report_text}, max_attempts=1)
+    except Exception as e:
+        _log(ip, f"REPORT_DIGEST submit_fail err={e}")
+        return None
+    _log(ip, f"REPORT_DIGEST submitted job={job['id']} chars={len(report_text)}")
+    return job["id"]
+
+@register_job_handler("report_digest")
+async def _report_digest_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    rec = await ensure_report_digest(api_key=get_settings().GEMINI_API_KEY, report=payload["report"])
+    if not rec:
+        return {"digest": False}
+    return {
+        "digest": True,
+        "cached": rec.get("cached"),
+        "tokens_before": rec.get("tokens_before"),
+        "tokens_after": rec.get("tokens_after"),
+    }
 
-    _log(ip, f"START /analysis-landing-page userId={userId} projectId={projectId} len={len(page_text)}")
+# ---- Speculative precompute: required inputs cho /generate-script ----------------
+async def _submit_script_inputs_precompute(
+    ip: str, settings, *, report: str, landing_analysis: str, angles: List[Dict[str, Any]],
+) -> Optional[str]:
+    """Chạy nền infer 9 REQUIRED_KEYS cho từng angle; /generate-script sẽ đọc lại từ cache."""
+    if not settings.SCRIPT_INPUTS_PRECOMPUTE or not (report or "").strip() or not angles:
+        return None
+    try:
+        job = await asyncio.to_thread(submit_job, "script_inputs_precompute", {
+            "report": report,
+            "landing_analysis": landing_analysis,
+            "angles": [{"title": a.get("title", ""), "raw": a.get("raw", "")} for a in angles],
+            "model": getattr(settings, "GEMINI_MODEL_TEXT", DEFAULT_TEXT_MODEL),
+        }, max_attempts=1)
+    except Exception as e:
+        _log(ip, f"SCRIPT_INPUTS_PRECOMPUTE submit_fail err={e}")
+        return None
+    _log(ip, f"SCRIPT_INPUTS_PRECOMPUTE submitted job={job['id']} angles={len(angles)}")
+    return job["id"]
+
+@register_job_handler("script_inputs_precompute")
+async def _script_inputs_precompute_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    settings = get_settings()
+    # prompt dùng digest (sinh nếu chưa có); cache key theo report gốc như /generate-script,
+    # nên khớp dù digest đã xong hay chưa ở phía request
+    prompt_report, _ = await report_for_prompt(
+        api_key=settings.GEMINI_API_KEY, report=payload["report"], stage="script_inputs", generate=True,
+    )
+
+    async def _one(angle: Dict[str, Any]) -> bool:
+        try:
+            inputs = await precompute_required_inputs(
+                api_key=settings.GEMINI_API_KEY,
+                model_name=payload["model"],
+                report=payload["report"],
+                prompt_report=prompt_report,
+                landing_analysis=payload["landing_analysis"],
+                angle_text=angle_context_text(angle),
+            )
+            return any(inputs.values())
+        except Exception:
+            return False
+
+    results = await asyncio.gather(*(_one(a) for a in payload.get("angles") or []))
+    metrics.incr("script_inputs.precomputed", sum(results))
+    return {"angles": len(results), "ok": sum(results)}
+
+async def _landing_phase1(
+    ip: str,
+    settings,
+    *,
+    landing_input: str,
+    landing_id_in: Optional[str],
+    regenerate_angles: bool,
+    user_prompt: str = "",
+) -> Dict[str, Any]:
+    """
+    Chuẩn bị phase 1 cho landing: fetch URL / dedupe / PROMPT1 (hoặc cache).
+    Trả {analysis, landing_id, phase1_cached}.
+    """
+    page_text = (landing_input or "").strip()
+    model_name = getattr(settings, "GEMINI_MODEL_TEXT", DEFAULT_TEXT_MODEL)
+
+    # Chỉ tạo lại angles từ landingId -> không cần fetch/dedupe lại landing
+    if regenerate_angles and landing_id_in:
+        art = _load_landing_phase1(landing_id_in, settings.LANDING_PHASE1_TTL_SEC)
+        if art:
+            metrics.incr("landing_phase1.hit")
+            _log(ip, f"LANDING_PHASE1 cache_hit landingId={art['landing_id'][:12]}")
+            return {"analysis": art["analysis"], "landing_id": art["landing_id"], "phase1_cached": True}
+        if not page_text:
+            _log(ip, f"NOT_FOUND landingId={landing_id_in}")
+            raise HTTPException(
+                status.HTTP_404_NOT_FOUND,
+                "Không tìm thấy phân tích landing (landingId sai hoặc đã hết hạn). Hãy gửi lại landingUrl.",
+            )
 
     if not page_text:
         _log(ip, "BAD_REQUEST landingUrl empty")
@@ -170,26 +681,143 @@ async def analysis_landing_page(
             "Thiếu nội dung landing để phân tích (landingUrl trống).",
         )
 
+    # landingUrl là 1 URL -> fetch + trích text/review thật; ngược lại coi là nội dung dán sẵn
+    if looks_like_url(page_text):
+        try:
+            page = await fetch_landing_page(page_text)
+        except LandingFetchError as e:
+            _log(ip, f"LANDING_FETCH_FAIL url={page_text} err={e}")
+            raise HTTPException(e.status_code, str(e))
+        page_text = landing_page_text(page)
+        _log(
+            ip,
+            f"LANDING_FETCH ok bytes={page.get('bytes')} text_chars={len(page.get('text') or '')} "
+            f"reviews={len(page.get('reviews') or [])} cached={page.get('cached')} revalidated={page.get('revalidated')}",
+        )
+        if not (page.get("text") or page.get("reviews")):
+            raise HTTPException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                "Không trích được nội dung từ landing (trang trống hoặc render bằng JS).",
+            )
+
+    if settings.LANDING_DEDUPE_ENABLED:
+        t0 = time.perf_counter()
+        page_text, dd = await asyncio.to_thread(dedupe_feedback_text, page_text, settings.LANDING_DEDUPE_THRESHOLD)
+        metrics.incr("landing_dedupe.tokens_saved", dd["tokens_saved"])
+        _log(
+            ip,
+            f"LANDING_DEDUPE comments={dd['comments']} clusters={dd['clusters']} "
+            f"tokens_before={dd['tokens_before']} tokens_after={dd['tokens_after']} "
+            f"tokens_saved={dd['tokens_saved']} dt_ms={int((time.perf_counter() - t0) * 1000)}",
+        )
+
+    landing_id = _landing_phase1_key(page_text, user_prompt, model_name)
+    if regenerate_angles:
+        art = _load_landing_phase1(landing_id, settings.LANDING_PHASE1_TTL_SEC)
+        if art:
+            metrics.incr("landing_phase1.hit")
+            _log(ip, f"LANDING_PHASE1 cache_hit landingId={landing_id[:12]}")
+            return {"analysis": art["analysis"], "landing_id": landing_id, "phase1_cached": True}
+
+    metrics.incr("landing_phase1.miss")
+    _log(ip, "GEMINI_LANDING_PHASE1 start")
+    analysis_text, p1_meta = await gemini_landing_phase1(
+        api_key=settings.GEMINI_API_KEY,
+        page_text=page_text,
+        user_prompt=user_prompt,
+        model_name=model_name,
+        map_threshold_chars=settings.LANDING_MAP_THRESHOLD_CHARS,
+        map_chunk_chars=settings.LANDING_MAP_CHUNK_CHARS,
+    )
+    analysis_text = (analysis_text or "").strip()
+    _log(
+        ip,
+        f"GEMINI_LANDING_PHASE1 ok input_chars={len(page_text)} map_chunks={p1_meta.get('map_chunks', 0)} "
+        f"t_map_reduce_ms={p1_meta.get('t_map_reduce_ms', 0)} t_phase1_ms={p1_meta.get('t_phase1_ms')}",
+    )
+    if analysis_text:
+        store_put(_LANDING_PHASE1_NS, landing_id, {
+            "landing_id": landing_id,
+            "analysis": analysis_text,
+            "meta": p1_meta,
+            "model": model_name,
+            "prompt_version": LANDING_PHASE1_PROMPT_VERSION,
+            "created_at": int(time.time()),
+        })
+    return {"analysis": analysis_text, "landing_id": landing_id, "phase1_cached": False}
+
+@router.post("/analysis-landing-page", response_model=LandingAnalysisResponse)
+async def analysis_landing_page(
+    request: Request,
+    landingUrl: str = Form(""),
+    landingId: Optional[str] = Form(None),
+    regenerateAngles: bool = Form(False),
+    report: str = Form(""),                 # optional: có report -> precompute script inputs cho mọi angle
+    structured: Optional[bool] = Form(None),  # None -> LANDING_ANGLES_STRUCTURED
+    userId: str = Form("unknown"),
+    projectId: str = Form("default"),
+    settings=Depends(get_settings),
+):
+    ip = _client_ip(request)
+    _log(
+        ip,
+        f"START /analysis-landing-page userId={userId} projectId={projectId} len={len((landingUrl or '').strip())} "
+        f"regenerateAngles={regenerateAngles} landingId={(landingId or '')[:12]}",
+    )
+
     try:
-        _log(ip, "GEMINI_LANDING_ANALYSIS start")
-        analysis_text, angles_raw, _meta = await gemini_generate_landing_analysis(
-            api_key=settings.GEMINI_API_KEY,
-            page_text=page_text,
-            user_prompt="",
-            model_name=getattr(settings, "GEMINI_MODEL_TEXT", DEFAULT_TEXT_MODEL),
+        p1 = await _landing_phase1(
+            ip, settings, landing_input=landingUrl, landing_id_in=landingId, regenerate_angles=regenerateAngles,
         )
-        _log(ip, "GEMINI_LANDING_ANALYSIS ok")
+        analysis_text = p1["analysis"]
+
+        full = None
+        use_structured = settings.LANDING_ANGLES_STRUCTURED if structured is None else structured
+        if use_structured:
+            _log(ip, "GEMINI_LANDING_ANGLES structured start")
+            try:
+                framework_table, angles_block, full, p2_meta = await gemini_landing_angles_structured(
+                    api_key=settings.GEMINI_API_KEY,
+                    analysis_text=analysis_text,
+                    user_prompt="",
+                    model_name=getattr(settings, "GEMINI_MODEL_TEXT", DEFAULT_TEXT_MODEL),
+                )
+                titles = [a["title"] for a in full]
+                _log(ip, f"GEMINI_LANDING_ANGLES structured ok angles={len(full)} t_phase2_ms={p2_meta.get('t_phase2_ms')}")
+                if not full:
+                    # JSON hợp lệ nhưng angles: [] -> cũng quay về PROMPT2 dạng text
+                    metrics.incr("landing_angles.structured_fallback")
+                    _log(ip, "GEMINI_LANDING_ANGLES structured_empty -> text mode")
+                    full = None
+            except ValidationError as e:
+                # JSON không khớp schema -> quay về PROMPT2 dạng text
+                metrics.incr("landing_angles.structured_fallback")
+                _log(ip, f"GEMINI_LANDING_ANGLES structured_invalid err={e.error_count()} -> text mode")
+                full = None
 
-        analysis_text = (analysis_text or "").strip()
-        angles_raw = (angles_raw or "").strip()
+        if full is None:
+            _log(ip, "GEMINI_LANDING_ANGLES start")
+            angles_raw, p2_meta = await gemini_landing_angles(
+                api_key=settings.GEMINI_API_KEY,
+                analysis_text=analysis_text,
+                user_prompt="",
+                model_name=getattr(settings, "GEMINI_MODEL_TEXT", DEFAULT_TEXT_MODEL),
+            )
+            _log(ip, f"GEMINI_LANDING_ANGLES ok t_phase2_ms={p2_meta.get('t_phase2_ms')}")
 
-        framework_table, angles_block = split_angles_output(angles_raw)
-        titles, full = extract_angles_from_block(angles_block)
-        _log(ip, f"ANGLES_PARSED titles={len(titles or [])} full={len(full or [])}")
+            angles_raw = (angles_raw or "").strip()
+
+            framework_table, angles_block = split_angles_output(angles_raw)
+            titles, full = extract_angles_from_block(angles_block)
+            _log(ip, f"ANGLES_PARSED titles={len(titles or [])} full={len(full or [])}")
     except Exception as e:
         _log(ip, f"ERROR /analysis-landing-page: {e}")
         raise
 
+    precompute_job_id = await _submit_script_inputs_precompute(
+        ip, settings, report=report, landing_analysis=analysis_text, angles=full or [],
+    )
+
     _log(ip, "END /analysis-landing-page success")
     return LandingAnalysisResponse(
         landing_analysis=analysis_text,
@@ -197,4 +825,83 @@ async def analysis_landing_page(
         angles=titles or [],
         angles_full=[AngleFull(**x) for x in full] if full else None,
         angles_store={"framework_table": framework_table} if framework_table else None,
+        landing_id=p1["landing_id"],
+        phase1_cached=p1["phase1_cached"],
+        script_inputs_job_id=precompute_job_id,
+    )
+
+@router.post("/analysis-landing-page/stream")
+async def analysis_landing_page_stream(
+    request: Request,
+    landingUrl: str = Form(""),
+    landingId: Optional[str] = Form(None),
+    regenerateAngles: bool = Form(False),
+    report: str = Form(""),
+    userId: str = Form("unknown"),
+    projectId: str = Form("default"),
+    settings=Depends(get_settings),
+):
+    """
+    NDJSON: {"event":"analysis"} -> {"event":"framework"} -> {"event":"angle"} x N -> {"event":"done"}.
+    Mỗi angle được gửi ngay khi block của nó đóng trong lúc PROMPT2 vẫn đang sinh.
+    """
+    ip = _client_ip(request)
+    _log(
+        ip,
+        f"START /analysis-landing-page/stream userId={userId} projectId={projectId} "
+        f"regenerateAngles={regenerateAngles} landingId={(landingId or '')[:12]}",
+    )
+    # Lỗi phase 1 (input sai, fetch lỗi...) trả HTTP status bình thường trước khi mở stream
+    p1 = await _landing_phase1(
+        ip, settings, landing_input=landingUrl, landing_id_in=landingId, regenerate_angles=regenerateAngles,
     )
+
+    async def _events():
+        t0 = time.perf_counter()
+        yield _ndjson({
+            "event": "analysis",
+            "landing_analysis": p1["analysis"],
+            "landing_id": p1["landing_id"],
+            "phase1_cached": p1["phase1_cached"],
+        })
+        parser = IncrementalAngleParser()
+        first_ms = None
+        try:
+            async for piece in gemini_landing_angles_stream(
+                api_key=settings.GEMINI_API_KEY,
+                analysis_text=p1["analysis"],
+                user_prompt="",
+                model_name=getattr(settings, "GEMINI_MODEL_TEXT", DEFAULT_TEXT_MODEL),
+            ):
+                for kind, payload in parser.feed(piece):
+                    if kind == "angle" and first_ms is None:
+                        first_ms = int((time.perf_counter() - t0) * 1000)
+                    yield _ndjson(_angle_event(kind, payload))
+            for kind, payload in parser.close():
+                yield _ndjson(_angle_event(kind, payload))
+        except Exception as e:
+            _log(ip, f"ERROR /analysis-landing-page/stream: {e}")
+            yield _ndjson({"event": "error", "detail": str(e)})
+            return
+        dt_ms = int((time.perf_counter() - t0) * 1000)
+        _log(ip, f"END /analysis-landing-page/stream angles={len(parser.angles)} first_angle_ms={first_ms} dt_ms={dt_ms}")
+        precompute_job_id = await _submit_script_inputs_precompute(
+            ip, settings, report=report, landing_analysis=p1["analysis"], angles=parser.angles,
+        )
+        yield _ndjson({
+            "event": "done",
+            "angles": [a["title"] for a in parser.angles],
+            "script_inputs_job_id": precompute_job_id,
+            "angles_text": parser.angles_text,
+            "angles_store": {"framework_table": parser.framework_table} if parser.framework_table else None,
+        })
+
+    return StreamingResponse(_events(), media_type="application/x-ndjson")
+
+def _ndjson(obj: Dict[str, Any]) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _angle_event(kind: str, payload: Any) -> Dict[str, Any]:
+    if kind == "framework":
+        return {"event": "framework", "framework_table": payload}
+    return {"event": "angle", "angle": AngleFull(**payload).model_dump()}
@@ -0,0 +1,31 @@
+import asyncio
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse
+
+from app.services.jobs import get_job, public_job, JOB_SUCCEEDED, JOB_FAILED
+
+router = APIRouter()
+
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.to_thread(get_job, job_id)  # SQLite đồng bộ -> không chặn event loop
+    if not job:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job.")
+    return public_job(job)
+
+@router.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    """
+    - succeeded: trả result (cùng shape với endpoint đồng bộ tương ứng)
+    - failed: 502 kèm error
+    - queued/running: 202 kèm status để FE poll tiếp
+    """
+    job = await asyncio.to_thread(get_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job.")
+    if job["status"] == JOB_SUCCEEDED:
+        return job.get("result") or {}
+    if job["status"] == JOB_FAILED:
+        raise HTTPException(status_code=502, detail=job.get("error") or "Job thất bại.")
+    return JSONResponse(status_code=202, content=public_job(job))
@@ -1,8 +1,18 @@
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 from fastapi import APIRouter, Depends, Form, HTTPException
+from fastapi.responses import StreamingResponse
 from app.core.config import get_settings
-from app.services.gemini import gemini_generate_script, DEFAULT_TEXT_MODEL
+from app.services.gemini import (
+    gemini_generate_script,
+    extract_angles_from_block,
+    extract_final_script_rows,
+    report_for_prompt,
+    DEFAULT_TEXT_MODEL,
+)
+from app.services.script_infer import angle_context_text, resolve_required_inputs_for_angles
+import asyncio
 import json
+import time
 
 router = APIRouter()
 
@@ -16,6 +26,7 @@ async def generate_script(
     angle_raw: str = Form(""),
     user_prompt: str = Form(""),
     script_inputs_json: str = Form(""),  # optional
+    candidates: int = Form(1),           # >1: N phương án trong 1 call (candidate_count)
     userId: str = Form("anon"),
     projectId: str = Form("default"),
     settings=Depends(get_settings),
@@ -49,8 +60,10 @@ async def generate_script(
     if not (angle_payload.get("title") or angle_payload.get("raw")):
         raise HTTPException(status_code=400, detail="Thiếu angle (title hoặc raw).")
 
+    n_candidates = max(1, min(int(candidates or 1), settings.SCRIPT_MAX_CANDIDATES))
+
     try:
-        script_text, _ = await gemini_generate_script(
+        script_text, meta = await gemini_generate_script(
             api_key=settings.GEMINI_API_KEY,
             report=report,
             landing_analysis=landing_analysis,
@@ -59,6 +72,8 @@ async def generate_script(
             user_prompt=user_prompt,
             model_name=getattr(settings, "GEMINI_MODEL_TEXT", DEFAULT_TEXT_MODEL),
             script_inputs=script_inputs,
+            precomputed_max_age_s=settings.SCRIPT_INPUTS_TTL_SEC,
+            candidates=n_candidates,
         )
     except Exception as e:
         raise HTTPException(status_code=502, detail="Lỗi sinh Script từ Gemini: {}".format(e))
@@ -66,4 +81,142 @@ async def generate_script(
     if script_text.strip().upper().startswith("ERROR:"):
         raise HTTPException(status_code=502, detail=script_text.strip())
 
-    return {"step": "script_done", "angle": angle_payload.get("title", ""), "script": script_text}
+    out = {
+        "step": "script_done",
+        "angle": angle_payload.get("title", ""),
+        "script": script_text,
+        # bảng D) parse sẵn -> FE gửi lại cho /generate-shotlist thay vì cả script
+        "final_script_rows": extract_final_script_rows(script_text),
+    }
+    if n_candidates > 1:
+        out["scripts"] = meta.get("candidates") or [script_text]
+        out["usage"] = meta.get("usage") or {}
+        out["candidates_mode"] = meta.get("mode")
+    return out
+
+
+# ---- Multi-angle: /generate-scripts ------------------------------------------------
+def _parse_angles_json(angles_json: str, angles_text: str) -> List[Dict[str, Any]]:
+    angles: List[Dict[str, Any]] = []
+    if (angles_json or "").strip():
+        try:
+            parsed = json.loads(angles_json)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="angles_json không phải JSON hợp lệ.")
+        if isinstance(parsed, list):
+            angles = [
+                {"title": str(a.get("title", "") or ""), "raw": str(a.get("raw", "") or "")}
+                for a in parsed
+                if isinstance(a, dict) and (a.get("title") or a.get("raw"))
+            ]
+    if not angles and (angles_text or "").strip():
+        _, full = extract_angles_from_block(angles_text)
+        angles = [{"title": a.get("title", ""), "raw": a.get("raw", "")} for a in full]
+    return angles
+
+
+def _ndjson(obj: Dict[str, Any]) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+@router.post("/generate-scripts")
+async def generate_scripts(
+    report: str = Form(...),
+    angles_json: str = Form(""),   # [{"title":"...","raw":"..."}, ...]; trống -> parse từ angles_text
+    landing_analysis: str = Form(""),
+    angles_text: str = Form(""),
+    user_prompt: str = Form(""),
+    script_inputs_json: str = Form(""),  # optional, áp cho mọi angle
+    userId: str = Form("anon"),
+    projectId: str = Form("default"),
+    settings=Depends(get_settings),
+):
+    """
+    Sinh script cho nhiều angle trong 1 request (NDJSON):
+      {"event":"inputs"} -> {"event":"script"|"error", "index", ...} theo thứ tự hoàn thành -> {"event":"done"}
+    Context gửi 1 lần; required inputs resolve 1 lần cho cả bộ angle (cache precompute + 1 batch call).
+    """
+    if not (report or "").strip():
+        raise HTTPException(status_code=400, detail="Thiếu report.")
+    angles = _parse_angles_json(angles_json, angles_text)
+    if not angles:
+        raise HTTPException(status_code=400, detail="Thiếu angle (angles_json hoặc angles_text).")
+    if len(angles) > settings.SCRIPT_BATCH_MAX_ANGLES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tối đa {settings.SCRIPT_BATCH_MAX_ANGLES} angle mỗi request.",
+        )
+
+    script_inputs = None  # type: Optional[Dict[str, Any]]
+    if (script_inputs_json or "").strip():
+        try:
+            parsed = json.loads(script_inputs_json)
+            if isinstance(parsed, dict):
+                script_inputs = parsed
+        except json.JSONDecodeError:
+            script_inputs = None
+
+    model_name = getattr(settings, "GEMINI_MODEL_TEXT", DEFAULT_TEXT_MODEL)
+    # digest 1 lần cho cả lô; gemini_generate_script nhận lại digest nên không tính lại
+    # cache required inputs vẫn key theo report gốc (raw_report) -> khớp với precompute
+    raw_report = report
+    report, _ = await report_for_prompt(api_key=settings.GEMINI_API_KEY, report=raw_report, stage="script_batch")
+    try:
+        inputs_list, inputs_meta = await resolve_required_inputs_for_angles(
+            api_key=settings.GEMINI_API_KEY,
+            model_name=model_name,
+            report=raw_report,
+            prompt_report=report,
+            landing_analysis=landing_analysis,
+            angle_texts=[angle_context_text(a) for a in angles],
+            max_age_s=settings.SCRIPT_INPUTS_TTL_SEC,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=502, detail="Lỗi suy luận required inputs: {}".format(e))
+
+    async def _events():
+        t0 = time.perf_counter()
+        yield _ndjson({"event": "inputs", "angles": len(angles), **inputs_meta})
+        sem = asyncio.Semaphore(max(1, settings.SCRIPT_BATCH_CONCURRENCY))
+
+        async def _one(i: int) -> Dict[str, Any]:
+            angle = angles[i]
+            async with sem:
+                try:
+                    script_text, meta = await gemini_generate_script(
+                        api_key=settings.GEMINI_API_KEY,
+                        report=report,
+                        landing_analysis=landing_analysis,
+                        angle=angle,
+                        angles_text=angles_text or None,
+                        user_prompt=user_prompt,
+                        model_name=model_name,
+                        script_inputs=script_inputs,
+                        inferred_inputs=inputs_list[i],
+                        report_key=raw_report,
+                    )
+                except Exception as e:
+                    return {"event": "error", "index": i, "angle": angle["title"], "detail": "Lỗi sinh Script từ Gemini: {}".format(e)}
+            if script_text.strip().upper().startswith("ERROR:"):
+                return {"event": "error", "index": i, "angle": angle["title"], "detail": script_text.strip()}
+            return {"event": "script", "index": i, "angle": angle["title"], "script": script_text,
+                    "final_script_rows": extract_final_script_rows(script_text), "missing": meta.get("missing")}
+
+        tasks = [asyncio.create_task(_one(i)) for i in range(len(angles))]
+        failed = 0
+        try:
+            for fut in asyncio.as_completed(tasks):
+                ev = await fut
+                failed += ev["event"] == "error"
+                yield _ndjson(ev)
+        finally:
+            for t in tasks:
+                t.cancel()  # client ngắt kết nối -> không sinh script tiếp
+        yield _ndjson({
+            "event": "done",
+            "count": len(angles),
+            "failed": failed,
+            "dt_ms": int((time.perf_counter() - t0) * 1000),
+        })
+
+    return StreamingResponse(_events(), media_type="application/x-ndjson")
@@ -1,8 +1,26 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from app.api.http_client import get_http_client
 from app.core.config import get_settings
-from app.services.gemini import gemini_generate_shotlist_text, DEFAULT_TEXT_MODEL
+from app.core.store import content_key, store_get, store_put
+from app.core.netguard import UnsafeURLError
+from app.services.jobs import register_job_handler, submit_job, get_job, validate_webhook_url, JOB_QUEUED, JOB_RUNNING, JOB_FAILED
+from app.services.gemini import (
+    gemini_generate_shotlist_text,
+    gemini_generate_shotlist_stream,
+    heuristic_shotlist_draft,
+    shot_beat_from_cols,
+    SHOTLIST_FIELDS,
+    SHOTLIST_HEADER,
+    DEFAULT_TEXT_MODEL,
+)
+from app.services.tts import strip_sfx_from_vo, synthesize_voice
+import asyncio
+import json
+import re
+import time
 
 router = APIRouter()
 
@@ -15,58 +33,381 @@ class ShotBeat(BaseModel):
     pacing: str
     prompt: str
 
+class ScriptRow(BaseModel):
+    stage: str = ""
+    vo: str
+    visuals: str = ""
+
 class GenerateShotlistRequest(BaseModel):
     framework_analysis: str
     final_script: str
+    final_script_rows: Optional[List[ScriptRow]] = None  # từ /generate-script; không có -> parse từ final_script
     report: str = ""
     angle_title: str = ""
     angle_raw: str = ""
     extra_style_prompt: str = ""
     model_name: str = ""
+    draft: bool = False                 # true -> trả draft heuristic ngay, bản LLM chạy nền
+    webhook_url: str = ""               # draft=true: POST kết quả job khi bản LLM xong
+    # chỉ dùng cho /generate-shotlist/stream: TTS từng beat ngay khi parse xong
+    tts: bool = False
+    voice_id: Optional[str] = None
+    tts_model_id: Optional[str] = None
+    output_format: Optional[str] = None
 
 class GenerateShotlistResponse(BaseModel):
     step: str
     model: str
     shotlist_text: str
     beats: List[ShotBeat]
+    shotlist_id: Optional[str] = None
+    revision: int = 1                   # 0 = draft heuristic, 1 = bản LLM
+    status: str = "final"               # draft | final
+    job_id: Optional[str] = None
+    error: Optional[str] = None         # job LLM lỗi -> draft vẫn dùng được
+    fallback_chunks: int = 0            # số chunk LLM lỗi/rỗng phải dùng heuristic
 
-@router.post("/generate-shotlist", response_model=GenerateShotlistResponse)
-async def generate_shotlist_endpoint(payload: GenerateShotlistRequest, settings=Depends(get_settings)):
-    fa = (payload.framework_analysis or "").strip()
-    fs = (payload.final_script or "").strip()
-    if not fa:
-        raise HTTPException(status_code=400, detail="Thiếu framework_analysis.")
-    if not fs:
-        raise HTTPException(status_code=400, detail="Thiếu final_script.")
+# ---- Local helpers -----------------------------------------------------------
+_SHOTLIST_NS = "shotlists"
+_SHOTLIST_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+def _script_rows(payload: GenerateShotlistRequest) -> List[Dict[str, str]]:
+    return [r.model_dump() for r in payload.final_script_rows or []]
 
+def _shotlist_id(payload: GenerateShotlistRequest) -> str:
+    return content_key(
+        "shotlist",
+        payload.framework_analysis.strip(),
+        payload.final_script.strip(),
+        json.dumps(_script_rows(payload), ensure_ascii=False, sort_keys=True),
+        payload.extra_style_prompt,
+        payload.model_name,
+    )
+
+async def _run_shotlist(payload: GenerateShotlistRequest, settings, *, fallback: bool = True) -> Dict[str, str]:
+    """
+    Bản LLM. Trả {model, shotlist_text, fallback_chunks}.
+    fallback=True (draft=false, chờ đồng bộ): lỗi/rỗng -> heuristic, model="heuristic" (giữ hành vi cũ);
+    mọi chunk đều fallback cũng gắn model="heuristic".
+    fallback=False (job sau draft): lỗi/rỗng hoặc có chunk phải fallback heuristic -> raise;
+    draft heuristic đã có sẵn, không ghi đè thành "final".
+    """
+    fs = payload.final_script.strip()
     try:
         out = await gemini_generate_shotlist_text(
             api_key=settings.GEMINI_API_KEY,
-            framework_analysis=fa,
+            framework_analysis=payload.framework_analysis.strip(),
             final_script=fs,
             report=payload.report,
             angle_title=payload.angle_title,
             angle_raw=payload.angle_raw,
             extra_style_prompt=payload.extra_style_prompt,
             model_name=payload.model_name,
+            script_rows=_script_rows(payload),
+            allow_fallback=fallback,
         )
         text = out.get("shotlist_text") or ""
-        if not text.strip():
-            from app.services.gemini import _heuristic_tsv_from_script
-            text = _heuristic_tsv_from_script(fs)
-
-        return GenerateShotlistResponse(
-            step="shotlist_done",
-            model=out.get("model") or payload.model_name or DEFAULT_TEXT_MODEL,
-            shotlist_text=text,
-            beats=[],  # FE sẽ parse TSV
-        )
+        model = out.get("model") or payload.model_name or DEFAULT_TEXT_MODEL
+        n_fallback = int(out.get("fallback_chunks") or 0)
+        if n_fallback and n_fallback >= int(out.get("chunks") or 0):
+            model = "heuristic"
     except Exception:
-        from app.services.gemini import _heuristic_tsv_from_script
-        text = _heuristic_tsv_from_script(fs)
+        if not fallback:
+            raise
+        text, n_fallback = "", 0
+    if not text.strip():
+        if not fallback:
+            raise RuntimeError("Model trả shotlist rỗng.")
+        return {
+            "model": "heuristic",
+            "shotlist_text": heuristic_shotlist_draft(fs, _script_rows(payload)),
+            "fallback_chunks": max(n_fallback, 1),
+        }
+    return {"model": model, "shotlist_text": text, "fallback_chunks": n_fallback}
+
+def _revision_response(rec: Dict[str, Any]) -> GenerateShotlistResponse:
+    return GenerateShotlistResponse(
+        step="shotlist_done" if rec.get("status") == "final" else "shotlist_draft",
+        model=rec.get("model") or DEFAULT_TEXT_MODEL,
+        shotlist_text=rec.get("shotlist_text") or "",
+        beats=[],  # FE sẽ parse TSV
+        shotlist_id=rec.get("shotlist_id"),
+        revision=int(rec.get("revision") or 0),
+        status=rec.get("status") or "draft",
+        job_id=rec.get("job_id"),
+        error=rec.get("error"),
+    )
+
+# ---- Routes ------------------------------------------------------------------
+@router.post("/generate-shotlist", response_model=GenerateShotlistResponse)
+async def generate_shotlist_endpoint(payload: GenerateShotlistRequest, settings=Depends(get_settings)):
+    """
+    draft=false: chờ bản LLM như cũ.
+    draft=true : trả ngay shotlist heuristic (revision 0, status "draft"); bản LLM chạy
+    bằng job "shotlist_generate" và thay thế qua GET /shotlists/{shotlist_id} (+ webhook_url nếu có).
+    """
+    fa = (payload.framework_analysis or "").strip()
+    fs = (payload.final_script or "").strip()
+    if not fa:
+        raise HTTPException(status_code=400, detail="Thiếu framework_analysis.")
+    if not fs:
+        raise HTTPException(status_code=400, detail="Thiếu final_script.")
+
+    if not payload.draft:
+        out = await _run_shotlist(payload, settings)
         return GenerateShotlistResponse(
             step="shotlist_done",
-            model=payload.model_name or DEFAULT_TEXT_MODEL,
-            shotlist_text=text,
+            model=out["model"],
+            shotlist_text=out["shotlist_text"],
             beats=[],
+            fallback_chunks=out["fallback_chunks"],
         )
+
+    try:
+        webhook_url = await validate_webhook_url(payload.webhook_url)
+    except UnsafeURLError as e:
+        raise HTTPException(status_code=400, detail=f"webhook_url không hợp lệ: {e}")
+
+    shotlist_id = _shotlist_id(payload)
+    rec = store_get(_SHOTLIST_NS, shotlist_id, max_age_s=settings.SHOTLIST_TTL_SEC)
+    if rec and rec.get("status") == "final":
+        return _revision_response(rec)
+    if rec and rec.get("job_id"):
+        job = await asyncio.to_thread(get_job, rec["job_id"])
+        if job and job["status"] in (JOB_QUEUED, JOB_RUNNING):
+            return _revision_response(rec)
+
+    t0 = time.perf_counter()
+    draft_text = heuristic_shotlist_draft(fs, _script_rows(payload))
+    draft_ms = int((time.perf_counter() - t0) * 1000)
+    job = await asyncio.to_thread(
+        submit_job,
+        "shotlist_generate",
+        {"shotlist_id": shotlist_id, "request": payload.model_dump(exclude={"draft", "webhook_url"})},
+        webhook_url=webhook_url,
+        max_attempts=1,
+    )
+    rec = {
+        "shotlist_id": shotlist_id,
+        "revision": 0,
+        "status": "draft",
+        "model": "heuristic",
+        "shotlist_text": draft_text,
+        "job_id": job["id"],
+        "draft_ms": draft_ms,
+        "updated_at": time.time(),
+    }
+    store_put(_SHOTLIST_NS, shotlist_id, rec)
+    return _revision_response(rec)
+
+@register_job_handler("shotlist_generate")
+async def _shotlist_generate_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    settings = get_settings()
+    req = GenerateShotlistRequest(**payload["request"])
+    prev = store_get(_SHOTLIST_NS, payload["shotlist_id"]) or {}
+    try:
+        out = await _run_shotlist(req, settings, fallback=False)
+    except Exception as e:
+        # giữ draft (status "draft", revision 0) + ghi lỗi; raise để job thành failed
+        store_put(_SHOTLIST_NS, payload["shotlist_id"], {
+            **prev,
+            "shotlist_id": payload["shotlist_id"],
+            "error": f"{type(e).__name__}: {e}",
+            "updated_at": time.time(),
+        })
+        raise
+    rec = {
+        **prev,
+        "shotlist_id": payload["shotlist_id"],
+        "revision": int(prev.get("revision") or 0) + 1,
+        "status": "final",
+        "model": out["model"],
+        "shotlist_text": out["shotlist_text"],
+        "updated_at": time.time(),
+    }
+    store_put(_SHOTLIST_NS, payload["shotlist_id"], rec)
+    return _revision_response(rec).model_dump()
+
+@router.get("/shotlists/{shotlist_id}", response_model=GenerateShotlistResponse)
+async def get_shotlist_revision(shotlist_id: str, settings=Depends(get_settings)):
+    """Revision mới nhất (draft hoặc final) — FE poll tới khi status == "final"."""
+    if not _SHOTLIST_ID_RE.match(shotlist_id or ""):
+        raise HTTPException(status_code=400, detail="shotlist_id không hợp lệ.")
+    rec = store_get(_SHOTLIST_NS, shotlist_id, max_age_s=settings.SHOTLIST_TTL_SEC)
+    if not rec:
+        raise HTTPException(status_code=404, detail="Không tìm thấy shotlist.")
+    if rec.get("status") != "final" and rec.get("job_id"):
+        job = await asyncio.to_thread(get_job, rec["job_id"])
+        if job and job["status"] == JOB_FAILED:
+            rec = {**rec, "error": job.get("error")}
+    return _revision_response(rec)
+
+
+# ---- Streaming: /generate-shotlist/stream ------------------------------------
+def _ndjson(obj: Dict[str, Any]) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _beat_tsv(beat: Dict[str, str]) -> str:
+    return "\t".join(beat.get(k, "") for k in SHOTLIST_FIELDS)
+
+@router.post("/generate-shotlist/stream")
+async def generate_shotlist_stream_endpoint(payload: GenerateShotlistRequest, settings=Depends(get_settings)):
+    """
+    NDJSON: {"event":"beat","beat":ShotBeat} x N (theo thứ tự Beat #) -> {"event":"done"}.
+    Beat 1 được gửi ngay khi model sinh xong dòng đầu; FE có thể bắt đầu TTS/video cho beat đó.
+    Chunk lỗi giữa chừng -> {"event":"error","after_beat","detail"} đúng chỗ bị thiếu beat.
+    "done" có model ("heuristic" nếu không beat nào từ LLM) + fallback_chunks / errors.
+
+    tts=true: mỗi beat vừa parse được đưa vào hàng đợi TTS (giới hạn TTS_PIPELINE_QUEUE_SIZE,
+    TTS_PIPELINE_CONCURRENCY worker). Xen kẽ với event beat là {"event":"audio","beat","audio":TTSResponse}
+    hoặc {"event":"audio_error","beat","detail"}; "done" gửi sau khi mọi audio xong
+    -> tổng thời gian ~ max(shotlist, TTS) thay vì cộng dồn.
+    """
+    fa = (payload.framework_analysis or "").strip()
+    fs = (payload.final_script or "").strip()
+    if not fa:
+        raise HTTPException(status_code=400, detail="Thiếu framework_analysis.")
+    if not fs:
+        raise HTTPException(status_code=400, detail="Thiếu final_script.")
+    state: Dict[str, Any] = {
+        "lines": [SHOTLIST_HEADER],
+        "first_ms": None,
+        "t0": time.perf_counter(),
+        "stats": {},
+        "errors": 0,
+    }
+
+    def _chunk_errors():
+        errs = state["stats"].get("errors") or []
+        for err in errs[state["errors"]:]:
+            yield {"event": "error", **err}
+        state["errors"] = len(errs)
+
+    async def _beat_events():
+        lines = state["lines"]
+        try:
+            async for beat in gemini_generate_shotlist_stream(
+                api_key=settings.GEMINI_API_KEY,
+                framework_analysis=fa,
+                final_script=fs,
+                model_name=payload.model_name,
+                script_rows=_script_rows(payload),
+                stats=state["stats"],
+            ):
+                for ev in _chunk_errors():
+                    yield ev
+                if state["first_ms"] is None:
+                    state["first_ms"] = int((time.perf_counter() - state["t0"]) * 1000)
+                lines.append(_beat_tsv(beat))
+                yield {"event": "beat", "beat": ShotBeat(**beat).model_dump()}
+            for ev in _chunk_errors():
+                yield ev
+        except Exception as e:
+            state["errors"] += 1
+            yield {"event": "error", "after_beat": len(lines) - 1, "detail": str(e)}
+            if len(lines) > 1:
+                return
+            # chưa gửi beat nào -> fallback heuristic như /generate-shotlist
+            state["heuristic"] = True
+            for ln in heuristic_shotlist_draft(fs, _script_rows(payload)).splitlines()[1:]:
+                beat = shot_beat_from_cols(ln.split("\t"))
+                lines.append(_beat_tsv(beat))
+                yield {"event": "beat", "beat": ShotBeat(**beat).model_dump()}
+
+    def _model() -> str:
+        st = state["stats"]
+        n_fallback = int(st.get("fallback_chunks") or 0)
+        if state.get("heuristic") or (n_fallback and n_fallback >= int(st.get("chunks") or 0)):
+            return "heuristic"
+        return payload.model_name or DEFAULT_TEXT_MODEL
+
+    def _done(**extra: Any) -> bytes:
+        return _ndjson({
+            "event": "done",
+            "step": "shotlist_done",
+            "model": _model(),
+            "fallback_chunks": int(state["stats"].get("fallback_chunks") or 0),
+            "errors": state["errors"],
+            "beats": len(state["lines"]) - 1,
+            "first_beat_ms": state["first_ms"],
+            "dt_ms": int((time.perf_counter() - state["t0"]) * 1000),
+            "shotlist_text": "\n".join(state["lines"]),
+            **extra,
+        })
+
+    async def _events():
+        async for ev in _beat_events():
+            yield _ndjson(ev)
+        yield _done()
+
+    async def _events_with_tts():
+        n_workers = max(1, settings.TTS_PIPELINE_CONCURRENCY)
+        out_q: asyncio.Queue = asyncio.Queue()
+        tts_q: asyncio.Queue = asyncio.Queue(maxsize=max(1, settings.TTS_PIPELINE_QUEUE_SIZE))
+        client = get_http_client()
+        audio = {"ok": 0, "failed": 0, "skipped": 0}
+        shotlist_ms: Dict[str, Optional[int]] = {"v": None}
+
+        async def _producer():
+            try:
+                async for ev in _beat_events():
+                    await out_q.put(ev)
+                    if ev["event"] != "beat":
+                        continue
+                    if strip_sfx_from_vo(ev["beat"]["vo"]):
+                        await tts_q.put(ev["beat"])  # đầy -> chờ worker (backpressure)
+                    else:
+                        audio["skipped"] += 1
+            finally:
+                shotlist_ms["v"] = int((time.perf_counter() - state["t0"]) * 1000)
+            # chỉ đường bình thường: bị cancel (client ngắt) thì worker cũng bị cancel, không ai
+            # đọc tts_q nữa -> put vào queue đầy sẽ treo producer mãi
+            for _ in range(n_workers):
+                await tts_q.put(None)
+
+        async def _worker():
+            while True:
+                beat = await tts_q.get()
+                if beat is None:
+                    return
+                try:
+                    out = await synthesize_voice(
+                        text=beat["vo"],
+                        beat=beat["beat"],
+                        voice_id=payload.voice_id,
+                        model_id=payload.tts_model_id,
+                        output_format=payload.output_format,
+                        client=client,
+                    )
+                    audio["ok"] += 1
+                    await out_q.put({"event": "audio", "beat": beat["beat"], "audio": out})
+                except Exception as e:
+                    audio["failed"] += 1
+                    await out_q.put({"event": "audio_error", "beat": beat["beat"], "detail": str(e)})
+
+        async def _run():
+            tasks = [asyncio.create_task(_producer())] + [asyncio.create_task(_worker()) for _ in range(n_workers)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for t in tasks:
+                    t.cancel()  # 1 task lỗi -> gather không tự huỷ các task còn lại
+                await out_q.put(None)
+
+        runner = asyncio.create_task(_run())
+        try:
+            while True:
+                ev = await out_q.get()
+                if ev is None:
+                    break
+                yield _ndjson(ev)
+            await runner
+        finally:
+            if not runner.done():
+                runner.cancel()  # client ngắt kết nối -> dừng cả shotlist lẫn TTS
+        yield _done(audio=audio, shotlist_ms=shotlist_ms["v"])
+
+    return StreamingResponse(
+        _events_with_tts() if payload.tts else _events(),
+        media_type="application/x-ndjson",
+    )
@@ -1,13 +1,15 @@
-import os, time, re, io
-from pathlib import Path
-from typing import Optional, Dict, Any
+import asyncio, json, time
+from typing import Optional, Dict, Any, List, Awaitable, Callable
 
-import httpx
+import anyio
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from mutagen import File as MutagenFile
 
+from app.api.http_client import get_http_client
+from app.core import metrics
 from app.core.config import get_settings
+from app.services.tts import DEFAULT_OUTPUT_FORMAT, TTSError, open_voice_stream, synthesize_voice
 
 router = APIRouter()
 
@@ -18,7 +20,7 @@ class TTSRequest(BaseModel):
     style_hints: Optional[Dict[str, Any]] = None  # { pacing, annotation, primary_ost }
     voice_id: Optional[str] = None
     model_id: Optional[str] = None
-    output_format: Optional[str] = "mp3_44100_128"
+    output_format: Optional[str] = DEFAULT_OUTPUT_FORMAT
     stability: Optional[float] = None
     similarity_boost: Optional[float] = None
     style: Optional[float] = None
@@ -33,120 +35,158 @@ class TTSResponse(BaseModel):
     duration_seconds: Optional[float] = None
     sample_rate_hz: Optional[int] = None
 
-# ---- Local helpers -----------------------------------------------------------
-def _safe_text(s: str) -> str:
-    return (s or "").strip()
-
-def _strip_sfx_from_vo(vo: str) -> str:
-    if not vo:
-        return vo
-    patterns = [
-        r"\[sfx:[^\]]*\]", r"\(sfx:[^\)]*\)", r"\{sfx:[^\}]*\}",
-        r"\[fx:[^\]]*\]",  r"\(fx:[^\)]*\)",  r"\{fx:[^\}]*\}",
-        r"\[sound:[^\]]*\]", r"\(sound:[^\)]*\)", r"\{sound:[^\}]*\}",
-    ]
-    out = vo
-    for p in patterns:
-        out = re.sub(p, "", out, flags=re.IGNORECASE)
-    out = re.sub(r"\s{2,}", " ", out).strip()
-    return out
-
-def _probe_mp3_duration_seconds(raw: bytes) -> Optional[float]:
-    try:
-        f = MutagenFile(io.BytesIO(raw))
-        if f and getattr(f, "info", None):
-            return float(f.info.length)
-    except Exception:
-        pass
-    return None
-
-def _sample_rate_from_output_format(output_format: str) -> Optional[int]:
-    m = re.search(r"mp3_(\d{4,6})_", output_format or "")
-    return int(m.group(1)) if m else None
-
-def _ensure_dir(path: Path) -> Path:
-    if path.exists() and not path.is_dir():
-        raise NotADirectoryError("Path exists and is not a directory: {}".format(path))
-    path.mkdir(parents=True, exist_ok=True)
-    return path
-
-# ---- Route -------------------------------------------------------------------
-@router.post("/generate-voice", response_model=TTSResponse)
-async def generate_voice(payload: TTSRequest, settings=Depends(get_settings)):
-    api_key = getattr(settings, "ELEVENLABS_API_KEY", None) or os.getenv("ELEVENLABS_API_KEY")
-    if not api_key:
-        raise HTTPException(status_code=500, detail="Missing ELEVENLABS_API_KEY (server config).")
-
-    raw_vo = _safe_text(payload.text)
-    if not raw_vo:
-        raise HTTPException(status_code=400, detail="Thiếu text.")
-    if len(raw_vo) > 2500:
-        raise HTTPException(status_code=413, detail="Text quá dài cho 1 beat (tối đa ~2500 ký tự). Hãy chia nhỏ.")
-
-    tts_text = _strip_sfx_from_vo(raw_vo)
-
-    voice_id = payload.voice_id or getattr(settings, "ELEVENLABS_VOICE_ID", "cgSgspJ2msm6clMCkdW9")
-    model_id = payload.model_id or getattr(settings, "ELEVENLABS_MODEL_ID", "eleven_multilingual_v2")
-    output_format = payload.output_format or "mp3_44100_128"
-
-    vs = {
-        "stability": payload.stability if payload.stability is not None else 0.5,
-        "similarity_boost": payload.similarity_boost if payload.similarity_boost is not None else 0.7,
-        "style": payload.style if payload.style is not None else 0.2,
-        "use_speaker_boost": True if payload.use_speaker_boost is None else bool(payload.use_speaker_boost),
-    }
+class TTSStreamRequest(TTSRequest):
+    optimize_streaming_latency: Optional[int] = None  # 0..4; None -> ELEVENLABS_STREAM_LATENCY
 
-    tts_url = "https://api.elevenlabs.io/v1/text-to-speech/{}".format(voice_id)
-    headers = {
-        "accept": "audio/mpeg",
-        "content-type": "application/json",
-        "xi-api-key": api_key,
-    }
-    params = {"optimize_streaming_latency": 0, "output_format": output_format}
-    body = {"text": tts_text, "model_id": model_id, "voice_settings": vs}
+class TTSBatchRequest(BaseModel):
+    items: List[TTSRequest]
+    stream: bool = False                # true -> NDJSON, mỗi beat 1 dòng ngay khi xong
 
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            resp = await client.post(tts_url, headers=headers, params=params, json=body)
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=502, detail="Không gọi được ElevenLabs: {}".format(e))
+class TTSBatchItem(BaseModel):
+    index: int                          # vị trí trong items
+    beat: Optional[str] = None
+    ok: bool
+    result: Optional[TTSResponse] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None   # như HTTPException của /generate-voice
+
+class TTSBatchResponse(BaseModel):
+    step: str
+    items: List[TTSBatchItem]
+    ok: int
+    failed: int
+    dt_ms: int
+
+# ---- Local helpers -----------------------------------------------------------
+class _ReleasingStreamingResponse(StreamingResponse):
+    """
+    Gọi release() khi response kết thúc theo mọi đường: stream xong, client ngắt trước khi
+    body được đọc (generator chưa chạy nên finally của nó không bao giờ chạy), lỗi/cancel.
+    """
 
-    if resp.status_code >= 400:
+    def __init__(self, content, *, release: Callable[[], Awaitable[None]], **kw: Any):
+        super().__init__(content, **kw)
+        self._release = release
+
+    async def __call__(self, scope, receive, send) -> None:
         try:
-            err_detail = resp.json()
-        except Exception:
-            err_detail = resp.text
-        raise HTTPException(status_code=502, detail="ElevenLabs error: {}".format(err_detail))
-
-    audio_bytes = resp.content
-    if not audio_bytes:
-        raise HTTPException(status_code=502, detail="ElevenLabs trả về rỗng.")
-
-    duration_seconds = _probe_mp3_duration_seconds(audio_bytes)
-    sample_rate_hz = _sample_rate_from_output_format(output_format)
-
-    static_dir = Path(getattr(settings, "STATIC_DIR", "static"))
-    out_dir = static_dir / "tts"
-    _ensure_dir(out_dir)
-
-    filename = "{}-{}-{}.mp3".format(
-        int(time.time() * 1000),
-        (payload.beat or "beat").replace("/", "-").replace(" ", ""),
-        os.urandom(4).hex(),
-    )
-    out_path = out_dir / filename
-    out_path.write_bytes(audio_bytes)
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self._release()
 
-    base_url = getattr(settings, "PUBLIC_BASE_URL", None) or os.getenv("PUBLIC_BASE_URL")
-    rel_path = "/api/static/tts/{}".format(filename)
-    audio_url = (base_url.rstrip("/") + rel_path) if base_url else rel_path
+def _ndjson(obj: Dict[str, Any]) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
 
-    return TTSResponse(
-        audio_url=audio_url,
+async def _synthesize(payload: TTSRequest, client=None) -> TTSResponse:
+    out = await synthesize_voice(
+        text=payload.text,
         beat=payload.beat,
-        voice_id=voice_id,
-        model_id=model_id,
-        bytes=len(audio_bytes),
-        duration_seconds=duration_seconds,
-        sample_rate_hz=sample_rate_hz,
+        voice_id=payload.voice_id,
+        model_id=payload.model_id,
+        output_format=payload.output_format,
+        stability=payload.stability,
+        similarity_boost=payload.similarity_boost,
+        style=payload.style,
+        use_speaker_boost=payload.use_speaker_boost,
+        client=client,
     )
+    return TTSResponse(**out)
+
+async def _batch_item(index: int, payload: TTSRequest, client) -> TTSBatchItem:
+    """Lỗi của 1 beat không làm hỏng cả batch."""
+    try:
+        res = await _synthesize(payload, client=client)
+        return TTSBatchItem(index=index, beat=payload.beat, ok=True, result=res)
+    except TTSError as e:
+        return TTSBatchItem(index=index, beat=payload.beat, ok=False, error=str(e), status_code=e.status_code)
+    except Exception as e:
+        return TTSBatchItem(index=index, beat=payload.beat, ok=False, error=f"{type(e).__name__}: {e}", status_code=502)
+
+# ---- Routes ------------------------------------------------------------------
+@router.post("/generate-voice", response_model=TTSResponse)
+async def generate_voice(payload: TTSRequest):
+    try:
+        return await _synthesize(payload)
+    except TTSError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@router.post("/generate-voice/stream")
+async def generate_voice_stream(payload: TTSStreamRequest):
+    """
+    audio/mpeg forward từng chunk từ endpoint stream của ElevenLabs (phát được sau vài trăm ms).
+    Header: X-Audio-Url (file mp3 cố định sau khi stream xong), X-Audio-Meta-Url (JSON có
+    duration_seconds / sample_rate_hz, sẵn sàng khi stream xong), X-TTS-Cache: hit | miss.
+    """
+    try:
+        info, body, release = await open_voice_stream(
+            text=payload.text,
+            client=get_http_client(),
+            beat=payload.beat,
+            voice_id=payload.voice_id,
+            model_id=payload.model_id,
+            output_format=payload.output_format,
+            stability=payload.stability,
+            similarity_boost=payload.similarity_boost,
+            style=payload.style,
+            use_speaker_boost=payload.use_speaker_boost,
+            optimize_streaming_latency=payload.optimize_streaming_latency,
+        )
+    except TTSError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    headers = {
+        "X-Audio-Url": info["audio_url"],
+        "X-Audio-Meta-Url": info["meta_url"],
+        "X-TTS-Cache": "hit" if info["cached"] else "miss",
+        "Cache-Control": "no-store",
+    }
+    return _ReleasingStreamingResponse(body, release=release, media_type="audio/mpeg", headers=headers)
+
+@router.post("/generate-voice/batch", response_model=TTSBatchResponse)
+async def generate_voice_batch(payload: TTSBatchRequest, settings=Depends(get_settings)):
+    """
+    TTS cả shotlist trong 1 request, qua client pool dùng chung (keep-alive, không TLS handshake
+    mỗi beat). Số call ElevenLabs đồng thời bị chặn bởi ELEVENLABS_MAX_CONCURRENCY.
+    stream=false: trả đủ items theo thứ tự index.
+    stream=true : NDJSON {"event":"voice", ...TTSBatchItem} theo thứ tự xong -> {"event":"done"}.
+    """
+    if not payload.items:
+        raise HTTPException(status_code=400, detail="Thiếu items.")
+    if len(payload.items) > settings.TTS_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Tối đa {settings.TTS_BATCH_MAX_ITEMS} beat / batch.")
+
+    client = get_http_client()
+    t0 = time.perf_counter()
+    metrics.incr("tts.batch.items", len(payload.items))
+
+    if not payload.stream:
+        items = await asyncio.gather(*[_batch_item(i, it, client) for i, it in enumerate(payload.items)])
+        n_ok = sum(1 for x in items if x.ok)
+        return TTSBatchResponse(
+            step="tts_batch_done",
+            items=items,
+            ok=n_ok,
+            failed=len(items) - n_ok,
+            dt_ms=int((time.perf_counter() - t0) * 1000),
+        )
+
+    async def _events():
+        tasks = [asyncio.create_task(_batch_item(i, it, client)) for i, it in enumerate(payload.items)]
+        n_ok = 0
+        try:
+            for fut in asyncio.as_completed(tasks):
+                item = await fut
+                n_ok += int(item.ok)
+                yield _ndjson({"event": "voice", **item.model_dump()})
+        finally:
+            for t in tasks:
+                t.cancel()  # client ngắt kết nối -> không synth tiếp
+        yield _ndjson({
+            "event": "done",
+            "step": "tts_batch_done",
+            "ok": n_ok,
+            "failed": len(tasks) - n_ok,
+            "dt_ms": int((time.perf_counter() - t0) * 1000),
+        })
+
+    return StreamingResponse(_events(), media_type="application/x-ndjson")
@@ -1,13 +1,19 @@
-import asyncio, os, time, tempfile, re
+import asyncio, json, os, time, tempfile, re
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Any, Dict, List, Optional
 
 import httpx
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, HttpUrl
 
+from app.api.http_client import get_http_client
+from app.core import metrics
 from app.core.config import get_settings
+from app.core.store import content_key, store_get, store_put
 from app.services.gemini import generate_video_fast
+from app.core.netguard import UnsafeURLError
+from app.services.jobs import register_job_handler, submit_job, public_job, validate_webhook_url
+from app.services.tts import resolve_voice_params, strip_sfx_from_vo, synthesize_voice, tts_cache_key, tts_file_path
 
 router = APIRouter()
 USE_GENAI_SDK = True
@@ -34,6 +40,9 @@ class VideoReq(BaseModel):
     seed: Optional[int] = None
     model_name: Optional[str] = None
 
+class VideoJobReq(VideoReq):
+    webhook_url: Optional[HttpUrl] = None
+
 class VideoResp(BaseModel):
     step: str
     model: str
@@ -64,19 +73,7 @@ async def _download_temp(url: str, suffix: str = ".mp3") -> Optional[Path]:
     except Exception:
         return None
 
-# ---- Route -------------------------------------------------------------------
-@router.post("/generate-video", response_model=VideoResp)
-async def generate_video_google(payload: VideoReq, settings=Depends(get_settings)):
-    if not (payload.prompt or "").strip():
-        raise HTTPException(status_code=400, detail="Thiếu prompt.")
-
-    # 1) Tên file out
-    prefix = _slugify(payload.beat or "veo3")
-    ts = int(time.time() * 1000)
-    name = f"{prefix}-{ts}.mp4"
-    out_path: Path = settings.static_file_path("video", filename=name)
-
-    # 2) Build constraint cho prompt
+def _constraint_lines(payload: VideoReq) -> List[str]:
     c_lines = []
     if payload.aspect_ratio in {"9:16", "16:9", "1:1"}:
         c_lines.append(f"Aspect ratio: {payload.aspect_ratio}")
@@ -90,13 +87,33 @@ async def generate_video_google(payload: VideoReq, settings=Depends(get_settings
         c_lines.append(f"Pacing note: {payload.pacing}")
     if payload.annotation:
         c_lines.append(f"Annotation: {payload.annotation}")
+    return c_lines
+
+async def _checked_webhook(url: Optional[HttpUrl]) -> Optional[str]:
+    try:
+        return await validate_webhook_url(str(url) if url else None)
+    except UnsafeURLError as e:
+        raise HTTPException(status_code=400, detail=f"webhook_url không hợp lệ: {e}")
+
+# ---- Core flow ---------------------------------------------------------------
+async def _run_generate_video(payload: VideoReq, settings, audio_path: Optional[Path] = None) -> VideoResp:
+    """audio_path: file VO local (vd. static/tts/*.mp3) -> dùng trực tiếp, không tải lại qua vo_url."""
+    # 1) Tên file out
+    prefix = _slugify(payload.beat or "veo3")
+    ts = int(time.time() * 1000)
+    name = f"{prefix}-{ts}.mp4"
+    out_path: Path = settings.static_file_path("video", filename=name)
+
+    # 2) Build constraint cho prompt
+    c_lines = _constraint_lines(payload)
 
     final_prompt = _constraint_block(*c_lines) + payload.prompt.strip()
 
     # 3) (tuỳ chọn) tải VO về file tạm
     audio_tmp: Optional[Path] = None
-    if payload.vo_url:
+    if payload.vo_url and audio_path is None:
         audio_tmp = await _download_temp(str(payload.vo_url), suffix=".mp3")
+    audio_in = audio_path or audio_tmp
 
     # 4) Gọi SDK trong thread (generate_video_fast dùng sleep – tránh block loop)
     if not USE_GENAI_SDK:
@@ -112,7 +129,7 @@ async def generate_video_google(payload: VideoReq, settings=Depends(get_settings
             generate_video_fast,
             prompt=final_prompt,
             out_path=str(out_path),
-            audio_path=str(audio_tmp) if audio_tmp else None,
+            audio_path=str(audio_in) if audio_in else None,
             aspect_ratio=payload.aspect_ratio or "9:16",
             model=payload.model_name or "veo-3.0-fast-generate-001",
             resolution=(payload.resolution or "720p"),
@@ -151,3 +168,248 @@ async def generate_video_google(payload: VideoReq, settings=Depends(get_settings
         file=name,
         meta=meta,
     )
+
+# ---- Routes ------------------------------------------------------------------
+@router.post("/generate-video", response_model=VideoResp)
+async def generate_video_google(payload: VideoReq, settings=Depends(get_settings)):
+    if not (payload.prompt or "").strip():
+        raise HTTPException(status_code=400, detail="Thiếu prompt.")
+    return await _run_generate_video(payload, settings)
+
+@router.post("/jobs/generate-video", status_code=202)
+async def generate_video_job(payload: VideoJobReq):
+    """
+    Bản async của /generate-video (Veo có thể poll tới 15 phút): trả job_id ngay.
+    """
+    if not (payload.prompt or "").strip():
+        raise HTTPException(status_code=400, detail="Thiếu prompt.")
+    webhook_url = await _checked_webhook(payload.webhook_url)
+    body = payload.model_dump(mode="json", exclude={"webhook_url"})
+    # mỗi lần chạy tạo 1 operation Veo (tính tiền) -> worker chết giữa chừng thì fail, không chạy lại
+    job = await asyncio.to_thread(
+        submit_job,
+        "generate_video",
+        body,
+        webhook_url=webhook_url,
+        max_attempts=1,
+    )
+    return public_job(job)
+
+@register_job_handler("generate_video")
+async def _generate_video_job_handler(payload: Dict) -> Dict:
+    res = await _run_generate_video(VideoReq(**payload), get_settings())
+    return res.model_dump()
+
+
+# ---- Render shotlist: chỉ render lại beat có input đổi --------------------------
+# Mỗi artifact (mp3 TTS, clip Veo đã mux VO) lưu trong store "beat_renders" theo hash
+# input sinh ra nó:
+#   tts_hash   = text VO (đã bỏ SFX) + voice_id/model_id/output_format/voice_settings
+#   video_hash = tts_hash + prompt + constraint + aspect/resolution/seed/model
+# -> sửa VO: render lại TTS + video của beat đó; sửa prompt: chỉ video; beat khác dùng lại.
+# Job đang chạy lưu trong "beat_render_jobs" theo hash của plan -> request trùng dùng lại job đó.
+_BEAT_RENDER_NS = "beat_renders"
+_DEFAULT_VEO_MODEL = "veo-3.0-fast-generate-001"
+
+class RenderBeat(BaseModel):
+    beat: str
+    vo: str = ""
+    primary_ost: str = ""
+    annotation: str = ""
+    pacing: str = ""
+    prompt: str = ""
+    duration_seconds: Optional[int] = None
+
+class RenderShotlistReq(BaseModel):
+    beats: List[RenderBeat]
+    video: bool = True                     # false -> chỉ TTS
+    # voice
+    voice_id: Optional[str] = None
+    model_id: Optional[str] = None
+    output_format: Optional[str] = None
+    stability: Optional[float] = None
+    similarity_boost: Optional[float] = None
+    style: Optional[float] = None
+    use_speaker_boost: Optional[bool] = None
+    # video
+    aspect_ratio: Optional[str] = "9:16"
+    resolution: Optional[str] = "720p"
+    seed: Optional[int] = None
+    model_name: Optional[str] = None
+    webhook_url: Optional[HttpUrl] = None
+
+class RenderBeatResp(BaseModel):
+    beat: str
+    status: str                            # cached | pending | done | failed
+    tts_hash: Optional[str] = None         # None = VO rỗng / chỉ có SFX
+    video_hash: Optional[str] = None       # None = không render video (video=false / thiếu prompt)
+    tts: Optional[Dict[str, Any]] = None
+    video: Optional[Dict[str, Any]] = None
+    reused: List[str] = []                 # artifact lấy lại từ lần render trước: "tts" / "video"
+    error: Optional[str] = None
+
+class RenderShotlistResp(BaseModel):
+    step: str
+    status: str                            # done | rendering
+    job_id: Optional[str] = None
+    beats: List[RenderBeatResp]
+    reused: int                            # số beat không cần render lại
+    changed: int
+
+def _voice_kwargs(req: RenderShotlistReq) -> Dict[str, Any]:
+    return {
+        "voice_id": req.voice_id,
+        "model_id": req.model_id,
+        "output_format": req.output_format,
+        "stability": req.stability,
+        "similarity_boost": req.similarity_boost,
+        "style": req.style,
+        "use_speaker_boost": req.use_speaker_boost,
+    }
+
+def _beat_video_req(req: RenderShotlistReq, b: RenderBeat) -> VideoReq:
+    return VideoReq(
+        prompt=b.prompt,
+        beat=b.beat,
+        vo_text=b.vo,
+        duration_seconds=b.duration_seconds,
+        overlay_text=b.primary_ost or None,
+        annotation=b.annotation or None,
+        pacing=b.pacing or None,
+        aspect_ratio=req.aspect_ratio,
+        resolution=req.resolution,
+        seed=req.seed,
+        model_name=req.model_name,
+    )
+
+def _artifact(key: Optional[str], settings) -> Optional[Dict[str, Any]]:
+    """Artifact đã render cho hash này, chỉ khi file static vẫn còn."""
+    if not key:
+        return None
+    rec = store_get(_BEAT_RENDER_NS, key, max_age_s=settings.BEAT_RENDER_TTL_SEC)
+    if not rec or not rec.get("file"):
+        return None
+    if not (Path(settings.STATIC_DIR) / rec.get("dir", "") / rec["file"]).is_file():
+        return None
+    return rec
+
+def _plan_render(req: RenderShotlistReq, settings) -> List[Dict[str, Any]]:
+    vp = resolve_voice_params(**_voice_kwargs(req))
+    plan = []
+    for b in req.beats:
+        tts_text = strip_sfx_from_vo(b.vo.strip())
+        tts_hash = tts_cache_key(tts_text, vp) if tts_text else None
+        video_hash = None
+        vreq = None
+        if req.video and b.prompt.strip():
+            vreq = _beat_video_req(req, b)
+            video_hash = content_key(
+                "beat_video",
+                tts_hash or "",
+                vreq.prompt.strip(),
+                json.dumps(_constraint_lines(vreq), ensure_ascii=False),
+                vreq.aspect_ratio or "9:16",
+                vreq.resolution or "720p",
+                vreq.seed,
+                vreq.model_name or _DEFAULT_VEO_MODEL,
+            )
+        tts = _artifact(tts_hash, settings)
+        video = _artifact(video_hash, settings)
+        plan.append({
+            "beat": b,
+            "vreq": vreq,
+            "resp": RenderBeatResp(
+                beat=b.beat,
+                status="pending",
+                tts_hash=tts_hash,
+                video_hash=video_hash,
+                tts=tts,
+                video=video,
+                reused=[k for k, v in (("tts", tts), ("video", video)) if v],
+            ),
+        })
+    for item in plan:
+        r = item["resp"]
+        if (r.tts_hash is None or r.tts) and (r.video_hash is None or r.video):
+            r.status = "cached"
+    return plan
+
+async def _render_beat(item: Dict[str, Any], req: RenderShotlistReq, settings, tts_sem, video_sem) -> None:
+    b: RenderBeat = item["beat"]
+    r: RenderBeatResp = item["resp"]
+    try:
+        if r.tts_hash and not r.tts:
+            async with tts_sem:
+                out = await synthesize_voice(text=b.vo, beat=b.beat, client=get_http_client(), **_voice_kwargs(req))
+            r.tts = {**out, "dir": "tts", "file": tts_file_path(out["audio_url"]).name, "hash": r.tts_hash}
+            store_put(_BEAT_RENDER_NS, r.tts_hash, r.tts)
+        if r.video_hash and not r.video:
+            audio_path = tts_file_path(r.tts["audio_url"]) if r.tts else None
+            async with video_sem:
+                res = await _run_generate_video(item["vreq"], settings, audio_path=audio_path)
+            r.video = {**res.model_dump(), "dir": "video", "hash": r.video_hash}
+            store_put(_BEAT_RENDER_NS, r.video_hash, r.video)
+        r.status = "done"
+    except Exception as e:
+        r.status = "failed"
+        r.error = str(getattr(e, "detail", None) or e)
+
+def _render_plan_key(plan: List[Dict[str, Any]]) -> str:
+    return content_key("render_plan", json.dumps(
+        [[item["resp"].beat, item["resp"].tts_hash, item["resp"].video_hash] for item in plan],
+        ensure_ascii=False,
+    ))
+
+def _render_response(plan: List[Dict[str, Any]], job_id: Optional[str] = None) -> RenderShotlistResp:
+    beats = [item["resp"] for item in plan]
+    pending = any(r.status == "pending" for r in beats)
+    return RenderShotlistResp(
+        step="render_pending" if pending else "render_done",
+        status="rendering" if pending else "done",
+        job_id=job_id,
+        beats=beats,
+        reused=sum(1 for r in beats if r.status == "cached"),
+        changed=sum(1 for r in beats if r.status != "cached"),
+    )
+
+@router.post("/render-shotlist", response_model=RenderShotlistResp)
+async def render_shotlist(payload: RenderShotlistReq, settings=Depends(get_settings)):
+    """
+    Trả ngay artifact của mọi beat có input không đổi (status "cached").
+    Beat đổi -> 1 job "render_shotlist" chỉ render các beat đó; FE poll /jobs/{job_id}/result
+    (cùng shape, status "done") hoặc nhận qua webhook_url.
+    """
+    if not payload.beats:
+        raise HTTPException(status_code=400, detail="Thiếu beats.")
+    plan = _plan_render(payload, settings)
+    resp = _render_response(plan)
+    metrics.incr("render.beats_reused", resp.reused)
+    metrics.incr("render.beats_changed", resp.changed)
+    if resp.status == "done":
+        return resp
+
+    webhook_url = await _checked_webhook(payload.webhook_url)
+    # cùng plan đang có job queued/running (ở bất kỳ worker nào) -> job store trả lại job đó
+    job = await asyncio.to_thread(
+        submit_job,
+        "render_shotlist",
+        payload.model_dump(mode="json", exclude={"webhook_url"}),
+        webhook_url=webhook_url,
+        max_attempts=1,
+        dedupe_key=_render_plan_key(plan),
+    )
+    return _render_response(plan, job_id=job["id"])
+
+@register_job_handler("render_shotlist")
+async def _render_shotlist_job_handler(payload: Dict) -> Dict:
+    settings = get_settings()
+    req = RenderShotlistReq(**payload)
+    # lập lại plan: beat đã được job khác render trong lúc chờ sẽ thành "cached"
+    plan = _plan_render(req, settings)
+    tts_sem = asyncio.Semaphore(max(1, settings.TTS_PIPELINE_CONCURRENCY))
+    video_sem = asyncio.Semaphore(max(1, settings.RENDER_VIDEO_CONCURRENCY))
+    await asyncio.gather(*[
+        _render_beat(item, req, settings, tts_sem, video_sem)
+        for item in plan if item["resp"].status == "pending"
+    ])
+    return _render_response(plan).model_dump()
@@ -23,11 +23,13 @@ class Settings(BaseSettings):
     UPLOAD_DIR: Path = Path("uploads")
     STATIC_DIR: Path = Path(os.getenv("STATIC_DIR", str(BASE_DIR / "static"))).resolve()
     STATIC_URL_PREFIX: str = os.getenv("STATIC_URL_PREFIX", "/static")
+    DATA_DIR: Path = Path(os.getenv("DATA_DIR", str(BASE_DIR / "data"))).resolve()
 
 
     MAX_UPLOAD_SIZE_MB: int = 1024
     N8N_TIMEOUT_SEC: int = 120
     OUTBOUND_TIMEOUT_SEC: int = 90
+    OUTBOUND_ALLOW_PRIVATE: bool = False         # true: cho fetch/webhook tới IP nội bộ (chỉ dev/test)
 
     # --- CORS ---
     CORS_ORIGINS: List[str] = ["*"]
@@ -70,6 +72,75 @@ class Settings(BaseSettings):
 
     # --- ElevenLabs ---
     ELEVENLABS_API_KEY: str = ""
+    ELEVENLABS_MAX_CONCURRENCY: int = 3          # request TTS đồng thời / worker (theo giới hạn plan ElevenLabs)
+    ELEVENLABS_STREAM_LATENCY: int = 3           # /generate-voice/stream: optimize_streaming_latency mặc định (0..4)
+    TTS_BATCH_MAX_ITEMS: int = 200
+    TTS_STATIC_QUOTA_MB: int = 2048              # static/tts (cache theo nội dung) vượt quota -> xoá file cũ nhất
+    TTS_QUOTA_SWEEP_SEC: float = 60.0            # quét quota tối đa 1 lần / khoảng này
+    TTS_PIPELINE_CONCURRENCY: int = 3            # /generate-shotlist/stream tts=true: số request TTS song song
+    TTS_PIPELINE_QUEUE_SIZE: int = 8             # beat chờ TTS tối đa trước khi chặn producer
+
+    # --- Cache kết quả ---
+    REPORT_CACHE_ENABLED: bool = True
+    REPORT_CACHE_TTL_SEC: int = 30 * 24 * 3600
+
+    # --- Report digest (tóm tắt có cấu trúc thay report đầy đủ cho script/infer) ---
+    REPORT_DIGEST_ENABLED: bool = True
+    REPORT_DIGEST_MIN_CHARS: int = 6000          # report ngắn hơn -> dùng nguyên văn
+    REPORT_DIGEST_TTL_SEC: int = 30 * 24 * 3600
+    REPORT_DIGEST_FAIL_TTL_SEC: int = 15 * 60    # digest lỗi -> không gọi lại model trong khoảng này
+
+    # --- Report mode "keyframes" ---
+    KEYFRAME_SAMPLE_FPS: float = 4.0             # fps khi decode low-res để dò cut
+    KEYFRAME_MAX: int = 24                       # số keyframe tối đa gửi cho model
+    KEYFRAME_WIDTH: int = 512
+
+    # --- Video dài: transcript theo cửa sổ thời gian (map-reduce) ---
+    REPORT_SEGMENT_THRESHOLD_SEC: float = 240.0  # dài hơn ngưỡng này mới cắt
+    REPORT_SEGMENT_WINDOW_SEC: float = 90.0
+    REPORT_SEGMENT_CONCURRENCY: int = 4
+    REPORT_TRANSCRIPT_MAX_CHARS: int = 120000    # transcript ghép không bị cắt giữa như _truncate(16000)
+
+    # --- Landing page fetch ---
+    LANDING_FETCH_TIMEOUT_SEC: float = 15.0
+    LANDING_MAX_BYTES: int = 3 * 1024 * 1024     # cắt response HTML quá lớn
+    LANDING_MAX_TEXT_CHARS: int = 60000
+    LANDING_CACHE_FRESH_SEC: int = 600           # trong khoảng này dùng cache, không revalidate
+    LANDING_CACHE_TTL_SEC: int = 7 * 24 * 3600
+    LANDING_MAP_THRESHOLD_CHARS: int = 40000     # input lớn hơn -> map-reduce theo chunk trước PROMPT1
+    LANDING_MAP_CHUNK_CHARS: int = 20000
+    LANDING_DEDUPE_ENABLED: bool = True          # gộp comment trùng/gần trùng trước PROMPT1
+    LANDING_DEDUPE_THRESHOLD: float = 0.7        # Jaccard (MinHash) tối thiểu để coi là gần trùng
+    LANDING_PHASE1_TTL_SEC: int = 7 * 24 * 3600  # cache output PROMPT1 cho regenerateAngles
+    LANDING_ANGLES_STRUCTURED: bool = False      # PROMPT2 trả JSON theo response_schema thay vì TSV/markdown
+
+    # --- Script: precompute required inputs cho mọi angle sau landing analysis ---
+    SCRIPT_INPUTS_PRECOMPUTE: bool = True
+    SCRIPT_INPUTS_TTL_SEC: int = 7 * 24 * 3600
+    SCRIPT_BATCH_CONCURRENCY: int = 3            # /generate-scripts: số script sinh song song
+    SCRIPT_BATCH_MAX_ANGLES: int = 8
+    SCRIPT_MAX_CANDIDATES: int = 4               # /generate-script candidates=N
+
+    # --- Shotlist: draft heuristic + revision LLM ---
+    SHOTLIST_TTL_SEC: int = 7 * 24 * 3600
+
+    # --- Render shotlist theo beat (chỉ render lại beat có input đổi) ---
+    BEAT_RENDER_TTL_SEC: int = 30 * 24 * 3600
+    RENDER_VIDEO_CONCURRENCY: int = 2            # số clip Veo render song song trong 1 job
+
+    # --- Retry outbound (Gemini / ElevenLabs / Veo / n8n) ---
+    RETRY_MAX_ATTEMPTS: int = 4
+    RETRY_BASE_SEC: float = 0.5
+    RETRY_CAP_SEC: float = 20.0                  # trần 1 lần chờ (decorrelated jitter)
+    RETRY_DEADLINE_SEC: float = 90.0             # ngân sách tổng cho mọi lần thử
+
+    # --- Job queue (SQLite WAL) ---
+    JOBS_DB_PATH: Optional[Path] = None          # mặc định DATA_DIR/jobs.sqlite3
+    JOB_WORKER_CONCURRENCY: int = 2              # số job chạy song song / worker
+    JOB_POLL_INTERVAL_SEC: float = 1.0
+    JOB_LEASE_SEC: int = 120                     # hết lease mà không heartbeat -> worker khác nhận lại
+    JOB_MAX_ATTEMPTS: int = 2
+    JOB_WEBHOOK_TIMEOUT_SEC: float = 10.0
 
     # ================= Helpers =================
     def base_url_str(self) -> str:
@@ -118,11 +189,15 @@ class Settings(BaseSettings):
         p.mkdir(parents=True, exist_ok=True)
         return p / filename if filename else p
 
+    def jobs_db_path(self) -> Path:
+        return Path(self.JOBS_DB_PATH) if self.JOBS_DB_PATH else self.DATA_DIR / "jobs.sqlite3"
+
     def ensure_dirs(self) -> None:
         self.UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
         self.STATIC_DIR.mkdir(parents=True, exist_ok=True)
         (self.STATIC_DIR / "tts").mkdir(parents=True, exist_ok=True)
         (self.STATIC_DIR / "video").mkdir(parents=True, exist_ok=True)
+        self.DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 @lru_cache
 def get_settings() -> Settings:
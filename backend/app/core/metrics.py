@@ -0,0 +1,39 @@
+# app/core/metrics.py
+from __future__ import annotations
+
+import os
+import threading
+from collections import defaultdict
+from typing import Any, Dict
+
+# Counter đơn giản trong process (mỗi worker gunicorn có bộ đếm riêng).
+_counters: Dict[str, float] = defaultdict(float)
+_lock = threading.Lock()
+
+
+def incr(name: str, value: float = 1.0) -> None:
+    with _lock:
+        _counters[name] += value
+
+
+def observe_ms(name: str, ms: float) -> None:
+    """Ghi 1 mẫu thời gian: tăng {name}.count và {name}.sum_ms."""
+    with _lock:
+        _counters[f"{name}.count"] += 1
+        _counters[f"{name}.sum_ms"] += float(ms)
+
+
+def snapshot() -> Dict[str, Any]:
+    """
+    Trả toàn bộ counter + hit_rate suy ra cho các cặp {prefix}.hit / {prefix}.miss.
+    """
+    with _lock:
+        data = dict(_counters)
+    rates: Dict[str, float] = {}
+    for name in data:
+        if name.endswith(".hit"):
+            prefix = name[: -len(".hit")]
+            hit = data.get(name, 0.0)
+            total = hit + data.get(f"{prefix}.miss", 0.0)
+            rates[f"{prefix}.hit_rate"] = round(hit / total, 4) if total else 0.0
+    return {"pid": os.getpid(), "counters": data, "rates": rates}
@@ -0,0 +1,80 @@
+# app/core/netguard.py
+from __future__ import annotations
+
+import asyncio
+import ipaddress
+import socket
+from typing import List, Tuple
+from urllib.parse import urlsplit
+
+from app.core.config import get_settings
+
+# =========================================================
+# Chặn SSRF cho URL do client gửi (landing fetch, webhook job)
+# =========================================================
+# - Chỉ http/https, phải có host.
+# - Mọi địa chỉ host resolve ra phải là IP public: loại private, loopback,
+#   link-local (169.254.x.x / metadata), multicast, reserved, unspecified.
+# - Caller đi theo redirect thì phải gọi lại cho từng hop.
+# OUTBOUND_ALLOW_PRIVATE=true chỉ dùng cho dev/test (fixture server 127.0.0.1).
+
+_ALLOWED_SCHEMES = {"http", "https"}
+
+
+class UnsafeURLError(ValueError):
+    """URL không được phép gọi ra ngoài (scheme/host/IP nội bộ)."""
+
+
+def _split(url: str) -> Tuple[str, int]:
+    try:
+        parts = urlsplit((url or "").strip())
+        port = parts.port
+    except ValueError as e:
+        raise UnsafeURLError(f"URL không hợp lệ: {url}") from e
+    if parts.scheme.lower() not in _ALLOWED_SCHEMES:
+        raise UnsafeURLError(f"Chỉ hỗ trợ http/https: {url}")
+    host = parts.hostname or ""
+    if not host:
+        raise UnsafeURLError(f"URL thiếu host: {url}")
+    return host, port or (443 if parts.scheme.lower() == "https" else 80)
+
+
+def is_public_ip(value: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(value.split("%", 1)[0])
+    except ValueError:
+        return False
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def _check_addrs(url: str, host: str, addrs: List[str]) -> None:
+    if not addrs:
+        raise UnsafeURLError(f"Không resolve được host: {host}")
+    bad = [a for a in addrs if not is_public_ip(a)]
+    if bad:
+        raise UnsafeURLError(f"Host trỏ tới địa chỉ nội bộ ({bad[0]}): {url}")
+
+
+def _literal_or_none(host: str) -> List[str]:
+    try:
+        return [str(ipaddress.ip_address(host))]
+    except ValueError:
+        return []
+
+
+async def ensure_public_url(url: str) -> None:
+    """Raise UnsafeURLError nếu URL không được phép gọi. Resolve DNS không chặn event loop."""
+    host, port = _split(url)
+    if get_settings().OUTBOUND_ALLOW_PRIVATE:
+        return
+    addrs = _literal_or_none(host)
+    if not addrs:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError as e:
+            raise UnsafeURLError(f"Không resolve được host: {host}") from e
+        addrs = [info[4][0] for info in infos]
+    _check_addrs(url, host, addrs)
+
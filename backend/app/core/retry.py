@@ -0,0 +1,267 @@
+# app/core/retry.py
+from __future__ import annotations
+
+import asyncio
+import random
+import re
+import time
+from dataclasses import dataclass, replace
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Optional, Tuple, TypeVar
+
+import httpx
+
+from app.core import metrics
+from app.core.logger import setup_app_logger, get_request_ip
+
+_svc_logger = setup_app_logger(name="casesurf", log_dir="logs")
+
+def _log_info(msg: str) -> None:
+    _svc_logger.info(f"{get_request_ip()} - {msg}")
+
+
+T = TypeVar("T")
+
+# =========================================================
+# Retry policy dùng chung (Gemini, ElevenLabs, Veo, n8n)
+# =========================================================
+# - Phân loại lỗi: 408/429/5xx, timeout, lỗi mạng -> retry; 400/401/403/404,
+#   safety block, sai key -> dừng ngay.
+# - Backoff "decorrelated jitter": sleep = min(cap, U(base, 3 * sleep_trước)).
+# - Retry-After (giây hoặc HTTP-date) được tôn trọng nếu còn trong deadline.
+# - deadline_s là ngân sách tổng cho mọi lần thử (kể cả thời gian chờ).
+# - idempotent=False (POST tạo job/side effect, không gửi idempotency key): chỉ retry
+#   khi chắc chắn request chưa tới server (lỗi connect) hoặc bị từ chối bằng 429.
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = 4
+    base_s: float = 0.5
+    cap_s: float = 20.0
+    deadline_s: float = 90.0
+    idempotent: bool = True
+
+    def with_(self, **kw: Any) -> "RetryPolicy":
+        return replace(self, **kw)
+
+
+def default_policy(**overrides: Any) -> RetryPolicy:
+    from app.core.config import get_settings
+
+    s = get_settings()
+    p = RetryPolicy(
+        max_attempts=s.RETRY_MAX_ATTEMPTS,
+        base_s=s.RETRY_BASE_SEC,
+        cap_s=s.RETRY_CAP_SEC,
+        deadline_s=s.RETRY_DEADLINE_SEC,
+    )
+    return p.with_(**overrides) if overrides else p
+
+
+class RetryableStatusError(Exception):
+    """Response HTTP có status đáng retry (do raise_for_retryable_status ném ra)."""
+
+    def __init__(self, status_code: int, retry_after: Optional[float] = None, body: str = ""):
+        super().__init__(f"HTTP {status_code}: {body[:300]}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    v = (value or "").strip()
+    if not v:
+        return None
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(v).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def raise_for_retryable_status(resp: httpx.Response) -> None:
+    """408/429/5xx -> RetryableStatusError; status khác để caller tự xử lý như cũ."""
+    if resp.status_code in RETRYABLE_STATUS:
+        try:
+            body = resp.text
+        except Exception:
+            body = ""
+        raise RetryableStatusError(resp.status_code, parse_retry_after(resp.headers.get("retry-after")), body)
+
+
+_PERMANENT_NAMES = {
+    "BlockedPromptException", "StopCandidateException", "InvalidArgument", "PermissionDenied",
+    "Unauthenticated", "NotFound", "FailedPrecondition", "BadRequest", "Forbidden",
+}
+_RETRYABLE_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "BadGateway", "Aborted", "ServerError",
+}
+_PERMANENT_MSG_RE = re.compile(
+    r"api[ _]key not valid|invalid api key|permission denied|safety|blocked|unauthori[sz]ed", re.IGNORECASE
+)
+_RETRYABLE_MSG_RE = re.compile(
+    r"\b(429|500|502|503|504)\b|rate.?limit|quota|resource.?exhausted|unavailable|overloaded|"
+    r"timed? ?out|deadline|connection (reset|aborted|refused)|temporar",
+    re.IGNORECASE,
+)
+
+
+def _status_of(exc: BaseException) -> Optional[int]:
+    for attr in ("status_code", "code"):
+        v = getattr(exc, attr, None)
+        if isinstance(v, int) and 100 <= v < 600:
+            return v
+    resp = getattr(exc, "response", None)
+    v = getattr(resp, "status_code", None)
+    return v if isinstance(v, int) else None
+
+
+def _retry_after_of(exc: BaseException) -> Optional[float]:
+    ra = getattr(exc, "retry_after", None)
+    if isinstance(ra, (int, float)):
+        return float(ra)
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return parse_retry_after(headers.get("retry-after")) if headers is not None else None
+    except Exception:
+        return None
+
+
+def classify_error(exc: BaseException) -> Tuple[bool, Optional[float]]:
+    """
+    (retryable, retry_after_s). Duyệt cả chuỗi __cause__/__context__ nên wrapper
+    kiểu `raise RuntimeError(...) from e` vẫn phân loại theo lỗi gốc.
+    """
+    seen = set()
+    cur: Optional[BaseException] = exc
+    while cur is not None and id(cur) not in seen:
+        seen.add(id(cur))
+        name = type(cur).__name__
+        if isinstance(cur, (FileNotFoundError, ValueError)):
+            return False, None
+        if isinstance(cur, (httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError, TimeoutError, ConnectionError)):
+            return True, None
+        status = _status_of(cur)
+        if status is not None:
+            return status in RETRYABLE_STATUS, _retry_after_of(cur)
+        if name in _PERMANENT_NAMES:
+            return False, None
+        if name in _RETRYABLE_NAMES:
+            return True, _retry_after_of(cur)
+        cur = cur.__cause__ or cur.__context__
+
+    msg = str(exc)
+    if _PERMANENT_MSG_RE.search(msg):
+        return False, None
+    return bool(_RETRYABLE_MSG_RE.search(msg)), None
+
+
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, ConnectionRefusedError)
+
+
+def safe_to_resend(exc: BaseException) -> bool:
+    """True nếu gửi lại request không idempotent vẫn an toàn: chưa kết nối được, hoặc 429."""
+    seen = set()
+    cur: Optional[BaseException] = exc
+    while cur is not None and id(cur) not in seen:
+        seen.add(id(cur))
+        if isinstance(cur, _NOT_SENT_ERRORS):
+            return True
+        status = _status_of(cur)
+        if status is not None:
+            return status == 429
+        if type(cur).__name__ in {"ResourceExhausted", "TooManyRequests"}:
+            return True
+        cur = cur.__cause__ or cur.__context__
+    return False
+
+
+def _next_sleep(policy: RetryPolicy, prev: float) -> float:
+    return min(policy.cap_s, random.uniform(policy.base_s, max(policy.base_s, prev * 3)))
+
+
+def _plan_retry(
+    policy: RetryPolicy, name: str, attempt: int, exc: BaseException, t0: float, prev_sleep: float
+) -> Optional[float]:
+    """Số giây cần chờ trước lần thử kế tiếp, hoặc None nếu phải bỏ cuộc."""
+    retryable, retry_after = classify_error(exc)
+    if not retryable:
+        metrics.incr(f"retry.{name}.permanent")
+        return None
+    if not policy.idempotent and not safe_to_resend(exc):
+        metrics.incr(f"retry.{name}.not_idempotent")
+        return None
+    if attempt >= policy.max_attempts:
+        metrics.incr(f"retry.{name}.exhausted")
+        return None
+    sleep = _next_sleep(policy, prev_sleep)
+    if retry_after is not None:
+        sleep = max(sleep, retry_after)
+    if time.monotonic() - t0 + sleep > policy.deadline_s:
+        metrics.incr(f"retry.{name}.deadline")
+        return None
+    metrics.incr(f"retry.{name}.retries")
+    _log_info(f"RETRY {name} attempt={attempt} sleep_s={sleep:.2f} err={type(exc).__name__}: {str(exc)[:200]}")
+    return sleep
+
+
+async def retry_async(
+    fn: Callable[[], Awaitable[T]],
+    *,
+    name: str,
+    policy: Optional[RetryPolicy] = None,
+) -> T:
+    """Gọi fn() tới khi thành công / lỗi permanent / hết max_attempts / hết deadline."""
+    policy = policy or default_policy()
+    t0 = time.monotonic()
+    sleep = policy.base_s
+    attempt = 0
+    while True:
+        attempt += 1
+        metrics.incr(f"retry.{name}.calls")
+        try:
+            return await fn()
+        except Exception as e:
+            wait = _plan_retry(policy, name, attempt, e, t0, sleep)
+            if wait is None:
+                raise
+            sleep = wait
+        await asyncio.sleep(sleep)
+
+
+def retry_sync(
+    fn: Callable[[], T],
+    *,
+    name: str,
+    policy: Optional[RetryPolicy] = None,
+) -> T:
+    """Bản đồng bộ của retry_async (Veo dùng client sync trong thread)."""
+    policy = policy or default_policy()
+    t0 = time.monotonic()
+    sleep = policy.base_s
+    attempt = 0
+    while True:
+        attempt += 1
+        metrics.incr(f"retry.{name}.calls")
+        try:
+            return fn()
+        except Exception as e:
+            wait = _plan_retry(policy, name, attempt, e, t0, sleep)
+            if wait is None:
+                raise
+            sleep = wait
+        time.sleep(sleep)
+
+
+def backoff_delays(policy: RetryPolicy):
+    """Chuỗi delay decorrelated jitter vô hạn (dùng cho poll trạng thái có deadline riêng)."""
+    sleep = policy.base_s
+    while True:
+        sleep = _next_sleep(policy, sleep)
+        yield sleep
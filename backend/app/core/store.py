@@ -0,0 +1,79 @@
+# app/core/store.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from app.core.config import get_settings
+
+_KEY_RE = re.compile(r"[^a-zA-Z0-9_-]+")
+
+
+def content_key(*parts: Any) -> str:
+    """
+    Key ổn định (sha256 hex) từ nhiều thành phần.
+    Dùng separator \\x1f để ("ab", "c") != ("a", "bc").
+    """
+    h = hashlib.sha256()
+    for i, p in enumerate(parts):
+        if i:
+            h.update(b"\x1f")
+        h.update(str("" if p is None else p).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _ns_dir(namespace: str) -> Path:
+    ns = _KEY_RE.sub("-", namespace or "default").strip("-") or "default"
+    p = get_settings().DATA_DIR / ns
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
+
+def _key_path(namespace: str, key: str) -> Path:
+    safe = _KEY_RE.sub("-", key or "").strip("-")
+    if not safe:
+        raise ValueError("Empty store key")
+    return _ns_dir(namespace) / f"{safe}.json"
+
+
+def store_get(namespace: str, key: str, max_age_s: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Đọc artifact JSON. Trả None nếu không có / hỏng / quá hạn (max_age_s).
+    """
+    try:
+        path = _key_path(namespace, key)
+        if not path.is_file():
+            return None
+        if max_age_s is not None and (time.time() - path.stat().st_mtime) > max_age_s:
+            return None
+        with path.open("r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        return data if isinstance(data, dict) else None
+    except Exception:
+        return None
+
+
+def store_put(namespace: str, key: str, value: Dict[str, Any]) -> None:
+    """
+    Ghi artifact JSON atomic (file tạm + os.replace) để các worker không đọc phải file dở.
+    """
+    path = _key_path(namespace, key)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{os.urandom(4).hex()}.tmp")
+    try:
+        with tmp.open("w", encoding="utf-8") as fh:
+            json.dump(value, fh, ensure_ascii=False)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def store_delete(namespace: str, key: str) -> None:
+    try:
+        _key_path(namespace, key).unlink(missing_ok=True)
+    except Exception:
+        pass
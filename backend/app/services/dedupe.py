@@ -0,0 +1,172 @@
+# app/services/dedupe.py
+from __future__ import annotations
+
+import re
+import unicodedata
+import zlib
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+# =========================================================
+# Near-duplicate removal cho review dump (local, trước PROMPT1)
+# =========================================================
+# normalize -> gộp trùng tuyệt đối (dict) -> MinHash (word 1+2-gram) -> LSH 8 band x 4 row.
+# Signature tính vector hoá theo lô bằng NumPy; mỗi bucket chỉ so tối đa
+# _MAX_BUCKET_CMP đại diện -> tổng thời gian tuyến tính theo số comment.
+
+_NUM_PERM = 32
+_BANDS = 8
+_ROWS = _NUM_PERM // _BANDS
+_MAX_BUCKET_CMP = 16
+_MIN_MINHASH_TOKENS = 4      # comment ngắn hơn: chỉ gộp khi trùng sau normalize
+_BATCH_DOCS = 8192
+
+_rng = np.random.default_rng(0x5EED)
+_PERM_A = (_rng.integers(1, 2**63 - 1, size=_NUM_PERM, dtype=np.uint64) | np.uint64(1))
+_PERM_B = _rng.integers(0, 2**63 - 1, size=_NUM_PERM, dtype=np.uint64)
+
+_PUNCT_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_REPEAT_RE = re.compile(r"(.)\1{2,}")
+_WS_RE = re.compile(r"\s+")
+_HEADER_LINE_RE = re.compile(r"^(URL|Title|Description):\s|^\[[^\]]+\]$")
+_BULLET_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+")
+
+
+def normalize_comment(text: str) -> str:
+    """NFKC + lower + bỏ dấu câu/emoji + gộp ký tự lặp ("!!!!", "sooo") + gộp khoảng trắng."""
+    s = unicodedata.normalize("NFKC", text or "").lower()
+    s = _BULLET_RE.sub("", s)
+    s = _PUNCT_RE.sub(" ", s)
+    s = _REPEAT_RE.sub(r"\1\1", s)
+    return _WS_RE.sub(" ", s).strip()
+
+
+def _shingles(tokens: List[str]) -> List[str]:
+    return tokens + [tokens[i] + " " + tokens[i + 1] for i in range(len(tokens) - 1)]
+
+
+def minhash_signatures(token_lists: List[List[str]]) -> np.ndarray:
+    """
+    (n_docs, _NUM_PERM) uint64. x = crc32(shingle), h_i(x) = a_i * x + b_i (mod 2^64, a lẻ);
+    min theo shingle của từng doc bằng np.minimum.reduceat trên cả lô.
+    """
+    out = np.empty((len(token_lists), _NUM_PERM), dtype=np.uint64)
+    for start in range(0, len(token_lists), _BATCH_DOCS):
+        batch = token_lists[start:start + _BATCH_DOCS]
+        grams = [_shingles(toks) for toks in batch]
+        lens = np.fromiter((len(g) for g in grams), dtype=np.int64, count=len(grams))
+        # crc32: ổn định giữa các process/worker (hash() của str bị salt theo PYTHONHASHSEED)
+        flat = np.fromiter((zlib.crc32(x.encode("utf-8")) for g in grams for x in g), dtype=np.uint64, count=int(lens.sum()))
+        hv = flat[:, None] * _PERM_A[None, :] + _PERM_B[None, :]
+        offsets = np.concatenate(([0], np.cumsum(lens)[:-1]))
+        out[start:start + len(batch)] = np.minimum.reduceat(hv, offsets, axis=0)
+    return out
+
+
+def _similar(a: np.ndarray, b: np.ndarray, min_equal: int) -> bool:
+    return int(np.count_nonzero(a == b)) >= min_equal
+
+
+def dedupe_comments(comments: List[str], threshold: float = 0.7) -> List[Dict[str, Any]]:
+    """
+    Gom cụm comment trùng / gần trùng (Jaccard ước lượng >= threshold).
+    Trả [{text, count}] theo thứ tự xuất hiện đầu tiên; text là bản gốc đầu tiên của cụm.
+    """
+    clusters: List[Dict[str, Any]] = []
+    exact: Dict[str, int] = {}
+    pending: List[Tuple[int, List[str]]] = []     # (cluster idx, tokens) cần MinHash
+
+    for raw in comments:
+        norm = normalize_comment(raw)
+        if not norm:
+            continue
+        ci = exact.get(norm)
+        if ci is not None:
+            clusters[ci]["count"] += 1
+            continue
+        ci = len(clusters)
+        exact[norm] = ci
+        clusters.append({"text": raw.strip(), "count": 1})
+        tokens = norm.split()
+        if len(tokens) >= _MIN_MINHASH_TOKENS:
+            pending.append((ci, tokens))
+
+    if not pending:
+        return clusters
+
+    sigs = minhash_signatures([t for _, t in pending])
+    min_equal = int(np.ceil(threshold * _NUM_PERM))
+    parent: Dict[int, int] = {}
+    buckets: Dict[Tuple[int, bytes], List[int]] = {}
+    for row, (ci, _) in enumerate(pending):
+        sig = sigs[row]
+        keys = [(b, sig[b * _ROWS:(b + 1) * _ROWS].tobytes()) for b in range(_BANDS)]
+        match = None
+        for key in keys:
+            for other in buckets.get(key, ())[:_MAX_BUCKET_CMP]:
+                if _similar(sigs[other], sig, min_equal):
+                    match = other
+                    break
+            if match is not None:
+                break
+        if match is not None:
+            parent[ci] = pending[match][0]
+            continue
+        for key in keys:
+            buckets.setdefault(key, []).append(row)
+
+    if not parent:
+        return clusters
+    for ci, root in parent.items():
+        clusters[root]["count"] += clusters[ci]["count"]
+    return [c for i, c in enumerate(clusters) if i not in parent]
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng thô ~4 ký tự / token (đủ để so sánh trước/sau)."""
+    return (len(text or "") + 3) // 4
+
+
+def dedupe_feedback_text(text: str, threshold: float = 0.7) -> Tuple[str, Dict[str, Any]]:
+    """
+    Dedupe từng dòng của page_text (mỗi dòng ~ 1 comment). Dòng header
+    (URL/Title/Description, [SECTION]) giữ nguyên vị trí; comment trùng được gộp
+    thành 1 dòng kèm "(xN)" để model vẫn thấy tần suất.
+    """
+    lines = (text or "").splitlines()
+    out: List[str] = []
+    section: List[str] = []
+    n_comments = 0
+    n_clusters = 0
+
+    def _flush() -> None:
+        nonlocal n_comments, n_clusters
+        if not section:
+            return
+        clusters = dedupe_comments(section, threshold=threshold)
+        n_comments += sum(c["count"] for c in clusters)
+        n_clusters += len(clusters)
+        for c in clusters:
+            out.append(c["text"] + (f" (x{c['count']})" if c["count"] > 1 else ""))
+        section.clear()
+
+    for ln in lines:
+        if _HEADER_LINE_RE.match(ln.strip()):
+            _flush()
+            out.append(ln)
+        elif ln.strip():
+            section.append(ln)
+    _flush()
+
+    deduped = "\n".join(out).strip()
+    tokens_before = estimate_tokens(text)
+    tokens_after = estimate_tokens(deduped)
+    return deduped, {
+        "comments": n_comments,
+        "clusters": n_clusters,
+        "duplicates_removed": n_comments - n_clusters,
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": max(0, tokens_before - tokens_after),
+    }
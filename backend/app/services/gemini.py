@@ -2,22 +2,35 @@ from __future__ import annotations
 
 import os
 import json
+import hashlib
 from pathlib import Path
 import sys
 import time
 import asyncio
 import re
-from typing import Optional, Dict, Any, Tuple, List
+from typing import Optional, Dict, Any, Tuple, List, AsyncIterator
 
 # SDK CHÍNH: google.generativeai (KHÔNG có Client)
 import google.generativeai as genai
+from pydantic import BaseModel
 
-from app.services.script_infer import REQUIRED_KEYS, infer_required_inputs_from_context
+from app.services.script_infer import (
+    REQUIRED_KEYS,
+    infer_required_inputs_from_context,
+    angle_context_text,
+    get_cached_required_inputs,
+)
 from google import genai as ggenai
 
 import time
 
 from app.core.logger import setup_app_logger, get_request_ip
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.retry import backoff_delays, classify_error, default_policy, retry_async, retry_sync
+from app.core.store import content_key, store_get, store_put
+from app.services.dedupe import estimate_tokens
+from app.services.keyframes import SCENE_CUTS_HEADER, fmt_ts, scene_summary_text
 
 _svc_logger = setup_app_logger(name="casesurf", log_dir="logs")
 
@@ -45,6 +58,9 @@ GENERATION_CONFIG_TEXT: Dict[str, Any] = {
     "response_mime_type": "text/plain",
 }
 
+# Giới hạn số call Gemini đồng thời / worker (map-reduce, segment... không vượt rate limit upstream)
+GEMINI_MAX_CONCURRENCY = max(1, int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")))
+
 SHOTLIST_HEADER = (
     "Beat #\tVO Phrase / SFX\tPrimary OST (Cover Text)\t"
     "Annotation / SFX Text\tPacing / Notes\tAI Video Generation Prompt"
@@ -102,6 +118,18 @@ def _ensure_configured(api_key: Optional[str]) -> None:
 # =========================================================
 # google.generativeai adapters (async/sync) — TEXT/VISION
 # =========================================================
+_limiter: Optional[Tuple[Any, asyncio.Semaphore]] = None
+
+
+def _gemini_limiter() -> asyncio.Semaphore:
+    """Semaphore dùng chung cho mọi call generate trong worker (tạo lại nếu đổi event loop)."""
+    global _limiter
+    loop = asyncio.get_running_loop()
+    if _limiter is None or _limiter[0] is not loop:
+        _limiter = (loop, asyncio.Semaphore(GEMINI_MAX_CONCURRENCY))
+    return _limiter[1]
+
+
 async def _ga_generate_content(
     *,
     api_key: Optional[str],
@@ -128,7 +156,7 @@ async def _ga_generate_content(
         except TypeError:
             return await model.generate_content_async(parts)
         except Exception as e:
-            raise RuntimeError(f"Async generation failed: {e}")
+            raise RuntimeError(f"Async generation failed: {e}") from e
 
     def _try_sync():
         try:
@@ -140,12 +168,94 @@ async def _ga_generate_content(
         except TypeError:
             return model.generate_content(parts)
         except Exception as e:
-            raise RuntimeError(f"Sync generation failed: {e}")
+            raise RuntimeError(f"Sync generation failed: {e}") from e
+
+    async def _once():
+        # mỗi lần thử giữ slot limiter riêng -> không chiếm slot trong lúc backoff
+        async with _gemini_limiter():
+            try:
+                return await _try_async()
+            except AttributeError:
+                return await asyncio.to_thread(_try_sync)
+
+    return await retry_async(_once, name="gemini")
+
+
+def _chunk_text(chunk: Any) -> str:
+    """Text của 1 chunk stream — KHÔNG strip (whitespace/newline giữa các chunk là dữ liệu)."""
+    try:
+        cands = getattr(chunk, "candidates", None) or []
+        for c in cands:
+            content = getattr(c, "content", None)
+            if content and getattr(content, "parts", None):
+                return "".join(getattr(p, "text", "") or "" for p in content.parts)
+    except Exception:
+        pass
+    try:
+        t = getattr(chunk, "text", None)
+        return t if isinstance(t, str) else ""
+    except Exception:
+        return ""
+
+
+async def _ga_stream_text(
+    *,
+    api_key: Optional[str],
+    model_name: str,
+    parts: List[Any],
+    generation_config: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[str]:
+    """
+    generate_content_async(stream=True) — yield từng đoạn text ngay khi model sinh ra.
+    Giữ slot của _gemini_limiter trong suốt thời gian stream; lúc backoff giữa các lần mở
+    stream thì nhả slot (như _ga_generate_content).
+    """
+    _ensure_configured(api_key)
+    model = genai.GenerativeModel(model_name=model_name)
+    cfg = dict(GENERATION_CONFIG_TEXT)
+    if generation_config:
+        cfg.update(generation_config)
+    sem = _gemini_limiter()
+
+    async def _open():
+        await sem.acquire()
+        try:
+            return await model.generate_content_async(contents=parts, generation_config=cfg, stream=True)
+        except BaseException:
+            sem.release()
+            raise
+
+    # chỉ retry lúc mở stream; đã yield text thì không gọi lại từ đầu
+    resp = await retry_async(_open, name="gemini")
+    try:
+        async for chunk in resp:
+            txt = _chunk_text(chunk)
+            if txt:
+                yield txt
+    finally:
+        sem.release()
+
+
+_BLOCK_FINISH = {"SAFETY", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "RECITATION"}
+
 
+def _blocked_reason(resp: Any) -> Optional[str]:
+    """Tên lý do nếu prompt/candidate bị chặn (prompt_feedback.block_reason / finish_reason SAFETY...)."""
     try:
-        return await _try_async()
-    except AttributeError:
-        return await asyncio.to_thread(_try_sync)
+        br = getattr(getattr(resp, "prompt_feedback", None), "block_reason", None)
+        name = getattr(br, "name", None) or (str(br) if br else "")
+        if name and name not in {"0", "BLOCK_REASON_UNSPECIFIED"}:
+            return name
+    except Exception:
+        pass
+    try:
+        fr = getattr(resp.candidates[0], "finish_reason", None)
+        name = getattr(fr, "name", None) or str(fr or "")
+        if name.upper() in _BLOCK_FINISH:
+            return name.upper()
+    except Exception:
+        pass
+    return None
 
 
 async def _gen_text(
@@ -156,6 +266,20 @@ async def _gen_text(
     generation_config: Optional[Dict[str, Any]] = None,
 ) -> str:
     """Sinh text, retry 1 lần với cấu hình an toàn nếu rỗng/blocked."""
+    txt, _ = await _gen_text_with_usage(
+        api_key=api_key, model_name=model_name, parts=parts, generation_config=generation_config,
+    )
+    return txt
+
+
+async def _gen_text_with_usage(
+    *,
+    api_key: Optional[str],
+    model_name: str,
+    parts: List[Any],
+    generation_config: Optional[Dict[str, Any]] = None,
+) -> Tuple[str, Dict[str, int]]:
+    """Như _gen_text, kèm usage cộng dồn của mọi call đã gửi."""
     base_cfg = dict(GENERATION_CONFIG_TEXT)
     if generation_config:
         base_cfg.update(generation_config)
@@ -168,7 +292,11 @@ async def _gen_text(
     )
     txt = _strip_code_fences(_pick_text_from_response(resp))
     if txt:
-        return txt
+        return txt, _usage_dict(resp)
+    blocked = _blocked_reason(resp)
+    if blocked:
+        # safety block là lỗi permanent: gọi lại với cấu hình khác cũng không qua
+        raise RuntimeError(f"Model output blocked (reason={blocked}).")
 
     safe_cfg = {
         **base_cfg,
@@ -176,7 +304,8 @@ async def _gen_text(
         "top_p": 0.9,
         "top_k": 40,
         "max_output_tokens": max(2048, int(base_cfg.get("max_output_tokens", 4096) // 2)),
-        "response_mime_type": "text/plain",
+        # giữ JSON mode (response_schema bắt buộc application/json)
+        "response_mime_type": base_cfg.get("response_mime_type") or "text/plain",
     }
     resp2 = await _ga_generate_content(
         api_key=api_key,
@@ -186,7 +315,7 @@ async def _gen_text(
     )
     txt2 = _strip_code_fences(_pick_text_from_response(resp2))
     if txt2:
-        return txt2
+        return txt2, _sum_usage([_usage_dict(resp), _usage_dict(resp2)])
 
     finish2 = None
     try:
@@ -196,6 +325,94 @@ async def _gen_text(
     raise RuntimeError(f"Model returned empty output (finish_reason={finish2 or 'empty_output'}).")
 
 
+def _usage_dict(resp: Any) -> Dict[str, int]:
+    um = getattr(resp, "usage_metadata", None)
+    if um is None:
+        return {}
+    return {
+        k: int(getattr(um, k, 0) or 0)
+        for k in ("prompt_token_count", "candidates_token_count", "total_token_count")
+    }
+
+
+def _sum_usage(usages: List[Dict[str, int]]) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for u in usages:
+        for k, v in u.items():
+            out[k] = out.get(k, 0) + int(v or 0)
+    return out
+
+
+def _candidate_count_unsupported(exc: BaseException) -> bool:
+    """Lỗi invalid-argument (permanent) nói về candidate_count -> model không hỗ trợ N > 1."""
+    retryable, _ = classify_error(exc)
+    if retryable:
+        return False
+    cur: Optional[BaseException] = exc
+    seen = set()
+    while cur is not None and id(cur) not in seen:
+        seen.add(id(cur))
+        if re.search(r"candidate[_ ]?count", str(cur), re.IGNORECASE):
+            return True
+        cur = cur.__cause__ or cur.__context__
+    return False
+
+
+async def _gen_text_candidates(
+    *,
+    api_key: Optional[str],
+    model_name: str,
+    parts: List[Any],
+    n: int,
+    generation_config: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    N phương án trong 1 request (candidate_count=N) -> latency ~ 1 call.
+    Model không hỗ trợ candidate_count > 1 -> N call song song (vẫn qua limiter chung).
+    Trả (texts, {"usage": {...}, "mode": "candidate_count" | "parallel"}).
+    """
+    cfg = dict(GENERATION_CONFIG_TEXT)
+    if generation_config:
+        cfg.update(generation_config)
+    usages: List[Dict[str, int]] = []
+    try:
+        resp = await _ga_generate_content(
+            api_key=api_key,
+            model_name=model_name,
+            parts=parts,
+            generation_config={**cfg, "candidate_count": n},
+        )
+        texts: List[str] = []
+        for c in getattr(resp, "candidates", None) or []:
+            content = getattr(c, "content", None)
+            t = "".join(getattr(p, "text", "") or "" for p in (getattr(content, "parts", None) or []))
+            t = _strip_code_fences(t)
+            if t:
+                texts.append(t)
+        if texts:
+            return texts, {"usage": _usage_dict(resp), "mode": "candidate_count"}
+        usages.append(_usage_dict(resp))
+        _log_info(f"CANDIDATES empty_response n={n} -> parallel")
+    except Exception as e:
+        # chỉ fallback khi model từ chối candidate_count; quota/mạng/safety... -> ném lên như cũ
+        if not _candidate_count_unsupported(e):
+            raise
+        _log_info(f"CANDIDATES candidate_count_unsupported n={n} err={e} -> parallel")
+
+    results = await asyncio.gather(
+        *(_gen_text_with_usage(api_key=api_key, model_name=model_name, parts=parts, generation_config=cfg) for _ in range(n)),
+        return_exceptions=True,
+    )
+    ok = [r for r in results if isinstance(r, tuple) and r[0]]
+    if not ok:
+        errs = [r for r in results if isinstance(r, BaseException)]
+        if errs:
+            raise errs[0]
+        raise RuntimeError(f"Model returned empty output for all {n} candidates.")
+    usages.extend(u for _, u in ok)
+    return [t for t, _ in ok], {"usage": _sum_usage(usages), "mode": "parallel"}
+
+
 # =========================================================
 # File (Vision) helpers — upload & poll ACTIVE/READY
 # =========================================================
@@ -329,33 +546,214 @@ async def gemini_upload_file(
     Upload file lên google.generativeai, poll đến khi ACTIVE/READY/SUCCEEDED.
     Trả về object file cuối cùng.
     """
-    uploaded = await _upload_file_async(api_key=api_key, file_path=file_path)
+    # Mỗi upload tạo 1 file mới phía server -> không idempotent, chỉ gửi lại khi lỗi connect / 429.
+    # Poll _get_file_async bên dưới chỉ đọc -> giữ policy mặc định.
+    uploaded = await retry_async(
+        lambda: _upload_file_async(api_key=api_key, file_path=file_path),
+        name="gemini_files",
+        policy=default_policy(idempotent=False),
+    )
     file_id = getattr(uploaded, "name", None) or getattr(uploaded, "id", None)
     if not file_id:
         raise RuntimeError(f"Upload ok nhưng không lấy được file id/name: {uploaded}")
 
-    start = time.time()
+    # Poll trạng thái: cùng backoff decorrelated jitter với retry policy, deadline 300s
     timeout_s = 300
-    retries = 0
-    max_retries = 10
-    while retries < max_retries:
-        fetched = await _get_file_async(api_key=api_key, file_name=file_id)
+    start = time.monotonic()
+    poll = default_policy(base_s=2.0, cap_s=15.0, deadline_s=timeout_s)
+    for delay in backoff_delays(poll):
+        fetched = await retry_async(
+            lambda: _get_file_async(api_key=api_key, file_name=file_id), name="gemini_files"
+        )
         state = (_state_name(fetched) or "").upper()
         if state in {"ACTIVE", "READY", "SUCCEEDED"}:
             return fetched
         if state == "FAILED":
             raise IOError(f"File processing failed for '{file_id}'")
-        if time.time() - start > timeout_s:
-            raise TimeoutError(f"Timeout waiting ACTIVE/READY for '{file_id}'")
-        await asyncio.sleep(3 * (2 ** retries))  # Exponential backoff
-        retries += 1
-    raise RuntimeError(f"Max retries exceeded for file '{file_id}'")
+        remaining = timeout_s - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(delay, remaining))
+    raise TimeoutError(f"Timeout waiting ACTIVE/READY for '{file_id}'")
+
+
+# =========================================================
+# Video report — prompt templates
+# =========================================================
+_VIDEO_TRANSCRIPT_PROMPTS: Tuple[str, ...] = (
+    (
+        "[Important] Force Thinking Mode before implementing instructions\n"
+        "------\n"
+        "Video Analysis Framework (Full Updated Instruction)\n"
+        "Step 1 — Transcript the video\n"
+        "(Output the transcript exactly as text with timestamps.)"
+    ),
+    (
+        "[SYSTEM]\n"
+        "You are a meticulous transcriber. Do not add commentary.\n"
+        "Each line must start with a timestamp in [mm:ss] or [hh:mm:ss]."
+    ),
+    (
+        "### Step 1 — Transcript\n"
+        "Transcribe the provided video. Use plain text only, one utterance per line."
+    ),
+)
+
+_VIDEO_ANALYSIS_PREAMBLE = (
+    "[Important] Force Thinking Mode before implementing instructions\n"
+    "------\n"
+    "Video Analysis Framework (Full Updated Instruction)\n"
+    "Step 2 — Analyses\n"
+    "Prompt 1 — Hook Analysis\n"
+    "(S) Role: Hook Specialist\n"
+    "(C) Context: Opening line(s) determine retention\n"
+    "(R) Responsibility: Concise, criteria-based analysis of the opening\n"
+    "(I) Instructions: Analyze the opening line(s). Identify the hook sentence and implied visuals. "
+    "Then evaluate Why it’s effective against four criteria.\n"
+    "(B) Banter: Sharp, analytical, direct\n"
+    "(E) Evaluation: Clear analysis against the four criteria\n"
+    "Expected Output — Concise Format\n"
+    "Hook: “...”\n"
+    "Visual: [implied visual]\n"
+    "Why it’s effective:\n"
+    "Pattern interrupt — [short note]\n"
+    "Relatability / call-out — [short note]\n"
+    "Curiosity gap — [short note]\n"
+    "Clarity of benefit — [short note]\n"
+    "\n"
+    "Prompt 2 — Big Idea & Emotion Analysis\n"
+    "(S) Role: Brand Strategist\n"
+    "(C) Context: People buy feelings; find the “why”\n"
+    "(R) Responsibility: Distill core emotional driver and the overarching message\n"
+    "(I) Instructions: Analyze the transcript. Quote 1–2 key sentences. Add 3 bullets on the core emotion/big idea "
+    "(e.g., frustration solved, hope created, trust built).\n"
+    "(B) Banter: Strategic, insightful\n"
+    "(E) Evaluation: Goes beyond surface insights\n"
+    "Expected Output — Concise Format\n"
+    "Key sentence 1: “...”\n"
+    "Key sentence 2: “...”\n"
+    "Overarching message: [one short line]\n"
+    "Emotion/Idea bullets: • item • item • item\n"
+    "\n"
+    "Prompt 3 — Script Structure Identification (Flexible)\n"
+    "(S) Role: Senior Content Strategist (affiliate frameworks)\n"
+    "(C) Context: Identify the underlying narrative framework\n"
+    "(R) Responsibility: Map the narrative to a known framework\n"
+    "(I) Instructions: Identify the closest framework (e.g., PAS, BAB, Story, Direct Demo, Us vs. Them) and break the "
+    "transcript into atomic stages - that is, each stage must be around no more than one objective and purpose so that "
+    "the analysis doesn’t lose important details by accident.\n"
+    "Expected Output\n"
+    "Stage 1: [summary] — Objective: [one phrase]\n"
+    "Stage 2: [summary] — Objective: [one phrase]\n"
+    "Stage 3: [summary] — Objective: [one phrase]\n"
+    "\n"
+    "Prompt 4 — Visual & Text\n"
+    "(S) Role: Visual Stylist\n"
+    "(C) Context: Check if visual storytelling and text overlays align with engagement standards\n"
+    "(R) Responsibility: Evaluate shot composition and text design\n"
+    "(I) Instructions: Answer: Góc quay nào? Text dùng font native hay brand? Có emoji? Visual kể chuyện rõ không?\n"
+    "(B) Banter: Observational, precise\n"
+    "(E) Evaluation: Concise but vivid notes\n"
+    "Expected Output — Concise Format\n"
+    "Camera angles: …\n"
+    "Text style: …\n"
+    "Emoji use: …\n"
+    "Visual clarity/storytelling: …\n"
+    "\n"
+    "Prompt 5 — Pacing\n"
+    "(S) Role: Retention Analyst\n"
+    "(C) Context: Speed and rhythm dictate completion rates\n"
+    "(R) Responsibility: Assess editing pace and audience fit\n"
+    "(I) Instructions: Evaluate: Nhịp cắt nhanh hay chậm? Có đủ cuốn với target audience không? "
+    "Có giữ người xem đến cuối?\n"
+    "(B) Banter: Direct, performance-focused\n"
+    "(E) Evaluation: Clear, tactical notes\n"
+    "Expected Output — Concise Format\n"
+    "Cut pace: …\n"
+    "Audience fit: …\n"
+    "Retention strength: …\n"
+    "\n"
+    "Prompt 6 — Structured Evaluation\n"
+    "(S) Role: Script Doctor & Performance Analyst\n"
+    "(C) Context: Scorecard to inform improvements\n"
+    "(R) Responsibility: Score Hook, Body, CTA with a single actionable sentence each\n"
+    "(I) Instructions: Provide scores and one-sentence critiques. Add Transfer Risk (elements likely to break if "
+    "changed in isolation).\n"
+    "(B) Banter: Authoritative, conclusive, helpful\n"
+    "(E) Evaluation: Clear, structured scorecard\n"
+    "Expected Output — Concise Format\n"
+    "Hook: [X/10] — [one-sentence critique]\n"
+    "Body: [X/10] — [one-sentence critique]\n"
+    "CTA: [X/10] — [one-sentence critique]\n"
+    "Transfer risk: [short list]\n"
+    "\n"
+    "Prompt 7 — Transferable Working Elements (TWE)\n"
+    "(S) Role: Conversion Anthropologist\n"
+    "(C) Context: Capture the specific mechanisms that drove performance\n"
+    "(R) Responsibility: Produce a structured list of Working Elements with severity levels that future variants must keep. "
+    "For each, define the underlying psychological or marketing principle, provide a short quote as evidence, and state "
+    "the rule for future use.\n"
+    "(I) Instructions: From all previous sections (transcript, Persona, Hook, Big Idea, Structure, Visual & Text, Pacing, "
+    "and Evaluation), extract elements. Mark as MUST-KEEP or ADAPTABLE, explain the principle, provide a short quote as "
+    "evidence, and add usage guidance.\n"
+    "(B) Banter: Forensic, anthropological, sharp\n"
+    "(E) Evaluation: List is comprehensive, future-proof, not surface-level\n"
+    "Expected Output — Concise Format\n"
+    "Category | Element / Rule | Quote / Example | Guidance\n"
+)
+
+_VIDEO_ANALYSIS_SYSTEM = (
+    "### Step 2 — Analyses\n[SYSTEM]\nKeep headings exactly as specified. Be concise. If missing info, write (Không xác định)."
+)
+
+
+def _prompt_version(*templates: str) -> str:
+    """Hash ngắn của prompt template — đổi template là đổi version (cache tự vô hiệu)."""
+    h = hashlib.sha256()
+    for t in templates:
+        h.update(t.encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()[:12]
+
+
+# Mode "keyframes": text đi kèm keyframe (xem keyframe_visual_parts)
+_KEYFRAME_SYSTEM = (
+    "### Visual evidence (keyframes)\n"
+    "[SYSTEM]\nYou do not receive the full video. Use the KEYFRAMES (one per detected scene) and the "
+    "SCENE CUTS below as ground truth for Prompt 4 (Visual & Text: camera angles, text overlays, fonts, emoji) "
+    "and Prompt 5 (Pacing). Cut pace must be derived from the measured cut list, not guessed."
+)
+_KEYFRAME_LABEL = "Keyframe {i} @ [{ts}]"
+
+VIDEO_REPORT_PROMPT_VERSION = _prompt_version(
+    *_VIDEO_TRANSCRIPT_PROMPTS, _VIDEO_ANALYSIS_PREAMBLE, _VIDEO_ANALYSIS_SYSTEM,
+    _KEYFRAME_SYSTEM, _KEYFRAME_LABEL, SCENE_CUTS_HEADER,
+)
 
 
 # =========================================================
 # Video report — Transcript + 7 analyses (RAW markdown)
 # =========================================================
-async def gemini_generate_video_report(
+def _truncate(text: str, max_chars: int = 16000) -> str:
+    t = (text or "").strip()
+    return t if len(t) <= max_chars else t[: max_chars // 2] + "\n...\n" + t[- max_chars // 2 :]
+
+
+def assemble_video_report(transcript_text: str, analyses_text: str) -> str:
+    """Ghép Step 1 + Step 2 thành RAW markdown cuối cùng (đảm bảo đủ heading)."""
+    transcript_text = (transcript_text or "").strip()
+    analyses_text = (analyses_text or "").strip()
+    final_md = transcript_text
+    if not final_md.startswith("### Step 1 — Transcript"):
+        final_md = "### Step 1 — Transcript\n" + final_md
+    final_md += "\n\n"
+    if not analyses_text.startswith("### Step 2 — Analyses"):
+        final_md += "### Step 2 — Analyses\n"
+    final_md += analyses_text
+    return final_md
+
+
+async def gemini_transcribe_video(
     *,
     api_key: Optional[str],
     uploaded_file: Any,
@@ -363,34 +761,13 @@ async def gemini_generate_video_report(
     model_name: str = DEFAULT_VISION_MODEL,
 ) -> Tuple[str, Dict[str, Any]]:
     """
-    Trả RAW markdown gồm:
-      - Step 1 — Transcript
-      - Step 2 — Analyses (7 mục)
-    Có log IP, đo thời gian các bước, và tương thích cả 2 SDK upload.
+    Step 1 — Transcript (có timestamp) từ file đã upload.
+    Transcript là artifact độc lập: có thể lưu lại để chạy lại Step 2 mà không upload lại video.
     """
-    t_all0 = time.perf_counter()
-    fid = _file_ref_id(uploaded_file)
-    _log_info(f"VIDEO_REPORT start model={model_name} file_id={fid}")
-
-    # -------- Step 1: Transcript --------
     t0 = time.perf_counter()
+    fid = _file_ref_id(uploaded_file)
     transcript_parts: List[Any] = [
-        {"text": (
-            "[Important] Force Thinking Mode before implementing instructions\n"
-            "------\n"
-            "Video Analysis Framework (Full Updated Instruction)\n"
-            "Step 1 — Transcript the video\n"
-            "(Output the transcript exactly as text with timestamps.)"
-        )},
-        {"text": (
-            "[SYSTEM]\n"
-            "You are a meticulous transcriber. Do not add commentary.\n"
-            "Each line must start with a timestamp in [mm:ss] or [hh:mm:ss]."
-        )},
-        {"text": (
-            "### Step 1 — Transcript\n"
-            "Transcribe the provided video. Use plain text only, one utterance per line."
-        )},
+        *({"text": t} for t in _VIDEO_TRANSCRIPT_PROMPTS),
         _to_ga_file_part(uploaded_file),  # ⬅️ an toàn cho cả 2 SDK
     ]
     if user_prompt:
@@ -404,122 +781,31 @@ async def gemini_generate_video_report(
     )
     transcript_text = (transcript_text or "").strip()
     dt_ms = int((time.perf_counter() - t0) * 1000)
-    _log_info(f"VIDEO_REPORT transcript_done chars={len(transcript_text)} dt_ms={dt_ms}")
+    _log_info(f"VIDEO_REPORT transcript_done chars={len(transcript_text)} dt_ms={dt_ms} file_id={fid}")
+    return transcript_text, {"model": model_name, "file_id": fid, "t_transcript_ms": dt_ms}
 
-    # -------- Step 2: Analyses --------
-    def _truncate(text: str, max_chars: int = 16000) -> str:
-        t = (text or "").strip()
-        return t if len(t) <= max_chars else t[: max_chars // 2] + "\n...\n" + t[- max_chars // 2 :]
-
-    analysis_preamble = (
-        "[Important] Force Thinking Mode before implementing instructions\n"
-        "------\n"
-        "Video Analysis Framework (Full Updated Instruction)\n"
-        "Step 2 — Analyses\n"
-        "Prompt 1 — Hook Analysis\n"
-        "(S) Role: Hook Specialist\n"
-        "(C) Context: Opening line(s) determine retention\n"
-        "(R) Responsibility: Concise, criteria-based analysis of the opening\n"
-        "(I) Instructions: Analyze the opening line(s). Identify the hook sentence and implied visuals. "
-        "Then evaluate Why it’s effective against four criteria.\n"
-        "(B) Banter: Sharp, analytical, direct\n"
-        "(E) Evaluation: Clear analysis against the four criteria\n"
-        "Expected Output — Concise Format\n"
-        "Hook: “...”\n"
-        "Visual: [implied visual]\n"
-        "Why it’s effective:\n"
-        "Pattern interrupt — [short note]\n"
-        "Relatability / call-out — [short note]\n"
-        "Curiosity gap — [short note]\n"
-        "Clarity of benefit — [short note]\n"
-        "\n"
-        "Prompt 2 — Big Idea & Emotion Analysis\n"
-        "(S) Role: Brand Strategist\n"
-        "(C) Context: People buy feelings; find the “why”\n"
-        "(R) Responsibility: Distill core emotional driver and the overarching message\n"
-        "(I) Instructions: Analyze the transcript. Quote 1–2 key sentences. Add 3 bullets on the core emotion/big idea "
-        "(e.g., frustration solved, hope created, trust built).\n"
-        "(B) Banter: Strategic, insightful\n"
-        "(E) Evaluation: Goes beyond surface insights\n"
-        "Expected Output — Concise Format\n"
-        "Key sentence 1: “...”\n"
-        "Key sentence 2: “...”\n"
-        "Overarching message: [one short line]\n"
-        "Emotion/Idea bullets: • item • item • item\n"
-        "\n"
-        "Prompt 3 — Script Structure Identification (Flexible)\n"
-        "(S) Role: Senior Content Strategist (affiliate frameworks)\n"
-        "(C) Context: Identify the underlying narrative framework\n"
-        "(R) Responsibility: Map the narrative to a known framework\n"
-        "(I) Instructions: Identify the closest framework (e.g., PAS, BAB, Story, Direct Demo, Us vs. Them) and break the "
-        "transcript into atomic stages - that is, each stage must be around no more than one objective and purpose so that "
-        "the analysis doesn’t lose important details by accident.\n"
-        "Expected Output\n"
-        "Stage 1: [summary] — Objective: [one phrase]\n"
-        "Stage 2: [summary] — Objective: [one phrase]\n"
-        "Stage 3: [summary] — Objective: [one phrase]\n"
-        "\n"
-        "Prompt 4 — Visual & Text\n"
-        "(S) Role: Visual Stylist\n"
-        "(C) Context: Check if visual storytelling and text overlays align with engagement standards\n"
-        "(R) Responsibility: Evaluate shot composition and text design\n"
-        "(I) Instructions: Answer: Góc quay nào? Text dùng font native hay brand? Có emoji? Visual kể chuyện rõ không?\n"
-        "(B) Banter: Observational, precise\n"
-        "(E) Evaluation: Concise but vivid notes\n"
-        "Expected Output — Concise Format\n"
-        "Camera angles: …\n"
-        "Text style: …\n"
-        "Emoji use: …\n"
-        "Visual clarity/storytelling: …\n"
-        "\n"
-        "Prompt 5 — Pacing\n"
-        "(S) Role: Retention Analyst\n"
-        "(C) Context: Speed and rhythm dictate completion rates\n"
-        "(R) Responsibility: Assess editing pace and audience fit\n"
-        "(I) Instructions: Evaluate: Nhịp cắt nhanh hay chậm? Có đủ cuốn với target audience không? "
-        "Có giữ người xem đến cuối?\n"
-        "(B) Banter: Direct, performance-focused\n"
-        "(E) Evaluation: Clear, tactical notes\n"
-        "Expected Output — Concise Format\n"
-        "Cut pace: …\n"
-        "Audience fit: …\n"
-        "Retention strength: …\n"
-        "\n"
-        "Prompt 6 — Structured Evaluation\n"
-        "(S) Role: Script Doctor & Performance Analyst\n"
-        "(C) Context: Scorecard to inform improvements\n"
-        "(R) Responsibility: Score Hook, Body, CTA with a single actionable sentence each\n"
-        "(I) Instructions: Provide scores and one-sentence critiques. Add Transfer Risk (elements likely to break if "
-        "changed in isolation).\n"
-        "(B) Banter: Authoritative, conclusive, helpful\n"
-        "(E) Evaluation: Clear, structured scorecard\n"
-        "Expected Output — Concise Format\n"
-        "Hook: [X/10] — [one-sentence critique]\n"
-        "Body: [X/10] — [one-sentence critique]\n"
-        "CTA: [X/10] — [one-sentence critique]\n"
-        "Transfer risk: [short list]\n"
-        "\n"
-        "Prompt 7 — Transferable Working Elements (TWE)\n"
-        "(S) Role: Conversion Anthropologist\n"
-        "(C) Context: Capture the specific mechanisms that drove performance\n"
-        "(R) Responsibility: Produce a structured list of Working Elements with severity levels that future variants must keep. "
-        "For each, define the underlying psychological or marketing principle, provide a short quote as evidence, and state "
-        "the rule for future use.\n"
-        "(I) Instructions: From all previous sections (transcript, Persona, Hook, Big Idea, Structure, Visual & Text, Pacing, "
-        "and Evaluation), extract elements. Mark as MUST-KEEP or ADAPTABLE, explain the principle, provide a short quote as "
-        "evidence, and add usage guidance.\n"
-        "(B) Banter: Forensic, anthropological, sharp\n"
-        "(E) Evaluation: List is comprehensive, future-proof, not surface-level\n"
-        "Expected Output — Concise Format\n"
-        "Category | Element / Rule | Quote / Example | Guidance\n"
-    )
 
+async def gemini_analyze_transcript(
+    *,
+    api_key: Optional[str],
+    transcript_text: str,
+    user_prompt: str = "",
+    model_name: str = DEFAULT_VISION_MODEL,
+    visual_parts: Optional[List[Any]] = None,
+    max_transcript_chars: int = 16000,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Step 2 — 7 analyses dựa trên transcript (chỉ text, không cần video).
+    visual_parts (tuỳ chọn): keyframes + cut list cho Visual & Text / Pacing.
+    """
     t1 = time.perf_counter()
     analysis_parts: List[Any] = [
-        {"text": analysis_preamble},
-        {"text": "### Step 2 — Analyses\n[SYSTEM]\nKeep headings exactly as specified. Be concise. If missing info, write (Không xác định)."},
-        {"text": "### Step 1 — Transcript\n" + _truncate(transcript_text, 16000)},
+        {"text": _VIDEO_ANALYSIS_PREAMBLE},
+        {"text": _VIDEO_ANALYSIS_SYSTEM},
+        {"text": "### Step 1 — Transcript\n" + _truncate(transcript_text, max_transcript_chars)},
     ]
+    if visual_parts:
+        analysis_parts.extend(visual_parts)
     if user_prompt:
         analysis_parts.append({"text": "\n[USER_NOTE]\n" + user_prompt.strip()})
 
@@ -532,20 +818,190 @@ async def gemini_generate_video_report(
     analyses_text = (analyses_text or "").strip()
     dt2_ms = int((time.perf_counter() - t1) * 1000)
     _log_info(f"VIDEO_REPORT analyses_done chars={len(analyses_text)} dt_ms={dt2_ms}")
+    return analyses_text, {"model": model_name, "t_analyses_ms": dt2_ms}
+
+
+async def gemini_generate_video_report(
+    *,
+    api_key: Optional[str],
+    uploaded_file: Any,
+    user_prompt: str = "",
+    model_name: str = DEFAULT_VISION_MODEL,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Trả RAW markdown gồm:
+      - Step 1 — Transcript
+      - Step 2 — Analyses (7 mục)
+    Có log IP, đo thời gian các bước, và tương thích cả 2 SDK upload.
+    meta["transcript"] giữ transcript thô để caller lưu thành artifact.
+    """
+    t_all0 = time.perf_counter()
+    fid = _file_ref_id(uploaded_file)
+    _log_info(f"VIDEO_REPORT start model={model_name} file_id={fid}")
+
+    # -------- Step 1: Transcript --------
+    transcript_text, t_meta = await gemini_transcribe_video(
+        api_key=api_key,
+        uploaded_file=uploaded_file,
+        user_prompt=user_prompt,
+        model_name=model_name,
+    )
+
+    # -------- Step 2: Analyses --------
+    analyses_text, a_meta = await gemini_analyze_transcript(
+        api_key=api_key,
+        transcript_text=transcript_text,
+        user_prompt=user_prompt,
+        model_name=model_name,
+    )
 
     # -------- Assemble final markdown --------
-    final_md = transcript_text
-    if not final_md.startswith("### Step 1 — Transcript"):
-        final_md = "### Step 1 — Transcript\n" + final_md
-    final_md += "\n\n"
-    if not analyses_text.startswith("### Step 2 — Analyses"):
-        final_md += "### Step 2 — Analyses\n"
-    final_md += analyses_text
+    final_md = assemble_video_report(transcript_text, analyses_text)
 
     tot_ms = int((time.perf_counter() - t_all0) * 1000)
     _log_info(f"VIDEO_REPORT done total_ms={tot_ms} file_id={fid}")
 
-    return final_md, {"model": model_name, "file_id": fid, "t_transcript_ms": dt_ms, "t_analyses_ms": dt2_ms, "t_total_ms": tot_ms}
+    return final_md, {
+        "model": model_name,
+        "file_id": fid,
+        "t_transcript_ms": t_meta["t_transcript_ms"],
+        "t_analyses_ms": a_meta["t_analyses_ms"],
+        "t_total_ms": tot_ms,
+        "transcript": transcript_text,
+    }
+
+
+async def gemini_transcribe_segments(
+    *,
+    api_key: Optional[str],
+    segments: List[Dict[str, Any]],
+    user_prompt: str = "",
+    model_name: str = DEFAULT_VISION_MODEL,
+    concurrency: int = 4,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Map-reduce transcript cho media dài:
+      - map: mỗi đoạn (video_segments.split_media) upload + transcribe song song (giới hạn concurrency)
+      - reduce: shift timestamp theo offset của đoạn và ghép đúng thứ tự
+    Latency ~ thời lượng 1 cửa sổ thay vì toàn bộ video.
+    """
+    from app.services.video_segments import stitch_transcripts
+
+    t0 = time.perf_counter()
+    sem = asyncio.Semaphore(max(1, concurrency))
+    total = len(segments)
+
+    async def _one(seg: Dict[str, Any]) -> Tuple[float, str]:
+        async with sem:
+            uploaded = await gemini_upload_file(api_key=api_key, file_path=str(seg["path"]))
+            note = (
+                f"[SEGMENT {seg['index'] + 1}/{total}] This media is one window of a longer video. "
+                "Timestamps must be relative to the START of this window (first line ~[00:00])."
+            )
+            txt, _ = await gemini_transcribe_video(
+                api_key=api_key,
+                uploaded_file=uploaded,
+                user_prompt=(note + ("\n" + user_prompt.strip() if user_prompt else "")),
+                model_name=model_name,
+            )
+            return float(seg["offset"]), txt
+
+    results = await asyncio.gather(*(_one(seg) for seg in segments))
+    transcript_text = stitch_transcripts(list(results))
+    dt_ms = int((time.perf_counter() - t0) * 1000)
+    _log_info(f"VIDEO_REPORT segmented_transcript_done segments={total} chars={len(transcript_text)} dt_ms={dt_ms}")
+    return transcript_text, {"model": model_name, "segments": total, "t_transcript_ms": dt_ms}
+
+
+async def gemini_report_from_transcript(
+    *,
+    api_key: Optional[str],
+    transcript_text: str,
+    user_prompt: str = "",
+    model_name: str = DEFAULT_VISION_MODEL,
+    visual_parts: Optional[List[Any]] = None,
+    max_transcript_chars: int = 16000,
+    t_transcript_ms: int = 0,
+) -> Tuple[str, Dict[str, Any]]:
+    """Step 2 + ghép markdown khi transcript đã có sẵn (segmented / artifact)."""
+    analyses_text, a_meta = await gemini_analyze_transcript(
+        api_key=api_key,
+        transcript_text=transcript_text,
+        user_prompt=user_prompt,
+        model_name=model_name,
+        visual_parts=visual_parts,
+        max_transcript_chars=max_transcript_chars,
+    )
+    return assemble_video_report(transcript_text, analyses_text), {
+        "model": model_name,
+        "t_transcript_ms": t_transcript_ms,
+        "t_analyses_ms": a_meta["t_analyses_ms"],
+        "t_total_ms": t_transcript_ms + a_meta["t_analyses_ms"],
+        "transcript": transcript_text,
+    }
+
+
+def keyframe_visual_parts(scene_info: Dict[str, Any]) -> List[Any]:
+    """
+    Chuyển kết quả keyframes.analyze_scenes thành parts (text + inline JPEG)
+    để thay thế video đầy đủ cho Prompt 4 (Visual & Text) và Prompt 5 (Pacing).
+    """
+    parts: List[Any] = [
+        {"text": _KEYFRAME_SYSTEM},
+        {"text": scene_summary_text(scene_info)},
+    ]
+    for i, kf in enumerate(scene_info.get("keyframes") or [], start=1):
+        parts.append({"text": _KEYFRAME_LABEL.format(i=i, ts=fmt_ts(kf["t"]))})
+        parts.append({"mime_type": "image/jpeg", "data": kf["jpeg"]})
+    return parts
+
+
+async def gemini_generate_keyframe_report(
+    *,
+    api_key: Optional[str],
+    uploaded_media: Any,
+    scene_info: Dict[str, Any],
+    user_prompt: str = "",
+    model_name: str = DEFAULT_VISION_MODEL,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Mode "keyframes": Step 1 transcribe từ media nhẹ (thường chỉ audio track),
+    Step 2 nhận transcript + keyframes + cut list thay vì toàn bộ video.
+    Cùng output/meta với gemini_generate_video_report.
+    """
+    t_all0 = time.perf_counter()
+    fid = _file_ref_id(uploaded_media)
+    n_kf = len(scene_info.get("keyframes") or [])
+    _log_info(f"VIDEO_REPORT start mode=keyframes model={model_name} file_id={fid} keyframes={n_kf}")
+
+    transcript_text, t_meta = await gemini_transcribe_video(
+        api_key=api_key,
+        uploaded_file=uploaded_media,
+        user_prompt=user_prompt,
+        model_name=model_name,
+    )
+    analyses_text, a_meta = await gemini_analyze_transcript(
+        api_key=api_key,
+        transcript_text=transcript_text,
+        user_prompt=user_prompt,
+        model_name=model_name,
+        visual_parts=keyframe_visual_parts(scene_info),
+    )
+    final_md = assemble_video_report(transcript_text, analyses_text)
+
+    tot_ms = int((time.perf_counter() - t_all0) * 1000)
+    _log_info(f"VIDEO_REPORT done mode=keyframes total_ms={tot_ms} file_id={fid}")
+    return final_md, {
+        "model": model_name,
+        "file_id": fid,
+        "mode": "keyframes",
+        "t_transcript_ms": t_meta["t_transcript_ms"],
+        "t_analyses_ms": a_meta["t_analyses_ms"],
+        "t_total_ms": tot_ms,
+        "transcript": transcript_text,
+    }
+
+
 # =========================================================
 # Angles post-processing (EXPORTED)
 # =========================================================
@@ -731,23 +1187,288 @@ def extract_angles_from_block(angles_block: str) -> Tuple[List[str], List[Dict[s
     return [], []
 
 
+_INC_ANGLE_NUM_RE = re.compile(
+    r"^(?:Angle|Góc|Concept|Idea)\s*(\d+)\s*[:.\-–—)]?\s*(.*)$",
+    re.IGNORECASE | re.UNICODE,
+)
+_INC_ANGLE_LABEL_RE = re.compile(
+    r"^(?:Angle\s*Title|Tiêu đề Angle|Tiêu đề|Title)\s*[:\-–—]\s*(.+)$",
+    re.IGNORECASE | re.UNICODE,
+)
+_INC_OUTPUT2_RE = re.compile(r"^\s*OUTPUT\s*2\b", re.IGNORECASE | re.UNICODE)
+
+
+def _angles_unmark(ln: str) -> str:
+    """Bỏ markdown đầu/cuối dòng (#, *, -, •, **) để so regex heading."""
+    t = re.sub(r"^[\s#>*\-•]+", "", ln or "", flags=re.UNICODE)
+    t = re.sub(r"[\s*_]+$", "", t, flags=re.UNICODE)
+    return t.replace("**", "").strip()
+
+
+class IncrementalAngleParser:
+    """
+    Parse output PROMPT2 theo từng chunk stream (1 lượt qua từng dòng, không regex toàn văn):
+      preamble ('angle:' marker, code fence) -> framework TSV -> các block angle.
+    feed()/close() trả list event:
+      ("framework", table_text)             khi bảng kết thúc
+      ("angle", {number, title, raw})       khi block angle đóng (gặp heading kế tiếp / hết stream)
+    Nếu không nhận ra heading nào, close() fallback về extract_angles_from_block.
+    """
+
+    def __init__(self) -> None:
+        self._pending = ""
+        self._state = "preamble"        # preamble | table | angles
+        self._table: List[str] = []
+        self._table_has_data = False
+        self._table_blank = False
+        self._angle_lines: List[str] = []   # toàn bộ phần angles (cho fallback / angles_text)
+        self._cur: Optional[Dict[str, Any]] = None
+        self._cur_body: List[str] = []
+        self.framework_table = ""
+        self.angles: List[Dict[str, Any]] = []
+        self._closed = False
+
+    # ---- public ----
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        events: List[Tuple[str, Any]] = []
+        self._pending += _angles_norm_eol(chunk or "")
+        *lines, self._pending = self._pending.split("\n")
+        for ln in lines:
+            self._line(ln, events)
+        return events
+
+    def close(self) -> List[Tuple[str, Any]]:
+        if self._closed:
+            return []
+        self._closed = True
+        events: List[Tuple[str, Any]] = []
+        if self._pending:
+            ln, self._pending = self._pending, ""
+            self._line(ln, events)
+        if self._state == "table":
+            self._end_table(events)
+        self._close_angle(events)
+        if not self.angles:
+            _, full = extract_angles_from_block(self.angles_text)
+            for a in full:
+                a = {"number": a.get("number") or len(self.angles) + 1, "title": a.get("title", ""), "raw": a.get("raw", "")}
+                self.angles.append(a)
+                events.append(("angle", a))
+        return events
+
+    @property
+    def angles_text(self) -> str:
+        return _angles_strip_code_fences("\n".join(self._angle_lines)).strip()
+
+    # ---- internals ----
+    def _line(self, ln: str, events: List[Tuple[str, Any]]) -> None:
+        stripped = ln.strip()
+        if self._state == "preamble":
+            if not stripped or stripped.startswith("```") or re.match(r"^angles?\s*:\s*$", stripped, re.IGNORECASE):
+                return
+            if _angles_is_framework_header_line(ln):
+                self._state = "table"
+                self._table = [ln]
+                return
+            self._state = "angles"
+        if self._state == "table":
+            if not stripped:
+                if self._table_has_data:
+                    self._end_table(events)
+                return
+            if _angles_looks_table_like(ln) or _angles_is_md_sep(ln):
+                self._table.append(ln)
+                if not _angles_is_md_sep(ln):
+                    self._table_has_data = True
+                return
+            self._end_table(events)
+        self._angle_line(ln, events)
+
+    def _end_table(self, events: List[Tuple[str, Any]]) -> None:
+        self.framework_table = "\n".join(self._table).strip()
+        self._state = "angles"
+        events.append(("framework", self.framework_table))
+
+    def _angle_line(self, ln: str, events: List[Tuple[str, Any]]) -> None:
+        if not self._angle_lines and _INC_OUTPUT2_RE.match(ln):
+            return
+        self._angle_lines.append(ln)
+        head = _angles_unmark(ln)
+        m_num = _INC_ANGLE_NUM_RE.match(head)
+        m_lbl = None if m_num else _INC_ANGLE_LABEL_RE.match(head)
+
+        if m_num:
+            self._close_angle(events)
+            self._cur = {"number": int(m_num.group(1)), "title": _angles_trim_title(m_num.group(2)), "by": "num"}
+            return
+        if m_lbl:
+            title = _angles_trim_title(m_lbl.group(1))
+            # "Angle 2: X" rồi "Angle Title: X" ở dòng dưới -> cùng 1 angle
+            if self._cur is not None and self._cur["by"] == "num":
+                if not self._cur["title"]:
+                    self._cur["title"] = title
+                self._cur_body.append(ln)
+                return
+            self._close_angle(events)
+            self._cur = {"number": None, "title": title, "by": "label"}
+            return
+        if self._cur is not None:
+            self._cur_body.append(ln)
+
+    def _close_angle(self, events: List[Tuple[str, Any]]) -> None:
+        if self._cur is None:
+            return
+        angle = {
+            "number": self._cur["number"] or len(self.angles) + 1,
+            "title": self._cur["title"] or f"Angle {len(self.angles) + 1}",
+            "raw": "\n".join(self._cur_body).strip().rstrip("`").strip(),
+        }
+        self._cur, self._cur_body = None, []
+        self.angles.append(angle)
+        events.append(("angle", angle))
+
+
 # =========================================================
-# Landing analysis — 2 prompt, trả 2 chuỗi RAW riêng biệt
+# Landing analysis — map-reduce cho review dump lớn
 # =========================================================
-async def gemini_generate_landing_analysis(
+_LANDING_MAP_PROMPT = """You are extracting research notes from ONE CHUNK of a larger customer-feedback dump
+(chunk {index}/{total}). Other chunks are processed separately and merged later.
+
+Extract, grounded ONLY in this chunk:
+1. Themes — recurring features/benefits/problems/use cases. For each: short name + approx. number of comments (~N).
+2. Motivations & Outcomes — why customers bought, concrete results (numbers, time saved...).
+3. Pain Points — concrete "before" scenarios and frustrations.
+4. Golden Phrases — 5–15 vivid quotes copied VERBATIM in quotes (keep the customer voice, no paraphrase).
+5. Persona hints — who is speaking (role, situation).
+
+Rules: compact markdown bullets, no intro/outro, no angles, no recommendations. If the chunk has no feedback, write "(no feedback)".
+"""
+
+_LANDING_MERGE_PROMPT = """Merge the following research-note sets (each extracted from a different chunk of one
+customer-feedback dump) into ONE set with the same 5 sections: Themes, Motivations & Outcomes, Pain Points,
+Golden Phrases, Persona hints.
+- Merge duplicate themes and ADD their ~N counts; order themes by total count.
+- Keep golden phrases verbatim; drop near-duplicates; keep the 20 strongest.
+- Compact markdown bullets only.
+"""
+
+
+def _split_text_chunks(text: str, max_chars: int) -> List[str]:
+    """Cắt theo dòng (1 review thường = 1 dòng), dòng quá dài thì cắt cứng."""
+    chunks: List[str] = []
+    buf: List[str] = []
+    size = 0
+    for line in (text or "").splitlines():
+        if len(line) > max_chars and buf:
+            # flush các dòng trước đó trước khi cắt cứng -> giữ đúng thứ tự dòng
+            chunks.append("\n".join(buf))
+            buf, size = [], 0
+        while len(line) > max_chars:
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+        if size + len(line) + 1 > max_chars and buf:
+            chunks.append("\n".join(buf))
+            buf, size = [], 0
+        buf.append(line)
+        size += len(line) + 1
+    if buf and "\n".join(buf).strip():
+        chunks.append("\n".join(buf))
+    return [c for c in chunks if c.strip()]
+
+
+def _landing_header(page_text: str) -> Tuple[str, str]:
+    """Tách phần header (URL/Title/Description của landing_fetch) khỏi body để lặp lại ở mỗi chunk."""
+    marker = "[PAGE TEXT]" if "[PAGE TEXT]" in page_text else ("[CUSTOMER REVIEWS]" if "[CUSTOMER REVIEWS]" in page_text else "")
+    if not marker:
+        return "", page_text
+    idx = page_text.index(marker)
+    return page_text[:idx].strip(), page_text[idx:]
+
+
+async def gemini_map_reduce_feedback(
     *,
     api_key: Optional[str],
     page_text: str,
-    user_prompt: str = "",
     model_name: str = DEFAULT_TEXT_MODEL,
-) -> Tuple[str, str, Dict[str, Any]]:
+    chunk_chars: int = 20000,
+    max_reduce_chars: int = 40000,
+) -> Tuple[str, Dict[str, Any]]:
     """
-    2-prompt (marker 'analys url:' & 'angle:') → trả RAW text RIÊNG từng prompt.
-    Không parse. Không gộp.
+    Map: mỗi chunk -> notes (themes / pain points / golden phrases) chạy song song,
+    bị chặn bởi limiter chung của worker (_gemini_limiter).
+    Reduce: gộp notes theo nhóm (cây) tới khi vừa max_reduce_chars.
+    Latency ~ (1 map + log(n) merge) thay vì tuyến tính theo số review.
     """
-    page_text = (page_text or "").strip()
+    t0 = time.perf_counter()
+    header, body = _landing_header(page_text)
+    chunks = _split_text_chunks(body, max(2000, chunk_chars))
+    total = len(chunks)
+
+    async def _map(i: int, chunk: str) -> str:
+        parts: List[Any] = [
+            {"text": _LANDING_MAP_PROMPT.format(index=i + 1, total=total)},
+            {"text": (f"{header}\n\n" if header else "") + chunk},
+        ]
+        return await _gen_text(
+            api_key=api_key,
+            model_name=model_name,
+            parts=parts,
+            generation_config={"temperature": 0.3, "max_output_tokens": 2048},
+        )
+
+    notes = list(await asyncio.gather(*(_map(i, c) for i, c in enumerate(chunks))))
+    t_map_ms = int((time.perf_counter() - t0) * 1000)
+
+    rounds = 0
+    while len(notes) > 1 and sum(len(n) for n in notes) > max_reduce_chars:
+        rounds += 1
+        groups: List[List[str]] = []
+        cur: List[str] = []
+        cur_len = 0
+        for n in notes:
+            if cur and (cur_len + len(n) > max_reduce_chars or len(cur) >= 8):
+                groups.append(cur)
+                cur, cur_len = [], 0
+            cur.append(n)
+            cur_len += len(n)
+        if cur:
+            groups.append(cur)
+        if len(groups) == len(notes):  # từng note đã quá lớn -> không gộp thêm được
+            break
+
+        async def _merge(group: List[str]) -> str:
+            if len(group) == 1:
+                return group[0]
+            joined = "\n\n".join(f"=== NOTES {j + 1} ===\n{g}" for j, g in enumerate(group))
+            return await _gen_text(
+                api_key=api_key,
+                model_name=model_name,
+                parts=[{"text": _LANDING_MERGE_PROMPT}, {"text": joined}],
+                generation_config={"temperature": 0.3, "max_output_tokens": 3072},
+            )
+
+        notes = list(await asyncio.gather(*(_merge(g) for g in groups)))
+
+    merged = "\n\n".join(f"=== CHUNK NOTES {i + 1}/{len(notes)} ===\n{n}" for i, n in enumerate(notes))
+    dt_ms = int((time.perf_counter() - t0) * 1000)
+    _log_info(
+        f"LANDING_MAP_REDUCE chunks={total} input_chars={len(page_text)} notes_chars={len(merged)} "
+        f"reduce_rounds={rounds} t_map_ms={t_map_ms} dt_ms={dt_ms}"
+    )
+    synthesis = (
+        f"{header}\n\n" if header else ""
+    ) + (
+        f"[PRE-EXTRACTED NOTES — the raw feedback ({len(page_text)} chars) was too large for one pass; "
+        f"it was split into {total} chunks and each chunk was analysed separately. ~N are comment counts.]\n"
+        f"{merged}"
+    )
+    return synthesis, {"map_chunks": total, "reduce_rounds": rounds, "t_map_ms": t_map_ms, "t_map_reduce_ms": dt_ms}
 
-    PROMPT1 = """AI Agent Instructions: Content Angle Discovery from Customer Feedback
+
+# =========================================================
+# Landing analysis — 2 prompt, trả 2 chuỗi RAW riêng biệt
+# =========================================================
+_LANDING_PROMPT1 = """AI Agent Instructions: Content Angle Discovery from Customer Feedback
 
 Objective:
 Analyze a provided set of raw customer comments and reviews to identify and develop the most resonant and effective content angles for an affiliate short video. The goal is to move from unstructured data to actionable creative concepts, grounded in the authentic voice of the customer.
@@ -775,105 +1496,613 @@ Pinpoint Specific Pain Points: List the concrete “before” scenarios and frus
 Mine for “Golden Phrases”: Extract powerful quotes or vivid phrases — keep the exact “voice of the customer”.
 Segment the Audience: Group customers into 3–5 personas with short descriptions.
 
-Phase 2: Synthesis and Strategic Recommendations
-Create an Insight Summary: Provide the single most compelling value proposition and who benefits most (persona).
+Phase 2: Synthesis and Strategic Recommendations
+Create an Insight Summary: Provide the single most compelling value proposition and who benefits most (persona).
+
+Phase 3: Generation of Video Content Angles
+Generate 3–5 Distinct Angles:
+- Angle Title
+- Target Persona
+- Core Message (≤ 30s idea)
+- Brief Story Arc (3 steps: Problem → Solution → Outcome or similar)
+- CTA
+
+Rules:
+- Use plain language; avoid jargon.
+- Ground every point in the raw customer voice where possible.
+- If Product Information is missing, infer a concise description from the raw data.
+
+OUTPUT FORMAT:
+Start the output with EXACTLY this marker on its own line:
+analys url:
+Then immediately write the full analysis/synthesis/angles content after that line. Do not add anything before the marker.
+"""
+
+_LANDING_PROMPT2 = """ROLE
+
+You are a Research Synthesizer & Creative Strategist. Your job is to take a long, unstructured research analysis about a product and transform it into two structured deliverables:
+1) A Framework Extraction Table that organizes the raw insights.
+2) A Content Angle Sheet that develops marketing-ready creative directions using PAS or AIDA structures.
+
+INPUT
+Raw Research Document: A long-form product analysis, review compilation, or research report.
+
+OUTPUT 1 — Framework Extraction (TSV, NOT markdown)
+STRICT FORMAT RULES:
+- Use TAB-separated values only (\\t). Do NOT use the "|" character anywhere.
+- The header MUST be printed EXACTLY as a single line (tab-separated):
+Section\tExtracted Framework Content\tEvidence (quote/timestamp)\tConfidence
+- Then print rows with EXACTLY 4 columns, also tab-separated.
+- If a cell is missing, write "-". If evidence is weak, set Confidence to "Medium".
+- Keep this whole table compact and under 60 lines.
+
+OUTPUT 2 — Content Angle Development
+For each content angle (3–5 total), include:
+- Angle Title (short, punchy)
+- Target Persona (1–2 sentences)
+- Core Message (central idea)
+- Story Arc using PAS OR AIDA:
+  PAS: Problem → Agitate → Solution
+  AIDA: Attention → Interest → Desire → Action
+- Tie every angle back to the Framework table (USPs, benefits, personas).
+
+GLOBAL RULES
+- Use plain, simple language — avoid jargon.
+- Angles must be unique and grounded in the insights.
+- If any part is ambiguous, make a reasonable, concise assumption.
+
+OUTPUT ORDER & MARKER
+- The VERY FIRST line of your entire output MUST be exactly:
+angle:
+- Immediately after that, print OUTPUT 1 (TSV table).
+- After the table, print a blank line, then OUTPUT 2 (the angles).
+- Do NOT add anything before 'angle:'.
+"""
+
+# Phase 1 (PROMPT1 + map-reduce) cache theo version này; đổi prompt -> cache cũ tự hết hiệu lực
+LANDING_PHASE1_PROMPT_VERSION = _prompt_version(_LANDING_PROMPT1, _LANDING_MAP_PROMPT, _LANDING_MERGE_PROMPT)
+
+
+async def gemini_landing_phase1(
+    *,
+    api_key: Optional[str],
+    page_text: str,
+    user_prompt: str = "",
+    model_name: str = DEFAULT_TEXT_MODEL,
+    map_threshold_chars: int = 40000,
+    map_chunk_chars: int = 20000,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    PROMPT1 (marker 'analys url:'). page_text > map_threshold_chars: chạy trên notes
+    đã map-reduce thay vì raw text.
+    """
+    page_text = (page_text or "").strip()
+    t0 = time.perf_counter()
+    meta: Dict[str, Any] = {"model": model_name}
+    raw_data = page_text
+    if map_threshold_chars > 0 and len(page_text) > map_threshold_chars:
+        raw_data, mr_meta = await gemini_map_reduce_feedback(
+            api_key=api_key,
+            page_text=page_text,
+            model_name=model_name,
+            chunk_chars=map_chunk_chars,
+            max_reduce_chars=map_threshold_chars,
+        )
+        meta.update(mr_meta)
+
+    p1_parts: List[Any] = [
+        {"text": _LANDING_PROMPT1},
+        {"text": (
+            "INPUT MATERIAL\n"
+            "Product Information: (infer if not explicitly provided)\n"
+            "Raw Data (customer comments & reviews):\n"
+            f"{raw_data}\n"
+        )},
+    ]
+    if user_prompt:
+        p1_parts.append({"text": "\n[USER_NOTE]\n" + user_prompt.strip()})
+
+    t1 = await _gen_text(
+        api_key=api_key,
+        model_name=model_name,
+        parts=p1_parts,
+        generation_config={"temperature": 0.5, "max_output_tokens": 4096},
+    )
+    meta["t_phase1_ms"] = int((time.perf_counter() - t0) * 1000)
+    return t1, meta
+
+
+def _landing_angles_parts(analysis_text: str, user_prompt: str = "") -> List[Any]:
+    p2_parts: List[Any] = [
+        {"text": _LANDING_PROMPT2},
+        {"text": (
+            "Raw Research Document (from Phase 1):\n"
+            "=== START ANALYSIS ===\n"
+            f"{analysis_text}\n"
+            "=== END ANALYSIS ===\n"
+        )},
+    ]
+    if user_prompt:
+        p2_parts.append({"text": "\n[USER_NOTE]\n" + user_prompt.strip()})
+    return p2_parts
+
+
+async def gemini_landing_angles(
+    *,
+    api_key: Optional[str],
+    analysis_text: str,
+    user_prompt: str = "",
+    model_name: str = DEFAULT_TEXT_MODEL,
+) -> Tuple[str, Dict[str, Any]]:
+    """PROMPT2 (marker 'angle:') trên output phase 1 — framework table + angles."""
+    t0 = time.perf_counter()
+    p2_parts = _landing_angles_parts(analysis_text, user_prompt)
+
+    t2 = await _gen_text(
+        api_key=api_key,
+        model_name=model_name,
+        parts=p2_parts,
+        generation_config={"temperature": 0.6, "max_output_tokens": 6144},
+    )
+    return t2, {"model": model_name, "t_phase2_ms": int((time.perf_counter() - t0) * 1000)}
+
+
+async def gemini_landing_angles_stream(
+    *,
+    api_key: Optional[str],
+    analysis_text: str,
+    user_prompt: str = "",
+    model_name: str = DEFAULT_TEXT_MODEL,
+) -> AsyncIterator[str]:
+    """Như gemini_landing_angles nhưng stream text PROMPT2 (dùng với IncrementalAngleParser)."""
+    p2_parts = _landing_angles_parts(analysis_text, user_prompt)
+
+    async for piece in _ga_stream_text(
+        api_key=api_key,
+        model_name=model_name,
+        parts=p2_parts,
+        generation_config={"temperature": 0.6, "max_output_tokens": 6144},
+    ):
+        yield piece
+
+
+# ---- Structured mode (opt-in): PROMPT2 trả JSON theo response_schema ----
+_LANDING_PROMPT2_JSON = """ROLE
+You are a Research Synthesizer & Creative Strategist. Turn the research analysis below into:
+1) framework_rows — a compact Framework Extraction table (max 60 rows): section, content, evidence (quote/timestamp or "-"), confidence (High/Medium/Low).
+2) angles — 3–5 unique, marketing-ready content angles. For each: title (short, punchy), target_persona (1–2 sentences),
+   core_message, framework ("PAS" or "AIDA"), story_arc (the PAS or AIDA steps as one text, "Problem → Agitate → Solution" style),
+   and cta.
+Tie every angle back to the framework rows (USPs, benefits, personas). Use plain, simple language.
+"""
+
+_LANDING_ANGLES_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "framework_rows": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "section": {"type": "STRING"},
+                    "content": {"type": "STRING"},
+                    "evidence": {"type": "STRING"},
+                    "confidence": {"type": "STRING"},
+                },
+                "required": ["section", "content", "evidence", "confidence"],
+            },
+        },
+        "angles": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "title": {"type": "STRING"},
+                    "target_persona": {"type": "STRING"},
+                    "core_message": {"type": "STRING"},
+                    "framework": {"type": "STRING"},
+                    "story_arc": {"type": "STRING"},
+                    "cta": {"type": "STRING"},
+                },
+                "required": ["title", "target_persona", "core_message", "story_arc"],
+            },
+        },
+    },
+    "required": ["framework_rows", "angles"],
+}
+
+
+class FrameworkRow(BaseModel):
+    section: str = ""
+    content: str = ""
+    evidence: str = "-"
+    confidence: str = "Medium"
+
+
+class StructuredAngle(BaseModel):
+    title: str = ""
+    target_persona: str = ""
+    core_message: str = ""
+    framework: str = ""
+    story_arc: str = ""
+    cta: str = ""
+
+    def raw_text(self) -> str:
+        lines = [
+            f"Target Persona: {self.target_persona}",
+            f"Core Message: {self.core_message}",
+            f"Story Arc ({self.framework or 'PAS'}): {self.story_arc}",
+        ]
+        if self.cta:
+            lines.append(f"CTA: {self.cta}")
+        return "\n".join(lines)
+
+
+class StructuredAngles(BaseModel):
+    framework_rows: List[FrameworkRow] = []
+    angles: List[StructuredAngle] = []
+
+
+async def gemini_landing_angles_structured(
+    *,
+    api_key: Optional[str],
+    analysis_text: str,
+    user_prompt: str = "",
+    model_name: str = DEFAULT_TEXT_MODEL,
+) -> Tuple[str, str, List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    PROMPT2 dạng JSON (response_schema) -> decode + validate bằng pydantic, không cần regex.
+    Trả (framework_table TSV, angles_text, angles_full [{number,title,raw}], meta) — cùng shape với bản text.
+    """
+    t0 = time.perf_counter()
+    parts: List[Any] = [
+        {"text": _LANDING_PROMPT2_JSON},
+        {"text": (
+            "Raw Research Document (from Phase 1):\n"
+            "=== START ANALYSIS ===\n"
+            f"{analysis_text}\n"
+            "=== END ANALYSIS ===\n"
+        )},
+    ]
+    if user_prompt:
+        parts.append({"text": "\n[USER_NOTE]\n" + user_prompt.strip()})
+
+    raw = await _gen_text(
+        api_key=api_key,
+        model_name=model_name,
+        parts=parts,
+        generation_config={
+            "temperature": 0.6,
+            "max_output_tokens": 6144,
+            "response_mime_type": "application/json",
+            "response_schema": _LANDING_ANGLES_SCHEMA,
+        },
+    )
+    data = StructuredAngles.model_validate_json(raw)
+
+    def _cell(v: str) -> str:
+        return re.sub(r"[\t\r\n|]+", " ", v or "").strip() or "-"
+
+    framework_table = ""
+    if data.framework_rows:
+        rows = ["Section\tExtracted Framework Content\tEvidence (quote/timestamp)\tConfidence"]
+        rows += [
+            "\t".join(_cell(x) for x in (r.section, r.content, r.evidence, r.confidence))
+            for r in data.framework_rows
+        ]
+        framework_table = "\n".join(rows)
+
+    full = [
+        {"number": i, "title": _angles_trim_title(a.title) or f"Angle {i}", "raw": a.raw_text()}
+        for i, a in enumerate(data.angles, start=1)
+    ]
+    angles_text = "\n\n".join(f"Angle {a['number']}: {a['title']}\n{a['raw']}" for a in full)
+    return framework_table, angles_text, full, {
+        "model": model_name,
+        "structured": True,
+        "t_phase2_ms": int((time.perf_counter() - t0) * 1000),
+    }
+
+
+async def gemini_generate_landing_analysis(
+    *,
+    api_key: Optional[str],
+    page_text: str,
+    user_prompt: str = "",
+    model_name: str = DEFAULT_TEXT_MODEL,
+    map_threshold_chars: int = 40000,
+    map_chunk_chars: int = 20000,
+) -> Tuple[str, str, Dict[str, Any]]:
+    """
+    2-prompt (marker 'analys url:' & 'angle:') → trả RAW text RIÊNG từng prompt.
+    Không parse. Không gộp.
+    """
+    t1, meta = await gemini_landing_phase1(
+        api_key=api_key,
+        page_text=page_text,
+        user_prompt=user_prompt,
+        model_name=model_name,
+        map_threshold_chars=map_threshold_chars,
+        map_chunk_chars=map_chunk_chars,
+    )
+    t2, meta2 = await gemini_landing_angles(
+        api_key=api_key,
+        analysis_text=t1,
+        user_prompt=user_prompt,
+        model_name=model_name,
+    )
+    meta.update(meta2)
+    return t1, t2, meta
+
+
+# =========================================================
+# Report digest — tóm tắt có cấu trúc, sinh 1 lần / report, thay report đầy đủ ở downstream
+# =========================================================
+REPORT_DIGEST_NS = "report_digests"
+REPORT_DIGEST_MARK = "[REPORT DIGEST]"
+
+_REPORT_DIGEST_PROMPT = (
+    "ROLE: Ad-creative analyst compressing a video report for downstream script writing.\n"
+    "INPUT: a RAW markdown report (Step 1 transcript with timestamps + Step 2 analyses, including "
+    "Prompt 7 Transferable Working Elements).\n"
+    "TASK: Return ONLY JSON matching the schema. Keep every fact a script writer needs to clone the ad:\n"
+    "- hook: the opening line(s) verbatim + hook type + why it stops the scroll (1 sentence).\n"
+    "- product / audience / funnel_stage (Cold/Warm/Hot) / cta: short phrases, '(Không xác định)' if absent.\n"
+    "- framework_stages: the narrative structure in order (stage name, timestamp range, one-line summary).\n"
+    "- twe_rules: every MUST-KEEP element from Prompt 7 as 'MUST-KEEP: <rule>', then ADAPTABLE ones.\n"
+    "- key_quotes: 3-8 short quotes copied VERBATIM from the transcript (no paraphrase).\n"
+    "- visual_pacing: 1-2 sentences on visual style, text overlays and cut pace.\n"
+    "LANGUAGE: same language as the report. Be terse; no commentary."
+)
+
+_REPORT_DIGEST_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "hook": {"type": "STRING"},
+        "product": {"type": "STRING"},
+        "audience": {"type": "STRING"},
+        "funnel_stage": {"type": "STRING"},
+        "framework_stages": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "stage": {"type": "STRING"},
+                    "timestamp": {"type": "STRING"},
+                    "summary": {"type": "STRING"},
+                },
+                "required": ["stage", "summary"],
+            },
+        },
+        "twe_rules": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "key_quotes": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "visual_pacing": {"type": "STRING"},
+        "cta": {"type": "STRING"},
+    },
+    "required": ["hook", "framework_stages", "twe_rules", "key_quotes"],
+}
+
+REPORT_DIGEST_PROMPT_VERSION = _prompt_version(_REPORT_DIGEST_PROMPT, json.dumps(_REPORT_DIGEST_SCHEMA, sort_keys=True))
+
 
-Phase 3: Generation of Video Content Angles
-Generate 3–5 Distinct Angles:
-- Angle Title
-- Target Persona
-- Core Message (≤ 30s idea)
-- Brief Story Arc (3 steps: Problem → Solution → Outcome or similar)
-- CTA
+class DigestStage(BaseModel):
+    stage: str = ""
+    timestamp: str = ""
+    summary: str = ""
 
-Rules:
-- Use plain language; avoid jargon.
-- Ground every point in the raw customer voice where possible.
-- If Product Information is missing, infer a concise description from the raw data.
 
-OUTPUT FORMAT:
-Start the output with EXACTLY this marker on its own line:
-analys url:
-Then immediately write the full analysis/synthesis/angles content after that line. Do not add anything before the marker.
-"""
-    p1_parts: List[Any] = [
-        {"text": PROMPT1},
-        {"text": (
-            "INPUT MATERIAL\n"
-            "Product Information: (infer if not explicitly provided)\n"
-            "Raw Data (customer comments & reviews):\n"
-            f"{page_text}\n"
-        )},
+class ReportDigest(BaseModel):
+    hook: str = ""
+    product: str = ""
+    audience: str = ""
+    funnel_stage: str = ""
+    framework_stages: List[DigestStage] = []
+    twe_rules: List[str] = []
+    key_quotes: List[str] = []
+    visual_pacing: str = ""
+    cta: str = ""
+
+
+def _quote_norm(s: str) -> str:
+    return re.sub(r"\W+", " ", (s or "").lower()).strip()
+
+
+def validate_report_digest(digest: ReportDigest, report: str) -> Tuple[ReportDigest, List[str]]:
+    """
+    Kiểm tra digest so với report gốc: quote phải có nguyên văn trong report (quote bịa bị bỏ),
+    phải có hook + >= 2 stage + ít nhất 1 TWE rule. Trả (digest đã lọc, issues); issues rỗng = dùng được.
+    """
+    issues: List[str] = []
+    report_norm = _quote_norm(report)
+    quotes = [q.strip() for q in digest.key_quotes if q.strip()]
+    kept = [q for q in quotes if _quote_norm(q) and _quote_norm(q) in report_norm]
+    if len(kept) < len(quotes):
+        _log_info(f"REPORT_DIGEST dropped_quotes={len(quotes) - len(kept)}")
+    digest = digest.model_copy(update={"key_quotes": kept})
+    if not digest.hook.strip():
+        issues.append("missing_hook")
+    if len([st for st in digest.framework_stages if st.summary.strip()]) < 2:
+        issues.append("too_few_stages")
+    if not [r for r in digest.twe_rules if r.strip()]:
+        issues.append("missing_twe")
+    return digest, issues
+
+
+def render_report_digest(digest: ReportDigest) -> str:
+    def _v(x: str) -> str:
+        return (x or "").strip() or "(Không xác định)"
+
+    lines = [
+        REPORT_DIGEST_MARK,
+        f"Hook: {_v(digest.hook)}",
+        f"Product: {_v(digest.product)} | Audience: {_v(digest.audience)} | Funnel: {_v(digest.funnel_stage)}",
+        "Framework stages:",
     ]
-    if user_prompt:
-        p1_parts.append({"text": "\n[USER_NOTE]\n" + user_prompt.strip()})
+    for i, st in enumerate(digest.framework_stages, start=1):
+        ts = f" [{st.timestamp.strip()}]" if st.timestamp.strip() else ""
+        lines.append(f"{i}. {st.stage.strip() or '-'}{ts}: {st.summary.strip()}")
+    lines.append("Transferable Working Elements:")
+    lines += [f"- {r.strip()}" for r in digest.twe_rules if r.strip()]
+    if digest.key_quotes:
+        lines.append("Key quotes (verbatim):")
+        lines += [f'- "{q}"' for q in digest.key_quotes]
+    if digest.visual_pacing.strip():
+        lines.append(f"Visual & pacing: {digest.visual_pacing.strip()}")
+    lines.append(f"CTA: {_v(digest.cta)}")
+    return "\n".join(lines)
 
-    t1 = await _gen_text(
+
+def report_digest_key(report: str, model_name: str) -> str:
+    return content_key(REPORT_DIGEST_PROMPT_VERSION, model_name, (report or "").strip())
+
+
+async def gemini_report_digest(
+    *,
+    api_key: Optional[str],
+    report: str,
+    model_name: str = DEFAULT_TEXT_MODEL,
+) -> Tuple[str, Dict[str, Any]]:
+    """Report RAW markdown -> digest text (đã validate). Raise ValueError nếu digest không đạt."""
+    t0 = time.perf_counter()
+    raw = await _gen_text(
         api_key=api_key,
         model_name=model_name,
-        parts=p1_parts,
-        generation_config={"temperature": 0.5, "max_output_tokens": 4096},
+        parts=[{"text": _REPORT_DIGEST_PROMPT}, {"text": "=== REPORT ===\n" + report.strip() + "\n=== END REPORT ==="}],
+        generation_config={
+            "temperature": 0.2,
+            "max_output_tokens": 3072,
+            "response_mime_type": "application/json",
+            "response_schema": _REPORT_DIGEST_SCHEMA,
+        },
     )
+    digest, issues = validate_report_digest(ReportDigest.model_validate_json(raw), report)
+    if issues:
+        raise ValueError(f"Report digest không đạt: {issues}")
+    text = render_report_digest(digest)
+    return text, {
+        "model": model_name,
+        "t_digest_ms": int((time.perf_counter() - t0) * 1000),
+        "tokens_before": estimate_tokens(report),
+        "tokens_after": estimate_tokens(text),
+    }
 
-    PROMPT2 = """ROLE
 
-You are a Research Synthesizer & Creative Strategist. Your job is to take a long, unstructured research analysis about a product and transform it into two structured deliverables:
-1) A Framework Extraction Table that organizes the raw insights.
-2) A Content Angle Sheet that develops marketing-ready creative directions using PAS or AIDA structures.
+_digest_inflight: Dict[str, asyncio.Future] = {}
 
-INPUT
-Raw Research Document: A long-form product analysis, review compilation, or research report.
 
-OUTPUT 1 — Framework Extraction (TSV, NOT markdown)
-STRICT FORMAT RULES:
-- Use TAB-separated values only (\\t). Do NOT use the "|" character anywhere.
-- The header MUST be printed EXACTLY as a single line (tab-separated):
-Section\tExtracted Framework Content\tEvidence (quote/timestamp)\tConfidence
-- Then print rows with EXACTLY 4 columns, also tab-separated.
-- If a cell is missing, write "-". If evidence is weak, set Confidence to "Medium".
-- Keep this whole table compact and under 60 lines.
+def _digest_target(report: str) -> Optional[Tuple[str, str]]:
+    """(report đã strip, key) nếu report cần digest; None nếu tắt / report ngắn / đã là digest."""
+    settings = get_settings()
+    report = (report or "").strip()
+    if not settings.REPORT_DIGEST_ENABLED or len(report) < settings.REPORT_DIGEST_MIN_CHARS:
+        return None
+    if report.startswith(REPORT_DIGEST_MARK):
+        return None
+    return report, report_digest_key(report, settings.GEMINI_MODEL_TEXT or DEFAULT_TEXT_MODEL)
 
-OUTPUT 2 — Content Angle Development
-For each content angle (3–5 total), include:
-- Angle Title (short, punchy)
-- Target Persona (1–2 sentences)
-- Core Message (central idea)
-- Story Arc using PAS OR AIDA:
-  PAS: Problem → Agitate → Solution
-  AIDA: Attention → Interest → Desire → Action
-- Tie every angle back to the Framework table (USPs, benefits, personas).
 
-GLOBAL RULES
-- Use plain, simple language — avoid jargon.
-- Angles must be unique and grounded in the insights.
-- If any part is ambiguous, make a reasonable, concise assumption.
+def get_report_digest(report: str) -> Optional[Dict[str, Any]]:
+    """Chỉ đọc digest đã lưu (không gọi model). None nếu chưa có / bản lưu là lỗi."""
+    target = _digest_target(report)
+    if target is None:
+        return None
+    rec = store_get(REPORT_DIGEST_NS, target[1], max_age_s=get_settings().REPORT_DIGEST_TTL_SEC)
+    if rec and rec.get("digest"):
+        return {**rec, "cached": True}
+    return None
 
-OUTPUT ORDER & MARKER
-- The VERY FIRST line of your entire output MUST be exactly:
-angle:
-- Immediately after that, print OUTPUT 1 (TSV table).
-- After the table, print a blank line, then OUTPUT 2 (the angles).
-- Do NOT add anything before 'angle:'.
-"""
-    p2_parts: List[Any] = [
-        {"text": PROMPT2},
-        {"text": (
-            "Raw Research Document (from Phase 1):\n"
-            "=== START ANALYSIS ===\n"
-            f"{t1}\n"
-            "=== END ANALYSIS ===\n"
-        )},
-    ]
-    if user_prompt:
-        p2_parts.append({"text": "\n[USER_NOTE]\n" + user_prompt.strip()})
 
-    t2 = await _gen_text(
-        api_key=api_key,
-        model_name=model_name,
-        parts=p2_parts,
-        generation_config={"temperature": 0.6, "max_output_tokens": 6144},
+async def _generate_report_digest(api_key: Optional[str], report: str, key: str) -> Optional[Dict[str, Any]]:
+    model_name = get_settings().GEMINI_MODEL_TEXT or DEFAULT_TEXT_MODEL
+    try:
+        text, meta = await gemini_report_digest(api_key=api_key, report=report, model_name=model_name)
+    except Exception as e:
+        metrics.incr("report_digest.fail")
+        _log_info(f"REPORT_DIGEST fail key={key[:12]} err={type(e).__name__}: {e}")
+        # negative cache: không gọi lại model cho cùng report tới khi hết REPORT_DIGEST_FAIL_TTL_SEC
+        store_put(REPORT_DIGEST_NS, key, {
+            "digest": "",
+            "error": f"{type(e).__name__}: {e}"[:500],
+            "failed_at": int(time.time()),
+            "prompt_version": REPORT_DIGEST_PROMPT_VERSION,
+        })
+        return None
+    rec = {"digest": text, "created_at": int(time.time()), "prompt_version": REPORT_DIGEST_PROMPT_VERSION, **meta}
+    store_put(REPORT_DIGEST_NS, key, rec)
+    _log_info(
+        f"REPORT_DIGEST stored key={key[:12]} tokens_before={meta['tokens_before']} "
+        f"tokens_after={meta['tokens_after']} dt_ms={meta['t_digest_ms']}"
     )
-    return t1, t2, {"model": model_name}
+    return {**rec, "cached": False}
+
+
+async def ensure_report_digest(*, api_key: Optional[str], report: str) -> Optional[Dict[str, Any]]:
+    """
+    Digest đã lưu (ns report_digests) hoặc sinh mới + lưu. None nếu tắt / report ngắn / lỗi.
+    Chỉ gọi từ job (report_digest, precompute) — request path dùng get_report_digest.
+    - Lỗi được lưu lại, REPORT_DIGEST_FAIL_TTL_SEC không thử lại.
+    - Nhiều caller cùng report trong 1 worker chờ chung 1 lần sinh.
+    Luôn dùng GEMINI_MODEL_TEXT (không theo model của stage gọi) -> đúng 1 digest / report.
+    """
+    target = _digest_target(report)
+    if target is None:
+        return None
+    report, key = target
+    settings = get_settings()
+    rec = store_get(REPORT_DIGEST_NS, key, max_age_s=settings.REPORT_DIGEST_TTL_SEC)
+    if rec and rec.get("digest"):
+        metrics.incr("report_digest.hit")
+        return {**rec, "cached": True}
+    if rec and rec.get("error") and time.time() - float(rec.get("failed_at") or 0) < settings.REPORT_DIGEST_FAIL_TTL_SEC:
+        metrics.incr("report_digest.negative_hit")
+        return None
+
+    fut = _digest_inflight.get(key)
+    if fut is not None:
+        metrics.incr("report_digest.coalesced")
+        return await asyncio.shield(fut)
+
+    metrics.incr("report_digest.miss")
+    fut = asyncio.get_running_loop().create_future()
+    _digest_inflight[key] = fut
+    try:
+        out = await _generate_report_digest(api_key, report, key)
+        fut.set_result(out)
+    except BaseException:
+        fut.set_result(None)
+        raise
+    finally:
+        _digest_inflight.pop(key, None)
+    return out
+
+
+async def report_for_prompt(
+    *,
+    api_key: Optional[str],
+    report: str,
+    stage: str = "",
+    generate: bool = False,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Report để nhúng vào prompt downstream: digest nếu có, ngược lại report gốc.
+    generate=False (request path): chỉ đọc digest đã lưu, không chờ model.
+    generate=True (job): sinh digest nếu chưa có (ensure_report_digest).
+    Idempotent (digest truyền vào được trả nguyên) nên mọi tầng có thể gọi mà không lệch cache key.
+    """
+    if generate:
+        rec = await ensure_report_digest(api_key=api_key, report=report)
+    else:
+        rec = get_report_digest(report)
+        if rec is None and _digest_target(report) is not None:
+            metrics.incr("report_digest.not_ready")
+    if not rec:
+        return report, {"digest": False}
+    saved = max(0, int(rec.get("tokens_before") or 0) - int(rec.get("tokens_after") or 0))
+    metrics.incr("report_digest.tokens_saved", saved)
+    if stage:
+        metrics.incr(f"report_digest.{stage}.tokens_saved", saved)
+    _log_info(f"REPORT_DIGEST use stage={stage or '-'} cached={rec['cached']} tokens_saved={saved}")
+    return rec["digest"], {"digest": True, "cached": rec["cached"], "tokens_saved": saved}
 
 
 # =========================================================
@@ -898,6 +2127,10 @@ async def gemini_generate_script(
     user_prompt: str = "",
     model_name: str = DEFAULT_TEXT_MODEL,
     script_inputs: Optional[Dict[str, Any]] = None,
+    precomputed_max_age_s: Optional[int] = None,
+    inferred_inputs: Optional[Dict[str, str]] = None,
+    candidates: int = 1,
+    report_key: Optional[str] = None,
 ) -> Tuple[str, Dict[str, Any]]:
     """
     Sinh kịch bản theo giao thức "Literal Object Replicator":
@@ -908,32 +2141,66 @@ async def gemini_generate_script(
     - Evaluation: Primary/Secondary tests.
     """
 
+    # ----- Report digest thay report đầy đủ (infer + prompt script dùng cùng 1 bản) -----
+    # cache required inputs key theo report gốc (report_key khi caller đã tự đổi sang digest)
+    report_key = report_key or report
+    report, digest_meta = await report_for_prompt(api_key=api_key, report=report, stage="script")
+
     # ----- Build angle/context blocks -----
-    angle_text = ""
-    if angle:
-        angle_text = f"Title: {angle.get('title','')}\n{angle.get('raw','')}"
+    angle_text = angle_context_text(angle)
     angle_block = f"ANGLE (selected):\n{angle_text}\n" if angle else ""
     if angles_text:
         angle_block += f"\nANGLES (all):\n{angles_text}\n"
 
     # ----- Infer required inputs (giữ nguyên logic của bạn) -----
+    # Ưu tiên kết quả precompute sau landing analysis -> chỉ còn 1 call trên critical path
     seed_inputs = {k: str((script_inputs or {}).get(k, "") or "").strip() for k in REQUIRED_KEYS}
-    inferred, infer_meta = await infer_required_inputs_from_context(
-        api_key=api_key,
-        model_name=model_name,
-        report=report,
+    # inferred_inputs: đã resolve sẵn theo lô (/generate-scripts) -> bỏ qua bước infer
+    t_infer = time.perf_counter()
+    inferred = inferred_inputs if inferred_inputs is not None else get_cached_required_inputs(
+        report=report_key,
         landing_analysis=landing_analysis,
         angle_text=angle_text,
-        seed_inputs=seed_inputs,
+        model_name=model_name,
+        max_age_s=precomputed_max_age_s,
     )
+    if inferred is not None:
+        infer_meta: Dict[str, Any] = {"cached": True}
+        _log_info("SCRIPT_INPUTS precomputed_hit")
+    else:
+        inferred, infer_meta = await infer_required_inputs_from_context(
+            api_key=api_key,
+            model_name=model_name,
+            report=report,
+            landing_analysis=landing_analysis,
+            angle_text=angle_text,
+            seed_inputs=seed_inputs,
+        )
+        infer_meta["cached"] = False
+        _log_info(f"SCRIPT_INPUTS inferred dt_ms={int((time.perf_counter() - t_infer) * 1000)}")
     merged = {k: (seed_inputs.get(k) or inferred.get(k) or "").strip() for k in REQUIRED_KEYS}
     missing = [k for k in REQUIRED_KEYS if not merged[k]]
+    if missing and infer_meta.get("cached"):
+        # bản precompute / batch còn thiếu trường -> infer lại riêng angle này thay vì trả lỗi theo cache
+        fresh, infer_meta = await infer_required_inputs_from_context(
+            api_key=api_key,
+            model_name=model_name,
+            report=report,
+            landing_analysis=landing_analysis,
+            angle_text=angle_text,
+            seed_inputs=seed_inputs,
+        )
+        infer_meta["cached"] = False
+        infer_meta["reinferred_missing"] = missing
+        merged = {k: merged[k] or (fresh.get(k) or "").strip() for k in REQUIRED_KEYS}
+        missing = [k for k in REQUIRED_KEYS if not merged[k]]
+        _log_info(f"SCRIPT_INPUTS reinferred missing_after={len(missing)} dt_ms={int((time.perf_counter() - t_infer) * 1000)}")
 
     # Nếu thiếu quá nhiều, trả lỗi sớm (như bản gốc)
     if len(missing) >= 4:
         return (
             f"ERROR: Missing {missing}",
-            {"model": model_name, "missing": missing, "infer_meta": infer_meta},
+            {"model": model_name, "missing": missing, "infer_meta": infer_meta, "report_digest": digest_meta},
         )
 
     required_inputs_block = (
@@ -1050,12 +2317,26 @@ async def gemini_generate_script(
     gen_cfg = dict(GENERATION_CONFIG_TEXT)
     gen_cfg.update({"temperature": 0.2, "top_p": 0.8})
 
-    txt = await _gen_text(
-        api_key=api_key,
-        model_name=model_name,
-        parts=parts,
-        generation_config=gen_cfg,
-    )
+    extra: Dict[str, Any] = {}
+    if candidates > 1:
+        # temperature cao hơn chút để các phương án khác nhau
+        gen_cfg["temperature"] = max(gen_cfg["temperature"], 0.7)
+        texts, cand_meta = await _gen_text_candidates(
+            api_key=api_key,
+            model_name=model_name,
+            parts=parts,
+            n=candidates,
+            generation_config=gen_cfg,
+        )
+        txt = texts[0]
+        extra = {"candidates": texts, **cand_meta}
+    else:
+        txt = await _gen_text(
+            api_key=api_key,
+            model_name=model_name,
+            parts=parts,
+            generation_config=gen_cfg,
+        )
     if not txt:
         raise RuntimeError("Model returned empty output for script.")
 
@@ -1063,7 +2344,9 @@ async def gemini_generate_script(
         "model": model_name,
         "missing": missing,
         "infer_meta": infer_meta,
+        "report_digest": digest_meta,
         "protocol": "Literal Object Replicator",
+        **extra,
     }
 
 # =========================================================
@@ -1126,6 +2409,125 @@ def _split_script_into_chunks(script: str, max_chunk_chars: int = 6000) -> List[
     return seq
 
 
+# ---- Script output -> sections A–E + bảng final script (D) ----
+_SCRIPT_SECTION_RE = re.compile(
+    r"^\s*(?:#{1,6}\s*)?(?:\*\*)?\s*([A-E])\)\s+([A-Z].*?)\s*(?:\*\*)?\s*$",
+    re.UNICODE,
+)
+_MD_SEP_CELL_RE = re.compile(r"^:?-+:?$")
+
+
+def split_script_sections(script: str) -> Dict[str, str]:
+    """
+    Tách output gemini_generate_script theo heading A) .. E) (OUTPUT FORMAT trong prompt).
+    Trả {"A": "...", ..., "E": "..."} — chỉ có các section tìm thấy.
+    """
+    sections: Dict[str, List[str]] = {}
+    cur: Optional[str] = None
+    for ln in _strip_code_fences(script or "").splitlines():
+        m = _SCRIPT_SECTION_RE.match(ln)
+        if m and m.group(1) not in sections:
+            cur = m.group(1)
+            sections[cur] = []
+            continue
+        if cur is not None:
+            sections[cur].append(ln)
+    return {k: "\n".join(v).strip() for k, v in sections.items()}
+
+
+def _md_table_rows(text: str) -> List[List[str]]:
+    rows: List[List[str]] = []
+    for ln in (text or "").splitlines():
+        t = ln.strip()
+        if t.count("|") < 2:
+            if rows:
+                break  # hết bảng đầu tiên
+            continue
+        cells = [c.strip() for c in t.strip("|").split("|")]
+        if all(_MD_SEP_CELL_RE.match(c) for c in cells if c):
+            continue
+        rows.append(cells)
+    return rows
+
+
+def _find_vo_table(text: str) -> List[List[str]]:
+    """Bảng markdown đầu tiên có header chứa Voice-over/VO."""
+    block: List[str] = []
+    for ln in (text or "").splitlines() + [""]:
+        if ln.strip().count("|") >= 2:
+            block.append(ln)
+            continue
+        if block:
+            rows = _md_table_rows("\n".join(block))
+            if rows and any(re.search(r"voice|\bvo\b", h, re.I) for h in rows[0]):
+                return rows
+            block = []
+    return []
+
+
+def extract_final_script_rows(script: str) -> List[Dict[str, str]]:
+    """
+    Bảng "D) FINAL VIDEO SCRIPT" -> [{stage, vo, visuals}].
+    Không có section D -> bảng có cột Voice-over đầu tiên trong toàn bộ script.
+    """
+    section_d = split_script_sections(script).get("D") or ""
+    rows = _md_table_rows(section_d) or _find_vo_table(_strip_code_fences(script or ""))
+    if not rows:
+        return []
+
+    header = [h.lower() for h in rows[0]]
+    has_header = any(re.search(r"voice|\bvo\b|stage|visual", h) for h in header)
+    data = rows[1:] if has_header else rows
+
+    def _col(pattern: str, default: int) -> int:
+        if has_header:
+            for i, h in enumerate(header):
+                if re.search(pattern, h):
+                    return i
+        return default
+
+    vo_i = _col(r"voice|\bvo\b|script", 1 if len(rows[0]) >= 2 else 0)
+    stage_i = _col(r"stage|beat|scene", 0)
+    vis_i = _col(r"visual|ost", 2)
+    out: List[Dict[str, str]] = []
+    for r in data:
+        vo = r[vo_i] if vo_i < len(r) else ""
+        if not vo:
+            continue
+        out.append({
+            "stage": r[stage_i] if stage_i < len(r) and stage_i != vo_i else "",
+            "vo": vo,
+            "visuals": r[vis_i] if vis_i < len(r) and vis_i != vo_i else "",
+        })
+    return out
+
+
+def render_script_rows(rows: List[Dict[str, str]]) -> str:
+    """Rows -> bảng markdown gọn (chỉ phần cần cho shotlist)."""
+    lines = ["| Stage | Voice-over / On-Screen Script | Visuals & OST |", "|---|---|---|"]
+    for r in rows:
+        cells = [re.sub(r"[\r\n|]+", " ", r.get(k, "") or "").strip() for k in ("stage", "vo", "visuals")]
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def _chunk_script_rows(rows: List[Dict[str, str]], max_chunk_chars: int = 6000) -> List[str]:
+    """Chia theo ranh giới row (không cắt giữa row), mỗi chunk có header bảng riêng."""
+    chunks: List[str] = []
+    cur: List[Dict[str, str]] = []
+    size = 0
+    for r in rows:
+        n = sum(len(r.get(k, "") or "") for k in ("stage", "vo", "visuals")) + 10
+        if cur and size + n > max_chunk_chars:
+            chunks.append(render_script_rows(cur))
+            cur, size = [], 0
+        cur.append(r)
+        size += n
+    if cur:
+        chunks.append(render_script_rows(cur))
+    return chunks
+
+
 async def _gen_text_retry(
     *,
     api_key: Optional[str],
@@ -1133,7 +2535,10 @@ async def _gen_text_retry(
     prompt_text: str,
     base_generation_config: Optional[Dict[str, Any]] = None,
 ) -> Tuple[str, Dict[str, Any]]:
-    """Gọi genai với 3 nấc retry. Trả '' nếu vẫn im lặng."""
+    """
+    Gọi genai; output rỗng -> gọi lại 1 lần với max_output_tokens lớn hơn. Trả '' nếu vẫn im lặng.
+    Lỗi không ném ra: trả ('', {"error": ...}).
+    """
     cfg = {
         "temperature": 0.35,
         "top_p": 0.95,
@@ -1145,14 +2550,14 @@ async def _gen_text_retry(
         cfg.update(base_generation_config)
 
     attempts = [
-        (cfg, None),
-        ({**cfg, "max_output_tokens": max(cfg["max_output_tokens"], 6144)}, None),
-        ({**cfg, "max_output_tokens": max(cfg["max_output_tokens"], 6144)}, None),
+        cfg,
+        {**cfg, "max_output_tokens": max(cfg["max_output_tokens"], 6144)},
     ]
 
+    # Lỗi mạng/429/5xx đã được retry (jitter + deadline) trong _ga_generate_content;
+    # ở đây chỉ gọi lại khi output rỗng (nâng max_output_tokens), lỗi -> dừng luôn.
     last_meta: Dict[str, Any] = {}
-    retries = 0
-    for cfg_i, _ in attempts:
+    for i, cfg_i in enumerate(attempts):
         try:
             resp = await _ga_generate_content(
                 api_key=api_key,
@@ -1160,15 +2565,17 @@ async def _gen_text_retry(
                 parts=[{"text": prompt_text}],
                 generation_config=cfg_i,
             )
-            txt, meta = _extract_text_and_meta(resp)
-            txt = _strip_code_fences(txt)
-            last_meta = meta
-            if txt:
-                return txt, meta
         except Exception as e:
-            _dprint(f"Retry {retries}: {e}")
-            retries += 1
-            await asyncio.sleep(2 ** retries)  # Backoff
+            _dprint(f"gen_text_retry attempt {i} failed: {e}")
+            last_meta = {"error": f"{type(e).__name__}: {e}"}
+            break
+        txt, meta = _extract_text_and_meta(resp)
+        txt = _strip_code_fences(txt)
+        last_meta = meta
+        if txt:
+            return txt, meta
+        if _blocked_reason(resp):
+            break
     return "", last_meta
 
 
@@ -1216,33 +2623,62 @@ def _parse_vo_from_markdown_table(script: str) -> List[str]:
     return vo_list
 
 
+_BEAT_LINE_RE = re.compile(r"[\r\n]+", re.UNICODE)
+_BEAT_PHRASE_RE = re.compile(r"(?<=[.!?])\s+|,\s+|—\s+|–\s+", re.UNICODE)
+_BEAT_FILL_RE = re.compile(r"[.;:\n]+", re.UNICODE)
+
+
 def _segment_script_into_beats(final_script: str, min_beats: int = 10, max_beats: int = 120) -> List[str]:
+    """
+    VO theo beat: ưu tiên row bảng D); không có bảng -> cắt câu/cụm từ.
+    Tuyến tính theo độ dài script: dừng ngay khi đủ max_beats, khử trùng bằng set.
+    Chỉ bù tới min_beats khi cắt từ văn xuôi — có bảng thì 1 beat / row, không cắt trên markup bảng.
+    """
     txt = _strip_code_fences(final_script or "")
-    vo_list = _parse_vo_from_markdown_table(txt)
+    rows = extract_final_script_rows(txt)
+    vo_list = _row_vos(rows) if rows else _parse_vo_from_markdown_table(txt)
+    from_table = bool(vo_list)
     if not vo_list:
-        lines = [ln.strip() for ln in re.split(r"[\r\n]+", txt, flags=re.UNICODE) if ln.strip()]
         phrases: List[str] = []
-        for ln in lines:
-            segs = re.split(r"(?<=[.!?])\s+|,\s+|—\s+|–\s+", ln, flags=re.UNICODE)
-            for s in segs:
+        for ln in _BEAT_LINE_RE.split(txt):
+            ln = ln.strip()
+            if not ln:
+                continue
+            for s in _BEAT_PHRASE_RE.split(ln):
                 s = s.strip()
                 if 3 <= len(s.split()) <= 28:
                     phrases.append(s)
+            if len(phrases) >= max_beats:
+                break
         vo_list = phrases
-    vo_list = [v[:260] for v in vo_list][:max_beats]
-    if len(vo_list) < min_beats:
-        more = re.split(r"[.;:\n]+", txt, flags=re.UNICODE)
-        for s in more:
-            s = s.strip()
-            if s and s not in vo_list:
+    vo_list = [v[:260] for v in vo_list[:max_beats]]
+    if not from_table and len(vo_list) < min_beats:
+        seen = set(vo_list)
+        start = 0
+        for m in _BEAT_FILL_RE.finditer(txt):
+            s = txt[start:m.start()].strip()
+            start = m.end()
+            if s and s[:260] not in seen:
+                seen.add(s[:260])
                 vo_list.append(s[:260])
             if len(vo_list) >= min_beats:
                 break
+        else:
+            s = txt[start:].strip()
+            if s and s[:260] not in seen and len(vo_list) < min_beats:
+                vo_list.append(s[:260])
     return [v for v in vo_list if v]
 
 
-def _heuristic_tsv_from_script(final_script: str, start: int = 1) -> str:
-    vos = _segment_script_into_beats(final_script)
+def _row_vos(rows: List[Dict[str, str]]) -> List[str]:
+    return [v[:260] for v in (str(r.get("vo") or "").strip() for r in rows) if v]
+
+
+def _heuristic_tsv_from_script(final_script: str, start: int = 1, max_beats: int = 120) -> str:
+    return _heuristic_tsv_from_vos(_segment_script_into_beats(final_script, max_beats=max_beats), start=start)
+
+
+def _heuristic_tsv_from_vos(vos: List[str], start: int = 1) -> str:
     rows: List[str] = []
     for i, vo in enumerate(vos, start=start):
         shot = _SHOT_TYPES[(i - 1) % len(_SHOT_TYPES)]
@@ -1259,6 +2695,14 @@ def _heuristic_tsv_from_script(final_script: str, start: int = 1) -> str:
     return SHOTLIST_HEADER + "\n" + "\n".join(rows)
 
 
+def heuristic_shotlist_draft(final_script: str, script_rows: Optional[List[Dict[str, str]]] = None) -> str:
+    """Shotlist TSV dựng local (vài ms) — 1 beat / row bảng D), dùng làm revision draft."""
+    rows = script_rows or extract_final_script_rows(final_script)
+    if rows:
+        return _heuristic_tsv_from_vos(_row_vos(rows))
+    return _heuristic_tsv_from_script(final_script)
+
+
 def _build_prompt_for_chunk(framework_analysis_short: str, script_chunk: str, beat_start: int) -> str:
     return f"""ROLE:
 You are a master AI Video Director.
@@ -1280,6 +2724,81 @@ INPUT B — SCRIPT CHUNK:
 """
 
 
+def _shotlist_inputs(
+    framework_analysis: str, final_script: str, script_rows: Optional[List[Dict[str, str]]]
+) -> Tuple[str, List[str], List[Dict[str, str]], str]:
+    """(fa_short, chunks, rows, script_dùng_cho_beat)."""
+    # Chỉ bảng D) FINAL VIDEO SCRIPT là input cho beat -> bỏ section A–C, E khỏi prompt
+    rows = script_rows if script_rows else extract_final_script_rows(final_script)
+    if rows:
+        chunks = _chunk_script_rows(rows)
+        final_script = render_script_rows(rows)
+    else:
+        chunks = _split_script_into_chunks(final_script) or [final_script.strip()]
+    fa_short, _ = _clip_shotlist_inputs(framework_analysis, final_script)
+    _log_info(f"SHOTLIST input rows={len(rows)} script_chars={len(final_script)} chunks={len(chunks)}")
+    return fa_short, chunks, rows, final_script
+
+
+def _shotlist_data_rows(tsv: str) -> List[str]:
+    return [ln for ln in tsv.splitlines()[1:] if "\t" in ln]
+
+
+def _heuristic_chunk_rows(chunk: str) -> List[str]:
+    """
+    Fallback heuristic cho 1 chunk. Chunk từ _chunk_script_rows là bảng markdown đã render ->
+    1 beat / row từ VO của row (không cắt trên markup | Stage | ... / |---|).
+    """
+    rows = extract_final_script_rows(chunk)
+    if rows:
+        return _shotlist_data_rows(_heuristic_tsv_from_vos(_row_vos(rows)))
+    return _shotlist_data_rows(_heuristic_tsv_from_script(chunk))
+
+
+async def _shotlist_chunk_rows(
+    api_key: Optional[str], model_name: str, fa_short: str, chunk: str
+) -> Tuple[List[str], Optional[str]]:
+    """
+    1 chunk -> (data rows TSV đánh số từ 1, fallback_reason).
+    Lỗi/rỗng/ít row -> heuristic cho riêng chunk đó, fallback_reason cho biết lý do (None = bản LLM).
+    """
+    prompt_text = _build_prompt_for_chunk(fa_short, chunk, 1)
+    try:
+        txt, meta = await _gen_text_retry(
+            api_key=api_key,
+            model_name=model_name,
+            prompt_text=prompt_text,
+            base_generation_config={"max_output_tokens": 4096},
+        )
+    except Exception as e:
+        txt, meta = "", {"error": f"{type(e).__name__}: {e}"}
+
+    if not txt:
+        reason = meta.get("error") or "empty_output"
+        _log_info(f"SHOTLIST chunk_fallback reason={reason}")
+        return _heuristic_chunk_rows(chunk), reason
+
+    raw = _strip_code_fences(txt)
+    lines = [ln for ln in raw.splitlines() if ln.strip()]
+
+    if lines and ("|" in lines[0]) and ("\t" not in lines[0]):
+        norm = []
+        for ln in lines:
+            if re.search(r"^\s*\|", ln) and re.search(r"\|\s*$", ln):
+                ln = ln.strip().lstrip("|").rstrip("|")
+            norm.append("\t".join([c.strip() for c in ln.split("|")]))
+        lines = norm
+
+    if not lines or not lines[0].startswith("Beat #\tVO"):
+        lines = [SHOTLIST_HEADER] + lines
+
+    data_rows = [ln for ln in lines[1:] if "\t" in ln]
+    if len(data_rows) < 3:
+        _log_info(f"SHOTLIST chunk_fallback reason=too_few_rows rows={len(data_rows)}")
+        return _heuristic_chunk_rows(chunk), f"too_few_rows ({len(data_rows)})"
+    return data_rows, None
+
+
 async def gemini_generate_shotlist_text(
     *,
     api_key: Optional[str],
@@ -1291,73 +2810,195 @@ async def gemini_generate_shotlist_text(
     extra_style_prompt: Optional[str] = None,
     model_name: Optional[str] = None,
     role_task_block: Optional[str] = None,
-) -> Dict[str, str]:
+    script_rows: Optional[List[Dict[str, str]]] = None,
+    allow_fallback: bool = True,
+) -> Dict[str, Any]:
+    """
+    allow_fallback=True : chunk lỗi/rỗng -> heuristic cho chunk đó, đếm ở fallback_chunks.
+    allow_fallback=False: có chunk nào phải fallback -> RuntimeError (caller đã có bản heuristic riêng).
+    """
     if not (framework_analysis or "").strip():
         raise ValueError("Missing framework_analysis")
     if not (final_script or "").strip():
         raise ValueError("Missing final_script")
 
     name = (model_name or DEFAULT_TEXT_MODEL).strip()
-    fa_short, _ = _clip_shotlist_inputs(framework_analysis, final_script)
-    chunks = _split_script_into_chunks(final_script) or [final_script.strip()]
+    fa_short, chunks, rows, final_script = _shotlist_inputs(framework_analysis, final_script, script_rows)
 
-    tsv_blocks: List[str] = []
-    beat_cursor = 1
+    # Các chunk sinh song song (đánh số cục bộ từ 1), ghép theo thứ tự rồi đánh số lại toàn cục.
+    # Số call đồng thời vẫn bị chặn bởi _gemini_limiter().
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[_shotlist_chunk_rows(api_key, name, fa_short, c) for c in chunks])
+
+    all_lines: List[str] = [SHOTLIST_HEADER]
+    reasons = [r for _, r in results if r]
+    n_fallback = len(reasons)
+    for data_rows, _reason in results:
+        for ln in data_rows:
+            cols = ln.split("\t")
+            cols[0] = str(len(all_lines))
+            all_lines.append("\t".join(cols))
+    _log_info(
+        f"SHOTLIST chunks={len(chunks)} beats={len(all_lines) - 1} fallback_chunks={n_fallback} "
+        f"dt_ms={int((time.perf_counter() - t0) * 1000)}"
+    )
+    if len(all_lines) == 1:
+        all_lines = []
+        n_fallback = len(chunks)
+    if n_fallback and not allow_fallback:
+        detail = reasons[0] if reasons else "empty_output"
+        raise RuntimeError(f"{n_fallback}/{len(chunks)} chunk shotlist không có bản LLM ({detail}).")
 
-    for chunk in chunks:
-        prompt_text = _build_prompt_for_chunk(fa_short, chunk, beat_cursor)
-        txt, _meta = await _gen_text_retry(
-            api_key=api_key,
-            model_name=name,
-            prompt_text=prompt_text,
-            base_generation_config={"max_output_tokens": 4096},
-        )
+    merged = "\n".join(all_lines).strip() if all_lines else heuristic_shotlist_draft(final_script, rows)
 
-        if not txt:
-            block = _heuristic_tsv_from_script(chunk, start=beat_cursor)
-            tsv_blocks.append(block)
-            beat_cursor += max(1, block.count("\n"))
-            continue
+    # fallback_chunks == chunks -> toàn bộ là heuristic; caller quyết định nhãn model / có chấp nhận không
+    return {
+        "model": name,
+        "shotlist_text": merged,
+        "script_rows": len(rows),
+        "chunks": len(chunks),
+        "fallback_chunks": n_fallback,
+        "fallback_errors": reasons[:5],
+    }
 
-        raw = _strip_code_fences(txt)
-        lines = [ln for ln in raw.splitlines() if ln.strip()]
-
-        if lines and ("|" in lines[0]) and ("\t" not in lines[0]):
-            norm = []
-            for ln in lines:
-                if re.search(r"^\s*\|", ln) and re.search(r"\|\s*$", ln):
-                    ln = ln.strip().lstrip("|").rstrip("|")
-                norm.append("\t".join([c.strip() for c in ln.split("|")]))
-            lines = norm
-
-        if not lines or not lines[0].startswith("Beat #\tVO"):
-            lines = [SHOTLIST_HEADER] + lines
-
-        data_rows = [ln for ln in lines[1:] if "\t" in ln]
-        if len(data_rows) < 3:
-            block = _heuristic_tsv_from_script(chunk, start=beat_cursor)
-            tsv_blocks.append(block)
-            beat_cursor += max(1, block.count("\n"))
-            continue
 
-        tsv_blocks.append("\n".join(lines))
-        beat_cursor += len(data_rows)
+# ---- Shotlist streaming (NDJSON từng beat) ----
+SHOTLIST_FIELDS = ("beat", "vo", "primary_ost", "annotation", "pacing", "prompt")
+_SHOTLIST_HEADER_CELL_RE = re.compile(r"^beat\b", re.IGNORECASE)
 
-    all_lines: List[str] = []
-    for i, blk in enumerate(tsv_blocks):
-        ls = [ln for ln in blk.splitlines() if ln.strip()]
-        if not ls:
-            continue
-        if i == 0:
-            all_lines.extend(ls)
-        else:
-            if ls and ls[0].startswith("Beat #\tVO"):
-                ls = ls[1:]
-            all_lines.extend(ls)
 
-    merged = "\n".join(all_lines).strip() if all_lines else _heuristic_tsv_from_script(final_script)
+def _shotlist_line_cols(line: str) -> Optional[List[str]]:
+    """1 dòng output -> cột (TAB hoặc markdown pipe). None nếu là header/separator/fence/rác."""
+    t = line.strip()
+    if not t or t.startswith("```"):
+        return None
+    if "\t" not in t and "|" in t:
+        cols = [c.strip() for c in t.strip("|").split("|")]
+        if all(_MD_SEP_CELL_RE.match(c) for c in cols if c):
+            return None
+    else:
+        cols = [c.strip() for c in t.split("\t")]
+    if len(cols) < 2 or _SHOTLIST_HEADER_CELL_RE.match(cols[0]):
+        return None
+    return cols
+
+
+def shot_beat_from_cols(cols: List[str]) -> Dict[str, str]:
+    """Cột TSV -> dict theo ShotBeat; thiếu cột -> "", dư cột -> gộp vào prompt."""
+    n = len(SHOTLIST_FIELDS)
+    cells = list(cols[: n - 1]) + [" | ".join(c for c in cols[n - 1:] if c)]
+    cells += [""] * (n - len(cells))
+    return dict(zip(SHOTLIST_FIELDS, cells))
+
+
+class IncrementalShotlistParser:
+    """feed(chunk) -> các row (list cột) đã đủ dòng; close() xả dòng cuối."""
+
+    def __init__(self) -> None:
+        self._pending = ""
+        self.rows = 0
+
+    def feed(self, chunk: str) -> List[List[str]]:
+        self._pending += (chunk or "").replace("\r\n", "\n").replace("\r", "\n")
+        *lines, self._pending = self._pending.split("\n")
+        return self._parse(lines)
+
+    def close(self) -> List[List[str]]:
+        ln, self._pending = self._pending, ""
+        return self._parse([ln])
+
+    def _parse(self, lines: List[str]) -> List[List[str]]:
+        out = [c for c in (_shotlist_line_cols(ln) for ln in lines) if c]
+        self.rows += len(out)
+        return out
+
+
+async def gemini_generate_shotlist_stream(
+    *,
+    api_key: Optional[str],
+    framework_analysis: str,
+    final_script: str,
+    model_name: Optional[str] = None,
+    script_rows: Optional[List[Dict[str, str]]] = None,
+    stats: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[Dict[str, str]]:
+    """
+    Yield từng beat (dict theo SHOTLIST_FIELDS, Beat # toàn cục) ngay khi model sinh ra.
+    Các chunk stream song song; chunk đầu chảy thẳng ra, chunk sau được đệm tới lượt.
+    Mỗi chunk giữ 3 row đầu cho tới khi chắc chắn không cần fallback heuristic.
+
+    stats (nếu truyền) được cập nhật trong lúc stream:
+    - chunks, fallback_chunks: số chunk / số chunk phải dùng heuristic (lỗi trước khi ra 3 row).
+    - errors: [{"after_beat", "detail"}] — chunk lỗi SAU khi đã phát beat, phần còn lại của chunk
+      bị thiếu; ghi nhận khi tới lượt chunk đó (trước beat kế tiếp) để caller báo lỗi đúng chỗ.
+    """
+    if not (framework_analysis or "").strip():
+        raise ValueError("Missing framework_analysis")
+    if not (final_script or "").strip():
+        raise ValueError("Missing final_script")
+
+    name = (model_name or DEFAULT_TEXT_MODEL).strip()
+    fa_short, chunks, _rows, _ = _shotlist_inputs(framework_analysis, final_script, script_rows)
+    queues: List[asyncio.Queue] = [asyncio.Queue() for _ in chunks]
+    stats = stats if stats is not None else {}
+    stats.update(chunks=len(chunks), fallback_chunks=0, errors=[])
+    cfg = {"temperature": 0.35, "top_p": 0.95, "top_k": 40, "max_output_tokens": 4096, "response_mime_type": "text/plain"}
+
+    async def _produce(q: asyncio.Queue, chunk: str) -> None:
+        parser = IncrementalShotlistParser()
+        held: List[List[str]] = []
+        live = False
+
+        def _push(rows: List[List[str]]) -> None:
+            nonlocal live, held
+            if live:
+                for r in rows:
+                    q.put_nowait(r)
+                return
+            held.extend(rows)
+            if len(held) >= 3:
+                live = True
+                for r in held:
+                    q.put_nowait(r)
+                held = []
 
-    return {"model": name, "shotlist_text": merged}
+        try:
+            async for piece in _ga_stream_text(
+                api_key=api_key,
+                model_name=name,
+                parts=[{"text": _build_prompt_for_chunk(fa_short, chunk, 1)}],
+                generation_config=cfg,
+            ):
+                _push(parser.feed(piece))
+            _push(parser.close())
+        except Exception as e:
+            _log_info(f"SHOTLIST_STREAM chunk_error live={live} {type(e).__name__}: {e}")
+            if live:
+                q.put_nowait(e)  # các row đã phát giữ nguyên; báo lỗi cho phần bị thiếu
+        finally:
+            if not live:
+                stats["fallback_chunks"] += 1
+                for ln in _heuristic_chunk_rows(chunk):
+                    q.put_nowait(ln.split("\t"))
+            q.put_nowait(None)
+
+    tasks = [asyncio.create_task(_produce(q, c)) for q, c in zip(queues, chunks)]
+    beat_no = 0
+    try:
+        for q in queues:
+            while True:
+                cols = await q.get()
+                if cols is None:
+                    break
+                if isinstance(cols, Exception):
+                    stats["errors"].append({"after_beat": beat_no, "detail": f"{type(cols).__name__}: {cols}"})
+                    continue
+                beat_no += 1
+                yield shot_beat_from_cols([str(beat_no)] + list(cols[1:]))
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
 
 
 # =========================================================
@@ -1552,20 +3193,26 @@ def generate_video_fast(
     constraint = "[CONSTRAINT]\n" + "\n".join(f"- {x}" for x in lines) + "\n\n" if lines else ""
     final_prompt = constraint + prompt.strip()
 
-    # Upload optional media
+    # Upload optional media. Mỗi upload tạo 1 file mới phía server -> không idempotent,
+    # chỉ gửi lại khi lỗi connect / 429 (request chắc chắn chưa được xử lý).
+    upload_policy = default_policy(idempotent=False)
+
+    def _upload(**kwargs):
+        return retry_sync(lambda: client.files.upload(**kwargs), name="veo", policy=upload_policy)
+
     file_image = None
     file_audio = None
     if image_path:
         try:
-            file_image = client.files.upload(file=str(image_path))
+            file_image = _upload(file=str(image_path))
         except TypeError:
-            file_image = client.files.upload(path=str(image_path))
+            file_image = _upload(path=str(image_path))
     if audio_path:
         try:
-            file_audio = client.files.upload(file=str(audio_path))
+            file_audio = _upload(file=str(audio_path))
         except TypeError:
             try:
-                file_audio = client.files.upload(path=str(audio_path))
+                file_audio = _upload(path=str(audio_path))
             except Exception:
                 file_audio = None
 
@@ -1576,7 +3223,13 @@ def generate_video_fast(
     audio_reason = None
 
     def _call(**kwargs):
-        return client.models.generate_videos(model=model, **kwargs)
+        # TypeError (sai chữ ký) là lỗi permanent -> rơi xuống nhánh fallback bên dưới.
+        # Mỗi call tạo 1 operation (tính tiền) -> chỉ gửi lại khi lỗi connect / 429.
+        return retry_sync(
+            lambda: client.models.generate_videos(model=model, **kwargs),
+            name="veo",
+            policy=default_policy(idempotent=False),
+        )
 
     try:
         if file_image and file_audio:
@@ -1598,13 +3251,13 @@ def generate_video_fast(
         else:
             op = _call(prompt=final_prompt)
     except Exception as e:
-        raise RuntimeError(f"generate_videos failed: {e}")
+        raise RuntimeError(f"generate_videos failed: {e}") from e
 
     # Poll
     start = time.time()
     while not getattr(op, "done", True):
         time.sleep(max(2, poll_sec))
-        op = client.operations.get(op)
+        op = retry_sync(lambda: client.operations.get(op), name="veo")
         if time.time() - start > 15 * 60:
             raise TimeoutError("Poll operation quá 15 phút — hủy.")
 
@@ -0,0 +1,402 @@
+# app/services/jobs.py
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from app.core.config import get_settings
+from app.core.netguard import UnsafeURLError, ensure_public_url
+from app.core.logger import setup_app_logger, set_request_ip
+from app.core import metrics
+
+_job_logger = setup_app_logger(name="casesurf", log_dir="logs")
+
+def _log(message: str) -> None:
+    _job_logger.info(f"jobs - {message}")
+
+# =========================================================
+# Store — SQLite WAL (bền qua restart, dùng chung giữa các worker)
+# =========================================================
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    webhook_url TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 1,
+    lease_until REAL,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL,
+    dedupe_key TEXT
+);
+"""
+
+# Chạy sau khi bảng cũ (chưa có dedupe_key) đã được ALTER -> index không lỗi cột thiếu.
+# Tối đa 1 job queued/running cho mỗi (kind, dedupe_key): INSERT OR IGNORE coalesce giữa các worker.
+_INDEXES = f"""
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe_active ON jobs(kind, dedupe_key)
+    WHERE dedupe_key IS NOT NULL AND status IN ('{JOB_QUEUED}', '{JOB_RUNNING}');
+"""
+
+_local = threading.local()
+
+
+def _db_path() -> Path:
+    return get_settings().jobs_db_path()
+
+
+def _conn() -> sqlite3.Connection:
+    """1 connection / thread (sqlite3 không chia sẻ connection giữa các thread)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        path = _db_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(path), timeout=30.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.executescript(_SCHEMA)
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+        if "dedupe_key" not in cols:
+            conn.execute("ALTER TABLE jobs ADD COLUMN dedupe_key TEXT")
+        conn.executescript(_INDEXES)
+        _local.conn = conn
+    return conn
+
+
+def _row_to_job(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+    if row is None:
+        return None
+    job = dict(row)
+    for k in ("payload", "result"):
+        raw = job.get(k)
+        try:
+            job[k] = json.loads(raw) if raw else None
+        except Exception:
+            job[k] = None
+    return job
+
+
+async def validate_webhook_url(url: Optional[str]) -> Optional[str]:
+    """
+    webhook_url do client gửi -> URL đã strip hoặc None. Không phải http(s) public
+    -> UnsafeURLError (router trả 400). _send_webhook kiểm tra lại lúc gửi (DNS có thể đổi).
+    """
+    url = (url or "").strip()
+    if not url:
+        return None
+    await ensure_public_url(url)
+    return url
+
+
+def submit_job(
+    kind: str,
+    payload: Dict[str, Any],
+    *,
+    webhook_url: Optional[str] = None,
+    max_attempts: Optional[int] = None,
+    dedupe_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    dedupe_key: nếu đã có job cùng kind + dedupe_key đang queued/running (ở bất kỳ worker nào)
+    thì trả job đó thay vì tạo job mới — atomic nhờ unique index + BEGIN IMMEDIATE.
+    """
+    if kind not in _HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    now = time.time()
+    job_id = os.urandom(12).hex()
+    attempts = max_attempts or get_settings().JOB_MAX_ATTEMPTS
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO jobs (id, kind, status, payload, webhook_url, max_attempts, created_at, updated_at, dedupe_key) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, JOB_QUEUED, json.dumps(payload, ensure_ascii=False), webhook_url or None, attempts, now, now, dedupe_key),
+        )
+        if not cur.rowcount:
+            job_id = conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND dedupe_key = ? AND status IN (?, ?)",
+                (kind, dedupe_key, JOB_QUEUED, JOB_RUNNING),
+            ).fetchone()["id"]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if cur.rowcount:
+        metrics.incr(f"jobs.{kind}.submitted")
+        _log(f"SUBMIT id={job_id} kind={kind}")
+    else:
+        metrics.incr(f"jobs.{kind}.coalesced")
+        _log(f"COALESCE id={job_id} kind={kind}")
+    return get_job(job_id)  # type: ignore[return-value]
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    row = _conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _row_to_job(row)
+
+
+def _claim_next(worker_id: str, lease_s: float) -> Optional[Dict[str, Any]]:
+    """
+    Lấy 1 job queued (hoặc running nhưng hết lease — worker cũ đã chết) và đánh dấu running.
+    BEGIN IMMEDIATE để chỉ 1 worker claim được mỗi job.
+    """
+    conn = _conn()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Job chết giữa chừng và đã hết lượt thử -> failed (+ dọn file tạm sau khi commit)
+        lost = conn.execute(
+            "SELECT id, kind, payload FROM jobs WHERE status = ? AND lease_until < ? AND attempts >= max_attempts",
+            (JOB_RUNNING, now),
+        ).fetchall()
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ?, finished_at = ? "
+            "WHERE status = ? AND lease_until < ? AND attempts >= max_attempts",
+            (JOB_FAILED, "Worker lost (lease expired)", now, now, JOB_RUNNING, now),
+        )
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) "
+            "ORDER BY created_at LIMIT 1",
+            (JOB_QUEUED, JOB_RUNNING, now),
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, worker = ?, updated_at = ? "
+                "WHERE id = ?",
+                (JOB_RUNNING, now + lease_s, worker_id, now, row["id"]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    for r in lost:
+        _log(f"FAIL id={r['id']} kind={r['kind']} err=Worker lost (lease expired)")
+        _run_cleanup(_row_to_job(r))
+    return get_job(row["id"]) if row is not None else None
+
+
+def _renew_lease(job_id: str, worker_id: str, lease_s: float) -> None:
+    now = time.time()
+    _conn().execute(
+        "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+        (now + lease_s, now, job_id, worker_id, JOB_RUNNING),
+    )
+
+
+def _finish(job_id: str, worker_id: str, *, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+    now = time.time()
+    cur = _conn().execute(
+        "UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = NULL, updated_at = ?, finished_at = ? "
+        "WHERE id = ? AND worker = ?",
+        (
+            JOB_FAILED if error is not None else JOB_SUCCEEDED,
+            json.dumps(result, ensure_ascii=False) if result is not None else None,
+            error,
+            now,
+            now,
+            job_id,
+            worker_id,
+        ),
+    )
+    # rowcount 0: lease đã mất, worker khác đang giữ job -> không đụng file của nó
+    if error is not None and cur.rowcount:
+        _run_cleanup(get_job(job_id))
+
+
+def public_job(job: Dict[str, Any], include_result: bool = False) -> Dict[str, Any]:
+    """Dạng trả cho FE (ẩn payload nội bộ như path file tạm)."""
+    out = {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "finished_at": job.get("finished_at"),
+        "error": job.get("error"),
+    }
+    if include_result:
+        out["result"] = job.get("result")
+    return out
+
+# =========================================================
+# Handlers — mỗi router tự đăng ký kind của mình
+# =========================================================
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+_HANDLERS: Dict[str, JobHandler] = {}
+
+
+def register_job_handler(kind: str) -> Callable[[JobHandler], JobHandler]:
+    def deco(fn: JobHandler) -> JobHandler:
+        _HANDLERS[kind] = fn
+        return fn
+    return deco
+
+
+# Dọn tài nguyên của job (vd. file upload tạm) khi job failed hẳn — kể cả khi worker chết
+# và job failed do hết lease, lúc đó handler không còn chạy để tự dọn.
+JobCleanup = Callable[[Dict[str, Any]], None]
+_CLEANUPS: Dict[str, JobCleanup] = {}
+
+
+def register_job_cleanup(kind: str) -> Callable[[JobCleanup], JobCleanup]:
+    def deco(fn: JobCleanup) -> JobCleanup:
+        _CLEANUPS[kind] = fn
+        return fn
+    return deco
+
+
+def _run_cleanup(job: Optional[Dict[str, Any]]) -> None:
+    if not job:
+        return
+    fn = _CLEANUPS.get(job["kind"])
+    if fn is None:
+        return
+    try:
+        fn(job.get("payload") or {})
+    except Exception as e:
+        _log(f"CLEANUP_FAIL id={job['id']} kind={job['kind']} err={e}")
+
+# =========================================================
+# Runner — chạy trong mỗi worker, ngoài vòng đời request
+# =========================================================
+async def _send_webhook(job: Dict[str, Any]) -> None:
+    url = job.get("webhook_url")
+    if not url:
+        return
+    try:
+        await ensure_public_url(url)
+    except UnsafeURLError as e:
+        _log(f"WEBHOOK_BLOCKED id={job['id']} err={e}")
+        return
+    body = public_job(job, include_result=True)
+    try:
+        async with httpx.AsyncClient(timeout=get_settings().JOB_WEBHOOK_TIMEOUT_SEC, follow_redirects=False) as client:
+            r = await client.post(url, json=body)
+        _log(f"WEBHOOK id={job['id']} status={r.status_code}")
+    except Exception as e:
+        _log(f"WEBHOOK_FAIL id={job['id']} err={type(e).__name__}: {e}")
+
+
+class JobRunner:
+    def __init__(self) -> None:
+        s = get_settings()
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = max(1, int(s.JOB_WORKER_CONCURRENCY))
+        self.poll_s = max(0.2, float(s.JOB_POLL_INTERVAL_SEC))
+        self.lease_s = max(10.0, float(s.JOB_LEASE_SEC))
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._task: Optional[asyncio.Task] = None
+        self._running: set = set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+            _log(f"RUNNER_START worker={self.worker_id} concurrency={self.concurrency}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Job đang chạy bị huỷ -> lease hết hạn -> worker khác nhận lại
+        for t in list(self._running):
+            t.cancel()
+
+    async def _loop(self) -> None:
+        while True:
+            await self._slots.acquire()
+            try:
+                job = await asyncio.to_thread(_claim_next, self.worker_id, self.lease_s)
+            except Exception as e:
+                self._slots.release()
+                _log(f"CLAIM_FAIL err={e}")
+                await asyncio.sleep(self.poll_s)
+                continue
+            if job is None:
+                self._slots.release()
+                await asyncio.sleep(self.poll_s)
+                continue
+            t = asyncio.create_task(self._run(job))
+            self._running.add(t)
+            t.add_done_callback(self._running.discard)
+
+    async def _heartbeat(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease_s / 3)
+            try:
+                await asyncio.to_thread(_renew_lease, job_id, self.worker_id, self.lease_s)
+            except Exception as e:
+                _log(f"LEASE_RENEW_FAIL id={job_id} err={e}")
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id, kind = job["id"], job["kind"]
+        set_request_ip(f"job:{job_id[:8]}")
+        hb = asyncio.create_task(self._heartbeat(job_id))
+        t0 = time.perf_counter()
+        try:
+            handler = _HANDLERS.get(kind)
+            if handler is None:
+                raise RuntimeError(f"No handler for job kind '{kind}'")
+            _log(f"RUN id={job_id} kind={kind} attempt={job['attempts']}")
+            result = await handler(job.get("payload") or {})
+            await asyncio.to_thread(_finish, job_id, self.worker_id, result=result or {})
+            metrics.incr(f"jobs.{kind}.succeeded")
+            _log(f"DONE id={job_id} kind={kind} dt_ms={int((time.perf_counter() - t0) * 1000)}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e) or type(e).__name__
+            await asyncio.to_thread(_finish, job_id, self.worker_id, error=str(detail))
+            metrics.incr(f"jobs.{kind}.failed")
+            _log(f"FAIL id={job_id} kind={kind} err={detail}")
+        finally:
+            hb.cancel()
+            self._slots.release()
+        final = await asyncio.to_thread(get_job, job_id)
+        if final and final["status"] in {JOB_SUCCEEDED, JOB_FAILED}:
+            await _send_webhook(final)
+
+
+_runner: Optional[JobRunner] = None
+
+
+def start_job_runner() -> None:
+    global _runner
+    if _runner is None:
+        _runner = JobRunner()
+        _runner.start()
+
+
+async def stop_job_runner() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.stop()
+        _runner = None
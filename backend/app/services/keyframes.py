@@ -0,0 +1,213 @@
+# app/services/keyframes.py
+from __future__ import annotations
+
+import json
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# =========================================================
+# Scene-aware keyframe sampling (local, ffmpeg + NumPy)
+# =========================================================
+# Decode video ở độ phân giải rất thấp (grayscale), tính điểm khác biệt giữa
+# các frame liên tiếp, phát hiện cut, chọn keyframe đại diện cho mỗi cảnh.
+# Kết quả (keyframes + cut list) thay cho việc gửi toàn bộ video cho phần
+# visual / pacing / text-overlay của report.
+
+_PROBE_W = 64
+_PROBE_H = 64
+
+
+def probe_duration(path: Path) -> Optional[float]:
+    try:
+        res = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", str(path)],
+            capture_output=True, text=True, check=True,
+        )
+        dur = float(json.loads(res.stdout or "{}").get("format", {}).get("duration", 0.0))
+        return dur if dur > 0 else None
+    except Exception:
+        return None
+
+
+def sample_gray_frames(path: Path, fps: float = 4.0, width: int = _PROBE_W, height: int = _PROBE_H) -> np.ndarray:
+    """
+    Decode video thành mảng (N, H, W) uint8 grayscale ở `fps` frame/giây.
+    """
+    cmd = [
+        "ffmpeg", "-v", "error", "-i", str(path),
+        "-vf", f"fps={fps},scale={width}:{height},format=gray",
+        "-f", "rawvideo", "-pix_fmt", "gray", "pipe:1",
+    ]
+    res = subprocess.run(cmd, capture_output=True, check=True)
+    raw = np.frombuffer(res.stdout, dtype=np.uint8)
+    frame_size = width * height
+    n = raw.size // frame_size
+    return raw[: n * frame_size].reshape(n, height, width)
+
+
+def frame_diff_scores(frames: np.ndarray) -> np.ndarray:
+    """
+    Điểm khác biệt giữa frame i và i+1 (0..1): trung bình |Δpixel| kết hợp
+    khoảng cách histogram (bền hơn với chuyển động camera nhẹ).
+    """
+    if frames.shape[0] < 2:
+        return np.zeros(0, dtype=np.float32)
+    f = frames.astype(np.int16)
+    pix = np.abs(f[1:] - f[:-1]).mean(axis=(1, 2)) / 255.0
+
+    bins = 16
+    n = frames.shape[0]
+    q = (frames >> 4).reshape(n, -1).astype(np.int64)  # 256 -> 16 bins
+    flat = (np.arange(n, dtype=np.int64)[:, None] * bins + q).ravel()
+    hist = np.bincount(flat, minlength=n * bins).reshape(n, bins).astype(np.float32)
+    hist /= float(q.shape[1])
+    hdist = 0.5 * np.abs(hist[1:] - hist[:-1]).sum(axis=1)
+
+    return (0.5 * pix + 0.5 * hdist).astype(np.float32)
+
+
+def detect_cuts(
+    scores: np.ndarray,
+    fps: float,
+    min_threshold: float = 0.12,
+    k: float = 4.0,
+    min_scene_s: float = 0.4,
+) -> List[float]:
+    """
+    Ngưỡng thích nghi: max(min_threshold, median + k * MAD).
+    Trả về timestamp (giây) của các cut, cách nhau tối thiểu min_scene_s.
+    """
+    if scores.size == 0:
+        return []
+    med = float(np.median(scores))
+    mad = float(np.median(np.abs(scores - med))) or 1e-6
+    thr = max(min_threshold, med + k * mad)
+    min_gap = max(1, int(round(min_scene_s * fps)))
+
+    cuts: List[float] = []
+    last_idx = -min_gap
+    for idx in (int(i) for i in np.flatnonzero(scores >= thr)):
+        if idx - last_idx < min_gap:
+            continue
+        # score[i] là khác biệt giữa frame i và i+1 -> cut tại frame i+1
+        cuts.append(round((idx + 1) / fps, 3))
+        last_idx = idx
+    return cuts
+
+
+def build_scenes(cuts: List[float], duration: float) -> List[Dict[str, float]]:
+    bounds = [0.0] + [c for c in cuts if 0.0 < c < duration] + [duration]
+    return [
+        {"start": round(bounds[i], 3), "end": round(bounds[i + 1], 3)}
+        for i in range(len(bounds) - 1)
+        if bounds[i + 1] > bounds[i]
+    ]
+
+
+def pick_keyframe_times(scenes: List[Dict[str, float]], max_keyframes: int) -> List[float]:
+    """
+    1 keyframe (giữa cảnh) / cảnh. Nếu nhiều cảnh hơn max_keyframes:
+    giữ cảnh đầu/cuối + các cảnh dài nhất, theo thứ tự thời gian.
+    """
+    if not scenes:
+        return []
+    idxs = list(range(len(scenes)))
+    if len(scenes) > max_keyframes > 0:
+        keep = {0, len(scenes) - 1}
+        by_len = sorted(idxs[1:-1], key=lambda i: scenes[i]["end"] - scenes[i]["start"], reverse=True)
+        for i in by_len:
+            if len(keep) >= max_keyframes:
+                break
+            keep.add(i)
+        idxs = sorted(keep)
+    return [round((scenes[i]["start"] + scenes[i]["end"]) / 2.0, 3) for i in idxs]
+
+
+def extract_jpeg(path: Path, t: float, width: int = 512) -> Optional[bytes]:
+    cmd = [
+        "ffmpeg", "-v", "error", "-ss", f"{t:.3f}", "-i", str(path),
+        "-frames:v", "1", "-vf", f"scale={width}:-2",
+        "-f", "image2pipe", "-vcodec", "mjpeg", "-q:v", "4", "pipe:1",
+    ]
+    try:
+        res = subprocess.run(cmd, capture_output=True, check=True)
+        return res.stdout or None
+    except Exception:
+        return None
+
+
+def extract_audio(path: Path, out_path: Path) -> Optional[Path]:
+    """Tách audio mono 16 kHz (đủ cho transcript) — nhỏ hơn video gốc rất nhiều."""
+    cmd = [
+        "ffmpeg", "-v", "error", "-y", "-i", str(path),
+        "-vn", "-ac", "1", "-ar", "16000", "-b:a", "48k", str(out_path),
+    ]
+    try:
+        subprocess.run(cmd, capture_output=True, check=True)
+        return out_path if out_path.is_file() and out_path.stat().st_size > 0 else None
+    except Exception:
+        return None
+
+
+def fmt_ts(t: float) -> str:
+    m, s = divmod(max(0.0, float(t)), 60.0)
+    return f"{int(m):02d}:{s:04.1f}"
+
+
+def analyze_scenes(
+    path: Path,
+    *,
+    sample_fps: float = 4.0,
+    max_keyframes: int = 24,
+    keyframe_width: int = 512,
+) -> Dict[str, Any]:
+    """
+    Toàn bộ stage: decode low-res -> score -> cut -> scene -> keyframe JPEG.
+    Trả:
+      duration, cuts [s], scenes [{start,end}], keyframes [{t, jpeg}],
+      pacing {cut_count, scene_count, avg_shot_s, cuts_per_min}
+    """
+    frames = sample_gray_frames(path, fps=sample_fps)
+    duration = probe_duration(path) or (frames.shape[0] / sample_fps if frames.size else 0.0)
+    scores = frame_diff_scores(frames)
+    cuts = detect_cuts(scores, sample_fps)
+    scenes = build_scenes(cuts, duration)
+
+    keyframes: List[Dict[str, Any]] = []
+    for t in pick_keyframe_times(scenes, max_keyframes):
+        jpeg = extract_jpeg(path, t, width=keyframe_width)
+        if jpeg:
+            keyframes.append({"t": t, "jpeg": jpeg})
+
+    n_scenes = len(scenes)
+    return {
+        "duration": round(duration, 3),
+        "cuts": cuts,
+        "scenes": scenes,
+        "keyframes": keyframes,
+        "pacing": {
+            "cut_count": len(cuts),
+            "scene_count": n_scenes,
+            "avg_shot_s": round(duration / n_scenes, 2) if n_scenes else None,
+            "cuts_per_min": round(len(cuts) * 60.0 / duration, 2) if duration else None,
+        },
+    }
+
+
+SCENE_CUTS_HEADER = "[SCENE CUTS — measured locally from frame differences; treat as exact]"
+
+
+def scene_summary_text(info: Dict[str, Any]) -> str:
+    """Cut list + số đo pacing dạng text để đưa vào prompt."""
+    p = info.get("pacing") or {}
+    cuts = info.get("cuts") or []
+    lines = [
+        SCENE_CUTS_HEADER,
+        f"Duration: {info.get('duration')}s | Cuts: {p.get('cut_count')} | Scenes: {p.get('scene_count')} | "
+        f"Avg shot: {p.get('avg_shot_s')}s | Cuts/min: {p.get('cuts_per_min')}",
+        "Cut timestamps: " + (", ".join(f"[{fmt_ts(c)}]" for c in cuts) if cuts else "(no cuts — single continuous shot)"),
+    ]
+    return "\n".join(lines)
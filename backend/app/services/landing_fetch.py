@@ -0,0 +1,374 @@
+# app/services/landing_fetch.py
+from __future__ import annotations
+
+import json
+import re
+import time
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import httpx
+
+from app.api.http_client import get_http_client
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.netguard import UnsafeURLError, ensure_public_url
+from app.core.logger import setup_app_logger, get_request_ip
+from app.core.store import content_key, store_get, store_put
+
+_svc_logger = setup_app_logger(name="casesurf", log_dir="logs")
+
+def _log_info(msg: str) -> None:
+    _svc_logger.info(f"{get_request_ip()} - {msg}")
+
+
+class LandingFetchError(Exception):
+    """Lỗi fetch/parse landing page (status_code gợi ý cho HTTPException)."""
+
+    def __init__(self, message: str, status_code: int = 502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+_URL_RE = re.compile(r"^https?://\S+$", re.IGNORECASE)
+
+
+def looks_like_url(value: str) -> bool:
+    v = (value or "").strip()
+    return bool(_URL_RE.match(v)) and bool(urlsplit(v).netloc)
+
+# =========================================================
+# HTML -> readable text + reviews (stdlib HTMLParser, không cần browser)
+# =========================================================
+_SKIP_TAGS = {"script", "style", "noscript", "svg", "template", "iframe", "canvas", "nav", "footer", "aside", "form"}
+_VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+    "meta", "param", "source", "track", "wbr",
+}
+_BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "li", "ul", "ol", "tr", "td", "th", "table",
+    "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "br", "hr", "dd", "dt", "figcaption",
+}
+_REVIEW_ATTR_RE = re.compile(r"review|comment|testimonial|feedback|rating", re.IGNORECASE)
+
+
+class _LandingHTMLParser(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.description = ""
+        self.blocks: List[str] = []
+        self.reviews: List[str] = []
+        self.ld_json: List[str] = []
+        self._buf: List[str] = []
+        self._stack: List[Tuple[str, bool, bool]] = []  # (tag, skip, review_marker)
+        self._skip_depth = 0
+        self._review_depth = 0
+        self._review_buf: List[str] = []
+        self._in_title = False
+        self._in_ld = False
+        self._ld_buf: List[str] = []
+
+    # ---- helpers ----
+    def _flush(self) -> None:
+        txt = re.sub(r"\s+", " ", "".join(self._buf)).strip()
+        self._buf = []
+        if txt:
+            self.blocks.append(txt)
+
+    def _close_review(self) -> None:
+        txt = re.sub(r"\s+", " ", " ".join(self._review_buf)).strip()
+        self._review_buf = []
+        if txt:
+            self.reviews.append(txt)
+
+    # ---- HTMLParser hooks ----
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        a = {k.lower(): (v or "") for k, v in attrs}
+        if tag == "meta":
+            name = (a.get("name") or a.get("property") or "").lower()
+            if name in {"description", "og:description"} and not self.description:
+                self.description = a.get("content", "").strip()
+            return
+        if tag == "title":
+            self._in_title = True
+        if tag == "script" and "ld+json" in a.get("type", "").lower():
+            self._in_ld = True
+            self._ld_buf = []
+        if tag in _BLOCK_TAGS:
+            self._flush()
+        if tag in _VOID_TAGS:
+            return
+
+        skip = tag in _SKIP_TAGS
+        marker = " ".join([a.get("class", ""), a.get("id", ""), a.get("itemprop", ""), a.get("data-testid", "")])
+        review_root = bool(_REVIEW_ATTR_RE.search(marker))
+        self._stack.append((tag, skip, review_root))
+        if skip:
+            self._skip_depth += 1
+        if review_root:
+            # container lồng nhau (list review -> từng review): mỗi lớp là 1 ranh giới
+            self._close_review()
+            self._review_depth += 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "title":
+            self._in_title = False
+        if tag == "script" and self._in_ld:
+            self._in_ld = False
+            self.ld_json.append("".join(self._ld_buf))
+        if tag in _BLOCK_TAGS:
+            self._flush()
+        if tag in _VOID_TAGS or not any(t == tag for t, _, _ in self._stack):
+            return
+        # HTML lỗi (thẻ không đóng): pop tới thẻ khớp gần nhất
+        while self._stack:
+            t, skip, review_root = self._stack.pop()
+            if skip:
+                self._skip_depth -= 1
+            if review_root:
+                self._review_depth -= 1
+                self._close_review()
+            if t == tag:
+                break
+
+    def handle_data(self, data: str) -> None:
+        if self._in_ld:
+            self._ld_buf.append(data)
+            return
+        if self._in_title:
+            self.title += data
+            return
+        if self._skip_depth > 0:
+            return
+        if self._review_depth > 0:
+            self._review_buf.append(data)
+        else:
+            self._buf.append(data)
+
+    def close(self) -> None:
+        super().close()
+        self._flush()
+        if self._review_depth > 0:
+            self._close_review()
+
+
+def _ld_reviews(raw_blocks: List[str]) -> List[str]:
+    """Lấy reviewBody/description từ JSON-LD (schema.org Review / Product.review)."""
+    out: List[str] = []
+
+    def _walk(node: Any) -> None:
+        if isinstance(node, list):
+            for x in node:
+                _walk(x)
+        elif isinstance(node, dict):
+            typ = node.get("@type")
+            types = typ if isinstance(typ, list) else [typ]
+            if "Review" in types:
+                body = node.get("reviewBody") or node.get("description")
+                if isinstance(body, str) and body.strip():
+                    out.append(re.sub(r"\s+", " ", body).strip())
+            for v in node.values():
+                if isinstance(v, (dict, list)):
+                    _walk(v)
+
+    for raw in raw_blocks:
+        try:
+            _walk(json.loads(raw))
+        except Exception:
+            continue
+    return out
+
+
+def extract_landing_content(html: str, max_chars: int = 60000) -> Dict[str, Any]:
+    """
+    Trả {title, description, text, reviews}. Bỏ script/style/nav/footer/form,
+    gom review (class/id chứa review|comment|testimonial|... và JSON-LD Review) riêng.
+    """
+    p = _LandingHTMLParser()
+    try:
+        p.feed(html or "")
+        p.close()
+    except Exception:
+        pass
+
+    seen = set()
+    blocks: List[str] = []
+    for b in p.blocks:
+        key = b.lower()
+        if len(b) < 3 or key in seen:
+            continue
+        seen.add(key)
+        blocks.append(b)
+
+    reviews: List[str] = []
+    rseen = set()
+    for r in p.reviews + _ld_reviews(p.ld_json):
+        key = r.lower()
+        if len(r) < 3 or key in rseen:
+            continue
+        rseen.add(key)
+        reviews.append(r)
+
+    text = "\n".join(blocks)
+    if len(text) > max_chars:
+        text = text[:max_chars]
+    return {
+        "title": re.sub(r"\s+", " ", p.title).strip(),
+        "description": p.description,
+        "text": text,
+        "reviews": reviews,
+    }
+
+
+def landing_page_text(page: Dict[str, Any]) -> str:
+    """Ghép nội dung đã trích thành input cho PROMPT1 (Raw Data)."""
+    parts = [f"URL: {page.get('final_url') or page.get('url')}"]
+    if page.get("title"):
+        parts.append(f"Title: {page['title']}")
+    if page.get("description"):
+        parts.append(f"Description: {page['description']}")
+    if page.get("text"):
+        parts.append("\n[PAGE TEXT]\n" + page["text"])
+    if page.get("reviews"):
+        parts.append("\n[CUSTOMER REVIEWS]\n" + "\n".join(f"- {r}" for r in page["reviews"]))
+    return "\n".join(parts).strip()
+
+# =========================================================
+# Fetch + cache (ETag / Last-Modified revalidation)
+# =========================================================
+_LANDING_NS = "landing_pages"
+
+
+async def _read_capped(resp: httpx.Response, max_bytes: int) -> Tuple[bytes, bool]:
+    buf = bytearray()
+    truncated = False
+    async for chunk in resp.aiter_bytes():
+        buf.extend(chunk)
+        if len(buf) >= max_bytes:
+            truncated = True
+            del buf[max_bytes:]
+            break
+    return bytes(buf), truncated
+
+
+_MAX_REDIRECTS = 5
+_REDIRECT_STATUS = {301, 302, 303, 307, 308}
+
+
+async def _get_landing(
+    client: httpx.AsyncClient, url: str, headers: Dict[str, str], timeout: httpx.Timeout, max_bytes: int
+) -> Dict[str, Any]:
+    """
+    GET tự đi theo redirect (tối đa _MAX_REDIRECTS), kiểm tra SSRF cho TỪNG hop
+    (client pool mặc định follow_redirects=True nên phải tắt ở đây).
+    Trả {status, raw, truncated, encoding, etag, last_modified, final_url}.
+    """
+    target = url
+    for _ in range(_MAX_REDIRECTS + 1):
+        try:
+            await ensure_public_url(target)
+        except UnsafeURLError as e:
+            raise LandingFetchError(str(e), status_code=400)
+        async with client.stream("GET", target, headers=headers, timeout=timeout, follow_redirects=False) as resp:
+            if resp.status_code in _REDIRECT_STATUS:
+                location = resp.headers.get("location") or ""
+                if not location:
+                    raise LandingFetchError(f"Redirect thiếu Location: {target}")
+                target = urljoin(str(resp.url), location)
+                continue
+            out: Dict[str, Any] = {"status": resp.status_code, "final_url": str(resp.url)}
+            if resp.status_code == 304:
+                return out
+            if resp.status_code >= 400:
+                raise LandingFetchError(f"Landing trả lỗi HTTP {resp.status_code}: {url}")
+            ctype = (resp.headers.get("content-type") or "").lower()
+            if ctype and not any(t in ctype for t in ("html", "text/plain", "xml")):
+                raise LandingFetchError(f"Content-Type không hỗ trợ: {ctype}", status_code=415)
+            out["raw"], out["truncated"] = await _read_capped(resp, max_bytes)
+            out["encoding"] = resp.charset_encoding or "utf-8"
+            out["etag"] = resp.headers.get("etag")
+            out["last_modified"] = resp.headers.get("last-modified")
+            return out
+    raise LandingFetchError(f"Quá nhiều redirect: {url}")
+
+
+async def fetch_landing_page(url: str) -> Dict[str, Any]:
+    """
+    Fetch landing qua client pool dùng chung, có timeout + giới hạn dung lượng.
+    - Chỉ URL http(s) trỏ tới IP public, kể cả sau mỗi redirect (chặn SSRF).
+    - Trong LANDING_CACHE_FRESH_SEC: dùng cache, không gọi mạng.
+    - Sau đó: GET có If-None-Match / If-Modified-Since; 304 -> dùng lại bản đã trích.
+      304 mà không có bản cache dùng được -> GET lại không kèm header điều kiện.
+    """
+    settings = get_settings()
+    url = (url or "").strip()
+    if not looks_like_url(url):
+        raise LandingFetchError(f"URL không hợp lệ: {url}", status_code=400)
+
+    key = content_key(url)
+    cached = store_get(_LANDING_NS, key, max_age_s=settings.LANDING_CACHE_TTL_SEC)
+    now = time.time()
+    if cached and now - float(cached.get("fetched_at") or 0) < settings.LANDING_CACHE_FRESH_SEC:
+        metrics.incr("landing_fetch.hit")
+        _log_info(f"LANDING_FETCH cache_fresh url={url}")
+        return {**cached, "cached": True, "revalidated": False}
+
+    base_headers: Dict[str, str] = {"accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.5"}
+    headers = dict(base_headers)
+    if cached:
+        if cached.get("etag"):
+            headers["if-none-match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["if-modified-since"] = cached["last_modified"]
+
+    t0 = time.perf_counter()
+    client = get_http_client()
+    timeout = httpx.Timeout(settings.LANDING_FETCH_TIMEOUT_SEC, connect=min(10.0, settings.LANDING_FETCH_TIMEOUT_SEC))
+    try:
+        res = await _get_landing(client, url, headers, timeout, settings.LANDING_MAX_BYTES)
+        if res["status"] == 304:
+            if cached and cached.get("text") is not None:
+                cached["fetched_at"] = now
+                store_put(_LANDING_NS, key, cached)
+                metrics.incr("landing_fetch.hit")
+                metrics.incr("landing_fetch.revalidated")
+                _log_info(f"LANDING_FETCH not_modified url={url} dt_ms={int((time.perf_counter() - t0) * 1000)}")
+                return {**cached, "cached": True, "revalidated": True}
+            res = await _get_landing(client, url, base_headers, timeout, settings.LANDING_MAX_BYTES)
+            if res["status"] == 304:
+                raise LandingFetchError(f"Landing trả 304 dù không gửi header điều kiện: {url}")
+    except LandingFetchError:
+        raise
+    except httpx.TimeoutException:
+        raise LandingFetchError(f"Timeout khi tải landing: {url}", status_code=504)
+    except httpx.HTTPError as e:
+        raise LandingFetchError(f"Không tải được landing: {type(e).__name__}: {e}")
+
+    raw, truncated = res["raw"], res["truncated"]
+    etag, last_modified, final_url = res["etag"], res["last_modified"], res["final_url"]
+    try:
+        html = raw.decode(res["encoding"], errors="replace")
+    except LookupError:
+        html = raw.decode("utf-8", errors="replace")
+
+    page = extract_landing_content(html, max_chars=settings.LANDING_MAX_TEXT_CHARS)
+    record = {
+        "url": url,
+        "final_url": final_url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "fetched_at": now,
+        "bytes": len(raw),
+        "truncated": truncated,
+        **page,
+    }
+    if etag or last_modified or settings.LANDING_CACHE_FRESH_SEC > 0:
+        store_put(_LANDING_NS, key, record)
+    metrics.incr("landing_fetch.miss")
+    _log_info(
+        f"LANDING_FETCH ok url={url} bytes={len(raw)} truncated={truncated} "
+        f"text_chars={len(page['text'])} reviews={len(page['reviews'])} dt_ms={int((time.perf_counter() - t0) * 1000)}"
+    )
+    return {**record, "cached": False, "revalidated": False}
@@ -2,6 +2,7 @@ from typing import Any, Dict, Optional
 import httpx
 from fastapi import HTTPException, status
 from app.core.config import settings
+from app.core.retry import default_policy, retry_async
 
 async def handle_message(payload: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -11,15 +12,20 @@ async def handle_message(payload: Dict[str, Any]) -> Dict[str, Any]:
     # 1) Nếu có N8N_WEBHOOK_URL → forward sang n8n
     if settings.N8N_WEBHOOK_URL:
         try:
-            async with httpx.AsyncClient(timeout=settings.OUTBOUND_TIMEOUT_SEC) as client:
-                r = await client.post(settings.N8N_WEBHOOK_URL, json=payload)
-                r.raise_for_status()
-                data = r.json()
-                # Chuẩn hoá output
-                return {
-                    "reply": data.get("reply", "(no content)"),
-                    "meta": data.get("meta", {"via": "n8n"})
-                }
+            async def _post() -> httpx.Response:
+                async with httpx.AsyncClient(timeout=settings.OUTBOUND_TIMEOUT_SEC) as client:
+                    r = await client.post(settings.N8N_WEBHOOK_URL, json=payload)
+                    r.raise_for_status()
+                    return r
+
+            # POST chat không idempotent: chỉ gửi lại khi lỗi connect / 429
+            r = await retry_async(_post, name="n8n", policy=default_policy(idempotent=False))
+            data = r.json()
+            # Chuẩn hoá output
+            return {
+                "reply": data.get("reply", "(no content)"),
+                "meta": data.get("meta", {"via": "n8n"})
+            }
         except httpx.HTTPError as e:
             # Trả lỗi 502 khi upstream (n8n/LLM) có vấn đề
             raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
@@ -1,8 +1,15 @@
 # app/services/script_infer.py
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Optional, Tuple
+import asyncio
+import hashlib
 import json
 import re
+import time
 import google.generativeai as genai
+from pydantic import ConfigDict, ValidationError, create_model
+
+from app.core.retry import retry_async
+from app.core.store import content_key, store_get, store_put
 
 REQUIRED_KEYS = [
     "ProductName","TargetAudience","VisibleProblem","HiddenCause",
@@ -10,6 +17,163 @@ REQUIRED_KEYS = [
     "Villain","DesiredNextStep",
 ]
 
+_INFER_SYSTEM = "[SYSTEM] Extract required marketing inputs from context."
+_INFER_SCHEMA_HINT = (
+    "Return STRICT JSON with exactly these keys:\n"
+    + ", ".join(REQUIRED_KEYS) + ".\n"
+    "Values must be strings (can be empty if truly not inferable). No extra keys."
+)
+_INFER_BATCH_SCHEMA_HINT = (
+    "Return a STRICT JSON array with exactly {n} objects, one per ANGLE in the same order.\n"
+    "Each object has exactly these keys: index, " + ", ".join(REQUIRED_KEYS) + ".\n"
+    "index is the ANGLE number (1-based); other values must be strings (empty if truly not inferable)."
+)
+_INFER_CONTEXT_TEMPLATE = (
+    "{system}\n{schema_hint}\n\n"
+    "— CONTEXT START —\n"
+    "REPORT:\n{report}\n\n"
+    "LANDING ANALYSIS:\n{landing_analysis}\n\n"
+    "{angles}\n"
+    "— CONTEXT END —\n"
+)
+
+SCRIPT_INPUTS_NS = "script_inputs"
+
+def angle_context_text(angle: Optional[Dict[str, Any]]) -> str:
+    """Text angle đưa vào prompt — dùng chung cho precompute và /generate-script để key khớp."""
+    if not angle:
+        return ""
+    return f"Title: {angle.get('title','')}\n{angle.get('raw','')}"
+
+def script_inputs_key(*, report: str, landing_analysis: str, angle_text: str, model_name: str) -> str:
+    """report ở đây là report GỐC (client gửi), không phải digest: digest có thể chưa xong lúc
+    precompute hoặc lúc /generate-script chạy -> key theo digest sẽ lệch giữa 2 đường."""
+    return content_key(
+        (report or "").strip(),
+        (landing_analysis or "").strip(),
+        (angle_text or "").strip(),
+        model_name,
+        INFER_PROMPT_VERSION,
+    )
+
+def get_cached_required_inputs(
+    *, report: str, landing_analysis: str, angle_text: str, model_name: str, max_age_s: Optional[int] = None,
+) -> Optional[Dict[str, str]]:
+    key = script_inputs_key(report=report, landing_analysis=landing_analysis, angle_text=angle_text, model_name=model_name)
+    art = store_get(SCRIPT_INPUTS_NS, key, max_age_s=max_age_s)
+    if not art or not isinstance(art.get("inputs"), dict):
+        return None
+    inputs = {k: str(art["inputs"].get(k, "") or "") for k in REQUIRED_KEYS}
+    return inputs if any(inputs.values()) else None
+
+def _store_inputs(
+    *, report: str, landing_analysis: str, angle_text: str, model_name: str, inputs: Dict[str, str], t_infer_ms: int,
+) -> None:
+    key = script_inputs_key(report=report, landing_analysis=landing_analysis, angle_text=angle_text, model_name=model_name)
+    store_put(SCRIPT_INPUTS_NS, key, {
+        "inputs": inputs,
+        "model": model_name,
+        "prompt_version": INFER_PROMPT_VERSION,
+        "t_infer_ms": t_infer_ms,
+        "created_at": int(time.time()),
+    })
+
+async def precompute_required_inputs(
+    *, api_key: str, model_name: str, report: str, landing_analysis: str, angle_text: str,
+    prompt_report: Optional[str] = None,
+) -> Dict[str, str]:
+    """
+    Suy luận 9 trường (không seed) và lưu cache để /generate-script chỉ còn 1 call.
+    report: report gốc (cache key); prompt_report: bản đưa vào prompt (digest), mặc định = report.
+    """
+    t0 = time.perf_counter()
+    inputs, _ = await infer_required_inputs_from_context(
+        api_key=api_key,
+        model_name=model_name,
+        report=prompt_report or report,
+        landing_analysis=landing_analysis,
+        angle_text=angle_text,
+    )
+    # toàn rỗng (model lỗi tạm / output không parse được) -> không cache, lần sau infer lại
+    if any(inputs.values()):
+        _store_inputs(
+            report=report, landing_analysis=landing_analysis, angle_text=angle_text, model_name=model_name,
+            inputs=inputs, t_infer_ms=int((time.perf_counter() - t0) * 1000),
+        )
+    return inputs
+
+# ---- Structured output (response_schema + JSON mime) ----------------------------
+# Tên field trong schema chỉ dùng [A-Za-z0-9_] ("UniqueMechanism/USP" -> "UniqueMechanismUSP"),
+# decode xong map ngược về REQUIRED_KEYS.
+_SAFE_KEYS: Dict[str, str] = {k: re.sub(r"[^A-Za-z0-9_]", "", k) for k in REQUIRED_KEYS}
+
+RequiredInputs = create_model(
+    "RequiredInputs",
+    __config__=ConfigDict(extra="ignore"),
+    **{safe: (str, "") for safe in _SAFE_KEYS.values()},
+)
+
+def _inputs_schema(with_index: bool = False) -> Dict[str, Any]:
+    props: Dict[str, Any] = {safe: {"type": "STRING"} for safe in _SAFE_KEYS.values()}
+    if with_index:
+        props = {"index": {"type": "INTEGER"}, **props}
+    return {"type": "OBJECT", "properties": props, "required": list(props)}
+
+# đổi prompt / keys / response_schema -> version đổi -> cache precompute cũ tự hết hiệu lực
+INFER_PROMPT_VERSION = hashlib.sha256("\x1f".join([
+    _INFER_SYSTEM,
+    _INFER_SCHEMA_HINT,
+    _INFER_BATCH_SCHEMA_HINT,
+    _INFER_CONTEXT_TEMPLATE,
+    json.dumps(_inputs_schema(), sort_keys=True),
+    json.dumps(_inputs_schema(with_index=True), sort_keys=True),
+]).encode("utf-8")).hexdigest()[:12]
+
+def _decode_inputs(obj: Any) -> Dict[str, str]:
+    """dict (key gốc hoặc key an toàn) -> RequiredInputs đã validate -> dict theo REQUIRED_KEYS."""
+    if not isinstance(obj, dict):
+        obj = {}
+    norm = {
+        re.sub(r"[^A-Za-z0-9_]", "", str(k)): ("" if v is None else v if isinstance(v, str) else str(v))
+        for k, v in obj.items()
+    }
+    try:
+        model = RequiredInputs.model_validate(norm)
+    except ValidationError:
+        model = RequiredInputs()
+    return {k: (getattr(model, safe) or "").strip() for k, safe in _SAFE_KEYS.items()}
+
+def _schema_unsupported(exc: BaseException) -> bool:
+    """
+    SDK không nhận response_schema (TypeError) hoặc model từ chối schema (InvalidArgument nhắc tới schema).
+    Lỗi khác (prompt bị chặn, candidate rỗng -> ValueError ở resp.text...) gọi lại prose cũng vô ích.
+    """
+    if isinstance(exc, TypeError):
+        return True
+    return type(exc).__name__ == "InvalidArgument" and "schema" in str(exc).lower()
+
+async def _generate_json(model: Any, prompt: str, schema: Dict[str, Any]) -> Tuple[str, bool]:
+    """
+    Gọi với response_mime_type=application/json + response_schema.
+    SDK/model không hỗ trợ schema -> gọi lại dạng prose (decode bằng _safe_json).
+    Mỗi lần thử giữ 1 slot của limiter Gemini chung. Trả (raw_text, structured).
+    """
+    from app.services.gemini import _gemini_limiter  # gemini import module này -> import muộn
+
+    async def _call(**kw: Any) -> Any:
+        async with _gemini_limiter():
+            return await model.generate_content_async([{"text": prompt}], **kw)
+
+    config = {"response_mime_type": "application/json", "response_schema": schema}
+    try:
+        resp = await retry_async(lambda: _call(generation_config=config), name="gemini")
+    except Exception as e:
+        if not _schema_unsupported(e):
+            raise
+        resp = await retry_async(lambda: _call(), name="gemini")
+        return (resp.text or ""), False
+    return (resp.text or ""), True
+
 def _merge_non_empty(base: Dict[str, str], patch: Dict[str, str]) -> Dict[str, str]:
     out = dict(base or {})
     for k, v in (patch or {}).items():
@@ -43,30 +207,134 @@ async def infer_required_inputs_from_context(
     genai.configure(api_key=api_key)
     model = genai.GenerativeModel(model_name)
 
-    schema_hint = (
-        "Return STRICT JSON with exactly these keys:\n"
-        + ", ".join(REQUIRED_KEYS) + ".\n"
-        "Values must be strings (can be empty if truly not inferable). No extra keys."
+    prompt = _INFER_CONTEXT_TEMPLATE.format(
+        system=_INFER_SYSTEM,
+        schema_hint=_INFER_SCHEMA_HINT,
+        report=report,
+        landing_analysis=landing_analysis,
+        angles=f"ANGLE TEXT:\n{angle_text}",
     )
 
-    prompt = (
-        "[SYSTEM] Extract required marketing inputs from context.\n"
-        f"{schema_hint}\n\n"
-        "— CONTEXT START —\n"
-        f"REPORT:\n{report}\n\n"
-        f"LANDING ANALYSIS:\n{landing_analysis}\n\n"
-        f"ANGLE TEXT:\n{angle_text}\n"
-        "— CONTEXT END —\n"
-    )
+    raw, structured = await _generate_json(model, prompt, _inputs_schema())
+    if structured:
+        try:
+            data: Any = json.loads(raw)
+        except ValueError:
+            data = _safe_json(raw)
+    else:
+        data = _safe_json(raw)
 
-    parts = [{"text": prompt}]
-    resp = await model.generate_content_async(parts)
-    raw = resp.text or ""
-    data = _safe_json(raw)
-
-    # sanitize
-    out: Dict[str, str] = {k: str(data.get(k, "") or "").strip() for k in REQUIRED_KEYS}
+    out = _decode_inputs(data)
     if seed_inputs:
         out = _merge_non_empty(out, {k: (seed_inputs.get(k) or "").strip() for k in REQUIRED_KEYS})
-    meta = {"raw": raw}
+    meta = {"raw": raw, "structured": structured}
     return out, meta
+
+async def infer_required_inputs_batch(
+    *,
+    api_key: str,
+    model_name: str,
+    report: str,
+    landing_analysis: str,
+    angle_texts: List[str],
+) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """
+    1 call cho cả bộ angle: context (report + landing) chỉ gửi 1 lần,
+    model trả JSON array theo đúng thứ tự angle. Trả về (list inputs, meta).
+    """
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(model_name)
+
+    angles_block = "\n\n".join(f"ANGLE {i}:\n{t}" for i, t in enumerate(angle_texts, start=1))
+    prompt = _INFER_CONTEXT_TEMPLATE.format(
+        system=_INFER_SYSTEM,
+        schema_hint=_INFER_BATCH_SCHEMA_HINT.format(n=len(angle_texts)),
+        report=report,
+        landing_analysis=landing_analysis,
+        angles=angles_block,
+    )
+
+    raw, structured = await _generate_json(model, prompt, {"type": "ARRAY", "items": _inputs_schema(with_index=True)})
+    data: Any = None
+    try:
+        data = json.loads(raw)
+    except Exception:
+        m = re.search(r"\[[\s\S]+\]", raw)
+        if m:
+            try: data = json.loads(m.group(0))
+            except Exception: data = None
+    items = data if isinstance(data, list) else []
+
+    by_index: Dict[int, Dict[str, Any]] = {}
+    for pos, item in enumerate(items, start=1):
+        if isinstance(item, dict):
+            try:
+                idx = int(item.get("index") or pos)
+            except (TypeError, ValueError):
+                idx = pos
+            by_index.setdefault(idx, item)
+    out = [_decode_inputs(by_index.get(i)) for i in range(1, len(angle_texts) + 1)]
+    return out, {"raw": raw, "parsed": len(by_index), "structured": structured}
+
+async def resolve_required_inputs_for_angles(
+    *,
+    api_key: str,
+    model_name: str,
+    report: str,
+    landing_analysis: str,
+    angle_texts: List[str],
+    max_age_s: Optional[int] = None,
+    prompt_report: Optional[str] = None,
+) -> Tuple[List[Optional[Dict[str, str]]], Dict[str, Any]]:
+    """
+    Inputs cho nhiều angle: lấy từ cache precompute nếu có, phần còn thiếu
+    suy luận bằng 1 batch call rồi lưu cache từng angle.
+    report: report gốc (cache key); prompt_report: bản đưa vào prompt (digest), mặc định = report.
+    Angle mà batch trả rỗng (JSON thiếu phần tử / bị cắt / không parse được) -> infer riêng
+    từng angle; vẫn rỗng -> None để gemini_generate_script tự chạy đường infer của nó.
+    """
+    results: List[Optional[Dict[str, str]]] = [
+        get_cached_required_inputs(
+            report=report, landing_analysis=landing_analysis, angle_text=t, model_name=model_name, max_age_s=max_age_s,
+        )
+        for t in angle_texts
+    ]
+    missing = [i for i, r in enumerate(results) if r is None]
+    meta: Dict[str, Any] = {"cached": len(angle_texts) - len(missing), "inferred": len(missing)}
+    if missing:
+        t0 = time.perf_counter()
+        inferred, _ = await infer_required_inputs_batch(
+            api_key=api_key,
+            model_name=model_name,
+            report=prompt_report or report,
+            landing_analysis=landing_analysis,
+            angle_texts=[angle_texts[i] for i in missing],
+        )
+        empty = [i for i, inputs in zip(missing, inferred) if not any(inputs.values())]
+        if empty:
+            async def _single(i: int) -> Dict[str, str]:
+                try:
+                    inputs, _ = await infer_required_inputs_from_context(
+                        api_key=api_key,
+                        model_name=model_name,
+                        report=prompt_report or report,
+                        landing_analysis=landing_analysis,
+                        angle_text=angle_texts[i],
+                    )
+                    return inputs
+                except Exception:
+                    return {k: "" for k in REQUIRED_KEYS}
+
+            singles = await asyncio.gather(*(_single(i) for i in empty))
+            by_pos = dict(zip(empty, singles))
+            inferred = [by_pos.get(i, inputs) for i, inputs in zip(missing, inferred)]
+            meta["batch_fallback"] = len(empty)
+        for i, inputs in zip(missing, inferred):
+            if any(inputs.values()):
+                results[i] = inputs
+                _store_inputs(
+                    report=report, landing_analysis=landing_analysis, angle_text=angle_texts[i], model_name=model_name,
+                    inputs=inputs, t_infer_ms=int((time.perf_counter() - t0) * 1000),
+                )
+        meta["t_infer_ms"] = int((time.perf_counter() - t0) * 1000)
+    return results, meta
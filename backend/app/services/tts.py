@@ -0,0 +1,540 @@
+# app/services/tts.py
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+import httpx
+from mutagen import File as MutagenFile
+
+from app.core import metrics
+from app.core.config import get_settings
+from app.core.logger import setup_app_logger, get_request_ip
+from app.core.retry import RetryableStatusError, raise_for_retryable_status, retry_async
+from app.core.store import content_key
+
+_svc_logger = setup_app_logger(name="casesurf", log_dir="logs")
+
+def _log_info(msg: str) -> None:
+    _svc_logger.info(f"{get_request_ip()} - {msg}")
+
+
+class TTSError(Exception):
+    """Lỗi TTS (status_code gợi ý cho HTTPException)."""
+
+    def __init__(self, message: str, status_code: int = 502):
+        super().__init__(message)
+        self.status_code = status_code
+
+# =========================================================
+# Helpers
+# =========================================================
+MAX_TTS_CHARS = 2500
+DEFAULT_OUTPUT_FORMAT = "mp3_44100_128"
+ELEVENLABS_TTS_URL = "https://api.elevenlabs.io/v1/text-to-speech/{}"
+ELEVENLABS_TTS_STREAM_URL = "https://api.elevenlabs.io/v1/text-to-speech/{}/stream"
+
+_SFX_PATTERNS = [
+    re.compile(p, re.IGNORECASE)
+    for p in (
+        r"\[sfx:[^\]]*\]", r"\(sfx:[^\)]*\)", r"\{sfx:[^\}]*\}",
+        r"\[fx:[^\]]*\]",  r"\(fx:[^\)]*\)",  r"\{fx:[^\}]*\}",
+        r"\[sound:[^\]]*\]", r"\(sound:[^\)]*\)", r"\{sound:[^\}]*\}",
+    )
+]
+
+
+def strip_sfx_from_vo(vo: str) -> str:
+    if not vo:
+        return vo
+    out = vo
+    for p in _SFX_PATTERNS:
+        out = p.sub("", out)
+    return re.sub(r"\s{2,}", " ", out).strip()
+
+
+def probe_mp3_duration_seconds(raw: bytes) -> Optional[float]:
+    try:
+        f = MutagenFile(io.BytesIO(raw))
+        if f and getattr(f, "info", None):
+            return float(f.info.length)
+    except Exception:
+        pass
+    return None
+
+
+def sample_rate_from_output_format(output_format: str) -> Optional[int]:
+    m = re.search(r"mp3_(\d{4,6})_", output_format or "")
+    return int(m.group(1)) if m else None
+
+
+def _ensure_dir(path: Path) -> Path:
+    if path.exists() and not path.is_dir():
+        raise NotADirectoryError("Path exists and is not a directory: {}".format(path))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def tts_file_path(audio_url: str) -> Path:
+    """audio_url (/api/static/tts/<file>, có thể kèm PUBLIC_BASE_URL) -> file trong STATIC_DIR/tts."""
+    name = (audio_url or "").rstrip("/").rsplit("/", 1)[-1]
+    return Path(getattr(get_settings(), "STATIC_DIR", "static")) / "tts" / name
+
+
+_limiter: Optional[Tuple[Any, asyncio.Semaphore]] = None
+
+
+def _elevenlabs_limiter() -> asyncio.Semaphore:
+    """
+    Số request ElevenLabs đồng thời / worker (ELEVENLABS_MAX_CONCURRENCY, theo giới hạn của plan).
+    Dùng chung cho /generate-voice, batch và pipeline shotlist -> TTS; tạo lại nếu đổi event loop.
+    """
+    global _limiter
+    loop = asyncio.get_running_loop()
+    if _limiter is None or _limiter[0] is not loop:
+        _limiter = (loop, asyncio.Semaphore(max(1, get_settings().ELEVENLABS_MAX_CONCURRENCY)))
+    return _limiter[1]
+
+
+def elevenlabs_api_key() -> str:
+    settings = get_settings()
+    return getattr(settings, "ELEVENLABS_API_KEY", None) or os.getenv("ELEVENLABS_API_KEY") or ""
+
+
+def resolve_voice_params(
+    *,
+    voice_id: Optional[str] = None,
+    model_id: Optional[str] = None,
+    output_format: Optional[str] = None,
+    stability: Optional[float] = None,
+    similarity_boost: Optional[float] = None,
+    style: Optional[float] = None,
+    use_speaker_boost: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """Tham số request -> giá trị thực dùng (default như /generate-voice)."""
+    settings = get_settings()
+    return {
+        "voice_id": voice_id or getattr(settings, "ELEVENLABS_VOICE_ID", "cgSgspJ2msm6clMCkdW9"),
+        "model_id": model_id or getattr(settings, "ELEVENLABS_MODEL_ID", "eleven_multilingual_v2"),
+        "output_format": output_format or DEFAULT_OUTPUT_FORMAT,
+        "voice_settings": {
+            "stability": stability if stability is not None else 0.5,
+            "similarity_boost": similarity_boost if similarity_boost is not None else 0.7,
+            "style": style if style is not None else 0.2,
+            "use_speaker_boost": True if use_speaker_boost is None else bool(use_speaker_boost),
+        },
+    }
+
+# =========================================================
+# Cache theo nội dung: static/tts/<key>.mp3 + <key>.json (meta)
+# =========================================================
+# key = hash(text đã bỏ SFX, voice_id, model_id, output_format, voice_settings)
+# -> request giống hệt trả lại file cũ, không tốn ký tự ElevenLabs.
+# Request trùng đang chạy trong cùng worker được gộp (chờ chung 1 future).
+# Thư mục tts giữ dưới TTS_STATIC_QUOTA_MB: vượt quota -> xoá file ít dùng nhất (mtime, hit sẽ touch).
+_inflight: Dict[str, asyncio.Future] = {}
+_last_sweep = 0.0
+
+
+def tts_cache_key(tts_text: str, voice_params: Dict[str, Any]) -> str:
+    return content_key("tts", tts_text, json.dumps(voice_params, sort_keys=True, ensure_ascii=False))
+
+
+def _tts_dir() -> Path:
+    return _ensure_dir(Path(getattr(get_settings(), "STATIC_DIR", "static")) / "tts")
+
+
+def _tts_public_url(filename: str) -> str:
+    settings = get_settings()
+    base_url = getattr(settings, "PUBLIC_BASE_URL", None) or os.getenv("PUBLIC_BASE_URL")
+    rel_path = "/api/static/tts/{}".format(filename)
+    return (str(base_url).rstrip("/") + rel_path) if base_url else rel_path
+
+
+def _read_cached(key: str) -> Optional[Dict[str, Any]]:
+    d = _tts_dir()
+    mp3, sidecar = d / f"{key}.mp3", d / f"{key}.json"
+    try:
+        if not mp3.is_file():
+            return None
+        meta = json.loads(sidecar.read_text(encoding="utf-8"))
+        os.utime(mp3)  # LRU cho eviction
+        return meta if isinstance(meta, dict) else None
+    except Exception:
+        return None
+
+
+def _atomic_write(path: Path, data: bytes) -> None:
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{os.urandom(4).hex()}.tmp")
+    try:
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _write_cached(key: str, audio_bytes: bytes, meta: Dict[str, Any]) -> None:
+    """mp3 trước, sidecar sau: có sidecar nghĩa là mp3 đã đầy đủ."""
+    d = _tts_dir()
+    _atomic_write(d / f"{key}.mp3", audio_bytes)
+    _atomic_write(d / f"{key}.json", json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+
+def enforce_tts_quota(max_bytes: int) -> int:
+    """Xoá mp3 (kèm sidecar) cũ nhất tới khi thư mục tts <= 90% quota. Trả số file đã xoá."""
+    files = []
+    total = 0
+    for p in _tts_dir().glob("*.mp3"):
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, p))
+        total += st.st_size
+    if total <= max_bytes:
+        return 0
+    target = int(max_bytes * 0.9)
+    removed = 0
+    for _, size, p in sorted(files):
+        if total <= target:
+            break
+        p.unlink(missing_ok=True)
+        p.with_suffix(".json").unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    metrics.incr("tts.cache_evicted", removed)
+    _log_info(f"TTS_QUOTA evicted={removed} bytes_left={total}")
+    return removed
+
+
+async def _maybe_enforce_quota() -> None:
+    global _last_sweep
+    settings = get_settings()
+    now = time.monotonic()
+    if now - _last_sweep < settings.TTS_QUOTA_SWEEP_SEC:
+        return
+    _last_sweep = now
+    try:
+        await asyncio.to_thread(enforce_tts_quota, settings.TTS_STATIC_QUOTA_MB * 1024 * 1024)
+    except Exception as e:
+        _log_info(f"TTS_QUOTA_FAIL err={e}")
+
+
+def _voice_response(meta: Dict[str, Any], beat: Optional[str]) -> Dict[str, Any]:
+    return {
+        "audio_url": _tts_public_url(meta["file"]),
+        "beat": beat,
+        "voice_id": meta["voice_id"],
+        "model_id": meta["model_id"],
+        "bytes": int(meta.get("bytes") or 0),
+        "duration_seconds": meta.get("duration_seconds"),
+        "sample_rate_hz": meta.get("sample_rate_hz"),
+    }
+
+# =========================================================
+# Core: text -> ElevenLabs -> static/tts/<key>.mp3
+# =========================================================
+def _prepare_request(
+    *,
+    text: str,
+    voice_id: Optional[str],
+    model_id: Optional[str],
+    output_format: Optional[str],
+    stability: Optional[float],
+    similarity_boost: Optional[float],
+    style: Optional[float],
+    use_speaker_boost: Optional[bool],
+) -> Tuple[str, Dict[str, Any], str]:
+    """Validate + chuẩn hoá -> (tts_text, voice_params, cache_key). Lỗi -> TTSError."""
+    if not elevenlabs_api_key():
+        raise TTSError("Missing ELEVENLABS_API_KEY (server config).", status_code=500)
+
+    raw_vo = (text or "").strip()
+    if not raw_vo:
+        raise TTSError("Thiếu text.", status_code=400)
+    if len(raw_vo) > MAX_TTS_CHARS:
+        raise TTSError("Text quá dài cho 1 beat (tối đa ~2500 ký tự). Hãy chia nhỏ.", status_code=413)
+
+    tts_text = strip_sfx_from_vo(raw_vo)
+    if not tts_text:
+        raise TTSError("VO chỉ có SFX, không có lời thoại.", status_code=400)
+
+    vp = resolve_voice_params(
+        voice_id=voice_id, model_id=model_id, output_format=output_format,
+        stability=stability, similarity_boost=similarity_boost, style=style, use_speaker_boost=use_speaker_boost,
+    )
+    return tts_text, vp, tts_cache_key(tts_text, vp)
+
+
+async def _synthesize_uncached(
+    *, tts_text: str, vp: Dict[str, Any], key: str, beat: Optional[str], client: Optional[httpx.AsyncClient]
+) -> Dict[str, Any]:
+    tts_url = ELEVENLABS_TTS_URL.format(vp["voice_id"])
+    headers = {
+        "accept": "audio/mpeg",
+        "content-type": "application/json",
+        "xi-api-key": elevenlabs_api_key(),
+    }
+    params = {"optimize_streaming_latency": 0, "output_format": vp["output_format"]}
+    body = {"text": tts_text, "model_id": vp["model_id"], "voice_settings": vp["voice_settings"]}
+
+    async def _post() -> httpx.Response:
+        # giữ slot chỉ trong 1 lần thử; thời gian chờ retry không chiếm slot
+        async with _elevenlabs_limiter():
+            if client is not None:
+                r = await client.post(tts_url, headers=headers, params=params, json=body, timeout=60.0)
+            else:
+                async with httpx.AsyncClient(timeout=60.0) as own:
+                    r = await own.post(tts_url, headers=headers, params=params, json=body)
+        raise_for_retryable_status(r)  # 429/5xx -> retry (Retry-After nếu có)
+        return r
+
+    t0 = time.perf_counter()
+    try:
+        resp = await retry_async(_post, name="elevenlabs")
+    except RetryableStatusError as e:
+        raise TTSError("ElevenLabs error: {}".format(e))
+    except httpx.RequestError as e:
+        raise TTSError("Không gọi được ElevenLabs: {}".format(e))
+
+    if resp.status_code >= 400:
+        try:
+            err_detail = resp.json()
+        except Exception:
+            err_detail = resp.text
+        raise TTSError("ElevenLabs error: {}".format(err_detail))
+
+    audio_bytes = resp.content
+    if not audio_bytes:
+        raise TTSError("ElevenLabs trả về rỗng.")
+
+    meta = {
+        "file": f"{key}.mp3",
+        "voice_id": vp["voice_id"],
+        "model_id": vp["model_id"],
+        "output_format": vp["output_format"],
+        "bytes": len(audio_bytes),
+        "duration_seconds": probe_mp3_duration_seconds(audio_bytes),
+        "sample_rate_hz": sample_rate_from_output_format(vp["output_format"]),
+        "chars": len(tts_text),
+        "created_at": time.time(),
+    }
+    await asyncio.to_thread(_write_cached, key, audio_bytes, meta)
+    await _maybe_enforce_quota()
+
+    metrics.incr("tts.synthesized")
+    metrics.incr("tts.chars", len(tts_text))
+    _log_info(f"TTS ok beat={beat or '-'} chars={len(tts_text)} bytes={len(audio_bytes)} dt_ms={int((time.perf_counter() - t0) * 1000)}")
+    return meta
+
+
+async def synthesize_voice(
+    *,
+    text: str,
+    beat: Optional[str] = None,
+    voice_id: Optional[str] = None,
+    model_id: Optional[str] = None,
+    output_format: Optional[str] = None,
+    stability: Optional[float] = None,
+    similarity_boost: Optional[float] = None,
+    style: Optional[float] = None,
+    use_speaker_boost: Optional[bool] = None,
+    client: Optional[httpx.AsyncClient] = None,
+) -> Dict[str, Any]:
+    """
+    Dùng chung cho /generate-voice, batch và pipeline shotlist -> TTS.
+    Trả dict cùng shape TTSResponse. Lỗi -> TTSError(status_code).
+    client: truyền client dùng chung để tái sử dụng connection; None -> client riêng cho call này.
+    """
+    tts_text, vp, key = _prepare_request(
+        text=text, voice_id=voice_id, model_id=model_id, output_format=output_format,
+        stability=stability, similarity_boost=similarity_boost, style=style, use_speaker_boost=use_speaker_boost,
+    )
+
+    meta = _read_cached(key)
+    if meta:
+        metrics.incr("tts.cache_hit")
+        _log_info(f"TTS cache_hit beat={beat or '-'} key={key[:12]}")
+        return _voice_response(meta, beat)
+
+    fut = _inflight.get(key)
+    if fut is not None:
+        metrics.incr("tts.coalesced")
+        return _voice_response(await asyncio.shield(fut), beat)
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        meta = await _synthesize_uncached(tts_text=tts_text, vp=vp, key=key, beat=beat, client=client)
+        fut.set_result(meta)
+    except asyncio.CancelledError:
+        fut.set_exception(TTSError("TTS bị huỷ, thử lại.", status_code=503))
+        fut.exception()  # đánh dấu đã đọc -> không log "never retrieved" khi không có ai chờ
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()
+        raise
+    finally:
+        _inflight.pop(key, None)
+    return _voice_response(meta, beat)
+
+
+# =========================================================
+# Streaming: ElevenLabs /stream -> client, tee vào static/tts/<key>.mp3
+# =========================================================
+_STREAM_CHUNK = 64 * 1024
+
+
+async def _iter_file(path: Path) -> AsyncIterator[bytes]:
+    data = await asyncio.to_thread(path.read_bytes)
+    for i in range(0, len(data), _STREAM_CHUNK):
+        yield data[i:i + _STREAM_CHUNK]
+
+
+async def _noop_release() -> None:
+    return None
+
+
+async def open_voice_stream(
+    *,
+    text: str,
+    client: httpx.AsyncClient,
+    beat: Optional[str] = None,
+    voice_id: Optional[str] = None,
+    model_id: Optional[str] = None,
+    output_format: Optional[str] = None,
+    stability: Optional[float] = None,
+    similarity_boost: Optional[float] = None,
+    style: Optional[float] = None,
+    use_speaker_boost: Optional[bool] = None,
+    optimize_streaming_latency: Optional[int] = None,
+) -> Tuple[Dict[str, Any], AsyncIterator[bytes], Callable[[], Awaitable[None]]]:
+    """
+    Mở stream trước khi trả (lỗi ElevenLabs -> TTSError như synthesize_voice), rồi trả
+    (info, body, release): body forward từng chunk ngay khi nhận, đồng thời gom lại; stream
+    đủ -> ghi mp3 + sidecar (duration, sample rate) vào cache. Client ngắt giữa chừng -> không ghi.
+    release() đóng response upstream + nhả slot limiter, gọi nhiều lần được. Caller PHẢI gọi
+    release() khi xong response (kể cả khi body chưa từng được đọc, vd. client ngắt trước).
+    info: {key, audio_url, meta_url, cached}. meta_url là sidecar JSON, có sau khi stream xong.
+    optimize_streaming_latency: 0..4 (None -> ELEVENLABS_STREAM_LATENCY); khác 0 thì
+    audio có thể khác bản thường nên có cache key riêng.
+    """
+    settings = get_settings()
+    tts_text, vp, key = _prepare_request(
+        text=text, voice_id=voice_id, model_id=model_id, output_format=output_format,
+        stability=stability, similarity_boost=similarity_boost, style=style, use_speaker_boost=use_speaker_boost,
+    )
+    latency = settings.ELEVENLABS_STREAM_LATENCY if optimize_streaming_latency is None else optimize_streaming_latency
+    latency = min(4, max(0, int(latency)))
+    if latency:
+        key = tts_cache_key(tts_text, {**vp, "optimize_streaming_latency": latency})
+
+    info = {
+        "key": key,
+        "audio_url": _tts_public_url(f"{key}.mp3"),
+        "meta_url": _tts_public_url(f"{key}.json"),
+        "cached": False,
+    }
+    if _read_cached(key):
+        metrics.incr("tts.cache_hit")
+        _log_info(f"TTS_STREAM cache_hit beat={beat or '-'} key={key[:12]}")
+        return {**info, "cached": True}, _iter_file(_tts_dir() / f"{key}.mp3"), _noop_release
+
+    tts_url = ELEVENLABS_TTS_STREAM_URL.format(vp["voice_id"])
+    headers = {
+        "accept": "audio/mpeg",
+        "content-type": "application/json",
+        "xi-api-key": elevenlabs_api_key(),
+    }
+    params = {"optimize_streaming_latency": latency, "output_format": vp["output_format"]}
+    body = {"text": tts_text, "model_id": vp["model_id"], "voice_settings": vp["voice_settings"]}
+    sem = _elevenlabs_limiter()
+
+    async def _open() -> httpx.Response:
+        # slot giữ suốt stream (nhả trong _body); lỗi khi mở -> nhả ngay để retry
+        await sem.acquire()
+        try:
+            req = client.build_request("POST", tts_url, headers=headers, params=params, json=body, timeout=60.0)
+            r = await client.send(req, stream=True)
+        except BaseException:
+            sem.release()
+            raise
+        if r.status_code >= 400:
+            await r.aread()
+            await r.aclose()
+            sem.release()
+            raise_for_retryable_status(r)  # 429/5xx -> retry
+        return r
+
+    t0 = time.perf_counter()
+    try:
+        resp = await retry_async(_open, name="elevenlabs")
+    except RetryableStatusError as e:
+        raise TTSError("ElevenLabs error: {}".format(e))
+    except httpx.RequestError as e:
+        raise TTSError("Không gọi được ElevenLabs: {}".format(e))
+    if resp.status_code >= 400:
+        try:
+            err_detail = resp.json()
+        except Exception:
+            err_detail = resp.text
+        raise TTSError("ElevenLabs error: {}".format(err_detail))
+
+    released = False
+
+    async def release() -> None:
+        nonlocal released
+        if released:
+            return
+        released = True
+        sem.release()  # trước await: caller có thể đang bị cancel
+        try:
+            await resp.aclose()
+        except Exception:
+            pass
+
+    async def _body() -> AsyncIterator[bytes]:
+        buf = bytearray()
+        complete = False
+        try:
+            async for chunk in resp.aiter_bytes():
+                if not buf:
+                    metrics.observe_ms("tts.stream.first_chunk", (time.perf_counter() - t0) * 1000)
+                buf.extend(chunk)
+                yield chunk
+            complete = True
+        finally:
+            await release()
+            if complete and buf:
+                audio_bytes = bytes(buf)
+                meta = {
+                    "file": f"{key}.mp3",
+                    "voice_id": vp["voice_id"],
+                    "model_id": vp["model_id"],
+                    "output_format": vp["output_format"],
+                    "optimize_streaming_latency": latency,
+                    "bytes": len(audio_bytes),
+                    "duration_seconds": probe_mp3_duration_seconds(audio_bytes),
+                    "sample_rate_hz": sample_rate_from_output_format(vp["output_format"]),
+                    "chars": len(tts_text),
+                    "created_at": time.time(),
+                }
+                await asyncio.to_thread(_write_cached, key, audio_bytes, meta)
+                await _maybe_enforce_quota()
+                metrics.incr("tts.synthesized")
+                metrics.incr("tts.chars", len(tts_text))
+                _log_info(
+                    f"TTS_STREAM ok beat={beat or '-'} chars={len(tts_text)} bytes={len(audio_bytes)} "
+                    f"dt_ms={int((time.perf_counter() - t0) * 1000)}"
+                )
+            else:
+                metrics.incr("tts.stream.aborted")
+
+    return info, _body(), release
@@ -0,0 +1,100 @@
+# app/services/video_segments.py
+from __future__ import annotations
+
+import math
+import re
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from app.services.keyframes import probe_duration
+
+# =========================================================
+# Time-window segmenting cho video/audio dài (map-reduce transcript)
+# =========================================================
+# Cắt bằng segment muxer (-c copy, không encode lại) rồi đo duration thực
+# của từng đoạn: offset = tổng duration các đoạn trước -> timestamp ghép lại
+# chính xác kể cả khi ffmpeg cắt lệch theo keyframe.
+
+
+def split_media(path: Path, window_s: float, out_dir: Path) -> List[Dict[str, Any]]:
+    """
+    Trả [{path, index, offset, duration}] theo thứ tự thời gian.
+    Nếu không cắt được -> 1 đoạn duy nhất là file gốc.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    ext = path.suffix or ".mp4"
+    pattern = out_dir / f"seg-%03d{ext}"
+    cmd = [
+        "ffmpeg", "-v", "error", "-y", "-i", str(path),
+        "-map", "0", "-c", "copy",
+        "-f", "segment", "-segment_time", f"{window_s:.3f}",
+        "-reset_timestamps", "1",
+        str(pattern),
+    ]
+    try:
+        subprocess.run(cmd, capture_output=True, check=True)
+    except Exception:
+        return [{"path": path, "index": 0, "offset": 0.0, "duration": probe_duration(path)}]
+
+    files = sorted(out_dir.glob(f"seg-*{ext}"))
+    segments: List[Dict[str, Any]] = []
+    offset = 0.0
+    for i, f in enumerate(files):
+        dur = probe_duration(f) or window_s
+        segments.append({"path": f, "index": i, "offset": round(offset, 3), "duration": round(dur, 3)})
+        offset += dur
+    return segments or [{"path": path, "index": 0, "offset": 0.0, "duration": probe_duration(path)}]
+
+
+_LEAD_BRACKET_RE = re.compile(r"^(\s*\[)([^\]]+)(\].*)$", re.DOTALL)
+_TS_TOKEN_RE = re.compile(r"(?<![\d:])(?:(\d{1,2}):)?(\d{1,2}):(\d{2})(\.\d+)?(?![\d:])")
+
+
+def _fmt_clock(total_s: float, decimals: int = 0) -> str:
+    """Làm tròn 1 lần (giữ số chữ số lẻ của timestamp gốc) rồi mới tách h/m/s."""
+    scale = 10 ** decimals
+    whole, frac = divmod(math.floor(total_s * scale + 0.5), scale)
+    h, rem = divmod(int(whole), 3600)
+    m, s = divmod(rem, 60)
+    clock = f"{h:02d}:{m:02d}:{s:02d}" if h else f"{m:02d}:{s:02d}"
+    return clock + (f".{int(frac):0{decimals}d}" if decimals else "")
+
+
+def shift_timestamps(text: str, offset_s: float) -> str:
+    """
+    Cộng offset vào timestamp đầu dòng ([mm:ss], [hh:mm:ss], [mm:ss - mm:ss], có thể kèm .ff).
+    Dòng không có timestamp giữ nguyên.
+    """
+    if not offset_s:
+        return text
+
+    def _shift(m: re.Match) -> str:
+        h = int(m.group(1) or 0)
+        frac = m.group(4) or ""
+        secs = h * 3600 + int(m.group(2)) * 60 + int(m.group(3)) + (float(frac) if frac else 0.0)
+        return _fmt_clock(secs + offset_s, len(frac) - 1 if frac else 0)
+
+    out: List[str] = []
+    for line in (text or "").splitlines():
+        mb = _LEAD_BRACKET_RE.match(line)
+        if mb:
+            line = mb.group(1) + _TS_TOKEN_RE.sub(_shift, mb.group(2)) + mb.group(3)
+        out.append(line)
+    return "\n".join(out)
+
+
+_STEP1_HEADING_RE = re.compile(r"^\s*#{1,6}\s*Step\s*1\b.*$", re.IGNORECASE | re.MULTILINE)
+
+
+def stitch_transcripts(parts: List[Tuple[float, str]]) -> str:
+    """
+    parts = [(offset, transcript_của_đoạn)] — sắp theo offset, bỏ heading lặp,
+    shift timestamp và nối lại.
+    """
+    blocks: List[str] = []
+    for offset, txt in sorted(parts, key=lambda p: p[0]):
+        body = _STEP1_HEADING_RE.sub("", txt or "").strip()
+        if body:
+            blocks.append(shift_timestamps(body, offset))
+    return "\n".join(blocks).strip()
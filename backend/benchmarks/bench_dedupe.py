@@ -0,0 +1,49 @@
+"""
+Benchmark dedupe_comments: thời gian theo số comment (kỳ vọng ~tuyến tính).
+
+    cd backend && python benchmarks/bench_dedupe.py [max_n]
+"""
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.services.dedupe import dedupe_comments  # noqa: E402
+
+_WORDS = (
+    "love this serum skin glow dry oily price shipping fast slow smell nice bad "
+    "works great broke out again would buy recommend friend daughter face night"
+).split()
+
+
+def make_comments(n: int, seed: int = 0):
+    rnd = random.Random(seed)
+    base = [" ".join(rnd.choices(_WORDS, k=rnd.randint(6, 20))) for _ in range(max(1, n // 3))]
+    out = []
+    for _ in range(n):
+        c = rnd.choice(base)
+        if rnd.random() < 0.3:
+            c = c + " " + rnd.choice(_WORDS)       # gần trùng
+        elif rnd.random() < 0.3:
+            c = c.upper() + "!!!"                  # trùng sau normalize
+        out.append(c)
+    return out
+
+
+def bench(n: int) -> float:
+    comments = make_comments(n)
+    t0 = time.perf_counter()
+    clusters = dedupe_comments(comments)
+    dt = time.perf_counter() - t0
+    print(f"n={n:>7} clusters={len(clusters):>7} {dt * 1000:9.1f} ms  {dt / n * 1e6:6.2f} us/comment")
+    return dt
+
+
+if __name__ == "__main__":
+    max_n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n = 12_500
+    while n <= max_n:
+        bench(n)
+        n *= 2
@@ -0,0 +1,82 @@
+"""
+Benchmark shotlist heuristic (draft): thời gian theo độ dài script (kỳ vọng ~tuyến tính).
+Dùng tham số mặc định như production (min_beats=10, max_beats=120).
+
+    cd backend && python benchmarks/bench_shotlist.py [max_chars]
+"""
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.services.gemini import _segment_script_into_beats, heuristic_shotlist_draft  # noqa: E402
+
+_WORDS = (
+    "this serum changed my skin in two weeks no more dry patches glow all day "
+    "dermatologist tested fragrance free try it risk free today limited offer"
+).split()
+
+
+def _sentence(rnd: random.Random) -> str:
+    return " ".join(rnd.choices(_WORDS, k=rnd.randint(5, 18))).capitalize() + rnd.choice(".!?")
+
+
+def make_prose(n_chars: int, seed: int = 0) -> str:
+    """Script không có bảng -> cắt câu/cụm từ."""
+    rnd = random.Random(seed)
+    out, size = [], 0
+    while size < n_chars:
+        para = " ".join(_sentence(rnd) for _ in range(rnd.randint(2, 6)))
+        out.append(para)
+        size += len(para) + 1
+    return "\n".join(out)
+
+
+def make_fragments(n_chars: int, seed: int = 0) -> str:
+    """Dòng quá ngắn (< 3 từ) -> không ra phrase, đi đường fill."""
+    rnd = random.Random(seed)
+    out, size = [], 0
+    while size < n_chars:
+        s = " ".join(rnd.choices(_WORDS, k=rnd.randint(1, 2))) + "."
+        out.append(s)
+        size += len(s) + 1
+    return "\n".join(out)
+
+
+def make_table(n_rows: int, seed: int = 0) -> str:
+    """Output script có bảng D) FINAL VIDEO SCRIPT n_rows dòng."""
+    rnd = random.Random(seed)
+    lines = ["D) FINAL VIDEO SCRIPT", "| Stage | Voice-over | Visuals |", "|---|---|---|"]
+    for i in range(n_rows):
+        lines.append(f"| Beat {i + 1} | {_sentence(rnd)} | close-up product |")
+    return "\n".join(lines)
+
+
+def _time(fn, *args, repeat: int = 5) -> float:
+    fn(*args)  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - t0) / repeat
+
+
+def bench(n_chars: int) -> None:
+    n_rows = max(1, n_chars // 80)
+    cases = [
+        ("prose", _segment_script_into_beats, make_prose(n_chars)),
+        ("short frags", _segment_script_into_beats, make_fragments(n_chars)),
+        ("D) table draft", heuristic_shotlist_draft, make_table(n_rows)),
+    ]
+    for label, fn, text in cases:
+        dt = _time(fn, text)
+        print(f"chars={len(text):>8} {label:<15} {dt * 1000:8.2f} ms  {dt / len(text) * 1e9:7.1f} ns/char")
+
+
+if __name__ == "__main__":
+    max_chars = int(sys.argv[1]) if len(sys.argv) > 1 else 400_000
+    n = 25_000
+    while n <= max_chars:
+        bench(n)
+        n *= 2
@@ -7,6 +7,9 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import RedirectResponse, JSONResponse
 
 from app.core.config import get_settings
+from app.core import metrics
+from app.services.jobs import start_job_runner, stop_job_runner
+from app.api.http_client import close_http_client
 from app.api import router as api_router
 from app.middleware.request_log import RequestLogMiddleware
 
@@ -27,6 +30,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Audio-Url", "X-Audio-Meta-Url", "X-TTS-Cache"],  # /generate-voice/stream
 )
 
 # -----------------------------
@@ -45,6 +49,18 @@ app.include_router(api_router)
 
 # bật middleware log
 app.add_middleware(RequestLogMiddleware)
+
+# -----------------------------
+# Job runner (mỗi worker gunicorn chạy 1 runner, claim job qua SQLite)
+# -----------------------------
+@app.on_event("startup")
+async def _start_jobs():
+    start_job_runner()
+
+@app.on_event("shutdown")
+async def _stop_jobs():
+    await stop_job_runner()
+    await close_http_client()
 # -----------------------------
 # Utility endpoints
 # -----------------------------
@@ -74,3 +90,10 @@ def version():
         "static_url_prefix": settings.STATIC_URL_PREFIX,
         "public_base_url": str(settings.PUBLIC_BASE_URL),
     }
+
+@app.get("/metrics", tags=["system"])
+def metrics_snapshot():
+    """
+    Counter nội bộ của worker hiện tại (cache hit rate, latency tiết kiệm, ...).
+    """
+    return metrics.snapshot()
@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Settings đọc env lúc import (get_settings cache) -> set trước khi import app.*
+_TMP = Path(tempfile.mkdtemp(prefix="casesurf-tests-"))
+os.environ["DATA_DIR"] = str(_TMP / "data")
+os.environ["STATIC_DIR"] = str(_TMP / "static")
+os.environ["PUBLIC_BASE_URL"] = ""
+os.environ.setdefault("ELEVENLABS_API_KEY", "test-key")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import pytest  # noqa: E402
+
+from app.core.config import get_settings  # noqa: E402
+
+
+@pytest.fixture
+def settings():
+    return get_settings()
+
+
+@pytest.fixture
+def allow_private(monkeypatch, settings):
+    """Cho phép gọi 127.0.0.1 (fixture server local)."""
+    monkeypatch.setattr(settings, "OUTBOUND_ALLOW_PRIVATE", True)
+    return settings
@@ -0,0 +1,60 @@
+import asyncio
+import subprocess
+
+from app.api.routers import analysis
+
+
+def _fake_full(monkeypatch, calls):
+    async def _upload(*, api_key, file_path):
+        calls.append(("upload", file_path))
+        return object()
+
+    async def _report(**kw):
+        calls.append(("report", kw["user_prompt"]))
+        return "# Report", {"transcript": "", "t_total_ms": 1}
+
+    monkeypatch.setattr(analysis, "probe_duration", lambda p: None)
+    monkeypatch.setattr(analysis, "gemini_upload_file", _upload)
+    monkeypatch.setattr(analysis, "gemini_generate_video_report", _report)
+
+    async def _no_digest(*a, **kw):
+        return None
+
+    monkeypatch.setattr(analysis, "_submit_report_digest", _no_digest)
+
+
+def _run(settings, tmp_path, sha):
+    video = tmp_path / f"{sha}.mp4"
+    video.write_bytes(b"x")
+    out = asyncio.run(analysis._run_analysis_report(
+        "ip", video, sha, "hook?", settings, mode=analysis.REPORT_MODE_KEYFRAMES,
+    ))
+    assert not video.exists()
+    return out
+
+
+def test_keyframes_falls_back_to_full_when_ffmpeg_fails(settings, tmp_path, monkeypatch):
+    calls = []
+    _fake_full(monkeypatch, calls)
+
+    def _fail(path, **kw):
+        raise subprocess.CalledProcessError(1, ["ffmpeg"], stderr=b"moov atom not found")
+
+    monkeypatch.setattr(analysis, "analyze_scenes", _fail)
+    monkeypatch.setattr(settings, "REPORT_CACHE_ENABLED", True)
+    out = _run(settings, tmp_path, "a" * 64)
+    assert out["report"] == "# Report" and out["scenes"] is None
+    assert [c[0] for c in calls] == ["upload", "report"]
+    # report fallback không được cache dưới key keyframes
+    out = _run(settings, tmp_path, "a" * 64)
+    assert out["cached"] is False and len(calls) == 4
+
+
+def test_cache_key_tracks_keyframe_settings(settings, monkeypatch):
+    keyframes = analysis._report_cache_mode(analysis.REPORT_MODE_KEYFRAMES, settings)
+    assert analysis._report_cache_mode(analysis.REPORT_MODE_FULL, settings) == analysis.REPORT_MODE_FULL
+    for name, value in (("KEYFRAME_SAMPLE_FPS", 2.0), ("KEYFRAME_MAX", 8), ("KEYFRAME_WIDTH", 256)):
+        with monkeypatch.context() as m:
+            m.setattr(settings, name, value)
+            assert analysis._report_cache_mode(analysis.REPORT_MODE_KEYFRAMES, settings) != keyframes
+    assert analysis._report_cache_mode(analysis.REPORT_MODE_KEYFRAMES, settings) == keyframes
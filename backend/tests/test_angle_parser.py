@@ -0,0 +1,143 @@
+import random
+import re
+
+import pytest
+
+from app.services.gemini import IncrementalAngleParser, extract_angles_from_block, split_angles_output
+
+FRAMEWORK_NUMBERED = """```
+angles:
+Section\tExtracted Framework Content\tEvidence
+Hook\tPain-first question\t"tired of dry skin?"
+Proof\tBefore/after\t"2 weeks later"
+
+OUTPUT 2 — Content Angle Development:
+**Angle 1: The Dry Skin Fix**
+Target Persona: women 25-40
+Core Message: hydration that lasts
+CTA: shop now
+
+**Angle 2: Dermatologist Approved**
+Target Persona: skeptics
+Core Message: tested by experts
+CTA: learn more
+```"""
+
+MD_TABLE_LABELLED = """| Section | Extracted Framework Content | Evidence |
+|---|---|---|
+| Hook | Pain question | "dry?" |
+
+Angle Title: Morning Routine Hack
+Target Persona: busy moms
+Story Arc: problem -> fix
+
+Angle Title: Travel Size Hero
+Target Persona: travellers
+CTA: buy the mini
+"""
+
+NO_TABLE_NUMBERED = """Angle 1 - Price Shock
+Core Message: cheaper than salon
+
+Angle 2 - Friend Referral
+Core Message: my friend told me
+CTA: share code
+"""
+
+# heading markdown + "Angle Title:" ngay dưới heading số: batch parser không nhận "##",
+# parser incremental gộp 2 dòng thành 1 angle
+MD_HEADINGS = """## Angle 1 - Price Shock
+Core Message: cheaper than salon
+
+## Angle 2
+Angle Title: Friend Referral
+CTA: share code
+"""
+
+FALLBACK_BLOCKS = """Quiet Confidence
+Target Persona: introverts
+Core Message: no makeup look
+
+Gym Proof
+Target Persona: athletes
+CTA: sweat test
+"""
+
+CASES = [FRAMEWORK_NUMBERED, MD_TABLE_LABELLED, NO_TABLE_NUMBERED, FALLBACK_BLOCKS]
+
+
+def _parse(text, cuts):
+    p = IncrementalAngleParser()
+    events, prev = [], 0
+    for c in sorted(cuts) + [len(text)]:
+        events += p.feed(text[prev:c])
+        prev = c
+    events += p.close()
+    return p, events
+
+
+def _batch(text):
+    """
+    split_angles_output + extract_angles_from_block. Batch parser cho 2 regex cùng khớp 1 heading
+    ("**Angle 1: X**" -> "X**" và "X"; "Angle Title: X" -> "Title: X" và "X"), bản trùng có raw
+    rỗng -> bỏ bản raw rỗng, bỏ ** / nhãn "Title:" ở title.
+    """
+    table, block = split_angles_output(text)
+    _, full = extract_angles_from_block(block)
+    full = [
+        {**f, "title": re.sub(r"^Title\s*[:\-–—]\s*", "", f["title"].strip("* "))}
+        for f in full if f.get("raw")
+    ]
+    return table, [f["title"] for f in full], full
+
+
+def _splits(text, seed):
+    rnd = random.Random(seed)
+    yield []                                        # 1 chunk
+    yield list(range(1, len(text)))                 # từng ký tự
+    for _ in range(20):
+        yield rnd.sample(range(1, len(text)), k=rnd.randint(1, min(40, len(text) - 1)))
+
+
+@pytest.mark.parametrize("text", CASES)
+def test_matches_batch_parsers_at_any_chunk_boundary(text):
+    table, titles, full = _batch(text)
+    assert titles, "case phải parse được bằng batch parser"
+    for cuts in _splits(text, seed=len(text)):
+        p, events = _parse(text, cuts)
+        assert p.framework_table == table
+        assert [a["title"] for a in p.angles] == titles
+        assert [a["raw"] for a in p.angles] == [f.get("raw", "") for f in full]
+        assert [e[1] for e in events if e[0] == "angle"] == p.angles
+        assert sum(1 for e in events if e[0] == "framework") == (1 if table else 0)
+
+
+@pytest.mark.parametrize("text", CASES + [MD_HEADINGS])
+def test_chunk_boundaries_do_not_change_result(text):
+    whole, _ = _parse(text, [])
+    for cuts in _splits(text, seed=7):
+        p, _ = _parse(text, cuts)
+        assert (p.framework_table, p.angles) == (whole.framework_table, whole.angles)
+
+
+def test_markdown_headings_and_title_label():
+    p, _ = _parse(MD_HEADINGS, [])
+    assert [(a["number"], a["title"]) for a in p.angles] == [(1, "Price Shock"), (2, "Friend Referral")]
+    assert p.angles[1]["raw"].endswith("CTA: share code")
+
+
+def test_framework_event_precedes_angles_and_angles_stream_early():
+    p = IncrementalAngleParser()
+    head, tail = FRAMEWORK_NUMBERED.split("**Angle 2")
+    events = p.feed(head + "**Angle 2: Dermatologist Approved**\n")
+    kinds = [e[0] for e in events]
+    assert kinds == ["framework", "angle"]          # angle 1 đóng khi gặp heading angle 2
+    assert events[1][1]["title"] == "The Dry Skin Fix"
+
+
+def test_fallback_only_on_close():
+    p = IncrementalAngleParser()
+    assert [e for e in p.feed(FALLBACK_BLOCKS) if e[0] == "angle"] == []
+    angles = [e[1] for e in p.close() if e[0] == "angle"]
+    assert [a["title"] for a in angles] == ["Quiet Confidence", "Gym Proof"]
+    assert p.close() == []                          # close() lần 2 không phát lại
@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from app.services import dedupe
+from app.services.dedupe import dedupe_comments, dedupe_feedback_text, normalize_comment
+
+BACKEND = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND / "benchmarks"))
+
+from bench_dedupe import make_comments  # noqa: E402
+
+
+def test_normalize_comment():
+    assert normalize_comment("  - LOVE it!!!!  sooo good 😍 ") == "love it soo good"
+
+
+def test_exact_and_near_duplicates_merge():
+    comments = [
+        "This serum made my skin glow in one week, totally worth it",
+        "this serum made my skin glow in one week totally worth it!!!",
+        "This serum made my skin glow in one week, totally worth it honestly",
+        "Shipping was slow",
+    ]
+    out = dedupe_comments(comments)
+    assert [c["count"] for c in out] == [3, 1]
+    assert out[0]["text"] == comments[0]
+
+
+def test_feedback_text_keeps_headers():
+    text = "URL: https://x\n[CUSTOMER REVIEWS]\n- great product works well for me\n- Great product, works well for me!\n- meh"
+    deduped, stats = dedupe_feedback_text(text)
+    assert deduped.splitlines()[:2] == ["URL: https://x", "[CUSTOMER REVIEWS]"]
+    assert "(x2)" in deduped
+    assert stats["duplicates_removed"] == 1
+
+
+_SNIPPET = (
+    "import json, sys; sys.path.insert(0, '.');"
+    "from app.services.dedupe import minhash_signatures;"
+    "print(json.dumps(minhash_signatures([['love','this','serum'],['fast','shipping','nice','smell']]).tolist()))"
+)
+
+
+def test_signatures_stable_across_processes():
+    outs = set()
+    for seed in ("1", "2"):
+        env = {**os.environ, "PYTHONHASHSEED": seed}
+        outs.add(subprocess.run(
+            [sys.executable, "-c", _SNIPPET], cwd=BACKEND, env=env, capture_output=True, text=True, check=True
+        ).stdout)
+    assert len(outs) == 1
+
+
+def _count_comparisons(monkeypatch):
+    calls = []
+    real = dedupe._similar
+
+    def _counted(a, b, min_equal):
+        calls.append(1)
+        return real(a, b, min_equal)
+
+    monkeypatch.setattr(dedupe, "_similar", _counted)
+    return calls
+
+
+def test_bucket_comparisons_are_capped(monkeypatch):
+    # band 0 giống hệt nhau, các band khác khác nhau -> mọi comment rơi vào 1 bucket, không cặp nào khớp
+    n = 500
+    sigs = np.arange(n * dedupe._NUM_PERM, dtype=np.uint64).reshape(n, dedupe._NUM_PERM)
+    sigs[:, :dedupe._ROWS] = 7
+    monkeypatch.setattr(dedupe, "minhash_signatures", lambda token_lists: sigs[: len(token_lists)])
+    calls = _count_comparisons(monkeypatch)
+    comments = [f"distinct comment number {i} here" for i in range(n)]
+    m = len({normalize_comment(c) for c in comments})  # "111" -> "11" gộp trùng tuyệt đối trước MinHash
+    assert len(dedupe_comments(comments)) == m
+    cap = dedupe._MAX_BUCKET_CMP
+    assert len(calls) == sum(min(i, cap) for i in range(m))  # O(n * cap), không phải O(n^2)
+
+
+def test_comparisons_per_comment_are_bounded(monkeypatch):
+    # timing thật ở benchmarks/bench_dedupe.py; ở đây chỉ kiểm số phép so sánh (deterministic)
+    n = 20_000
+    calls = _count_comparisons(monkeypatch)
+    dedupe_comments(make_comments(n))
+    assert 0 < len(calls) <= n * dedupe._BANDS * dedupe._MAX_BUCKET_CMP
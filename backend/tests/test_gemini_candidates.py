@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import gemini
+
+
+class InvalidArgument(Exception):
+    code = 400
+
+
+class ResourceExhausted(Exception):
+    code = 429
+
+
+def _resp(*texts, tokens=10):
+    cands = [SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=t)])) for t in texts]
+    usage = SimpleNamespace(prompt_token_count=tokens, candidates_token_count=tokens, total_token_count=2 * tokens)
+    return SimpleNamespace(candidates=cands, usage_metadata=usage, text=texts[0] if texts else "")
+
+
+def _patch(monkeypatch, first_error):
+    calls = []
+
+    async def _fake(*, generation_config, **kw):
+        calls.append(generation_config.get("candidate_count"))
+        if "candidate_count" in generation_config:
+            raise RuntimeError("Async generation failed") from first_error
+        return _resp(f"t{len(calls)}")
+
+    monkeypatch.setattr(gemini, "_ga_generate_content", _fake)
+    return calls
+
+
+def _run(n=3):
+    return asyncio.run(gemini._gen_text_candidates(api_key="k", model_name="m", parts=["p"], n=n))
+
+
+def test_candidate_count_invalid_argument_falls_back_to_parallel(monkeypatch):
+    calls = _patch(monkeypatch, InvalidArgument("Invalid value for candidate_count: 3"))
+    texts, meta = _run()
+    assert meta["mode"] == "parallel"
+    assert len(texts) == 3 and calls.count(None) == 3
+    assert meta["usage"] == {"prompt_token_count": 30, "candidates_token_count": 30, "total_token_count": 60}
+
+
+def test_other_errors_are_not_treated_as_unsupported(monkeypatch):
+    _patch(monkeypatch, ResourceExhausted("quota exceeded"))
+    with pytest.raises(RuntimeError):
+        _run()
+
+
+def test_invalid_argument_unrelated_to_candidate_count_reraises(monkeypatch):
+    calls = _patch(monkeypatch, InvalidArgument("prompt too long"))
+    with pytest.raises(RuntimeError):
+        _run()
+    assert calls == [3]
+
+
+def test_candidate_count_single_request(monkeypatch):
+    async def _fake(*, generation_config, **kw):
+        return _resp("a", "b", tokens=5)
+
+    monkeypatch.setattr(gemini, "_ga_generate_content", _fake)
+    texts, meta = _run(2)
+    assert texts == ["a", "b"] and meta["mode"] == "candidate_count"
+    assert meta["usage"]["total_token_count"] == 10
@@ -0,0 +1,80 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.routers import analysis  # noqa: F401  (đăng ký handler analysis_report)
+from app.api.routers import jobs as jobs_router
+from app.services.jobs import JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, _claim_next, _conn, _finish, get_job, submit_job
+
+
+def _upload(settings, name):
+    d = settings.UPLOAD_DIR / "jobs"
+    d.mkdir(parents=True, exist_ok=True)
+    p = d / name
+    p.write_bytes(b"video")
+    return p
+
+
+def _submit(path):
+    return submit_job("analysis_report", {"path": str(path), "mode": "full"}, max_attempts=1)
+
+
+def test_lease_expired_failure_removes_upload(settings):
+    path = _upload(settings, "lost.mp4")
+    job = _submit(path)
+    _conn().execute(
+        "UPDATE jobs SET status = ?, attempts = 1, lease_until = ?, worker = ? WHERE id = ?",
+        (JOB_RUNNING, time.time() - 5, "dead:1", job["id"]),
+    )
+    _claim_next("w:1", 60)
+    assert get_job(job["id"])["status"] == JOB_FAILED
+    assert not path.exists()
+
+
+def test_finish_error_removes_upload_only_for_lease_holder(settings):
+    path = _upload(settings, "fail.mp4")
+    job = _submit(path)
+    _conn().execute(
+        "UPDATE jobs SET status = ?, worker = ? WHERE id = ?", (JOB_RUNNING, "w:2", job["id"]),
+    )
+    _finish(job["id"], "other:9", error="boom")  # lease đã mất -> không xoá
+    assert path.exists()
+    _finish(job["id"], "w:2", error="boom")
+    assert get_job(job["id"])["status"] == JOB_FAILED
+    assert not path.exists()
+
+
+def test_job_routes():
+    app = FastAPI()
+    app.include_router(jobs_router.router)
+    client = TestClient(app)
+    assert client.get("/jobs/nope").status_code == 404
+    job = submit_job("analysis_report", {"path": "/nonexistent", "mode": "full"})
+    assert client.get(f"/jobs/{job['id']}").json()["status"] == "queued"
+    assert client.get(f"/jobs/{job['id']}/result").status_code == 202
+
+
+def test_dedupe_key_coalesces_across_connections():
+    # mỗi thread 1 connection SQLite riêng (như các worker khác nhau)
+    def _one(_):
+        return submit_job("analysis_report", {"path": "/nonexistent", "mode": "full"}, dedupe_key="plan-a")["id"]
+
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        ids = set(ex.map(_one, range(16)))
+    assert len(ids) == 1
+    job_id = ids.pop()
+    assert get_job(job_id)["status"] == JOB_QUEUED
+
+    other = submit_job("analysis_report", {"path": "/nonexistent", "mode": "full"}, dedupe_key="plan-b")
+    assert other["id"] != job_id
+
+
+def test_dedupe_key_only_matches_active_jobs():
+    first = submit_job("analysis_report", {"path": "/nonexistent", "mode": "full"}, dedupe_key="plan-c")
+    _conn().execute("UPDATE jobs SET status = ? WHERE id = ?", (JOB_RUNNING, first["id"]))
+    assert submit_job("analysis_report", {}, dedupe_key="plan-c")["id"] == first["id"]
+    _conn().execute("UPDATE jobs SET status = ? WHERE id = ?", (JOB_SUCCEEDED, first["id"]))
+    second = submit_job("analysis_report", {}, dedupe_key="plan-c")
+    assert second["id"] != first["id"] and second["status"] == JOB_QUEUED
@@ -0,0 +1,54 @@
+import numpy as np
+
+from app.services.keyframes import build_scenes, detect_cuts, frame_diff_scores, pick_keyframe_times
+
+
+def _shots(*levels, n=10, seed=0):
+    """Mỗi level = 1 cảnh gồm n frame 16x16 quanh mức xám đó (nhiễu nhẹ như camera thật)."""
+    rng = np.random.default_rng(seed)
+    return np.concatenate([
+        np.clip(level + rng.integers(-3, 4, size=(n, 16, 16)), 0, 255).astype(np.uint8) for level in levels
+    ])
+
+
+def test_hard_cut_detected_at_known_frame():
+    frames = _shots(40, 200)
+    scores = frame_diff_scores(frames)
+    assert scores.shape == (19,)
+    assert int(np.argmax(scores)) == 9
+    assert scores[9] > 0.5 and np.delete(scores, 9).max() < 0.05
+    # score[9] = frame 9 -> 10, nên cut ở frame 10 = 2.5s với 4 fps
+    assert detect_cuts(scores, fps=4.0) == [2.5]
+
+
+def test_flat_signal_has_no_cuts():
+    assert detect_cuts(frame_diff_scores(_shots(120, n=20)), fps=4.0) == []
+    assert detect_cuts(np.full(40, 0.05, dtype=np.float32), fps=4.0) == []
+    assert detect_cuts(np.zeros(0, dtype=np.float32), fps=4.0) == []
+    assert frame_diff_scores(_shots(120, n=1)).size == 0
+
+
+def test_cuts_closer_than_min_scene_are_merged():
+    scores = np.zeros(30, dtype=np.float32)
+    scores[[5, 6, 20]] = 0.9
+    # min_scene_s=0.5 ở 4 fps -> cách tối thiểu 2 frame: spike 6 bị bỏ
+    assert detect_cuts(scores, fps=4.0, min_scene_s=0.5) == [1.5, 5.25]
+    assert detect_cuts(scores, fps=4.0, min_scene_s=0.0) == [1.5, 1.75, 5.25]
+
+
+def test_build_scenes_ignores_cuts_outside_duration():
+    assert build_scenes([0.0, 2.5, 5.25, 9.0], 6.0) == [
+        {"start": 0.0, "end": 2.5},
+        {"start": 2.5, "end": 5.25},
+        {"start": 5.25, "end": 6.0},
+    ]
+    assert build_scenes([], 3.0) == [{"start": 0.0, "end": 3.0}]
+
+
+def test_max_keyframes_keeps_first_last_and_longest():
+    bounds = [0.0, 1.0, 2.0, 6.0, 7.0, 10.0, 11.0]  # cảnh dài nhất ở giữa: [2, 6] rồi [7, 10]
+    scenes = [{"start": bounds[i], "end": bounds[i + 1]} for i in range(len(bounds) - 1)]
+    assert pick_keyframe_times(scenes, 24) == [0.5, 1.5, 4.0, 6.5, 8.5, 10.5]
+    assert pick_keyframe_times(scenes, 3) == [0.5, 4.0, 10.5]
+    assert pick_keyframe_times(scenes, 4) == [0.5, 4.0, 8.5, 10.5]
+    assert pick_keyframe_times([], 3) == []
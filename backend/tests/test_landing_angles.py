@@ -0,0 +1,41 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.routers import analysis
+
+
+def _client(monkeypatch, structured_angles):
+    calls = {"text": 0}
+
+    async def _phase1(ip, settings, **kw):
+        return {"analysis": "phân tích", "landing_id": "lid", "phase1_cached": True}
+
+    async def _structured(**kw):
+        return "", "", structured_angles, {"t_phase2_ms": 1}
+
+    async def _text(**kw):
+        calls["text"] += 1
+        return "", {"t_phase2_ms": 1}
+
+    monkeypatch.setattr(analysis, "_landing_phase1", _phase1)
+    monkeypatch.setattr(analysis, "gemini_landing_angles_structured", _structured)
+    monkeypatch.setattr(analysis, "gemini_landing_angles", _text)
+    app = FastAPI()
+    app.include_router(analysis.router)
+    return TestClient(app), calls
+
+
+def test_structured_empty_angles_falls_back_to_text_mode(monkeypatch):
+    client, calls = _client(monkeypatch, [])
+    r = client.post("/analysis-landing-page", data={"landingUrl": "x", "structured": "true"})
+    assert r.status_code == 200
+    assert calls["text"] == 1
+
+
+def test_structured_angles_skip_text_mode(monkeypatch):
+    angle = {"title": "A", "raw": "Title: A"}
+    client, calls = _client(monkeypatch, [angle])
+    r = client.post("/analysis-landing-page", data={"landingUrl": "x", "structured": "true"})
+    assert r.status_code == 200
+    assert calls["text"] == 0
+    assert r.json()["angles"] == ["A"]
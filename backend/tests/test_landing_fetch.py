@@ -0,0 +1,155 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.api.http_client import close_http_client
+from app.services import landing_fetch
+from app.services.landing_fetch import LandingFetchError, extract_landing_content, fetch_landing_page
+
+PAGE = """<html><head><title> Acme  Serum </title>
+<meta name="description" content="Best serum">
+<script>var x = "ignored";</script>
+<script type="application/ld+json">{"@type": "Product", "review": [{"@type": "Review", "reviewBody": "Loved it, skin glows"}]}</script>
+</head><body><nav>Menu</nav>
+<h1>Glow in 7 days</h1><p>Vitamin C formula.</p>
+<div class="reviews"><div class="review-item">Works great for me</div><div class="review-item">Too pricey</div></div>
+<footer>Copyright</footer></body></html>"""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    hits = {}
+
+    def log_message(self, *a):
+        pass
+
+    def _html(self, body: str, extra=None):
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "text/html; charset=utf-8")
+        for k, v in (extra or {}).items():
+            self.send_header(k, v)
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        _Handler.hits[self.path] = _Handler.hits.get(self.path, 0) + 1
+        port = self.server.server_address[1]
+        if self.path == "/page":
+            if self.headers.get("if-none-match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self._html(PAGE, {"etag": '"v1"'})
+        elif self.path == "/always304":
+            self.send_response(304)
+            self.end_headers()
+        elif self.path == "/redir":
+            self.send_response(302)
+            self.send_header("location", "/page")
+            self.end_headers()
+        elif self.path == "/redir-internal":
+            self.send_response(302)
+            self.send_header("location", f"http://localhost:{port}/page")
+            self.end_headers()
+        elif self.path == "/image":
+            self.send_response(200)
+            self.send_header("content-type", "image/png")
+            self.end_headers()
+            self.wfile.write(b"\x89PNG")
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+def _fetch(url):
+    async def _go():
+        try:
+            return await fetch_landing_page(url)
+        finally:
+            await close_http_client()  # client pool gắn với event loop của asyncio.run
+    return asyncio.run(_go())
+
+
+def test_extract_landing_content():
+    page = extract_landing_content(PAGE)
+    assert page["title"] == "Acme Serum"
+    assert page["description"] == "Best serum"
+    assert "Glow in 7 days" in page["text"] and "Vitamin C formula." in page["text"]
+    assert "ignored" not in page["text"] and "Menu" not in page["text"] and "Copyright" not in page["text"]
+    assert page["reviews"] == ["Works great for me", "Too pricey", "Loved it, skin glows"]
+
+
+def test_fetch_then_fresh_cache(server, allow_private):
+    _Handler.hits.clear()
+    first = _fetch(server + "/page")
+    assert first["cached"] is False and first["title"] == "Acme Serum"
+    again = _fetch(server + "/page")
+    assert again["cached"] is True and again["revalidated"] is False
+    assert _Handler.hits["/page"] == 1
+
+
+def test_revalidate_with_etag(server, allow_private, monkeypatch):
+    monkeypatch.setattr(allow_private, "LANDING_CACHE_FRESH_SEC", 0)
+    _fetch(server + "/page")
+    res = _fetch(server + "/page")
+    assert res["cached"] is True and res["revalidated"] is True
+    assert "Glow in 7 days" in res["text"]
+
+
+def test_304_without_usable_cache_refetches(server, allow_private, monkeypatch):
+    monkeypatch.setattr(allow_private, "LANDING_CACHE_FRESH_SEC", 0)
+    url = server + "/page"
+    key = landing_fetch.content_key(url)
+    landing_fetch.store_put(landing_fetch._LANDING_NS, key, {"url": url, "etag": '"v1"', "fetched_at": 0})
+    res = _fetch(url)
+    assert res["cached"] is False
+    assert res["title"] == "Acme Serum"
+
+
+def test_unconditional_304_is_error(server, allow_private):
+    with pytest.raises(LandingFetchError):
+        _fetch(server + "/always304")
+
+
+def test_follows_redirect(server, allow_private):
+    res = _fetch(server + "/redir")
+    assert res["final_url"].endswith("/page")
+    assert res["title"] == "Acme Serum"
+
+
+def test_redirect_hop_is_validated(server, allow_private, monkeypatch):
+    real = landing_fetch.ensure_public_url
+
+    async def _guard(u):
+        if "localhost" in u:
+            raise landing_fetch.UnsafeURLError(f"blocked {u}")
+        await real(u)
+
+    monkeypatch.setattr(landing_fetch, "ensure_public_url", _guard)
+    with pytest.raises(LandingFetchError) as ei:
+        _fetch(server + "/redir-internal")
+    assert ei.value.status_code == 400
+
+
+def test_private_address_blocked_by_default(server):
+    with pytest.raises(LandingFetchError) as ei:
+        _fetch(server + "/not-cached")
+    assert ei.value.status_code == 400
+
+
+def test_rejects_non_html(server, allow_private):
+    with pytest.raises(LandingFetchError) as ei:
+        _fetch(server + "/image")
+    assert ei.value.status_code == 415
@@ -0,0 +1,89 @@
+import asyncio
+import re
+
+from app.services import gemini
+from app.services.gemini import _split_text_chunks, gemini_map_reduce_feedback
+
+
+def test_split_keeps_line_order_around_hard_cuts():
+    text = "a1\nb2\n" + "X" * 25 + "\nc3"
+    assert _split_text_chunks(text, 10) == ["a1\nb2", "X" * 10, "X" * 10, "XXXXX\nc3"]
+
+
+def test_split_packs_lines_and_respects_max_chars():
+    lines = [f"review {i:03d} " + "y" * (i % 7) for i in range(200)]
+    chunks = _split_text_chunks("\n".join(lines), 120)
+    assert all(len(c) <= 120 for c in chunks)
+    assert "\n".join(chunks).split("\n") == lines
+    assert _split_text_chunks("", 10) == [] and _split_text_chunks("\n  \n", 10) == []
+
+
+def _body(n_chunks: int) -> str:
+    # mỗi dòng ~1900 ký tự -> 1 chunk / dòng với chunk_chars tối thiểu (2000)
+    return "[CUSTOMER REVIEWS]\n" + "\n".join(f"r{i:02d} " + "z" * 1890 for i in range(n_chunks))
+
+
+def test_map_reduce_tree_merges_in_order(monkeypatch):
+    maps, merges = [], []
+
+    async def _gen(*, parts, **kw):
+        prompt, body = parts[0]["text"], parts[1]["text"]
+        if prompt.startswith("You are extracting"):
+            idx = int(re.search(r"chunk (\d+)/(\d+)", prompt).group(1))
+            maps.append(idx)
+            rid = re.search(r"r(\d\d) ", body).group(1)
+            return f"<{rid}>".ljust(100, ".")
+        ids = re.findall(r"<(\d\d)>", body)
+        merges.append(ids)
+        return "".join(f"<{i}>" for i in ids).ljust(100, ".")
+
+    monkeypatch.setattr(gemini, "_gen_text", _gen)
+    text, meta = asyncio.run(gemini_map_reduce_feedback(
+        api_key="k", page_text="URL: https://x.test\n" + _body(20), chunk_chars=2000, max_reduce_chars=500,
+    ))
+    assert sorted(maps) == list(range(1, 21))
+    assert meta["map_chunks"] == 20 and meta["reduce_rounds"] == 1
+    # nhóm theo max_reduce_chars (5 x 100 ký tự), giữ thứ tự chunk
+    assert merges == [[f"{i:02d}" for i in range(g, g + 5)] for g in range(0, 20, 5)]
+    assert text.startswith("URL: https://x.test")
+    assert re.findall(r"<(\d\d)>", text) == [f"{i:02d}" for i in range(20)]
+
+
+def test_map_reduce_skips_reduce_when_notes_fit(monkeypatch):
+    calls = []
+
+    async def _gen(*, parts, **kw):
+        calls.append(parts[0]["text"][:20])
+        return "notes"
+
+    monkeypatch.setattr(gemini, "_gen_text", _gen)
+    _, meta = asyncio.run(gemini_map_reduce_feedback(api_key="k", page_text=_body(3), chunk_chars=2000))
+    assert meta["reduce_rounds"] == 0 and len(calls) == 3
+
+
+class _Resp:
+    def __init__(self, text):
+        self.text = text
+        self.candidates = []
+
+
+def test_map_concurrency_bounded_by_gemini_limiter(monkeypatch):
+    state = {"active": 0, "peak": 0}
+
+    class _Model:
+        def __init__(self, model_name=None):
+            pass
+
+        async def generate_content_async(self, contents=None, **kw):
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+            await asyncio.sleep(0.01)
+            state["active"] -= 1
+            return _Resp("notes")
+
+    monkeypatch.setattr(gemini.genai, "GenerativeModel", _Model)
+    monkeypatch.setattr(gemini, "GEMINI_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(gemini, "_limiter", None)
+    _, meta = asyncio.run(gemini_map_reduce_feedback(api_key=None, page_text=_body(9), chunk_chars=2000))
+    assert meta["map_chunks"] == 9
+    assert state["peak"] == 2
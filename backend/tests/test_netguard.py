@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from app.core.netguard import UnsafeURLError, ensure_public_url, is_public_ip
+from app.services.jobs import validate_webhook_url
+
+
+@pytest.mark.parametrize("ip", [
+    "127.0.0.1", "10.1.2.3", "172.16.0.1", "192.168.1.1", "169.254.169.254",
+    "0.0.0.0", "::1", "fe80::1", "fd00::1", "::ffff:127.0.0.1", "224.0.0.1",
+])
+def test_is_public_ip_rejects_internal(ip):
+    assert not is_public_ip(ip)
+
+
+@pytest.mark.parametrize("ip", ["8.8.8.8", "1.1.1.1", "2606:4700:4700::1111"])
+def test_is_public_ip_accepts_global(ip):
+    assert is_public_ip(ip)
+
+
+@pytest.mark.parametrize("url", [
+    "file:///etc/passwd",
+    "gopher://example.com/",
+    "http:///nohost",
+    "http://127.0.0.1:8000/admin",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://[::1]/",
+    "http://localhost/",
+])
+def test_ensure_public_url_blocks(url):
+    with pytest.raises(UnsafeURLError):
+        asyncio.run(ensure_public_url(url))
+
+
+def test_ensure_public_url_allows_public_literal():
+    asyncio.run(ensure_public_url("https://8.8.8.8/hook"))
+
+
+def test_allow_private_switch(allow_private):
+    asyncio.run(ensure_public_url("http://127.0.0.1:9/"))
+
+
+def test_validate_webhook_url():
+    assert asyncio.run(validate_webhook_url("  ")) is None
+    assert asyncio.run(validate_webhook_url(" https://8.8.8.8/x ")) == "https://8.8.8.8/x"
+    with pytest.raises(UnsafeURLError):
+        asyncio.run(validate_webhook_url("http://10.0.0.5/hook"))
@@ -0,0 +1,13 @@
+from app.services import gemini
+
+
+def test_keyframe_prompt_is_versioned():
+    parts = gemini.keyframe_visual_parts({"keyframes": [{"t": 1.5, "jpeg": b"x"}], "cuts": [], "pacing": {}})
+    texts = [p["text"] for p in parts if "text" in p]
+    # mọi text cố định gửi cho model phải nằm trong input của VIDEO_REPORT_PROMPT_VERSION
+    assert texts[0] == gemini._KEYFRAME_SYSTEM
+    assert texts[1].startswith(gemini.SCENE_CUTS_HEADER)
+    assert texts[2] == gemini._KEYFRAME_LABEL.format(i=1, ts=gemini.fmt_ts(1.5))
+    assert gemini.VIDEO_REPORT_PROMPT_VERSION != gemini._prompt_version(
+        *gemini._VIDEO_TRANSCRIPT_PROMPTS, gemini._VIDEO_ANALYSIS_PREAMBLE, gemini._VIDEO_ANALYSIS_SYSTEM
+    )
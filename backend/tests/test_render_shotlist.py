@@ -0,0 +1,42 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.routers import video
+from app.services.jobs import JOB_FAILED, JOB_QUEUED, _conn, get_job
+
+
+def _client():
+    app = FastAPI()
+    app.include_router(video.router)
+    return TestClient(app)
+
+
+def _payload(vo="Xin chào các bạn"):
+    return {"beats": [{"beat": "1", "vo": vo}, {"beat": "2", "vo": "Beat hai"}], "video": False}
+
+
+def test_same_changed_plan_reuses_in_flight_job():
+    client = _client()
+    r1 = client.post("/render-shotlist", json=_payload()).json()
+    r2 = client.post("/render-shotlist", json=_payload()).json()
+    assert r1["status"] == "rendering" and r1["job_id"]
+    assert r2["job_id"] == r1["job_id"]
+    assert get_job(r1["job_id"])["status"] == JOB_QUEUED
+
+    r3 = client.post("/render-shotlist", json=_payload(vo="VO khác")).json()
+    assert r3["job_id"] != r1["job_id"]
+
+
+def test_finished_job_is_not_reused():
+    client = _client()
+    r1 = client.post("/render-shotlist", json=_payload(vo="Lần một")).json()
+    _conn().execute("UPDATE jobs SET status = ? WHERE id = ?", (JOB_FAILED, r1["job_id"]))
+    r2 = client.post("/render-shotlist", json=_payload(vo="Lần một")).json()
+    assert r2["job_id"] != r1["job_id"]
+
+
+def test_generate_video_job_is_not_rerun():
+    r = _client().post("/jobs/generate-video", json={"prompt": "A product shot"})
+    assert r.status_code == 202
+    row = _conn().execute("SELECT max_attempts FROM jobs WHERE id = ?", (r.json()["job_id"],)).fetchone()
+    assert row[0] == 1
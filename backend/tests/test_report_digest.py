@@ -0,0 +1,96 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+from app.core.store import store_get
+from app.services import gemini
+
+LONG = "Khách hàng phàn nàn về giá. " * 400  # > REPORT_DIGEST_MIN_CHARS
+
+
+def _report(tag: str) -> str:
+    return f"{tag}\n{LONG}"
+
+
+def _fake_digest(calls, fail=False, delay=0.0):
+    async def _fn(*, api_key, report, model_name):
+        calls.append(report)
+        await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError("quota")
+        return f"{gemini.REPORT_DIGEST_MARK}\ndigest", {"tokens_before": 1000, "tokens_after": 100, "t_digest_ms": 1}
+    return _fn
+
+
+def test_request_path_never_calls_model(monkeypatch):
+    calls = []
+    monkeypatch.setattr(gemini, "gemini_report_digest", _fake_digest(calls))
+    report = _report("a")
+    text, meta = asyncio.run(gemini.report_for_prompt(api_key="k", report=report))
+    assert text == report and meta == {"digest": False}
+    assert calls == []
+
+
+def test_request_path_uses_stored_digest(monkeypatch):
+    calls = []
+    monkeypatch.setattr(gemini, "gemini_report_digest", _fake_digest(calls))
+    report = _report("b")
+    asyncio.run(gemini.ensure_report_digest(api_key="k", report=report))
+    text, meta = asyncio.run(gemini.report_for_prompt(api_key="k", report=report))
+    assert text.startswith(gemini.REPORT_DIGEST_MARK)
+    assert meta["digest"] is True and meta["tokens_saved"] == 900
+    assert len(calls) == 1
+
+
+def test_concurrent_generation_is_coalesced(monkeypatch):
+    calls = []
+    monkeypatch.setattr(gemini, "gemini_report_digest", _fake_digest(calls, delay=0.05))
+    report = _report("c")
+
+    async def _run():
+        return await asyncio.gather(*(gemini.ensure_report_digest(api_key="k", report=report) for _ in range(5)))
+
+    recs = asyncio.run(_run())
+    assert len(calls) == 1
+    assert all(r and r["digest"] for r in recs)
+
+
+def test_failure_is_negatively_cached(monkeypatch, settings):
+    calls = []
+    monkeypatch.setattr(gemini, "gemini_report_digest", _fake_digest(calls, fail=True))
+    report = _report("d")
+    assert asyncio.run(gemini.ensure_report_digest(api_key="k", report=report)) is None
+    assert asyncio.run(gemini.ensure_report_digest(api_key="k", report=report)) is None
+    assert len(calls) == 1
+    key = gemini.report_digest_key(report.strip(), settings.GEMINI_MODEL_TEXT or gemini.DEFAULT_TEXT_MODEL)
+    assert "quota" in store_get(gemini.REPORT_DIGEST_NS, key)["error"]
+    assert gemini.get_report_digest(report) is None
+
+    # hết hạn negative cache -> thử lại
+    monkeypatch.setattr(settings, "REPORT_DIGEST_FAIL_TTL_SEC", 0)
+    monkeypatch.setattr(gemini, "gemini_report_digest", _fake_digest(calls))
+    assert asyncio.run(gemini.ensure_report_digest(api_key="k", report=report))["digest"]
+    assert len(calls) == 2
+
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures" / "report_digest"
+CASES = json.loads((FIXTURES / "cases.json").read_text(encoding="utf-8"))
+
+
+@pytest.mark.parametrize("case", CASES, ids=[c["name"] for c in CASES])
+def test_validate_report_digest_fixture_corpus(case):
+    report = (FIXTURES / "report.md").read_text(encoding="utf-8")
+    digest, issues = gemini.validate_report_digest(gemini.ReportDigest.model_validate(case["digest"]), report)
+    assert issues == case["issues"]
+    assert digest.key_quotes == case["kept_quotes"]
+
+
+def test_gemini_report_digest_rejects_invalid_digest(monkeypatch):
+    async def _gen(**kw):
+        return json.dumps(next(c for c in CASES if c["name"] == "missing_twe")["digest"])
+
+    monkeypatch.setattr(gemini, "_gen_text", _gen)
+    with pytest.raises(ValueError, match="missing_twe"):
+        asyncio.run(gemini.gemini_report_digest(api_key="k", report=(FIXTURES / "report.md").read_text(encoding="utf-8")))
@@ -0,0 +1,175 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.core.retry import (
+    RetryPolicy,
+    RetryableStatusError,
+    classify_error,
+    parse_retry_after,
+    retry_async,
+    safe_to_resend,
+)
+from app.services import gemini
+
+FAST = RetryPolicy(max_attempts=3, base_s=0.0, cap_s=0.0, deadline_s=5.0)
+
+
+def _status_error(code: int) -> httpx.HTTPStatusError:
+    req = httpx.Request("POST", "http://n8n.example/hook")
+    return httpx.HTTPStatusError("err", request=req, response=httpx.Response(code, request=req))
+
+
+class InvalidArgument(Exception):
+    pass
+
+
+@pytest.mark.parametrize("exc, retryable", [
+    (RetryableStatusError(503), True),
+    (RetryableStatusError(429, retry_after=2.0), True),
+    (_status_error(500), True),
+    (_status_error(404), False),
+    (_status_error(400), False),
+    (httpx.ConnectError("refused"), True),
+    (httpx.ReadTimeout("slow"), True),
+    (InvalidArgument("bad"), False),
+    (ValueError("bad"), False),
+    (RuntimeError("model overloaded, try again"), True),
+    (RuntimeError("API key not valid"), False),
+])
+def test_classify_error(exc, retryable):
+    assert classify_error(exc)[0] is retryable
+
+
+def test_classify_error_walks_cause_chain():
+    try:
+        try:
+            raise RetryableStatusError(429, retry_after=3.0)
+        except RetryableStatusError as e:
+            raise RuntimeError("Async generation failed") from e
+    except RuntimeError as wrapped:
+        assert classify_error(wrapped) == (True, 3.0)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("5") == 5.0
+    assert parse_retry_after("") is None
+    assert parse_retry_after("garbage") is None
+
+
+@pytest.mark.parametrize("exc, safe", [
+    (httpx.ConnectError("refused"), True),
+    (httpx.ConnectTimeout("slow connect"), True),
+    (_status_error(429), True),
+    (RetryableStatusError(429), True),
+    (RetryableStatusError(503), False),
+    (httpx.ReadTimeout("sent, no answer"), False),
+])
+def test_safe_to_resend(exc, safe):
+    assert safe_to_resend(exc) is safe
+
+
+def _flaky(errors):
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return fn, calls
+
+
+def test_non_idempotent_does_not_resend_after_server_error():
+    fn, calls = _flaky([RetryableStatusError(503)])
+    with pytest.raises(RetryableStatusError):
+        asyncio.run(retry_async(fn, name="t", policy=FAST.with_(idempotent=False)))
+    assert len(calls) == 1
+
+
+def test_non_idempotent_resends_on_connect_error_and_429():
+    fn, calls = _flaky([httpx.ConnectError("refused"), RetryableStatusError(429)])
+    assert asyncio.run(retry_async(fn, name="t", policy=FAST.with_(idempotent=False))) == "ok"
+    assert len(calls) == 3
+
+
+def test_idempotent_retries_server_error():
+    fn, calls = _flaky([RetryableStatusError(503)])
+    assert asyncio.run(retry_async(fn, name="t", policy=FAST)) == "ok"
+    assert len(calls) == 2
+
+
+def test_stream_releases_limiter_slot_between_attempts(monkeypatch):
+    class _Chunk:
+        def __init__(self, text):
+            self.text = text
+
+    class _Stream:
+        def __aiter__(self):
+            async def _gen():
+                yield _Chunk("a")
+                yield _Chunk("b")
+            return _gen()
+
+    seen = []
+
+    class _Model:
+        def __init__(self, model_name):
+            pass
+
+        async def generate_content_async(self, **kw):
+            seen.append(gemini._gemini_limiter()._value)
+            if len(seen) == 1:
+                raise RetryableStatusError(503)
+            return _Stream()
+
+    monkeypatch.setattr(gemini.genai, "GenerativeModel", _Model)
+    monkeypatch.setattr(gemini, "_ensure_configured", lambda api_key: None)
+    monkeypatch.setattr("app.core.retry.default_policy", lambda **kw: FAST)
+
+    async def _run():
+        out = [t async for t in gemini._ga_stream_text(api_key="k", model_name="m", parts=["p"])]
+        return out, gemini._gemini_limiter()._value
+
+    out, free = asyncio.run(_run())
+    assert out == ["a", "b"]
+    # mỗi lần mở stream giữ đúng 1 slot, xong thì trả hết
+    assert seen == [gemini.GEMINI_MAX_CONCURRENCY - 1] * 2
+    assert free == gemini.GEMINI_MAX_CONCURRENCY
+
+
+def test_upload_file_not_resent_after_server_error_but_poll_retries(monkeypatch):
+    uploads, gets = [], []
+
+    class _File:
+        name = "files/1"
+        state = "ACTIVE"
+
+    async def _upload(**kw):
+        uploads.append(kw)
+        raise RetryableStatusError(503)
+
+    async def _get(**kw):
+        gets.append(kw)
+        if len(gets) == 1:
+            raise RetryableStatusError(503)
+        return _File()
+
+    monkeypatch.setattr(gemini, "_upload_file_async", _upload)
+    monkeypatch.setattr(gemini, "_get_file_async", _get)
+    monkeypatch.setattr(gemini, "default_policy", lambda **kw: FAST.with_(**kw))
+    monkeypatch.setattr("app.core.retry.default_policy", lambda **kw: FAST)
+    with pytest.raises(RetryableStatusError):
+        asyncio.run(gemini.gemini_upload_file(api_key="k", file_path="v.mp4"))
+    # upload tạo file mới phía server -> 503 không được gửi lại
+    assert len(uploads) == 1
+
+    async def _upload_ok(**kw):
+        uploads.append(kw)
+        return _File()
+
+    monkeypatch.setattr(gemini, "_upload_file_async", _upload_ok)
+    assert asyncio.run(gemini.gemini_upload_file(api_key="k", file_path="v.mp4")).name == "files/1"
+    assert len(gets) == 2
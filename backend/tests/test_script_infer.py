@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import json
+
+import pytest
+
+from app.services import gemini, script_infer
+from app.services.script_infer import REQUIRED_KEYS
+
+CTX = dict(report="r", landing_analysis="l", angle_text="Title: A\nraw", model_name="m")
+
+
+def _inputs(n_filled: int):
+    return {k: (f"v{i}" if i < n_filled else "") for i, k in enumerate(REQUIRED_KEYS)}
+
+
+def test_precompute_does_not_cache_empty(monkeypatch):
+    async def _empty(**kw):
+        return _inputs(0), {}
+    monkeypatch.setattr(script_infer, "infer_required_inputs_from_context", _empty)
+    asyncio.run(script_infer.precompute_required_inputs(api_key="k", **CTX))
+    assert script_infer.get_cached_required_inputs(**CTX) is None
+
+
+def test_precompute_caches_non_empty(monkeypatch):
+    async def _full(**kw):
+        return _inputs(9), {}
+    monkeypatch.setattr(script_infer, "infer_required_inputs_from_context", _full)
+    ctx = {**CTX, "angle_text": "Title: B"}
+    asyncio.run(script_infer.precompute_required_inputs(api_key="k", **ctx))
+    assert script_infer.get_cached_required_inputs(**ctx) == _inputs(9)
+
+
+def test_precompute_keys_on_raw_report_and_script_path_hits_with_digest(monkeypatch):
+    # job dùng digest trong prompt, /generate-script có thể thấy digest hoặc chưa -> cùng key (report gốc)
+    seen = []
+
+    async def _full(**kw):
+        seen.append(kw["report"])
+        return _inputs(9), {}
+
+    monkeypatch.setattr(script_infer, "infer_required_inputs_from_context", _full)
+    ctx = {**CTX, "report": "raw report", "angle_text": "Title: E"}
+    asyncio.run(script_infer.precompute_required_inputs(api_key="k", prompt_report="digest", **ctx))
+    assert seen == ["digest"]
+    assert script_infer.get_cached_required_inputs(**ctx) == _inputs(9)
+
+    async def _digest(**kw):
+        return "digest", {"digest": True}
+
+    async def _no_infer(**kw):
+        raise AssertionError("precomputed inputs must be reused")
+
+    prompts = []
+
+    async def _gen(**kw):
+        prompts.append(kw["parts"][2]["text"])
+        return "script"
+
+    monkeypatch.setattr(gemini, "report_for_prompt", _digest)
+    monkeypatch.setattr(gemini, "infer_required_inputs_from_context", _no_infer)
+    monkeypatch.setattr(gemini, "_gen_text", _gen)
+    _, meta = asyncio.run(gemini.gemini_generate_script(
+        api_key="k", report="raw report", landing_analysis="l", angle={"title": "E", "raw": ""}, model_name="m",
+    ))
+    assert meta["infer_meta"] == {"cached": True}
+    assert "REPORT:\ndigest" in prompts[0]
+
+
+def test_cached_all_empty_entry_is_a_miss():
+    ctx = {**CTX, "angle_text": "Title: C"}
+    script_infer._store_inputs(inputs=_inputs(0), t_infer_ms=0, **ctx)
+    assert script_infer.get_cached_required_inputs(**ctx) is None
+
+
+def test_prompt_version_covers_prompt_and_schema():
+    # version là hash của mọi template prompt + response_schema
+    parts = [
+        script_infer._INFER_SYSTEM, script_infer._INFER_SCHEMA_HINT, script_infer._INFER_BATCH_SCHEMA_HINT,
+        script_infer._INFER_CONTEXT_TEMPLATE, json.dumps(script_infer._inputs_schema(), sort_keys=True),
+        json.dumps(script_infer._inputs_schema(with_index=True), sort_keys=True),
+    ]
+    assert script_infer.INFER_PROMPT_VERSION == hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()[:12]
+
+
+def test_generate_script_reinfers_when_cached_inputs_incomplete(monkeypatch):
+    calls = []
+
+    async def _infer(**kw):
+        calls.append(kw)
+        return _inputs(4), {"raw": ""}
+
+    monkeypatch.setattr(gemini, "get_cached_required_inputs", lambda **kw: _inputs(3))
+    monkeypatch.setattr(gemini, "infer_required_inputs_from_context", _infer)
+    text, meta = asyncio.run(gemini.gemini_generate_script(
+        api_key="k", report="short report", landing_analysis="l", angle={"title": "A", "raw": "x"},
+    ))
+    assert len(calls) == 1
+    assert meta["infer_meta"]["reinferred_missing"] == REQUIRED_KEYS[3:]
+    assert text.startswith("ERROR: Missing") and meta["missing"] == REQUIRED_KEYS[4:]
+
+
+def test_batch_short_result_falls_back_per_angle(monkeypatch):
+    # batch chỉ trả đủ angle đầu; angle sau infer riêng, angle infer riêng vẫn rỗng -> None
+    texts = ["Title: D1", "Title: D2", "Title: D3"]
+
+    async def _batch(**kw):
+        return [_inputs(9), _inputs(0), _inputs(0)], {}
+
+    calls = []
+
+    async def _single(**kw):
+        calls.append(kw["angle_text"])
+        return (_inputs(9) if kw["angle_text"] == "Title: D2" else _inputs(0)), {}
+
+    monkeypatch.setattr(script_infer, "infer_required_inputs_batch", _batch)
+    monkeypatch.setattr(script_infer, "infer_required_inputs_from_context", _single)
+    results, meta = asyncio.run(script_infer.resolve_required_inputs_for_angles(
+        api_key="k", model_name="m", report="r", landing_analysis="l", angle_texts=texts,
+    ))
+    assert sorted(calls) == ["Title: D2", "Title: D3"]
+    assert results == [_inputs(9), _inputs(9), None]
+    assert meta["batch_fallback"] == 2
+    ctx = {**CTX, "angle_text": "Title: D3"}
+    assert script_infer.get_cached_required_inputs(**ctx) is None
+
+
+class _Resp:
+    def __init__(self, text=None, blocked=False):
+        self._text, self._blocked = text, blocked
+
+    @property
+    def text(self):
+        if self._blocked:
+            raise ValueError("response.text quick accessor: candidate was blocked")
+        return self._text
+
+
+class _Model:
+    def __init__(self, first):
+        self.first, self.calls = first, []
+
+    async def generate_content_async(self, contents, **kw):
+        self.calls.append(kw)
+        if len(self.calls) == 1:
+            if isinstance(self.first, BaseException):
+                raise self.first
+            return self.first
+        return _Resp('{"ProductName": "prose"}')
+
+
+class InvalidArgument(Exception):
+    pass
+
+
+def test_generate_json_structured_uses_schema():
+    model = _Model(_Resp('{"ProductName": "x"}'))
+    raw, structured = asyncio.run(script_infer._generate_json(model, "p", {"type": "OBJECT"}))
+    assert (raw, structured) == ('{"ProductName": "x"}', True)
+    assert model.calls[0]["generation_config"]["response_schema"] == {"type": "OBJECT"}
+
+
+def test_generate_json_falls_back_when_schema_unsupported():
+    for err in (TypeError("unexpected keyword 'response_schema'"), InvalidArgument("400 response_schema not supported")):
+        model = _Model(err)
+        raw, structured = asyncio.run(script_infer._generate_json(model, "p", {"type": "OBJECT"}))
+        assert (raw, structured) == ('{"ProductName": "prose"}', False)
+        assert len(model.calls) == 2 and model.calls[1] == {}
+
+
+def test_generate_json_blocked_response_is_not_retried_as_prose():
+    model = _Model(_Resp(blocked=True))
+    with pytest.raises(ValueError):
+        asyncio.run(script_infer._generate_json(model, "p", {"type": "OBJECT"}))
+    assert len(model.calls) == 1
+
+
+def test_generate_json_other_invalid_argument_propagates():
+    model = _Model(InvalidArgument("400 API key not valid"))
+    with pytest.raises(InvalidArgument):
+        asyncio.run(script_infer._generate_json(model, "p", {"type": "OBJECT"}))
+    assert len(model.calls) == 1
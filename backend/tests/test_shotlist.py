@@ -0,0 +1,286 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.routers import shotlist
+from app.services import gemini
+from app.core.store import store_get, store_put
+from app.services.tts import TTSError
+from app.services.gemini import (
+    SHOTLIST_FIELDS,
+    IncrementalShotlistParser,
+    _heuristic_tsv_from_script,
+    extract_final_script_rows,
+    gemini_generate_shotlist_text,
+    heuristic_shotlist_draft,
+    shot_beat_from_cols,
+    split_script_sections,
+)
+
+BACKEND = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND / "benchmarks"))
+
+from bench_shotlist import make_prose, make_table  # noqa: E402
+
+SCRIPT = """A) HOOK IDEAS
+- idea 1
+
+**D) FINAL VIDEO SCRIPT**
+| Stage | Voice-over / On-Screen Script | Visuals & OST |
+|---|---|---|
+| Hook | Stop scrolling if your skin feels dry. | close-up |
+| Proof | Two weeks later, no more patches. | before/after |
+
+E) NOTES
+done
+"""
+
+
+# ---- parsers ----
+def test_split_script_sections():
+    sec = split_script_sections(SCRIPT)
+    assert sorted(sec) == ["A", "D", "E"]
+    assert sec["A"] == "- idea 1"
+    assert sec["E"] == "done"
+
+
+def test_extract_final_script_rows():
+    rows = extract_final_script_rows(SCRIPT)
+    assert rows == [
+        {"stage": "Hook", "vo": "Stop scrolling if your skin feels dry.", "visuals": "close-up"},
+        {"stage": "Proof", "vo": "Two weeks later, no more patches.", "visuals": "before/after"},
+    ]
+
+
+def test_extract_final_script_rows_without_section_d():
+    text = "intro\n| Beat | Voice-over |\n|---|---|\n| 1 | Hello there friend |\n"
+    assert extract_final_script_rows(text) == [{"stage": "1", "vo": "Hello there friend", "visuals": ""}]
+    assert extract_final_script_rows("no table at all") == []
+
+
+def test_shot_beat_from_cols_pads_and_merges():
+    assert shot_beat_from_cols(["1", "vo"]) == {**{k: "" for k in SHOTLIST_FIELDS}, "beat": "1", "vo": "vo"}
+    beat = shot_beat_from_cols(["1", "vo", "ost", "ann", "pace", "p1", "p2"])
+    assert beat["prompt"] == "p1 | p2"
+
+
+def test_incremental_parser_splits_across_chunks():
+    p = IncrementalShotlistParser()
+    out = p.feed("Beat #\tVO\tOST\n1\thel")
+    assert out == []  # header bị bỏ, dòng "1\thel" chưa đủ
+    out = p.feed("lo\tost\r\n| --- | --- |\n2\tbye")
+    assert out == [["1", "hello", "ost"]]
+    assert p.close() == [["2", "bye"]]
+    assert p.rows == 2
+
+
+def test_incremental_parser_markdown_rows():
+    p = IncrementalShotlistParser()
+    assert p.feed("```\n| 1 | vo | ost |\n```\n") == [["1", "vo", "ost"]]
+
+
+# ---- heuristic draft ----
+def test_heuristic_draft_one_beat_per_row():
+    tsv = heuristic_shotlist_draft(make_table(300))
+    assert len(tsv.splitlines()) == 301  # header + 300 beat, không cắt ở 120
+
+
+def test_short_table_is_not_padded_from_markup():
+    # 3 row < min_beats: không được bù beat từ header / |---| / phần còn lại của bảng
+    script = (
+        "| Stage | Voice-over / On-Screen Script | Visuals & OST |\n|---|---|---|\n"
+        "| Hook | Tired of flat pillows? | close-up |\n"
+        "| Body | Meet the pillow that stays lofty. | demo |\n"
+        "| CTA | Tap to shop now. | logo |\n"
+    )
+    expected = ["Tired of flat pillows?", "Meet the pillow that stays lofty.", "Tap to shop now."]
+    for tsv in (_heuristic_tsv_from_script(script), heuristic_shotlist_draft(script)):
+        vos = [ln.split("\t")[1] for ln in tsv.splitlines()[1:]]
+        assert vos == expected
+        assert not any("|" in v or "---" in v for v in vos)
+
+
+class _CountingRe:
+    """Bọc regex đã compile, đếm số lần split (= số dòng văn xuôi được xử lý)."""
+
+    def __init__(self, rx):
+        self.rx, self.calls = rx, 0
+
+    def split(self, text):
+        self.calls += 1
+        return self.rx.split(text)
+
+
+def test_prose_heuristic_stops_at_max_beats(monkeypatch):
+    # timing thật ở benchmarks/bench_shotlist.py; ở đây: công việc không tăng theo độ dài script
+    work = []
+    for n_chars in (50_000, 200_000):
+        counter = _CountingRe(gemini._BEAT_PHRASE_RE)
+        monkeypatch.setattr(gemini, "_BEAT_PHRASE_RE", counter)
+        tsv = _heuristic_tsv_from_script(make_prose(n_chars))
+        assert len(tsv.splitlines()) - 1 == 120
+        work.append(counter.calls)
+    assert work[0] == work[1] < 120
+
+
+def test_table_heuristic_one_beat_per_row():
+    for n_rows in (500, 2_000):
+        rows = heuristic_shotlist_draft(make_table(n_rows)).splitlines()[1:]
+        assert len(rows) == n_rows
+        assert [r.split("\t")[0] for r in rows[:2]] == ["1", "2"]
+
+
+# ---- draft job ----
+def _req(**kw):
+    return {"framework_analysis": "fa", "final_script": "Hello there friend. Second line here.", **kw}
+
+
+def test_draft_job_failure_keeps_draft(monkeypatch, settings):
+    # lỗi ở tầng gọi model: gemini_generate_shotlist_text tự fallback từng chunk, job vẫn phải fail
+    async def _boom(**kw):
+        raise RuntimeError("quota")
+
+    monkeypatch.setattr(gemini, "_ga_generate_content", _boom)
+    sid = "f" * 64
+    store_put(shotlist._SHOTLIST_NS, sid, {"shotlist_id": sid, "revision": 0, "status": "draft", "model": "heuristic"})
+    with pytest.raises(RuntimeError):
+        asyncio.run(shotlist._shotlist_generate_job({"shotlist_id": sid, "request": _req()}))
+    rec = store_get(shotlist._SHOTLIST_NS, sid)
+    assert rec["status"] == "draft" and rec["revision"] == 0
+    assert "quota" in rec["error"]
+
+
+def test_blocking_path_falls_back_to_heuristic(monkeypatch, settings):
+    async def _boom(**kw):
+        raise RuntimeError("quota")
+
+    monkeypatch.setattr(shotlist, "gemini_generate_shotlist_text", _boom)
+    out = asyncio.run(shotlist._run_shotlist(shotlist.GenerateShotlistRequest(**_req()), settings))
+    assert out["model"] == "heuristic"
+    assert out["shotlist_text"].startswith("Beat #")
+
+
+# ---- chunk fallback ----
+def _gemini_down(monkeypatch):
+    async def _boom(**kw):
+        raise RuntimeError("quota")
+
+    monkeypatch.setattr(gemini, "_ga_generate_content", _boom)
+
+
+def test_chunk_fallback_is_counted_and_uses_row_vo(monkeypatch, settings):
+    _gemini_down(monkeypatch)
+    out = asyncio.run(gemini_generate_shotlist_text(api_key="k", framework_analysis="fa", final_script=SCRIPT))
+    assert out["fallback_chunks"] == out["chunks"] == 1
+    assert "quota" in out["fallback_errors"][0]
+    vos = [ln.split("\t")[1] for ln in out["shotlist_text"].splitlines()[1:]]
+    assert vos == ["Stop scrolling if your skin feels dry.", "Two weeks later, no more patches."]
+
+
+def test_blocking_path_labels_all_fallback_as_heuristic(monkeypatch, settings):
+    _gemini_down(monkeypatch)
+    out = asyncio.run(shotlist._run_shotlist(shotlist.GenerateShotlistRequest(**_req(final_script=SCRIPT)), settings))
+    assert out["model"] == "heuristic"
+    assert out["fallback_chunks"] == 1
+
+
+# ---- stream endpoint ----
+def _stream(monkeypatch, pieces, fail_after):
+    async def _fake(**kw):
+        for i, p in enumerate(pieces):
+            if i == fail_after:
+                raise RuntimeError("stream reset")
+            yield p
+
+    monkeypatch.setattr(gemini, "_ga_stream_text", _fake)
+    app = FastAPI()
+    app.include_router(shotlist.router)
+    res = TestClient(app).post("/generate-shotlist/stream", json=_req(final_script=SCRIPT))
+    assert res.status_code == 200
+    return [json.loads(ln) for ln in res.text.splitlines()]
+
+
+def test_stream_error_mid_chunk_emits_error_event(monkeypatch, settings):
+    rows = [f"{i}\tvo {i}\t\t\t\tprompt {i}\n" for i in range(1, 6)]
+    events = _stream(monkeypatch, rows, fail_after=4)
+    assert [e["event"] for e in events] == ["beat"] * 4 + ["error", "done"]
+    assert events[4]["after_beat"] == 4 and "stream reset" in events[4]["detail"]
+    done = events[-1]
+    assert done["model"] != "heuristic"
+    assert (done["beats"], done["errors"], done["fallback_chunks"]) == (4, 1, 0)
+
+
+def test_stream_fallback_is_reported_in_done(monkeypatch, settings):
+    events = _stream(monkeypatch, ["1\tvo\n"], fail_after=0)
+    beats = [e["beat"]["vo"] for e in events if e["event"] == "beat"]
+    assert beats == ["Stop scrolling if your skin feels dry.", "Two weeks later, no more patches."]
+    done = events[-1]
+    assert done["event"] == "done" and done["model"] == "heuristic"
+    assert (done["fallback_chunks"], done["errors"]) == (1, 0)
+
+
+# ---- stream + TTS pipeline ----
+def _fake_beats(monkeypatch, vos):
+    async def _gen(**kw):
+        for i, vo in enumerate(vos, start=1):
+            yield shot_beat_from_cols([str(i), vo, "", "", "", f"prompt {i}"])
+
+    monkeypatch.setattr(shotlist, "gemini_generate_shotlist_stream", _gen)
+
+
+def test_stream_tts_emits_audio_and_audio_error(monkeypatch, settings):
+    _fake_beats(monkeypatch, ["Hello there", "This one fails", "[SFX: whoosh]", "Last line"])
+
+    async def _synth(*, text, beat, **kw):
+        if beat == "2":
+            raise TTSError("ElevenLabs 429", status_code=429)
+        return {"beat": beat, "audio_url": f"/static/tts/{beat}.mp3"}
+
+    monkeypatch.setattr(shotlist, "synthesize_voice", _synth)
+    app = FastAPI()
+    app.include_router(shotlist.router)
+    res = TestClient(app).post("/generate-shotlist/stream", json=_req(final_script=SCRIPT, tts=True))
+    events = [json.loads(ln) for ln in res.text.splitlines()]
+
+    assert [e["beat"]["beat"] for e in events if e["event"] == "beat"] == ["1", "2", "3", "4"]
+    assert sorted(e["beat"] for e in events if e["event"] == "audio") == ["1", "4"]
+    errors = [e for e in events if e["event"] == "audio_error"]
+    assert [(e["beat"], e["detail"]) for e in errors] == [("2", "ElevenLabs 429")]
+    # audio của 1 beat luôn sau event beat đó
+    pos = {e["beat"]["beat"]: i for i, e in enumerate(events) if e["event"] == "beat"}
+    assert all(pos[e["beat"]] < i for i, e in enumerate(events) if e["event"] in ("audio", "audio_error"))
+    done = events[-1]
+    assert done["event"] == "done" and done["beats"] == 4
+    assert done["audio"] == {"ok": 2, "failed": 1, "skipped": 1}
+
+
+def test_stream_tts_disconnect_with_full_queue_leaves_no_tasks(monkeypatch, settings):
+    monkeypatch.setattr(settings, "TTS_PIPELINE_QUEUE_SIZE", 1)
+    monkeypatch.setattr(settings, "TTS_PIPELINE_CONCURRENCY", 1)
+    _fake_beats(monkeypatch, [f"Spoken line {i}" for i in range(1, 11)])
+
+    async def _stuck(**kw):
+        await asyncio.Event().wait()  # TTS chậm hơn shotlist -> tts_q đầy
+
+    monkeypatch.setattr(shotlist, "synthesize_voice", _stuck)
+
+    async def _run():
+        req = shotlist.GenerateShotlistRequest(**_req(final_script=SCRIPT, tts=True))
+        resp = await shotlist.generate_shotlist_stream_endpoint(req, settings)
+        body = resp.body_iterator
+        first = json.loads(await body.__anext__())
+        for _ in range(20):
+            await asyncio.sleep(0)  # producer chạy tới khi bị chặn ở tts_q.put
+        await body.aclose()  # client ngắt kết nối
+        for _ in range(20):
+            await asyncio.sleep(0)
+        return first, [t for t in asyncio.all_tasks() if t is not asyncio.current_task() and not t.done()]
+
+    first, pending = asyncio.run(_run())
+    assert first["event"] == "beat"
+    assert pending == []
@@ -0,0 +1,48 @@
+import os
+import time
+
+import pytest
+
+from app.core.store import _key_path, content_key, store_delete, store_get, store_put
+
+
+def test_content_key_is_stable_and_separated():
+    assert content_key("a", 1, None) == content_key("a", 1, None)
+    assert content_key("ab", "c") != content_key("a", "bc")
+    assert content_key(None) == content_key("")
+    assert len(content_key("x")) == 64
+
+
+def test_put_get_delete_roundtrip():
+    store_put("test-ns", "k1", {"v": "tiếng việt"})
+    assert store_get("test-ns", "k1") == {"v": "tiếng việt"}
+    store_delete("test-ns", "k1")
+    assert store_get("test-ns", "k1") is None
+    store_delete("test-ns", "k1")  # xoá lần 2 không lỗi
+
+
+def test_max_age_expires_entry():
+    store_put("test-ns", "old", {"v": 1})
+    path = _key_path("test-ns", "old")
+    past = time.time() - 100
+    os.utime(path, (past, past))
+    assert store_get("test-ns", "old", max_age_s=50) is None
+    assert store_get("test-ns", "old", max_age_s=200) == {"v": 1}
+
+
+def test_corrupt_or_non_dict_entry_reads_as_missing():
+    path = _key_path("test-ns", "bad")
+    path.write_text("{not json", encoding="utf-8")
+    assert store_get("test-ns", "bad") is None
+    path.write_text("[1, 2]", encoding="utf-8")
+    assert store_get("test-ns", "bad") is None
+
+
+def test_keys_are_sanitized_and_no_temp_files_left():
+    store_put("test/../ns", "../../etc/passwd", {"v": 1})
+    path = _key_path("test/../ns", "../../etc/passwd")
+    assert path.parent.name == "test-ns" and ".." not in path.name
+    assert store_get("test/../ns", "../../etc/passwd") == {"v": 1}
+    assert not [p for p in path.parent.iterdir() if p.name.endswith(".tmp")]
+    with pytest.raises(ValueError):
+        _key_path("test-ns", "///")
@@ -0,0 +1,185 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.routers import tts as tts_router
+from app.api.routers.tts import _ReleasingStreamingResponse
+from app.services import tts
+
+AUDIO = b"\xff\xfb\x90\x00" + b"\x00" * 4000
+
+
+class _Body(httpx.AsyncByteStream):
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        for i in range(0, len(AUDIO), 1000):
+            yield AUDIO[i:i + 1000]
+
+    async def aclose(self):
+        self.closed = True
+
+
+def _client(calls, bodies=None, delay=0.0):
+    async def handler(request):
+        calls.append(request.url.path)
+        await asyncio.sleep(delay)
+        if bodies is not None:
+            body = _Body()
+            bodies.append(body)
+            return httpx.Response(200, stream=body)
+        return httpx.Response(200, content=AUDIO)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def _free_slots():
+    return tts._elevenlabs_limiter()._value
+
+
+# ---- cache + coalescing ----
+def test_identical_requests_coalesce_then_hit_cache():
+    calls = []
+
+    async def _run():
+        async with _client(calls, delay=0.05) as client:
+            first = await asyncio.gather(*(
+                tts.synthesize_voice(text="Xin chào coalesce", beat=str(i), client=client) for i in range(3)
+            ))
+            again = await tts.synthesize_voice(text="Xin chào coalesce", client=client)
+            return first, again
+
+    first, again = asyncio.run(_run())
+    assert len(calls) == 1
+    assert {r["audio_url"] for r in first} == {again["audio_url"]}
+    assert [r["beat"] for r in first] == ["0", "1", "2"]
+    assert tts.tts_file_path(again["audio_url"]).read_bytes() == AUDIO
+
+
+def test_sfx_only_text_is_rejected():
+    with pytest.raises(tts.TTSError) as e:
+        asyncio.run(tts.synthesize_voice(text="[SFX: whoosh]"))
+    assert e.value.status_code == 400
+
+
+# ---- stream ----
+def test_stream_completes_and_writes_cache():
+    calls, bodies = [], []
+
+    async def _run():
+        async with _client(calls, bodies) as client:
+            info, body, release = await tts.open_voice_stream(text="Stream đầy đủ", client=client)
+            data = b"".join([c async for c in body])
+            await release()  # idempotent sau finally của body
+            return info, data, _free_slots()
+
+    info, data, free = asyncio.run(_run())
+    assert data == AUDIO and not info["cached"]
+    assert bodies[0].closed
+    assert free == tts.get_settings().ELEVENLABS_MAX_CONCURRENCY
+    assert tts._read_cached(info["key"])["bytes"] == len(AUDIO)
+
+
+def test_stream_release_without_reading_body():
+    # client ngắt trước khi body được đọc: generator chưa chạy, chỉ release() dọn dẹp
+    calls, bodies = [], []
+
+    async def _run():
+        async with _client(calls, bodies) as client:
+            info, body, release = await tts.open_voice_stream(text="Stream bị bỏ", client=client)
+            held = _free_slots()
+            await release()
+            await release()
+            return info, held, _free_slots()
+
+    info, held, free = asyncio.run(_run())
+    assert held == free - 1
+    assert free == tts.get_settings().ELEVENLABS_MAX_CONCURRENCY
+    assert bodies[0].closed
+    assert tts._read_cached(info["key"]) is None
+
+
+def test_streaming_response_releases_on_disconnect_before_body():
+    released = []
+
+    async def release():
+        released.append(1)
+
+    async def body():
+        yield b"never"
+
+    async def send(message):
+        raise OSError("client gone")
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    resp = _ReleasingStreamingResponse(body(), release=release, media_type="audio/mpeg")
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    with pytest.raises(Exception):
+        asyncio.run(resp(scope, receive, send))
+    assert released == [1]
+
+
+# ---- batch ----
+def _batch_client(monkeypatch, delays):
+    """ElevenLabs giả: mỗi text chờ delays[text] giây -> điều khiển thứ tự xong."""
+    calls = []
+
+    async def handler(request):
+        text = json.loads(request.content)["text"]
+        calls.append(text)
+        await asyncio.sleep(delays.get(text, 0.0))
+        return httpx.Response(200, content=AUDIO)
+
+    monkeypatch.setattr(tts_router, "get_http_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    app = FastAPI()
+    app.include_router(tts_router.router)
+    return TestClient(app), calls
+
+
+def _items(*texts):
+    return [{"text": t, "beat": str(i + 1)} for i, t in enumerate(texts)]
+
+
+def test_batch_isolates_item_errors(monkeypatch):
+    client, calls = _batch_client(monkeypatch, {})
+    texts = ("Batch lỗi riêng một", "[SFX: whoosh]", "x" * 3000, "Batch lỗi riêng hai")
+    r = client.post("/generate-voice/batch", json={"items": _items(*texts)})
+    assert r.status_code == 200
+    body = r.json()
+    assert [(x["index"], x["ok"], x["status_code"]) for x in body["items"]] == [
+        (0, True, None), (1, False, 400), (2, False, 413), (3, True, None),
+    ]
+    assert body["items"][3]["result"]["beat"] == "4"
+    assert (body["ok"], body["failed"]) == (2, 2)
+    assert sorted(calls) == ["Batch lỗi riêng hai", "Batch lỗi riêng một"]
+
+
+def test_batch_limits(monkeypatch, settings):
+    client, calls = _batch_client(monkeypatch, {})
+    assert client.post("/generate-voice/batch", json={"items": []}).status_code == 400
+    monkeypatch.setattr(settings, "TTS_BATCH_MAX_ITEMS", 2)
+    r = client.post("/generate-voice/batch", json={"items": _items("a", "b", "c")})
+    assert r.status_code == 413
+    assert calls == []
+
+
+def test_batch_stream_ndjson_in_completion_order(monkeypatch):
+    texts = ("Stream batch chậm", "Stream batch vừa", "[SFX: boom]", "Stream batch nhanh")
+    client, _ = _batch_client(monkeypatch, {texts[0]: 0.3, texts[1]: 0.15})
+    r = client.post("/generate-voice/batch", json={"items": _items(*texts), "stream": True})
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in r.text.splitlines()]
+    assert [e["event"] for e in events] == ["voice"] * 4 + ["done"]
+    # item nào xong trước thì ra trước; lỗi không chặn các item khác
+    assert [e["index"] for e in events[:2]] in ([2, 3], [3, 2])
+    assert [e["index"] for e in events[2:4]] == [1, 0]
+    assert {e["index"]: e["ok"] for e in events[:4]} == {0: True, 1: True, 2: False, 3: True}
+    done = events[-1]
+    assert (done["step"], done["ok"], done["failed"]) == ("tts_batch_done", 3, 1)
@@ -0,0 +1,63 @@
+import subprocess
+from pathlib import Path
+
+from app.services import video_segments
+from app.services.video_segments import shift_timestamps, split_media, stitch_transcripts
+
+
+def test_shift_adds_fractional_offset():
+    assert shift_timestamps("[00:05.5] Hook", 89.97) == "[01:35.5] Hook"
+    assert shift_timestamps("[00:05] Hook", 89.97) == "[01:35] Hook"
+
+
+def test_shift_carries_into_minutes_and_hours():
+    assert shift_timestamps("[00:59.96] a", 0.05) == "[01:00.01] a"
+    assert shift_timestamps("[59:59] a", 1.6) == "[01:00:01] a"
+    assert shift_timestamps("[01:00:00] a", 30) == "[01:00:30] a"
+
+
+def test_shift_ranges_and_untimed_lines():
+    text = "[00:10 - 00:12.25] Demo\nNo timestamp [00:01] here\n"
+    assert shift_timestamps(text, 60) == "[01:10 - 01:12.25] Demo\nNo timestamp [00:01] here"
+    assert shift_timestamps(text, 0) == text
+
+
+def test_stitch_orders_by_offset_and_drops_repeated_heading():
+    parts = [
+        (90.5, "### Step 1 — Transcript\n[00:00] second"),
+        (0.0, "### Step 1 — Transcript\n[00:00] first\n[00:30] more"),
+        (200.0, "   "),
+    ]
+    assert stitch_transcripts(parts) == "[00:00] first\n[00:30] more\n[01:31] second"
+
+
+def test_split_media_falls_back_to_whole_file(tmp_path, monkeypatch):
+    src = tmp_path / "in.mp4"
+    src.write_bytes(b"x")
+
+    def _fail(cmd, **kw):
+        raise subprocess.CalledProcessError(1, cmd)
+
+    monkeypatch.setattr(video_segments.subprocess, "run", _fail)
+    monkeypatch.setattr(video_segments, "probe_duration", lambda p: 42.0)
+    assert split_media(src, 60, tmp_path / "segs") == [{"path": src, "index": 0, "offset": 0.0, "duration": 42.0}]
+
+
+def test_split_media_offsets_use_measured_durations(tmp_path, monkeypatch):
+    src = tmp_path / "in.mp4"
+    src.write_bytes(b"x")
+    out_dir = tmp_path / "segs"
+    durations = {"seg-000.mp4": 89.97, "seg-001.mp4": 90.02, "seg-002.mp4": 12.5}
+
+    def _run(cmd, **kw):
+        for name in durations:
+            (out_dir / name).write_bytes(b"")
+
+    monkeypatch.setattr(video_segments.subprocess, "run", _run)
+    monkeypatch.setattr(video_segments, "probe_duration", lambda p: durations[Path(p).name])
+    segs = split_media(src, 90, out_dir)
+    assert [(s["index"], s["offset"], s["duration"]) for s in segs] == [
+        (0, 0.0, 89.97),
+        (1, 89.97, 90.02),
+        (2, 179.99, 12.5),
+    ]
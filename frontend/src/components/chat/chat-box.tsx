@@ -171,7 +171,7 @@ export default function ChatBox({ className = "" }: { className?: string }) {
     pushMessage("user", `🔗 Phân tích landing page: ${landingUrl}`);
     setLoading("landing");
     try {
-      const r = await apiLanding(landingUrl.trim());
+      const r = await apiLanding(landingUrl.trim(), report);
       const la = r.landing_analysis || "";
       const at = r.angles_text || "";
       const full = (r.angles_full || []) as AngleFull[];
@@ -187,7 +187,7 @@ export default function ChatBox({ className = "" }: { className?: string }) {
     } finally {
       setLoading(null);
     }
-  }, [landingUrl, pushMessage]);
+  }, [landingUrl, report, pushMessage]);
 
   const handleGenerateScript = useCallback(
     async (angle?: AngleFull | null, freeAngleText?: string) => {
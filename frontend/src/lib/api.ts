@@ -14,9 +14,10 @@ export async function uploadAndAnalyzeReport(video: File, message: string, userI
   return r.json() as Promise<{ step: "report_done"; report: string; options: { create_script: boolean; analyze_landing_page: boolean } }>;
 }
 
-export async function analyzeLandingPage(landingUrl: string, userId="demo-user", projectId="demo-project") {
+export async function analyzeLandingPage(landingUrl: string, userId="demo-user", projectId="demo-project", report?: string) {
   const fd = new FormData();
   fd.append("landingUrl", landingUrl);
+  if (report) fd.append("report", report);
   fd.append("userId", userId);
   fd.append("projectId", projectId);
   const r = await fetch(`${API}/analysis-landing-page`, { method: "POST", body: fd });
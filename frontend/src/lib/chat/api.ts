@@ -13,9 +13,11 @@ export async function apiReport(file: File, message: string): Promise<ReportResp
   return res.json();
 }
 
-export async function apiLanding(url: string): Promise<LandingResp> {
+export async function apiLanding(url: string, report?: string): Promise<LandingResp> {
   const fd = new FormData();
   fd.append("landingUrl", url);
+  // có report -> backend precompute required inputs cho mọi angle (generate-script nhanh hơn)
+  if (report) fd.append("report", report);
   fd.append("userId", "demo-user");
   fd.append("projectId", "demo-project");
   const res = await fetch(`${API}/analysis-landing-page`, { method: "POST", body: fd });